@@ -1,20 +1,25 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, abort, Response
 import os
-from image_to_text import extract_text_from_image, format_text_to_table, append_to_spreadsheet
-import glob
-from datetime import datetime
+from image_to_text import extract_table_from_image, append_to_spreadsheet
+from clients import registry
+from image_store import image_store
+from image_preprocess import preprocess_image
+from blob_stream import ingest_message_image
+from idempotency import deduplicator, event_keys, is_redelivery
+import metrics
+from metrics import span, request_context, instrument_webhook_handler
+from warmup import start_warm_up
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.webhooks import MessageEvent
 from linebot.v3.webhooks.models import ImageMessageContent
-from linebot.v3.messaging import Configuration, ApiClient, MessagingApi, ReplyMessageRequest, TextMessage
 
 app = Flask(__name__)
 
 # LINE APIの設定
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
 LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET')
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+handler = instrument_webhook_handler(WebhookHandler(LINE_CHANNEL_SECRET))
 
 @app.route('/callback', methods=['POST'])
 def callback():
@@ -27,103 +32,107 @@ def callback():
 
     try:
         # 署名を検証し、問題なければhandleに定義されている関数を呼び出す
-        handler.handle(body, signature)
+        with request_context(), span('webhook'):
+            handler.handle(body, signature)
     except InvalidSignatureError:
         # 署名検証で失敗したときは例外をあげる
         abort(400)
 
     return 'OK'
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+def create_line_api_client():
+    """
+    LINE Messaging APIのクライアントを生成する関数（SDKは初回の呼び出し時に読み込む）
+    """
+    from linebot.v3.messaging import ApiClient, Configuration
+    return ApiClient(Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN))
+
+# LINEのAPIクライアントはプロセス内で使い回す
+registry.register('line', create_line_api_client)
+
+def reply_text(reply_token, text):
+    """
+    テキストメッセージで返信する関数
+    """
+    from linebot.v3.messaging import MessagingApi, ReplyMessageRequest, TextMessage
+    line_bot_api = MessagingApi(registry.get('line'))
+    line_bot_api.reply_message_with_http_info(
+        ReplyMessageRequest(
+            reply_token=reply_token,
+            messages=[TextMessage(text=text)]
+        )
+    )
+
 @handler.add(MessageEvent, message=ImageMessageContent)
 def handle_image(event):
+    # 再送や重複したイベントは、画像の取得やモデルの呼び出しの前に打ち切る
+    keys = event_keys(event)
+    claimed, entry = deduplicator.claim(keys, redelivery=is_redelivery(event))
+    if not claimed:
+        print(f"重複したイベントのため処理をスキップしました: {event.message.id} ({entry['state']})")
+        return
+    
+    succeeded = False
     try:
-        # 最新の画像ファイルを取得
-        image_path = get_latest_image()
+        # 送信された画像を取得（未保存の場合はLINEから取得して保存する）
+        image_path, image_data, stats = get_event_image(event)
         print(f"処理する画像: {image_path}")
         
-        # テキスト抽出を実行
-        extracted_text = extract_text_from_image(image_path)
+        # 画像から表形式のデータを抽出（保存時に前処理済みのため、前処理は繰り返さない）
+        table_data = extract_table_from_image(image_data, stats=stats)
         
-        if extracted_text:
-            print("\n抽出されたテキスト:")
-            print(extracted_text)
+        if table_data:
+            print("\n表形式に整形されたテキスト:")
+            for row in table_data:
+                print(' | '.join(str(cell) for cell in row))
             
-            # テキストを表形式に整形
-            table_data = format_text_to_table(extracted_text)
+            # スプレッドシートにデータを追加
+            append_to_spreadsheet(table_data, image_path, image_id=event.message.id,
+                                  user_id=getattr(event.source, 'user_id', None))
             
-            if table_data:
-                print("\n表形式に整形されたテキスト:")
-                for row in table_data:
-                    print(' | '.join(row))
-                
-                # スプレッドシートにデータを追加
-                append_to_spreadsheet(table_data, image_path)
-                
-                # 完了メッセージを送信
-                reply_message = "画像の処理が完了しました！\nスプレッドシートにデータを保存しました。"
-                with ApiClient(Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=reply_message)]
-                        )
-                    )
-            else:
-                with ApiClient(Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="テキストの整形に失敗しました。")]
-                        )
-                    )
+            # 完了メッセージを送信
+            reply_message = "画像の処理が完了しました！\nスプレッドシートにデータを保存しました。"
+            reply_text(event.reply_token, reply_message)
+            succeeded = True
         else:
-            with ApiClient(Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="テキストの抽出に失敗しました。")]
-                    )
-                )
+            reply_text(event.reply_token, "テキストの抽出に失敗しました。")
             
     except FileNotFoundError as e:
-        with ApiClient(Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=str(e))]
-                )
-            )
+        reply_text(event.reply_token, str(e))
     except Exception as e:
-        with ApiClient(Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=f"予期せぬエラーが発生しました: {str(e)}")]
-                )
-            )
+        reply_text(event.reply_token, f"予期せぬエラーが発生しました: {str(e)}")
+    finally:
+        # 失敗した場合は再送されたイベントで再試行できるようにする
+        deduplicator.complete(keys, success=succeeded)
 
-def get_latest_image():
+def get_event_image(event):
     """
-    saved_imagesディレクトリから最新の画像ファイルを取得する関数
+    イベントで送信された画像を取得する関数
+    
+    画像ストアには前処理した画像を保存しているため、保存済みの画像は
+    そのまま読み込み、未保存の場合はLINEから取得して前処理してから保存する。
+    
+    Args:
+        event (MessageEvent): 画像メッセージのイベント
     
     Returns:
-        str: 最新の画像ファイルのパス
+        tuple: (画像ファイルのパス, 前処理済みの画像のバイト列, 前処理の統計情報のdict)
     """
-    # saved_imagesディレクトリ内のすべての画像ファイルを取得
-    image_files = glob.glob('saved_images/*.jpg')
-    
-    if not image_files:
-        raise FileNotFoundError("saved_imagesディレクトリに画像ファイルが見つかりません。")
+    record = image_store.get(event.message.id)
+    if record:
+        with image_store.open(record['path']) as f:
+            return record['path'], f.read(), {}
     
-    # 最新の画像ファイルを取得（タイムスタンプでソート）
-    latest_image = max(image_files, key=os.path.getctime)
-    return latest_image
+    return ingest_message_image(
+        registry.get('line'), image_store, event.message.id,
+        preprocess=preprocess_image,
+        user_id=getattr(event.source, 'user_id', None))
 
 if __name__ == "__main__":
+    start_warm_up()
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port) 
\ No newline at end of file
@@ -0,0 +1,365 @@
+import os
+import queue
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager
+
+from blob_stream import ingest_message_image_async
+from image_preprocess import preprocess_image_async
+import table_extraction
+from ocr_cache import extract_table_cached_async
+from text_prefilter import text_prefilter
+from event_loop import runner
+from job_queue import UserQueueFull
+
+logger = logging.getLogger(__name__)
+
+# 画像の処理方法（'queue': ジョブキューのスレッドで処理, 'async': asyncioのパイプラインで処理）
+PIPELINE_MODE = os.getenv('IMAGE_PIPELINE', 'queue')
+
+
+class BackendLimits:
+    """
+    バックエンドごとの同時リクエスト数をセマフォで制限する
+
+    Args:
+        limits (dict): バックエンド名（'line', 'gemini', 'sheets'）をキーにした同時リクエスト数
+    """
+
+    def __init__(self, limits):
+        self.limits = dict(limits)
+        self._semaphores = {name: asyncio.Semaphore(limit) for name, limit in self.limits.items()}
+        self._waiting = {name: 0 for name in self.limits}
+        self._in_flight = {name: 0 for name in self.limits}
+        self._completed = {name: 0 for name in self.limits}
+
+    @asynccontextmanager
+    async def slot(self, backend):
+        """
+        バックエンドの枠が空くまで待ち、ブロックの間その枠を使う
+
+        例:
+            async with limits.slot('gemini'):
+                await model.generate_content_async(...)
+        """
+        semaphore = self._semaphores[backend]
+        self._waiting[backend] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self._waiting[backend] -= 1
+        self._in_flight[backend] += 1
+        try:
+            yield
+        finally:
+            self._in_flight[backend] -= 1
+            self._completed[backend] += 1
+            semaphore.release()
+
+    def stats(self):
+        return {
+            name: {
+                'limit': limit,
+                'waiting': self._waiting[name],
+                'in_flight': self._in_flight[name],
+                'completed': self._completed[name],
+            }
+            for name, limit in self.limits.items()
+        }
+
+
+class AdmissionControl:
+    """
+    asyncioのパイプラインで受け付ける画像の数を、ユーザーごとと全体で制限する
+
+    ジョブキュー（FairQueue）と同じく、処理待ちが上限に達した画像はすぐに断り、
+    1人のユーザーの画像を同時に処理する数を制限して他のユーザーを待たせないようにする。
+    admitはWebhookのスレッドから、slotはイベントループから呼ぶ。
+
+    Args:
+        maxsize (int): 受け付けて処理が終わっていない画像の全体の上限（0は無制限）
+        user_maxsize (int): 1人のユーザーの処理を始めていない画像の上限（0は無制限）
+        user_concurrency (int): 1人のユーザーの画像を同時に処理する最大数（0は無制限）
+        capacity (int): 全体で同時に処理できる画像の数（超えた画像はすぐには処理を始めないとみなす）
+    """
+
+    def __init__(self, maxsize=0, user_maxsize=0, user_concurrency=0, capacity=0):
+        self.maxsize = maxsize
+        self.user_maxsize = user_maxsize
+        self.user_concurrency = user_concurrency
+        self.capacity = capacity
+        self._admitted = {}
+        self._running = {}
+        self._semaphores = {}
+        self._size = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    def admit(self, key):
+        """
+        画像を受け付ける（受け付けた画像は必ずslotで処理するか、releaseで解除する）
+
+        Args:
+            key (str): ユーザー
+
+        Returns:
+            tuple: (受け付け後のそのユーザーの処理待ち件数, すぐには処理を始めない場合はTrue)
+
+        Raises:
+            UserQueueFull: ユーザーの処理待ちが上限に達している場合
+            queue.Full: 全体の処理待ちが上限に達している場合
+        """
+        with self._lock:
+            admitted = self._admitted.get(key, 0)
+            waiting = admitted - self._running.get(key, 0)
+            if self.user_maxsize and waiting >= self.user_maxsize:
+                self._rejected += 1
+                raise UserQueueFull()
+            if self.maxsize and self._size >= self.maxsize:
+                self._rejected += 1
+                raise queue.Full()
+            self._admitted[key] = admitted + 1
+            self._size += 1
+            delayed = ((self.user_concurrency and admitted >= self.user_concurrency)
+                       or (self.capacity and self._size > self.capacity))
+            return waiting + 1, bool(delayed)
+
+    @asynccontextmanager
+    async def slot(self, key):
+        """
+        ユーザーの枠が空くまで待ち、ブロックの間その枠を使う（終わると受け付けを解除する）
+        """
+        semaphore = None
+        try:
+            if self.user_concurrency:
+                with self._lock:
+                    semaphore = self._semaphores.get(key)
+                    if semaphore is None:
+                        semaphore = self._semaphores[key] = asyncio.Semaphore(self.user_concurrency)
+                await semaphore.acquire()
+            with self._lock:
+                self._running[key] = self._running.get(key, 0) + 1
+            try:
+                yield
+            finally:
+                with self._lock:
+                    self._running[key] -= 1
+                    if not self._running[key]:
+                        del self._running[key]
+                if semaphore is not None:
+                    semaphore.release()
+        finally:
+            self.release(key)
+
+    def release(self, key):
+        """
+        受け付けた画像の処理が終わった（または処理を始められなかった）ことを通知する
+        """
+        with self._lock:
+            self._size -= 1
+            self._admitted[key] -= 1
+            if not self._admitted[key]:
+                del self._admitted[key]
+                self._semaphores.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': self._size,
+                'running': sum(self._running.values()),
+                'users': len(self._admitted),
+                'rejected': self._rejected,
+                'maxsize': self.maxsize,
+            }
+
+
+async def preprocess_async(path):
+    """
+    画像の前処理をスレッドプールで行い、完了を待つ関数（CPUを使う処理のため）
+    """
+    return await asyncio.wrap_future(preprocess_image_async(path))
+
+
+class AsyncPipeline:
+    """
+    画像の取得→前処理→表の抽出→保存をasyncioで行うパイプライン
+
+    LINEのコンテンツ取得・Geminiの呼び出し・抽出結果の書き込みの応答を待つ間は
+    スレッドを占有しないため、1つのプロセスで数百枚の画像を同時に処理できる。
+    各バックエンドへの同時リクエスト数はBackendLimitsで制限する
+    （Geminiはさらに共有のスケジューラーの上限とレート制限に従う）。
+
+    Args:
+        line_client: LINEの非同期APIクライアント（AsyncApiClient）を返す関数
+        store (image_store.ImageStore): 画像の保存先
+        sink: 抽出結果の出力先（write_asyncを持つもの）
+        limits (BackendLimits): バックエンドごとの同時リクエスト数
+    """
+
+    def __init__(self, line_client, store, sink, limits):
+        self.line_client = line_client
+        self.store = store
+        self.sink = sink
+        self.limits = limits
+        self._processed = 0
+        self._failed = 0
+
+    async def ingest(self, message_id, user_id=None):
+        """
+        LINEの画像を取得・前処理して保存する
+
+        Returns:
+            tuple: (保存したパス, 前処理後のバイト列, 統計情報のdict)
+        """
+        async with self.limits.slot('line'):
+            return await ingest_message_image_async(self.line_client(), self.store, message_id,
+                                                    preprocess_async, user_id=user_id)
+
+    async def extract(self, image_data, mode=None, details=None, on_rows=None, user_id=None):
+        """
+        OCRキャッシュを参照しながら画像から表を抽出する
+
+        Args:
+            on_rows: 指定した場合は表の応答をストリーミングで受け取り、完成した行から
+                (ヘッダー, 行のリスト)を渡す関数
+            user_id (str): 送信したユーザーのID（OCRキャッシュの類似画像の照合に使う）
+
+        Returns:
+            list: 表形式のデータ（2次元リスト）。失敗した場合はNone
+        """
+        async with self.limits.slot('gemini'):
+            return await extract_table_cached_async(image_data, mode=mode, details=details, on_rows=on_rows,
+                                                    user_id=user_id)
+
+    def open_stream(self, image_path):
+        """
+        GEMINI_STREAMING=onの場合に、抽出しながら行を書き込むストリームを開く
+
+        Returns:
+            ストリーム。使わない場合や開けない場合はNone
+        """
+        if table_extraction.STREAMING != 'on':
+            return None
+        try:
+            return self.sink.open_stream(image_path)
+        except Exception as e:
+            logger.error(f"抽出結果の書き込みを開始できませんでした: {str(e)}")
+            return None
+
+    async def write(self, table_data, image_path, image_id=None, user_id=None, raw_text=None, stream=None):
+        """
+        抽出結果を出力先に書き込む（streamを指定した場合は抽出中に書き込んだ行の残りを書き込む）
+
+        Returns:
+            int: 書き込んだセル数
+        """
+        async with self.limits.slot('sheets'):
+            if stream is not None:
+                return await stream.close_async(table_data, image_id=image_id, user_id=user_id,
+                                                raw_text=raw_text)
+            return await self.sink.write_async(table_data, image_path, image_id=image_id,
+                                               user_id=user_id, raw_text=raw_text)
+
+    async def process_message(self, message_id, user_id=None):
+        """
+        LINEの画像を取得して表を抽出し、抽出結果を書き込む
+
+        書き込みに失敗した場合はログに残し、抽出結果はそのまま返す
+        （同期版のappend_to_spreadsheetと同じ扱い）。
+        文字が写っていないと判定した画像は表の抽出を行わない。
+
+        Args:
+            message_id (str): メッセージID
+            user_id (str): 送信したユーザーのID
+
+        Returns:
+            dict: 'path'（保存したパス）, 'table'（表、失敗した場合はNone）,
+                'raw_text'（モデルの出力）, 'cells'（書き込んだセル数）, 'stats'（前処理の統計情報）,
+                'no_text'（文字がないと判定した理由、判定しなかった場合はNone）
+        """
+        try:
+            path, image_data, stats = await self.ingest(message_id, user_id)
+            no_text = await asyncio.to_thread(text_prefilter.screen, image_data, stats.get('text_features'))
+            if no_text:
+                self._processed += 1
+                return {'path': path, 'table': None, 'raw_text': None, 'cells': None, 'stats': stats,
+                        'no_text': no_text}
+            details = {}
+            stream = self.open_stream(path)
+            table_data = await self.extract(image_data, details=details,
+                                            on_rows=stream.add_rows if stream else None, user_id=user_id)
+        except BaseException:
+            self._failed += 1
+            raise
+
+        cells = None
+        if table_data:
+            try:
+                cells = await self.write(table_data, path, image_id=message_id, user_id=user_id,
+                                         raw_text=details.get('raw_text'), stream=stream)
+            except Exception as e:
+                logger.error(f"抽出結果の書き込み中にエラーが発生しました: {str(e)}")
+        self._processed += 1
+        return {'path': path, 'table': table_data, 'raw_text': details.get('raw_text'),
+                'cells': cells, 'stats': stats, 'no_text': None}
+
+    def stats(self):
+        """
+        パイプラインの統計情報を取得する
+
+        Returns:
+            dict: 処理した画像の数、失敗した数、実行中の処理の数、バックエンドごとの待ち・実行中の数
+        """
+        return {
+            'processed': self._processed,
+            'failed': self._failed,
+            'runner': runner.stats(),
+            'backends': self.limits.stats(),
+        }
+
+
+def create_async_pipeline(line_client, store, sink):
+    """
+    環境変数の設定からパイプラインを作成する関数
+
+    ASYNC_LINE_CONCURRENCY: LINEのコンテンツ取得の同時リクエスト数（デフォルト64）
+    ASYNC_GEMINI_CONCURRENCY: Geminiの呼び出しを待つ画像の数（デフォルト64、
+        実際の同時リクエスト数はスケジューラーが制限する）
+    ASYNC_SHEETS_CONCURRENCY: 抽出結果の書き込みの同時実行数（デフォルト16）
+
+    Args:
+        line_client: LINEの非同期APIクライアントを返す関数（取得を行わない場合はNone）
+        store (image_store.ImageStore): 画像の保存先
+        sink: 抽出結果の出力先
+
+    Returns:
+        AsyncPipeline: パイプライン
+    """
+    limits = BackendLimits({
+        'line': int(os.getenv('ASYNC_LINE_CONCURRENCY', 64)),
+        'gemini': int(os.getenv('ASYNC_GEMINI_CONCURRENCY', 64)),
+        'sheets': int(os.getenv('ASYNC_SHEETS_CONCURRENCY', 16)),
+    })
+    return AsyncPipeline(line_client, store, sink, limits)
+
+
+def create_admission_control():
+    """
+    環境変数の設定からasyncioのパイプラインの受け付けの制限を作成する関数
+
+    ASYNC_MAXSIZE: 受け付けて処理が終わっていない画像の上限（デフォルト1000、0は無制限）
+    ASYNC_USER_MAXSIZE: 1人のユーザーの処理を始めていない画像の上限（デフォルト0で無制限）
+    ASYNC_USER_CONCURRENCY: 1人のユーザーの画像を同時に処理する最大数
+        （デフォルトはASYNC_GEMINI_CONCURRENCYの半分、0は無制限）
+
+    Returns:
+        AdmissionControl: 受け付けの制限
+    """
+    gemini_concurrency = int(os.getenv('ASYNC_GEMINI_CONCURRENCY', 64))
+    return AdmissionControl(
+        maxsize=int(os.getenv('ASYNC_MAXSIZE', 1000)),
+        user_maxsize=int(os.getenv('ASYNC_USER_MAXSIZE', 0)),
+        user_concurrency=int(os.getenv('ASYNC_USER_CONCURRENCY', max(1, gemini_concurrency // 2))),
+        capacity=gemini_concurrency,
+    )
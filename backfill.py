@@ -0,0 +1,235 @@
+import os
+import json
+import glob
+import time
+import random
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from image_to_text import sheet_writer
+from image_store import image_store
+from image_archive import parse_archive_path
+from image_preprocess import preprocess_image
+from ocr_cache import extract_table_cached, sha256_hex
+from sheet_writer import build_rows
+import table_extraction
+from gemini_scheduler import scheduler, is_rate_limit_error
+
+# 対象とする画像の拡張子
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+class Manifest:
+    """
+    処理済みの画像を記録するマニフェスト（JSON Lines形式）
+
+    1行に1画像の処理結果を追記するため、途中で停止しても
+    再実行時に処理済みの画像をスキップできる。
+
+    Args:
+        path (str): マニフェストファイルのパス
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._done = set()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 書き込み途中で停止した行は無視する
+                        continue
+                    if entry.get('status') == 'ok':
+                        self._done.add(entry['key'])
+
+    def is_done(self, key):
+        return key in self._done
+
+    def record(self, entry):
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            if entry['status'] == 'ok':
+                self._done.add(entry['key'])
+
+
+def percentile(values, p):
+    """
+    値のリストからパーセンタイルを求める関数
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def extract_with_retry(image_data, mode, retries, base_delay):
+    """
+    レート制限の場合は指数バックオフで再試行しながら表を抽出する関数
+
+    Args:
+        image_data (bytes): 前処理済みの画像のバイト列
+        mode (str): 抽出モード
+        retries (int): 最大再試行回数
+        base_delay (float): 最初の待ち時間（秒）
+
+    Returns:
+        tuple: (表形式のデータ, 再試行した回数)
+    """
+    attempt = 0
+    while True:
+        try:
+            return extract_table_cached(image_data, mode=mode, raise_errors=True), attempt
+        except Exception as e:
+            if attempt >= retries or not is_rate_limit_error(e):
+                raise
+            delay = base_delay * (2 ** attempt) * (0.5 + random.random())
+            print(f"レート制限のため{delay:.1f}秒後に再試行します（{attempt + 1}/{retries}）")
+            time.sleep(delay)
+            attempt += 1
+
+
+def process_image(path, key, args, manifest, latencies):
+    """
+    1枚の画像を処理し、スプレッドシートへの書き込み後にマニフェストへ記録する関数
+
+    モデルの呼び出しはLINEからの依頼より後回しにされる。
+    """
+    started = time.perf_counter()
+    image_data, _, _ = preprocess_image(image_store.source(path))
+    with scheduler.priority('backfill'):
+        table_data, retries = extract_with_retry(image_data, args.mode, args.retries, args.backoff)
+    latency = time.perf_counter() - started
+    latencies.append(latency)
+
+    entry = {
+        'key': key,
+        'path': path,
+        'rows': len(table_data) - 1 if table_data else 0,
+        'retries': retries,
+        'seconds': round(latency, 3),
+        'finished_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    if not table_data:
+        manifest.record(dict(entry, status='empty'))
+        return entry
+
+    if args.no_sheets:
+        manifest.record(dict(entry, status='ok'))
+        return entry
+
+    # スプレッドシートへの書き込みは他の画像とまとめて送信し、完了後に記録する
+    rows = build_rows(table_data, path, entry['finished_at'])
+    future = sheet_writer.submit(args.spreadsheet_id, args.sheet_name, rows, replace=False)
+    future.result()
+    manifest.record(dict(entry, status='ok'))
+    return entry
+
+
+def indexed_images():
+    """
+    画像ストアのインデックスに登録されている画像を古い順に返す関数
+
+    アーカイブにまとめた画像（archive://のパス）も含む。保持期間を過ぎて
+    削除されたファイルは含めない。
+
+    Returns:
+        list: (パス, SHA-256（登録されていない場合はNone）)のリスト
+    """
+    images = []
+    for record in image_store.records():
+        path = record['path']
+        if parse_archive_path(path) is None and not os.path.isfile(path):
+            continue
+        images.append((path, record['sha256']))
+    return images
+
+
+def globbed_images(pattern):
+    """
+    globパターンに一致する画像ファイルを返す関数（インデックスに登録されていない画像用）
+
+    Returns:
+        list: (パス, None)のリスト
+    """
+    paths = sorted(path for path in glob.glob(pattern, recursive=True)
+                   if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS))
+    return [(path, None) for path in paths]
+
+
+def image_sha256(path, sha256=None):
+    """
+    画像のSHA-256を求める関数（インデックスに登録されている場合は読み込まない）
+    """
+    if sha256:
+        return sha256
+    with image_store.open(path) as f:
+        return sha256_hex(f.read())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='保存済みの画像をまとめて文字起こししてスプレッドシートに送信する')
+    parser.add_argument('--glob', help='指定した場合は画像ストアのインデックスの代わりに、globパターンに一致する'
+                                       '画像ファイルを対象にする（**で下位ディレクトリも対象）')
+    parser.add_argument('--manifest', default='backfill_manifest.jsonl', help='処理済み画像を記録するファイル')
+    parser.add_argument('--concurrency', type=int, default=4, help='同時に処理する画像数')
+    parser.add_argument('--mode', default=table_extraction.EXTRACTION_MODE, choices=['direct', 'two_stage'])
+    parser.add_argument('--retries', type=int, default=5, help='レート制限時の最大再試行回数')
+    parser.add_argument('--backoff', type=float, default=2.0, help='再試行の最初の待ち時間（秒）')
+    parser.add_argument('--no-sheets', action='store_true', help='スプレッドシートに送信しない')
+    parser.add_argument('--spreadsheet-id', default=os.getenv('SPREADSHEET_ID'))
+    parser.add_argument('--sheet-name', default=os.getenv('SHEET_NAME', 'Sheet1'))
+    args = parser.parse_args()
+
+    if not args.no_sheets and not args.spreadsheet_id:
+        parser.error("SPREADSHEET_IDが設定されていません。--spreadsheet-idを指定するか--no-sheetsを付けてください。")
+
+    manifest = Manifest(args.manifest)
+    images = globbed_images(args.glob) if args.glob else indexed_images()
+
+    # プロンプトやモードが変わった場合は同じ画像でも再処理する（同じ内容の画像は1回だけ処理する）
+    pending = []
+    keys = set()
+    for path, sha256 in images:
+        key = f"{image_sha256(path, sha256)}:{table_extraction.PROMPT_VERSION}:{args.mode}"
+        if not manifest.is_done(key) and key not in keys:
+            keys.add(key)
+            pending.append((path, key))
+
+    print(f"対象: {len(images)}枚  処理済み・重複: {len(images) - len(pending)}枚  未処理: {len(pending)}枚")
+    if not pending:
+        return
+
+    latencies = []
+    failed = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {executor.submit(process_image, path, key, args, manifest, latencies): path
+                   for path, key in pending}
+        for i, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            try:
+                entry = future.result()
+                print(f"[{i}/{len(pending)}] {path}: {entry['rows']}行 ({entry['seconds']}秒)")
+            except Exception as e:
+                failed += 1
+                print(f"[{i}/{len(pending)}] {path}: エラーが発生しました: {str(e)}")
+    sheet_writer.stop()
+
+    elapsed = time.perf_counter() - started
+    succeeded = len(pending) - failed
+    print(f"\n完了: {succeeded}枚  失敗: {failed}枚  経過時間: {elapsed:.1f}秒")
+    print(f"スループット: {succeeded / elapsed * 60:.1f} 枚/分")
+    print(f"レイテンシ: p50 {percentile(latencies, 50):.2f}秒  p95 {percentile(latencies, 95):.2f}秒")
+
+
+if __name__ == '__main__':
+    main()
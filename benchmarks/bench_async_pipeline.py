@@ -0,0 +1,144 @@
+"""
+スレッドのジョブ処理とasyncioのパイプラインで、同時に多数の画像を処理した場合を比べるベンチマーク
+
+同じ疑似バックエンド（fake_backends）で、画像の取得→前処理→表の抽出→保存を
+- thread: スレッドプールのワーカーで同期版の関数を実行する（ジョブキューと同じ）
+- async: async_pipelineのパイプラインで全ての画像を同時に実行する
+の2通りで処理し、処理時間・スループット・レイテンシ（全ての画像を同時に受け付けてから
+各画像の処理が終わるまで）・最大スレッド数・最大常駐メモリを表示する。
+
+使い方:
+    python -m benchmarks.bench_async_pipeline --images 500 --gemini-concurrency 64
+    python -m benchmarks.bench_async_pipeline --modes async --images 1000 --chunk-latency 0.02
+"""
+import os
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.bench_e2e import make_images, peak_rss_mb, percentile
+from fake_backends import FakeGeminiModel, FakeLineApiClient, FakeAsyncLineApiClient, latency_distribution
+
+
+class ThreadSampler:
+    """
+    実行中のスレッド数の最大値を記録する
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_threads(message_ids, line_client, store, sink, threads, started):
+    from blob_stream import ingest_message_image
+    from image_preprocess import preprocess_image_async
+    from ocr_cache import extract_table_cached
+
+    def process(message_id):
+        path, image_data, _ = ingest_message_image(
+            line_client, store, message_id, preprocess=lambda p: preprocess_image_async(p).result())
+        table_data = extract_table_cached(image_data)
+        if table_data:
+            sink.write(table_data, path, image_id=message_id)
+        return time.perf_counter() - started, bool(table_data)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(process, message_ids))
+
+
+def run_async(message_ids, line_client, store, sink, limits, started):
+    from async_pipeline import runner, AsyncPipeline, BackendLimits
+
+    pipeline = AsyncPipeline(lambda: line_client, store, sink, BackendLimits(limits))
+
+    async def process(message_id):
+        result = await pipeline.process_message(message_id)
+        return time.perf_counter() - started, bool(result['table'])
+
+    async def process_all():
+        return await asyncio.gather(*(process(message_id) for message_id in message_ids))
+
+    return runner.run(process_all())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='スレッドとasyncioのパイプラインの比較')
+    parser.add_argument('--modes', nargs='+', choices=['thread', 'async'], default=['thread', 'async'])
+    parser.add_argument('--images', type=int, default=300, help='同時に処理する画像の数')
+    parser.add_argument('--threads', type=int, default=4, help='threadモードのワーカー数（JOB_WORKERSに相当）')
+    parser.add_argument('--image-size', default='800x1000', help='画像のサイズ（幅x高さ）')
+    parser.add_argument('--gemini-latency', type=float, default=1.0, help='Gemini呼び出しの平均（中央値）秒数')
+    parser.add_argument('--gemini-dist', choices=['fixed', 'uniform', 'exponential', 'lognormal'],
+                        default='lognormal', help='Gemini呼び出しの遅延の分布')
+    parser.add_argument('--gemini-concurrency', type=int, default=64, help='スケジューラーの同時実行数の上限')
+    parser.add_argument('--chunk-latency', type=float, default=0.005, help='画像取得の1チャンクあたりの秒数')
+    parser.add_argument('--line-concurrency', type=int, default=64)
+    parser.add_argument('--sheets-concurrency', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_async_')
+    os.environ.update({'IMAGE_STORE_DIR': os.path.join(workdir, 'images'), 'OCR_CACHE_BACKEND': 'off',
+                       'GOOGLE_API_KEY': os.getenv('GOOGLE_API_KEY', 'bench')})
+    logging.disable(logging.CRITICAL)
+
+    width, height = (int(v) for v in args.image_size.split('x'))
+    images = make_images(args.images, width, height, args.seed)
+
+    from clients import registry
+    from gemini_scheduler import GeminiScheduler, ScheduledModel
+    # table_extractionの読み込み時に'gemini'が登録されるため、差し替える前に読み込んでおく
+    import async_pipeline  # noqa: F401
+    from image_store import ImageStore
+    from results_store import ResultsStore, LocalSink
+
+    print(f"画像: {args.images}枚  Gemini: {args.gemini_dist} {args.gemini_latency}秒 "
+          f"同時実行数 {args.gemini_concurrency}")
+    print(f"{'mode':<8} {'秒':>8} {'枚/秒':>8} {'p50':>8} {'p95':>8} {'max':>8} {'失敗':>6} {'スレッド':>8} {'RSS(MB)':>8}")
+    for mode in args.modes:
+        # モードごとに新しいスケジューラーと保存先を使う
+        gemini = FakeGeminiModel(latency=latency_distribution(args.gemini_dist, args.gemini_latency, 0.4, args.seed))
+        registry.override('gemini', ScheduledModel(gemini, GeminiScheduler(max_concurrency=args.gemini_concurrency)))
+        store = ImageStore(os.path.join(workdir, mode))
+        sink = LocalSink(ResultsStore(os.path.join(workdir, f'{mode}.sqlite3')))
+        message_ids = list(images)
+
+        started = time.perf_counter()
+        with ThreadSampler() as sampler:
+            if mode == 'thread':
+                results = run_threads(message_ids, FakeLineApiClient(images, args.chunk_latency),
+                                      store, sink, args.threads, started)
+            else:
+                results = run_async(message_ids, FakeAsyncLineApiClient(images, args.chunk_latency), store, sink,
+                                    {'line': args.line_concurrency, 'gemini': args.images,
+                                     'sheets': args.sheets_concurrency}, started)
+        elapsed = time.perf_counter() - started
+        latencies = [latency for latency, _ in results]
+        failed = sum(1 for _, ok in results if not ok)
+        print(f"{mode:<8} {elapsed:>8.2f} {len(results) / elapsed:>8.1f} {percentile(latencies, 50):>8.2f} "
+              f"{percentile(latencies, 95):>8.2f} {max(latencies):>8.2f} {failed:>6} {sampler.peak:>8} "
+              f"{peak_rss_mb():>8.1f}")
+    print(f"作業ディレクトリ: {workdir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+APIクライアントを毎回生成する場合と使い回す場合の所要時間を比較するベンチマーク
+
+ネットワーク通信は行わない（Sheetsは同梱のディスカバリードキュメントを使用）。
+
+使い方:
+    python -m benchmarks.bench_clients --repeat 20
+"""
+import argparse
+import time
+
+import google.generativeai as genai
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient.discovery import build
+from linebot.v3.messaging import ApiClient, Configuration
+
+from clients import ClientRegistry
+
+FACTORIES = {
+    'sheets': lambda: build('sheets', 'v4', credentials=AnonymousCredentials(),
+                            static_discovery=True, cache_discovery=False),
+    'gemini': lambda: genai.GenerativeModel('gemini-1.5-flash'),
+    'line': lambda: ApiClient(Configuration(access_token='dummy')),
+}
+
+
+def measure(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description='APIクライアント生成コストのベンチマーク')
+    parser.add_argument('--repeat', type=int, default=20, help='各クライアントを取得する回数')
+    args = parser.parse_args()
+
+    registry = ClientRegistry()
+    for name, factory in FACTORIES.items():
+        registry.register(name, factory, per_thread=(name == 'sheets'))
+
+    print(f"{'client':<8} {'per-call build(ms)':>19} {'registry get(ms)':>17} {'saved/req(ms)':>14}")
+    for name, factory in FACTORIES.items():
+        uncached = measure(factory, args.repeat)
+        cached = measure(lambda: registry.get(name), args.repeat)
+        print(f"{name:<8} {uncached * 1000:>19.3f} {cached * 1000:>17.4f} {(uncached - cached) * 1000:>14.3f}")
+
+    print(f"\nレジストリの統計: {registry.stats()}")
+
+
+if __name__ == '__main__':
+    main()
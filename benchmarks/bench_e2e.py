@@ -0,0 +1,270 @@
+"""
+Webhookの受信から結果の通知までを疑似バックエンドで測るエンドツーエンドのベンチマーク
+
+テスト用のチャネルシークレットで署名した画像メッセージのWebhookを指定したレートで
+/callbackに送信し、LINEのコンテンツ取得・Gemini・スプレッドシートは
+fake_backendsの疑似クライアントに差し替えて実行する。APIキーや通信は不要。
+
+- line_image_saver: Webhookの応答時間と、ジョブが完了して通知するまでの時間を測る
+- app: Webhookの中で処理まで行うため、応答時間がそのまま処理時間になる
+
+IMAGE_PIPELINE=asyncを指定すると、line_image_saverはasyncioのパイプラインで処理する。
+
+スループット、p50/p95/p99レイテンシ、エラー率、最大常駐メモリを表示する。
+
+使い方:
+    python -m benchmarks.bench_e2e --target line_image_saver --requests 200 --rate 20
+    python -m benchmarks.bench_e2e --target app --requests 50 --gemini-latency 1.5 --gemini-dist lognormal
+"""
+import os
+import io
+import sys
+import json
+import hmac
+import time
+import base64
+import random
+import hashlib
+import logging
+import argparse
+import resource
+import tempfile
+import importlib
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from fake_backends import (FakeGeminiModel, FakeLineApiClient, FakeAsyncLineApiClient, FakeSheetsService,
+                           latency_distribution)
+
+CHANNEL_SECRET = 'bench-secret'
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    # Linuxではキロバイト、macOSではバイト単位
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def prepare_environment(workdir, sink):
+    """
+    対象のアプリを読み込む前に、一時ディレクトリと疑似的な設定を環境変数に入れる
+    """
+    os.environ.update({
+        'LINE_CHANNEL_SECRET': CHANNEL_SECRET,
+        'LINE_CHANNEL_ACCESS_TOKEN': 'bench-token',
+        'IMAGE_STORE_DIR': os.path.join(workdir, 'images'),
+        'RESULTS_DB': os.path.join(workdir, 'results.sqlite3'),
+        'RESULTS_SINK': sink,
+    })
+    for name, value in (('GOOGLE_API_KEY', 'bench'), ('SPREADSHEET_ID', 'bench-sheet'),
+                        ('GOOGLE_SERVICE_ACCOUNT', '{}'), ('OCR_CACHE_BACKEND', 'off'),
+                        ('GEMINI_RPM', '0'), ('GEMINI_TPM', '0'), ('LOG_LEVEL', 'WARNING')):
+        os.environ.setdefault(name, value)
+
+
+def make_images(count, width, height, seed):
+    # 画像ごとに内容を変え、OCRキャッシュや重複排除に当たらないようにする
+    rng = random.Random(seed)
+    images = {}
+    for i in range(count):
+        image = Image.new('RGB', (width, height), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        noise = Image.effect_noise((width, height), 30).convert('RGB')
+        image = Image.blend(image, noise, 0.5)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=85)
+        images[f'bench{i}'] = buffer.getvalue()
+    return images
+
+
+def sign(body):
+    digest = hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+
+def webhook_body(index, message_ids):
+    """
+    画像メッセージのイベントを含むWebhookの本文を作成する
+
+    ユーザーIDと応答トークンはイベントごとに変え、通知の宛先から完了したイベントを特定する。
+    """
+    events = []
+    for message_id in message_ids:
+        events.append({
+            'type': 'message', 'mode': 'active', 'timestamp': int(time.time() * 1000),
+            'webhookEventId': f'EV-{index}-{message_id}',
+            'deliveryContext': {'isRedelivery': False},
+            'replyToken': message_id,
+            'source': {'type': 'user', 'userId': message_id},
+            'message': {'type': 'image', 'id': message_id, 'quoteToken': 'q',
+                        'contentProvider': {'type': 'line'}},
+        })
+    return json.dumps({'destination': 'bench', 'events': events})
+
+
+class Recorder:
+    """
+    送信時刻と完了の通知を記録する
+    """
+
+    def __init__(self):
+        self.sent = {}
+        self.done = {}
+        self.failed = set()
+        self.lock = threading.Lock()
+        self.all_done = threading.Event()
+        self.expected = 0
+
+    def start(self, key):
+        with self.lock:
+            self.sent[key] = time.perf_counter()
+
+    def finish(self, key, text):
+        with self.lock:
+            if key not in self.sent or key in self.done:
+                return
+            self.done[key] = time.perf_counter() - self.sent[key]
+            if 'エラー' in text or '失敗' in text:
+                self.failed.add(key)
+            if len(self.done) >= self.expected:
+                self.all_done.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Webhookのエンドツーエンドのベンチマーク')
+    parser.add_argument('--target', choices=['line_image_saver', 'app'], default='line_image_saver')
+    parser.add_argument('--requests', type=int, default=100, help='送信するWebhookの数')
+    parser.add_argument('--events', type=int, default=1, help='1つのWebhookに含める画像イベントの数')
+    parser.add_argument('--rate', type=float, default=10.0, help='1秒あたりの送信数（0で待たずに送信）')
+    parser.add_argument('--senders', type=int, default=16, help='同時に送信するスレッド数')
+    parser.add_argument('--image-size', default='1200x1600', help='画像のサイズ（幅x高さ）')
+    parser.add_argument('--gemini-latency', type=float, default=0.8, help='Gemini呼び出しの平均（中央値）秒数')
+    parser.add_argument('--gemini-dist', choices=['fixed', 'uniform', 'exponential', 'lognormal'],
+                        default='lognormal', help='Gemini呼び出しの遅延の分布')
+    parser.add_argument('--gemini-spread', type=float, default=0.4, help='遅延のばらつき')
+    parser.add_argument('--gemini-429-rate', type=float, default=0.0, help='429を返す割合')
+    parser.add_argument('--gemini-error-rate', type=float, default=0.0, help='500を返す割合')
+    parser.add_argument('--sheets-latency', type=float, default=0.2, help='スプレッドシートの1リクエストの秒数')
+    parser.add_argument('--chunk-latency', type=float, default=0.0, help='画像取得の1チャンクあたりの秒数')
+    parser.add_argument('--sink', choices=['local', 'sheets'], default='local', help='RESULTS_SINKの設定')
+    parser.add_argument('--timeout', type=float, default=300.0, help='全ての完了を待つ最大秒数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help='アプリのログと出力を表示する')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_e2e_')
+    prepare_environment(workdir, args.sink)
+    width, height = (int(v) for v in args.image_size.split('x'))
+    total_events = args.requests * args.events
+    images = make_images(total_events, width, height, args.seed)
+
+    baseline_mb = peak_rss_mb()
+    target = importlib.import_module(args.target)
+    import image_to_text
+    from clients import registry
+    from gemini_scheduler import scheduler, ScheduledModel
+
+    gemini = FakeGeminiModel(
+        latency=latency_distribution(args.gemini_dist, args.gemini_latency, args.gemini_spread, args.seed),
+        error_rate=args.gemini_429_rate, failure_rate=args.gemini_error_rate)
+    sheets = FakeSheetsService(latency=args.sheets_latency)
+    registry.override('line', FakeLineApiClient(images, chunk_latency=args.chunk_latency))
+    registry.override('line:async', FakeAsyncLineApiClient(images, chunk_latency=args.chunk_latency))
+    # 本番と同じくスケジューラー（同時実行数の制御・429の再試行）を経由させる
+    registry.override('gemini', ScheduledModel(gemini, scheduler))
+    registry.override('sheets', sheets)
+
+    # 完了の通知（lineはプッシュ、appは応答）を疑似的に受け取る
+    recorder = Recorder()
+    recorder.expected = total_events
+    if args.target == 'line_image_saver':
+        target.push_text = recorder.finish
+
+        async def push_text_async(to, text):
+            recorder.finish(to, text)
+        target.push_text_async = push_text_async
+
+        def reply_text(reply_token, text):
+            # 混雑で受け付けなかった画像は失敗として数える（順番待ちの返信は完了ではない）
+            if text == target.REJECTED_MESSAGE:
+                recorder.finish(reply_token, '失敗')
+        target.reply_text = reply_text
+        sink = target.results_sink
+    else:
+        target.reply_text = recorder.finish
+        sink = image_to_text.results_sink
+    if hasattr(sink, 'start'):
+        sink.start()
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    http_latencies = []
+    http_errors = 0
+    lock = threading.Lock()
+    message_ids = list(images)
+
+    def send(index):
+        nonlocal http_errors
+        ids = message_ids[index * args.events:(index + 1) * args.events]
+        body = webhook_body(index, ids)
+        for message_id in ids:
+            recorder.start(message_id)
+        started = time.perf_counter()
+        response = target.app.test_client().post(
+            '/callback', data=body, headers={'X-Line-Signature': sign(body)})
+        elapsed = time.perf_counter() - started
+        with lock:
+            http_latencies.append(elapsed)
+            if response.status_code != 200:
+                http_errors += 1
+                for message_id in ids:
+                    recorder.finish(message_id, 'エラー')
+
+    print(f"対象: {args.target}  Webhook: {args.requests}件 x {args.events}イベント  "
+          f"レート: {args.rate or '制限なし'}/秒  Gemini: {args.gemini_dist} {args.gemini_latency}秒")
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else output):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.senders) as executor:
+            for index in range(args.requests):
+                if args.rate:
+                    delay = started + index / args.rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                executor.submit(send, index)
+        sent_seconds = time.perf_counter() - started
+        recorder.all_done.wait(args.timeout)
+        elapsed = time.perf_counter() - started
+        if hasattr(sink, 'stop'):
+            sink.stop()
+
+    latencies = list(recorder.done.values())
+    timed_out = total_events - len(latencies)
+    errors = len(recorder.failed) + timed_out
+    print(f"送信: {sent_seconds:.2f}秒  完了まで: {elapsed:.2f}秒  "
+          f"スループット: {len(latencies) / elapsed:.2f}件/秒")
+    print(f"{'':<10} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for name, values in (('webhook', http_latencies), ('e2e', latencies)):
+        print(f"{name:<10} " + ' '.join(f"{percentile(values, p):>8.3f}" for p in (50, 95, 99))
+              + f" {max(values, default=0.0):>8.3f}")
+    print(f"エラー率: {errors / total_events:.1%}（HTTPエラー {http_errors}件、"
+          f"処理の失敗 {len(recorder.failed)}件、タイムアウト {timed_out}件）")
+    print(f"Gemini: 呼び出し {gemini.calls}回、429 {gemini.rate_limited}回、500 {gemini.failed}回  "
+          f"スプレッドシート: {sheets.requests}リクエスト")
+    print(f"最大常駐メモリ: {peak_rss_mb():.1f}MB（アプリの読み込み前 {baseline_mb:.1f}MB）")
+    print(f"作業ディレクトリ: {workdir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+directモードと2段階モードの抽出処理を比較するベンチマーク
+
+疑似モデルを使うため、APIキーやネットワークは不要。
+
+使い方:
+    python -m benchmarks.bench_extraction_modes --latency 0.5 --repeat 3
+"""
+import argparse
+import glob
+import time
+from PIL import Image
+
+import table_extraction
+from fake_backends import FakeGeminiModel
+
+
+def run_mode(mode, images, latency, repeat):
+    model = FakeGeminiModel(latency=latency)
+    latencies = []
+    for _ in range(repeat):
+        for image in images:
+            started = time.perf_counter()
+            table_data = table_extraction.extract_table(image, mode=mode, model=model)
+            latencies.append(time.perf_counter() - started)
+            if not table_data:
+                raise RuntimeError(f"{mode}モードで表の抽出に失敗しました")
+    return model.calls, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='抽出モードの比較ベンチマーク')
+    parser.add_argument('--images', default='saved_images/*.jpg', help='対象画像のglobパターン')
+    parser.add_argument('--latency', type=float, default=0.2, help='疑似モデル1回あたりの遅延（秒）')
+    parser.add_argument('--repeat', type=int, default=3, help='各画像を処理する回数')
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(args.images))
+    if not paths:
+        raise SystemExit(f"画像が見つかりません: {args.images}")
+    images = [Image.open(path) for path in paths]
+
+    print(f"画像数: {len(images)}  繰り返し: {args.repeat}  疑似遅延: {args.latency}s")
+    print(f"{'mode':<10} {'calls':>6} {'calls/img':>10} {'mean(s)':>9} {'total(s)':>9}")
+    for mode in ('two_stage', 'direct'):
+        calls, latencies = run_mode(mode, images, args.latency, args.repeat)
+        print(f"{mode:<10} {calls:>6} {calls / len(latencies):>10.2f} "
+              f"{sum(latencies) / len(latencies):>9.3f} {sum(latencies):>9.3f}")
+
+
+if __name__ == '__main__':
+    main()
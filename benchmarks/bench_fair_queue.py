@@ -0,0 +1,110 @@
+"""
+1人のユーザーが続けて多くの画像を送ったときの、他のユーザーの待ち時間を比べるベンチマーク
+
+- fifo: 到着順に処理する（ユーザーを区別しない）
+- fair: ユーザーごとのキューから順番に取り出し、1人の同時実行数を制限する（JobQueueの既定）
+
+を同じ到着パターンで実行し、大量に送ったユーザーと他のユーザーの待ち時間（p50/p95/最大）、
+全体の処理時間、すぐに処理できず混雑を知らせたジョブの数、受け付けなかったジョブの数を表示する。
+ジョブはGeminiの呼び出しの代わりに--service秒だけ待つ。
+
+使い方:
+    python -m benchmarks.bench_fair_queue
+    python -m benchmarks.bench_fair_queue --heavy 60 --light-users 10 --workers 8 --user-concurrency 2
+"""
+import queue
+import random
+import argparse
+import logging
+import threading
+import time
+
+from job_queue import JobQueue
+
+
+def percentile(values, ratio):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def run(mode, args):
+    if mode == 'fifo':
+        jobs = JobQueue(num_workers=args.workers, maxsize=args.maxsize, key_func=lambda payload: '')
+    else:
+        jobs = JobQueue(num_workers=args.workers, maxsize=args.maxsize, user_maxsize=args.user_maxsize,
+                        user_concurrency=args.user_concurrency)
+
+    waits = {'heavy': [], 'light': []}
+    done = threading.Semaphore(0)
+    lock = threading.Lock()
+
+    @jobs.register('process_image')
+    def process(payload):
+        with lock:
+            waits[payload['kind']].append(time.time() - payload['sent_at'])
+        time.sleep(args.service)
+        done.release()
+
+    randomizer = random.Random(args.seed)
+    arrivals = [(i * args.heavy_interval, 'heavy', 'heavy-user') for i in range(args.heavy)]
+    for i in range(args.light_users):
+        for _ in range(args.light_images):
+            arrivals.append((randomizer.uniform(0.0, args.heavy * args.heavy_interval + args.service),
+                             'light', f'user-{i}'))
+    arrivals.sort()
+
+    accepted = delayed = rejected = 0
+    started = time.time()
+    jobs.start()
+    for offset, kind, user_id in arrivals:
+        delay = started + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            job = jobs.enqueue('process_image', {'user_id': user_id, 'kind': kind, 'sent_at': time.time()})
+        except queue.Full:
+            rejected += 1
+            continue
+        accepted += 1
+        if job.delayed and job.user_depth == 1:
+            delayed += 1
+    for _ in range(accepted):
+        done.acquire()
+    elapsed = time.time() - started
+    jobs.stop()
+    return waits, elapsed, delayed, rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ユーザーごとの公平なスケジューリングの比較')
+    parser.add_argument('--heavy', type=int, default=30, help='1人のユーザーが続けて送る画像の枚数')
+    parser.add_argument('--heavy-interval', type=float, default=0.01, help='続けて送る画像の間隔（秒）')
+    parser.add_argument('--light-users', type=int, default=8, help='同じ時間帯に送る他のユーザーの数')
+    parser.add_argument('--light-images', type=int, default=1, help='他のユーザーが送る画像の枚数')
+    parser.add_argument('--service', type=float, default=0.2, help='1件の処理にかかる秒数')
+    parser.add_argument('--workers', type=int, default=4, help='ワーカー数（JOB_QUEUE_WORKERS）')
+    parser.add_argument('--maxsize', type=int, default=100, help='処理待ちの最大長（JOB_QUEUE_MAXSIZE）')
+    parser.add_argument('--user-maxsize', type=int, default=0, help='1人の処理待ちの最大長（JOB_QUEUE_USER_MAXSIZE）')
+    parser.add_argument('--user-concurrency', type=int, default=2,
+                        help='1人の同時実行数（JOB_QUEUE_USER_CONCURRENCY）')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    print(f"大量に送るユーザー: {args.heavy}枚  他のユーザー: {args.light_users}人×{args.light_images}枚  "
+          f"ワーカー{args.workers}  1件{args.service}秒")
+    print(f"{'mode':<6} {'ユーザー':<8} {'件数':>4} {'p50秒':>7} {'p95秒':>7} {'最大秒':>7} "
+          f"{'全体秒':>7} {'混雑通知':>8} {'拒否':>4}")
+    for mode in ('fifo', 'fair'):
+        waits, elapsed, delayed, rejected = run(mode, args)
+        for kind in ('heavy', 'light'):
+            values = waits[kind]
+            print(f"{mode:<6} {kind:<8} {len(values):>4} {percentile(values, 0.5):>7.2f} "
+                  f"{percentile(values, 0.95):>7.2f} {max(values, default=0.0):>7.2f} "
+                  f"{elapsed:>7.2f} {delayed:>8} {rejected:>4}")
+
+
+if __name__ == '__main__':
+    main()
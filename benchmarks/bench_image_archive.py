@@ -0,0 +1,130 @@
+"""
+画像を1枚ずつのファイルに保存する場合（files）と、アーカイブのセグメントに追記する場合
+（packed、IMAGE_STORE_BACKEND=packed）を比べるベンチマーク
+
+一時ディレクトリの画像ストアに疑似的な画像（一部は同じ内容）を保存し、
+- 書き込みのスループット（枚/秒・MB/秒）
+- 読み込みのスループット（filesはファイルを読み込み、packedはmmapからコピーせずに読み込む）
+- ファイルとディレクトリの数（inode）とディスク使用量
+- ディレクトリ全体の一覧にかかる時間
+を表示する。読み込みはページキャッシュに載った状態での計測になる。
+
+使い方:
+    python -m benchmarks.bench_image_archive
+    python -m benchmarks.bench_image_archive --images 5000 --size-kb 300 --duplicates 0.2
+"""
+import os
+import time
+import zlib
+import random
+import shutil
+import hashlib
+import logging
+import argparse
+import tempfile
+
+from image_archive import SegmentArchive, parse_archive_path
+from image_store import ImageStore
+
+
+def make_images(count, size_kb, duplicates, seed):
+    # 一部の画像は以前の画像と同じ内容にする（同じ画像の再送や転送を想定）
+    rng = random.Random(seed)
+    images = []
+    for i in range(count):
+        if images and rng.random() < duplicates:
+            images.append(rng.choice(images))
+        else:
+            size = int(size_kb * 1024 * rng.uniform(0.5, 1.5))
+            images.append(rng.randbytes(size))
+    return images
+
+
+def disk_usage(root):
+    inodes = 0
+    used = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        inodes += len(dirnames) + len(filenames)
+        for name in filenames:
+            used += os.stat(os.path.join(dirpath, name)).st_blocks * 512
+    return inodes, used
+
+
+def run(mode, images, hashes, workdir, segment_max_bytes):
+    root = os.path.join(workdir, mode)
+    archive = SegmentArchive(os.path.join(root, 'archive'), segment_max_bytes) if mode == 'packed' else None
+    store = ImageStore(root, archive=archive)
+
+    started = time.perf_counter()
+    paths = [store.put(f'msg{i:07d}', data, user_id=f'user{i % 50}', sha256=sha256)
+             for i, (data, sha256) in enumerate(zip(images, hashes))]
+    write_seconds = time.perf_counter() - started
+
+    # 読み込んだ内容に触れるため、どちらもCRC32を計算する
+    checksum = 0
+    started = time.perf_counter()
+    if mode == 'packed':
+        for path in paths:
+            with archive.view(parse_archive_path(path)) as view:
+                checksum ^= zlib.crc32(view)
+    else:
+        for path in paths:
+            with open(path, 'rb') as f:
+                checksum ^= zlib.crc32(f.read())
+    read_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    sum(len(filenames) for _, _, filenames in os.walk(root))
+    list_seconds = time.perf_counter() - started
+
+    inodes, used = disk_usage(root)
+    if archive is not None:
+        archive.close()
+    return {
+        'write_seconds': write_seconds,
+        'read_seconds': read_seconds,
+        'list_seconds': list_seconds,
+        'inodes': inodes,
+        'used_bytes': used,
+        'checksum': checksum,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='1枚ずつのファイルとアーカイブのセグメントの保存の比較')
+    parser.add_argument('--images', type=int, default=2000, help='保存する画像の数')
+    parser.add_argument('--size-kb', type=float, default=200, help='画像の平均サイズ（KB）')
+    parser.add_argument('--duplicates', type=float, default=0.1, help='以前の画像と同じ内容の画像の割合')
+    parser.add_argument('--segment-mb', type=float, default=256, help='1つのセグメントの最大サイズ（MB）')
+    parser.add_argument('--dir', help='作業ディレクトリ（省略時は一時ディレクトリ、終了時に削除）')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    images = make_images(args.images, args.size_kb, args.duplicates, args.seed)
+    hashes = [hashlib.sha256(data).hexdigest() for data in images]
+    total_mb = sum(len(data) for data in images) / 1024 / 1024
+    workdir = args.dir or tempfile.mkdtemp(prefix='bench_image_archive_')
+    print(f"画像: {args.images}枚（{total_mb:.1f}MB、重複 {len(images) - len(set(hashes))}枚）  "
+          f"セグメント: {args.segment_mb:.0f}MB")
+
+    results = {}
+    try:
+        for mode in ('files', 'packed'):
+            results[mode] = run(mode, images, hashes, workdir, int(args.segment_mb * 1024 * 1024))
+    finally:
+        if not args.dir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'mode':<7} {'書込 枚/秒':>10} {'書込 MB/秒':>10} {'読込 枚/秒':>10} {'読込 MB/秒':>10} "
+          f"{'一覧 秒':>8} {'inode':>7} {'使用量 MB':>9}")
+    for mode, result in results.items():
+        print(f"{mode:<7} {args.images / result['write_seconds']:>10.0f} {total_mb / result['write_seconds']:>10.1f} "
+              f"{args.images / result['read_seconds']:>10.0f} {total_mb / result['read_seconds']:>10.1f} "
+              f"{result['list_seconds']:>8.3f} {result['inodes']:>7} {result['used_bytes'] / 1024 / 1024:>9.1f}")
+    if results['files']['checksum'] != results['packed']['checksum']:
+        print("読み込んだ内容が一致しません")
+
+
+if __name__ == '__main__':
+    main()
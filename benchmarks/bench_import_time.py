@@ -0,0 +1,103 @@
+"""
+アプリの読み込み時間（コールドスタート）を測るベンチマーク
+
+新しいプロセスで`python -X importtime -c "import <モジュール>"`を実行し、
+読み込みにかかった時間と時間のかかったモジュールを表示する。
+読み込み時間が予算を超えた場合や、初回の利用時に読み込むはずの
+重いライブラリ（warmup.HEAVY_MODULES）が読み込まれた場合は終了コード1で終了する。
+
+使い方:
+    python -m benchmarks.bench_import_time
+    python -m benchmarks.bench_import_time --targets line_image_saver --budget-ms 800 --repeat 5
+"""
+import os
+import sys
+import argparse
+import tempfile
+import subprocess
+
+from warmup import HEAVY_MODULES
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 読み込みに必要な環境変数（実際の値は不要）
+DUMMY_ENV = {
+    'LINE_CHANNEL_ACCESS_TOKEN': 'bench',
+    'LINE_CHANNEL_SECRET': 'bench',
+    'GOOGLE_API_KEY': 'bench',
+    'SPREADSHEET_ID': 'bench',
+    'GOOGLE_SERVICE_ACCOUNT': '{}',
+}
+
+
+def parse_importtime(stderr):
+    """
+    -X importtimeの出力を解析する
+
+    Returns:
+        list: (モジュール名, 累積マイクロ秒, 入れ子の深さ) のリスト
+    """
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line.split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        entries.append((name.strip(), int(cumulative_us), depth))
+    return entries
+
+
+def measure(target, workdir):
+    env = dict(os.environ)
+    for name, value in DUMMY_ENV.items():
+        env.setdefault(name, value)
+    # 読み込み時に作成されるデータベースや画像の保存先は一時ディレクトリにする
+    env.update(IMAGE_STORE_DIR=os.path.join(workdir, 'images'),
+               RESULTS_DB=os.path.join(workdir, 'results.sqlite3'),
+               PYTHONPATH=ROOT)
+    check = f"import {target}, sys; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', check],
+                            cwd=workdir, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SystemExit(f"{target}の読み込みに失敗しました:\n{result.stderr[-2000:]}")
+    entries = parse_importtime(result.stderr)
+    total = next(us for name, us, depth in reversed(entries) if name == target and depth == 0)
+    loaded = [name for name in result.stdout.strip().split(',') if name]
+    return total, entries, loaded
+
+
+def top_level_packages(entries, limit):
+    # 各トップレベルパッケージの累積時間（最初に読み込まれた時点のもの）
+    totals = {}
+    for name, us, depth in entries:
+        if depth == 0 or '.' in name or name.startswith('_'):
+            continue
+        totals[name] = max(totals.get(name, 0), us)
+    return sorted(totals.items(), key=lambda item: -item[1])[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='アプリの読み込み時間のベンチマーク')
+    parser.add_argument('--targets', nargs='+', default=['line_image_saver', 'app', 'image_to_text'])
+    parser.add_argument('--budget-ms', type=float, default=1000.0, help='読み込み時間の予算（ミリ秒）')
+    parser.add_argument('--repeat', type=int, default=3, help='測定回数（最小値で判定する）')
+    parser.add_argument('--top', type=int, default=8, help='表示する時間のかかったパッケージの数')
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as workdir:
+        for target in args.targets:
+            runs = [measure(target, workdir) for _ in range(args.repeat)]
+            total, entries, loaded = min(runs, key=lambda run: run[0])
+            ok = total / 1000 <= args.budget_ms and not loaded
+            failed = failed or not ok
+            print(f"{target:<18} {total / 1000:>8.1f}ms  (予算 {args.budget_ms:.0f}ms)  {'OK' if ok else 'NG'}")
+            if loaded:
+                print(f"  読み込み時に読み込まれた重いライブラリ: {', '.join(loaded)}")
+            for name, us in top_level_packages(entries, args.top):
+                print(f"  {name:<28} {us / 1000:>8.1f}ms")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+画像取得処理の1リクエストあたりのピークメモリを比較するベンチマーク
+
+legacy: コンテンツ全体をbytesで受け取り、保存してからバイト列を前処理する従来の処理
+stream: チャンクごとにディスクへ書き込み、ファイルから前処理する処理
+
+各方式を別プロセスで実行し、最大常駐メモリ（ru_maxrss）の増分と
+Pythonオブジェクトのピーク（tracemalloc）を表示する。
+
+使い方:
+    python -m benchmarks.bench_ingest_memory --width 6000 --height 8000
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+from PIL import Image
+
+from blob_stream import stream_message_content
+from fake_backends import FakeLineApiClient
+from image_preprocess import preprocess_image
+
+
+def make_image(width, height):
+    image = Image.effect_noise((width, height), 40).convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=95)
+    return buffer.getvalue()
+
+
+def run_legacy(client, workdir):
+    # 従来の処理：全体をbytesで取得 → 保存 → バイト列から前処理
+    message_content = b''.join(client.request('GET', '/v2/bot/message/1/content').stream(64 * 1024))
+    with open(os.path.join(workdir, 'legacy.jpg'), 'wb') as f:
+        f.write(message_content)
+    processed, _, _ = preprocess_image(message_content)
+    return len(processed)
+
+
+def run_stream(client, workdir):
+    path = os.path.join(workdir, 'incoming_1')
+    stream_message_content(client, '1', path)
+    processed, _, _ = preprocess_image(path)
+    os.remove(path)
+    return len(processed)
+
+
+def child(mode, source):
+    # 疑似サーバーはファイルから少しずつ返すため、ベンチマーク自体はメモリを使わない
+    client = FakeLineApiClient({'1': source})
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    with tempfile.TemporaryDirectory() as workdir:
+        sent = (run_legacy if mode == 'legacy' else run_stream)(client, workdir)
+    _, peak = tracemalloc.get_traced_memory()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    print(json.dumps({'mode': mode, 'rss_kb': rss, 'python_peak_kb': peak // 1024, 'sent_kb': sent // 1024}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='画像取得処理のピークメモリのベンチマーク')
+    parser.add_argument('--width', type=int, default=4032)
+    parser.add_argument('--height', type=int, default=3024)
+    parser.add_argument('--child', choices=['legacy', 'stream'], help=argparse.SUPPRESS)
+    parser.add_argument('--source', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.source)
+        return
+
+    with tempfile.TemporaryDirectory() as workdir:
+        source = os.path.join(workdir, 'source.jpg')
+        with open(source, 'wb') as f:
+            f.write(make_image(args.width, args.height))
+
+        print(f"画像サイズ: {args.width}x{args.height}  ({os.path.getsize(source) // 1024} KB)")
+        print(f"{'mode':<8} {'peak rss +(MB)':>15} {'python peak(MB)':>16} {'sent(KB)':>9}")
+        for mode in ('legacy', 'stream'):
+            output = subprocess.check_output([
+                sys.executable, '-m', 'benchmarks.bench_ingest_memory', '--child', mode, '--source', source
+            ])
+            result = json.loads(output.decode().strip().splitlines()[-1])
+            print(f"{mode:<8} {result['rss_kb'] / 1024:>15.1f} {result['python_peak_kb'] / 1024:>16.1f} "
+                  f"{result['sent_kb']:>9}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+OCRキャッシュの類似画像の照合（OCR_CACHE_MAX_DISTANCE / OCR_CACHE_NEAR_MAX_PIXELS）を
+調整するためのベンチマーク
+
+生成したレシートについて、
+- 同じ画像の再送（リサイズ・再圧縮）
+- 書式が同じで数字だけが違うレシート（1行だけ違うもの・全ての行が違うもの）
+の知覚ハッシュの距離と、縮小画像で違う画素の数を比べる。
+再送を全て類似と判定し、数字が違うレシートを1枚も類似と判定しない設定があるかを表示する。
+
+使い方:
+    python -m benchmarks.bench_ocr_cache
+    python -m benchmarks.bench_ocr_cache --receipts 20 --rows 30
+"""
+import io
+import random
+import argparse
+
+from PIL import Image, ImageDraw
+
+from ocr_cache import perceptual_hash, hamming_distance, thumbnail, thumbnail_difference
+
+# 再送を想定した (縮尺, JPEGの品質)
+RESENDS = [(1.0, 90), (1.0, 70), (1.0, 50), (0.75, 85), (0.75, 60), (0.5, 85), (0.5, 60)]
+
+
+def render_receipt(rows, width=600):
+    height = 120 + 40 * (len(rows) + 1)
+    image = Image.new('L', (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    for i, (name, quantity, amount) in enumerate(rows):
+        draw.text((30, 60 + i * 40), f'{name}    {quantity}    {amount:>6}', fill=0)
+    draw.text((30, 60 + len(rows) * 40), f'TOTAL   {sum(q * a for _, q, a in rows)}', fill=0)
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def random_rows(rng, count):
+    return [(f'item{i:02d}', rng.randint(1, 9), rng.randint(1, 500) * 10) for i in range(count)]
+
+
+def change_numbers(rows, rng, count):
+    # 品名と行数はそのままで、count行の数量・金額だけを変える
+    changed = list(rows)
+    for index in rng.sample(range(len(rows)), count):
+        name, quantity, amount = rows[index]
+        while (quantity, amount) == rows[index][1:]:
+            quantity, amount = rng.randint(1, 9), rng.randint(1, 500) * 10
+        changed[index] = (name, quantity, amount)
+    return changed
+
+
+def resend(data, scale, quality):
+    image = Image.open(io.BytesIO(data))
+    if scale != 1.0:
+        image = image.resize((int(image.width * scale), int(image.height * scale)), Image.BILINEAR)
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def compare(a, b):
+    return (hamming_distance(perceptual_hash(a), perceptual_hash(b)),
+            thumbnail_difference(thumbnail(a), thumbnail(b)))
+
+
+def summarize(name, pairs):
+    distances = sorted(d for d, _ in pairs)
+    pixels = sorted(p for _, p in pairs if p is not None)
+    print(f"{name:<14} {len(pairs):>5} {distances[0]:>8} {distances[-1]:>8} "
+          f"{pixels[0] if pixels else '-':>8} {pixels[-1] if pixels else '-':>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OCRキャッシュの類似画像の照合の調整')
+    parser.add_argument('--receipts', type=int, default=10, help='生成するレシートの数')
+    parser.add_argument('--rows', type=int, default=20, help='レシートの行数')
+    parser.add_argument('--variants', type=int, default=5, help='1枚のレシートあたりの数字だけが違うレシートの数')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    resends, one_row, all_rows = [], [], []
+    for _ in range(args.receipts):
+        rows = random_rows(rng, args.rows)
+        original = render_receipt(rows)
+        resends += [compare(original, resend(original, scale, quality)) for scale, quality in RESENDS]
+        one_row += [compare(original, render_receipt(change_numbers(rows, rng, 1)))
+                    for _ in range(args.variants)]
+        all_rows += [compare(original, render_receipt(change_numbers(rows, rng, args.rows)))
+                     for _ in range(args.variants)]
+
+    print(f"{'':<14} {'組数':>5} {'距離min':>8} {'距離max':>8} {'画素min':>8} {'画素max':>8}")
+    summarize('再送', resends)
+    summarize('数字が1行違う', one_row)
+    summarize('数字が全て違う', all_rows)
+
+    max_distance = max(d for d, _ in resends)
+    max_pixels = max(p for _, p in resends)
+    different = one_row + all_rows
+    hash_only = sum(1 for d, _ in different if d <= max_distance)
+    false_matches = sum(1 for d, p in different if d <= max_distance and p is not None and p <= max_pixels)
+    print(f"\n知覚ハッシュだけで照合した場合（距離{max_distance}以下）: "
+          f"数字が違うレシート{len(different)}組のうち{hash_only}組を類似と判定")
+    print(f"縮小画像でも確認した場合（違う画素{max_pixels}以下）: {false_matches}組を類似と判定")
+    print(f"再送を全て類似と判定する設定: OCR_CACHE_MAX_DISTANCE={max(1, max_distance)} "
+          f"OCR_CACHE_NEAR_MAX_PIXELS={max_pixels}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+"""
+文字の有無の事前判定（text_prefilter）の正確さと処理時間を測るベンチマーク
+
+ラベル付きの画像（文字あり / 文字なし）を判定し、種類ごとの除外率と特徴量の平均、
+全体の混同行列（文字のある画像を誤って除外した数を含む）、1枚あたりの判定時間を表示する。
+判定時間は、アプリと同じく前処理でデコード済みの画像から求める場合（--input decoded）と、
+元の画像のバイト列をデコードする場合（--input bytes）を選べる。
+
+画像は次のいずれかを使う。
+- --dataset DIR: DIR/text/* と DIR/no_text/* に置いたラベル付きの画像（実際の画像で確認する場合）
+- 指定しない場合: saved_images（文字あり）と、種類ごとに生成した写真サイズの画像
+  （--saveで生成した画像を上の形式で書き出せる）
+
+使い方:
+    python -m benchmarks.bench_prefilter
+    python -m benchmarks.bench_prefilter --per-kind 20 --min-text-lines 0.1
+    python -m benchmarks.bench_prefilter --dataset ~/labelled_images
+"""
+import io
+import os
+import glob
+import time
+import random
+import argparse
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+from benchmarks.bench_e2e import percentile
+
+WORDS = ['2025-01-04', 'Orange', 'Banana', 'Apple', 'TOTAL', '1,280', 'x3', '¥450', 'Invoice No.', 'Qty',
+         'Amount', 'Tax 10%', 'Melon', '12:30', 'Subtotal', 'Cash', 'Change', 'Receipt']
+
+
+def new_canvas(randomizer, size, color):
+    image = Image.new('L', size, color)
+    # センサーのノイズ
+    noise = Image.effect_noise(size, randomizer.uniform(4, 12))
+    return Image.blend(image, noise, 0.08)
+
+
+def lighting(randomizer, image):
+    # 撮影時の照明のむらを模した明るさの勾配
+    gradient = Image.linear_gradient('L').resize(image.size).rotate(randomizer.uniform(0, 360))
+    return Image.blend(image, gradient, randomizer.uniform(0.05, 0.25))
+
+
+def draw_lines(randomizer, image, box, font_size, fill, vertical=False):
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default(size=font_size)
+    left, top, right, bottom = box
+    step = int(font_size * randomizer.uniform(1.4, 2.0))
+    if vertical:
+        for x in range(right - font_size, left, -step):
+            chars = ''.join(randomizer.choice('ABCDEFGHJKLMNPQRSTUVWXYZ0123456789') for _ in range(40))
+            for i, char in enumerate(chars):
+                y = top + i * font_size
+                if y > bottom - font_size:
+                    break
+                draw.text((x, y), char, fill=fill, font=font)
+        return
+    for y in range(top, bottom - font_size, step):
+        words = [randomizer.choice(WORDS) for _ in range(12)]
+        draw.text((left, y), '   '.join(words), fill=fill, font=font)
+
+
+def text_table(randomizer, size):
+    image = new_canvas(randomizer, size, 250)
+    draw_lines(randomizer, image, (40, 40, size[0] - 40, size[1] - 40), randomizer.randint(18, 36), 20)
+    draw = ImageDraw.Draw(image)
+    for x in range(40, size[0] - 40, size[0] // 5):
+        draw.line((x, 40, x, size[1] - 40), fill=180)
+    return lighting(randomizer, image)
+
+
+def text_receipt(randomizer, size):
+    image = new_canvas(randomizer, size, 70)
+    paper = (size[0] // 4, 30, size[0] * 3 // 4, size[1] - 30)
+    ImageDraw.Draw(image).rectangle(paper, fill=235)
+    draw_lines(randomizer, image, (paper[0] + 20, paper[1] + 20, paper[2] - 20, paper[3] - 20),
+               randomizer.randint(16, 26), 40)
+    return lighting(randomizer, image)
+
+
+def text_low_contrast(randomizer, size):
+    image = new_canvas(randomizer, size, 225)
+    draw_lines(randomizer, image, (60, 60, size[0] - 60, size[1] - 60), randomizer.randint(20, 32), 140)
+    return lighting(randomizer, image)
+
+
+def text_photo(randomizer, size):
+    # 机の上の書類を斜めに撮った写真
+    image = new_canvas(randomizer, size, 60)
+    paper = new_canvas(randomizer, (size[0] * 2 // 3, size[1] * 2 // 3), 240)
+    draw_lines(randomizer, paper, (30, 30, paper.width - 30, paper.height - 30), randomizer.randint(16, 28), 30)
+    paper = paper.rotate(randomizer.uniform(-8, 8), expand=True, fillcolor=60)
+    image.paste(paper, ((size[0] - paper.width) // 2, (size[1] - paper.height) // 2))
+    return lighting(randomizer, image)
+
+
+def text_vertical(randomizer, size):
+    image = new_canvas(randomizer, size, 245)
+    draw_lines(randomizer, image, (60, 60, size[0] - 60, size[1] - 60), randomizer.randint(22, 34), 25,
+               vertical=True)
+    return lighting(randomizer, image)
+
+
+def text_screenshot(randomizer, size):
+    image = new_canvas(randomizer, size, 255)
+    draw = ImageDraw.Draw(image)
+    for y in range(0, size[1], 160):
+        draw.rectangle((0, y, size[0], y + 4), fill=210)
+    draw_lines(randomizer, image, (30, 30, size[0] - 30, size[1] - 30), randomizer.randint(12, 16), 50)
+    return image
+
+
+def blank_paper(randomizer, size):
+    return lighting(randomizer, new_canvas(randomizer, size, randomizer.randint(200, 245)))
+
+
+def dark_shot(randomizer, size):
+    return new_canvas(randomizer, size, randomizer.randint(5, 30))
+
+
+def sky(randomizer, size):
+    image = Image.linear_gradient('L').resize(size)
+    image = Image.eval(image, lambda v: 120 + v // 3)
+    return lighting(randomizer, image)
+
+
+def selfie(randomizer, size):
+    # ぼけた背景の前の顔と髪
+    image = Image.effect_noise((size[0] // 40, size[1] // 40), 60).resize(size, Image.BICUBIC)
+    image = image.filter(ImageFilter.GaussianBlur(30))
+    draw = ImageDraw.Draw(image)
+    width, height = size
+    draw.ellipse((width * 0.2, height * 0.1, width * 0.8, height * 0.75), fill=40)
+    draw.ellipse((width * 0.27, height * 0.2, width * 0.73, height * 0.8), fill=randomizer.randint(150, 200))
+    draw.ellipse((width * 0.37, height * 0.38, width * 0.43, height * 0.43), fill=50)
+    draw.ellipse((width * 0.57, height * 0.38, width * 0.63, height * 0.43), fill=50)
+    draw.arc((width * 0.4, height * 0.55, width * 0.6, height * 0.65), 20, 160, fill=90, width=6)
+    draw.rectangle((0, height * 0.85, width, height), fill=randomizer.randint(60, 120))
+    return image.filter(ImageFilter.GaussianBlur(2))
+
+
+def landscape(randomizer, size):
+    coarse = Image.effect_noise((size[0] // 20, size[1] // 20), 50).resize(size, Image.BICUBIC)
+    image = Image.blend(sky(randomizer, size), coarse, 0.5)
+    draw = ImageDraw.Draw(image)
+    horizon = int(size[1] * randomizer.uniform(0.4, 0.7))
+    draw.rectangle((0, horizon, size[0], size[1]), fill=randomizer.randint(50, 100))
+    return image.filter(ImageFilter.GaussianBlur(3))
+
+
+def blurred_document(randomizer, size):
+    # 手ぶれなどで文字が読めない書類
+    return text_table(randomizer, size).filter(ImageFilter.GaussianBlur(randomizer.uniform(8, 14)))
+
+
+def foliage(randomizer, size):
+    # 細かい模様の多い写真（文字と間違えやすい）
+    image = Image.effect_noise((size[0] // 4, size[1] // 4), 80).resize(size, Image.BICUBIC)
+    return image.filter(ImageFilter.GaussianBlur(1.5))
+
+
+GENERATORS = {
+    'text': [text_table, text_receipt, text_low_contrast, text_photo, text_vertical, text_screenshot],
+    'no_text': [blank_paper, dark_shot, sky, selfie, landscape, blurred_document, foliage],
+}
+
+
+def encode(image):
+    buffer = io.BytesIO()
+    image.convert('RGB').save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def generate_samples(per_kind, seed):
+    """
+    種類ごとにper_kind枚の画像を生成する
+
+    Returns:
+        list: (ラベル, 種類, JPEGのバイト列) のリスト
+    """
+    samples = []
+    for path in sorted(glob.glob('saved_images/*.jpg')):
+        samples.append(('text', 'saved_images', open(path, 'rb').read()))
+    for label, generators in GENERATORS.items():
+        for generator in generators:
+            for i in range(per_kind):
+                randomizer = random.Random(f'{seed}:{generator.__name__}:{i}')
+                size = randomizer.choice([(1200, 1600), (1600, 1200), (1080, 1920), (1536, 2048)])
+                samples.append((label, generator.__name__, encode(generator(randomizer, size))))
+    return samples
+
+
+def load_dataset(directory):
+    samples = []
+    for label in ('text', 'no_text'):
+        for path in sorted(glob.glob(os.path.join(directory, label, '*'))):
+            samples.append((label, label, open(path, 'rb').read()))
+    if not samples:
+        raise SystemExit(f"画像が見つかりません: {directory}/text, {directory}/no_text")
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description='文字の有無の事前判定のベンチマーク')
+    parser.add_argument('--dataset', help='text/ と no_text/ にラベル付きの画像を置いたディレクトリ')
+    parser.add_argument('--per-kind', type=int, default=10, help='生成する画像の種類ごとの枚数')
+    parser.add_argument('--save', help='生成した画像を書き出すディレクトリ')
+    parser.add_argument('--min-contrast', type=float, help='PREFILTER_MIN_CONTRAST')
+    parser.add_argument('--min-sharpness', type=float, help='PREFILTER_MIN_SHARPNESS')
+    parser.add_argument('--max-edge-density', type=float, help='PREFILTER_MAX_EDGE_DENSITY')
+    parser.add_argument('--min-text-lines', type=float, help='PREFILTER_MIN_TEXT_LINES')
+    parser.add_argument('--input', choices=['decoded', 'bytes'], default='decoded',
+                        help='decoded: 前処理でデコードした画像から判定する（アプリと同じ）, '
+                             'bytes: 元の画像のバイト列をデコードして判定する')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    from text_prefilter import TextPrefilter, analyze, create_text_prefilter
+    from image_preprocess import preprocess_image, OPTIONS
+
+    defaults = create_text_prefilter()
+    prefilter = TextPrefilter(
+        mode='on',
+        min_contrast=defaults.min_contrast if args.min_contrast is None else args.min_contrast,
+        min_sharpness=defaults.min_sharpness if args.min_sharpness is None else args.min_sharpness,
+        max_edge_density=defaults.max_edge_density if args.max_edge_density is None else args.max_edge_density,
+        min_text_lines=defaults.min_text_lines if args.min_text_lines is None else args.min_text_lines,
+    )
+
+    samples = load_dataset(args.dataset) if args.dataset else generate_samples(args.per_kind, args.seed)
+    if args.save and not args.dataset:
+        for i, (label, kind, data) in enumerate(samples):
+            os.makedirs(os.path.join(args.save, label), exist_ok=True)
+            with open(os.path.join(args.save, label, f'{kind}_{i:04d}.jpg'), 'wb') as f:
+                f.write(data)
+
+    # NumPyの読み込みを計測に含めない
+    analyze(samples[0][2])
+
+    results = []
+    for label, kind, data in samples:
+        if args.input == 'decoded':
+            # アプリと同じく、前処理でデコード・縮小・補正した画像から特徴量を求める
+            image_data, _, _ = preprocess_image(data, dict(OPTIONS, text_features=False))
+            source = Image.open(io.BytesIO(image_data))
+            source.load()
+        else:
+            source = data
+        started = time.perf_counter()
+        features = analyze(source)
+        reason = prefilter.screen(data, features)
+        milliseconds = (time.perf_counter() - started) * 1000
+        results.append((label, kind, reason, milliseconds, features))
+
+    print(f"しきい値: contrast {prefilter.min_contrast} / sharpness {prefilter.min_sharpness} / "
+          f"edges {prefilter.max_edge_density} / text_lines {prefilter.min_text_lines}")
+    print(f"{'種類':<20} {'label':<8} {'枚数':>4} {'除外':>6} {'contrast':>9} {'sharpness':>10} "
+          f"{'edges':>6} {'lines':>6}")
+    kinds = sorted({(label, kind) for label, kind, _, _, _ in results})
+    for label, kind in kinds:
+        rows = [r for r in results if r[0] == label and r[1] == kind]
+        skipped = sum(1 for r in rows if r[2])
+        mean = {key: sum(r[4][key] for r in rows) / len(rows) for key in rows[0][4]}
+        print(f"{kind:<20} {label:<8} {len(rows):>4} {skipped / len(rows):>6.0%} {mean['contrast']:>9.1f} "
+              f"{mean['sharpness']:>10.1f} {mean['edge_density']:>6.3f} {mean['text_lines']:>6.3f}")
+
+    text_kept = sum(1 for r in results if r[0] == 'text' and not r[2])
+    text_skipped = sum(1 for r in results if r[0] == 'text' and r[2])
+    blank_skipped = sum(1 for r in results if r[0] == 'no_text' and r[2])
+    blank_kept = sum(1 for r in results if r[0] == 'no_text' and not r[2])
+    latencies = [r[3] for r in results]
+    print()
+    print(f"文字あり: 呼び出す {text_kept} / 誤って除外 {text_skipped}")
+    print(f"文字なし: 除外 {blank_skipped} / 見逃して呼び出す {blank_kept}")
+    print(f"正解率 {(text_kept + blank_skipped) / len(results):.1%}  "
+          f"省略できた呼び出し {blank_skipped / len(results):.1%}（全{len(results)}枚中）")
+    print(f"判定時間(ms): p50 {percentile(latencies, 50):.2f}  p95 {percentile(latencies, 95):.2f}  "
+          f"max {max(latencies):.2f}")
+
+
+if __name__ == '__main__':
+    main()
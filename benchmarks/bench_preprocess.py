@@ -0,0 +1,58 @@
+"""
+画像の前処理による送信サイズと処理時間の変化を測るベンチマーク
+
+saved_images/の画像に加え、スマートフォンで撮影した書類を想定した
+大きな合成画像も対象にする。エンドツーエンドの時間は、前処理時間と
+疑似的なアップロード時間（バイト数÷帯域）と疑似モデルの遅延の合計とする。
+
+使い方:
+    python -m benchmarks.bench_preprocess --bandwidth 1000000 --model-latency 1.0
+"""
+import argparse
+import glob
+import io
+import os
+import time
+
+from PIL import Image, ImageDraw
+
+from image_preprocess import OPTIONS, preprocess_image
+
+
+def synthetic_photo(width=4032, height=3024):
+    # 紙の書類を撮影したような画像（背景にノイズ、中央に文字の行）
+    image = Image.effect_noise((width, height), 20).convert('RGB')
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([width // 6, height // 10, width * 5 // 6, height * 9 // 10], fill=(235, 232, 225))
+    for i in range(40):
+        y = height // 8 + i * 60
+        draw.text((width // 5, y), f'ITEM {i:03d}    QTY 1    PRICE {100 + i * 7}', fill=(30, 30, 30))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=95)
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='画像前処理のベンチマーク')
+    parser.add_argument('--images', default='saved_images/*.jpg', help='対象画像のglobパターン')
+    parser.add_argument('--bandwidth', type=float, default=1_000_000, help='疑似アップロード帯域（バイト/秒）')
+    parser.add_argument('--model-latency', type=float, default=1.0, help='疑似モデルの処理時間（秒）')
+    args = parser.parse_args()
+
+    samples = [(os.path.basename(path), open(path, 'rb').read()) for path in sorted(glob.glob(args.images))]
+    samples.append(('synthetic_4032x3024.jpg', synthetic_photo()))
+
+    print(f"設定: {OPTIONS}")
+    print(f"{'image':<28} {'orig(KB)':>9} {'sent(KB)':>9} {'prep(ms)':>9} {'e2e raw(s)':>11} {'e2e prep(s)':>12}")
+    for name, data in samples:
+        started = time.perf_counter()
+        processed, _, stats = preprocess_image(data)
+        prep_seconds = time.perf_counter() - started
+        raw_e2e = len(data) / args.bandwidth + args.model_latency
+        prep_e2e = prep_seconds + len(processed) / args.bandwidth + args.model_latency
+        print(f"{name:<28} {len(data) / 1024:>9.1f} {len(processed) / 1024:>9.1f} "
+              f"{prep_seconds * 1000:>9.1f} {raw_e2e:>11.3f} {prep_e2e:>12.3f}")
+
+
+if __name__ == '__main__':
+    main()
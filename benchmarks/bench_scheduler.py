@@ -0,0 +1,78 @@
+"""
+Geminiスケジューラーの有無で429の発生数と処理時間を比較するベンチマーク
+
+疑似モデルは同時実行数がmax_concurrentを超えると429を返す。
+後半ではバックフィルの呼び出しが詰まっている状態で、
+LINEからの依頼（interactive）の待ち時間を測る。
+
+使い方:
+    python -m benchmarks.bench_scheduler --calls 64 --threads 16 --capacity 4
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_backends import FakeGeminiModel
+from gemini_scheduler import GeminiScheduler, ScheduledModel
+
+
+def run(model, calls, threads, priority=None, scheduler=None):
+    def call(_):
+        started = time.perf_counter()
+        try:
+            if scheduler and priority:
+                with scheduler.priority(priority):
+                    model.generate_content('プロンプト')
+            else:
+                model.generate_content('プロンプト')
+            return True, time.perf_counter() - started
+        except Exception:
+            return False, time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(call, range(calls)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Geminiスケジューラーのベンチマーク')
+    parser.add_argument('--calls', type=int, default=64, help='呼び出し回数')
+    parser.add_argument('--threads', type=int, default=16, help='呼び出し元のスレッド数')
+    parser.add_argument('--capacity', type=int, default=4, help='疑似モデルが同時に受け付ける数')
+    parser.add_argument('--latency', type=float, default=0.05, help='疑似モデル1回あたりの遅延（秒）')
+    args = parser.parse_args()
+
+    print(f"呼び出し: {args.calls}  スレッド: {args.threads}  疑似モデルの同時受付数: {args.capacity}")
+    print(f"{'mode':<10} {'ok':>5} {'failed':>7} {'429s':>6} {'total(s)':>9}")
+
+    fake = FakeGeminiModel(latency=args.latency, max_concurrent=args.capacity)
+    started = time.perf_counter()
+    results = run(fake, args.calls, args.threads)
+    ok = sum(1 for success, _ in results if success)
+    print(f"{'direct':<10} {ok:>5} {len(results) - ok:>7} {fake.rate_limited:>6} "
+          f"{time.perf_counter() - started:>9.2f}")
+
+    fake = FakeGeminiModel(latency=args.latency, max_concurrent=args.capacity)
+    scheduler = GeminiScheduler(max_concurrency=args.threads, retries=8, base_delay=args.latency)
+    started = time.perf_counter()
+    results = run(ScheduledModel(fake, scheduler), args.calls, args.threads)
+    ok = sum(1 for success, _ in results if success)
+    print(f"{'scheduled':<10} {ok:>5} {len(results) - ok:>7} {fake.rate_limited:>6} "
+          f"{time.perf_counter() - started:>9.2f}")
+    print(f"スケジューラーの統計: {scheduler.stats()}")
+
+    # バックフィルが詰まっている間のLINEからの依頼の待ち時間
+    fake = FakeGeminiModel(latency=args.latency)
+    scheduler = GeminiScheduler(max_concurrency=args.capacity)
+    model = ScheduledModel(fake, scheduler)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        backfill = executor.submit(run, model, args.calls * 2, args.threads * 2, 'backfill', scheduler)
+        time.sleep(args.latency * 2)
+        interactive = executor.submit(run, model, args.threads, args.threads, 'interactive', scheduler)
+        backfill_latencies = [seconds for _, seconds in backfill.result()]
+        interactive_latencies = [seconds for _, seconds in interactive.result()]
+    print(f"\n優先度: backfill 平均 {sum(backfill_latencies) / len(backfill_latencies):.2f}秒  "
+          f"interactive 平均 {sum(interactive_latencies) / len(interactive_latencies):.2f}秒")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+スプレッドシート書き込み方式の比較ベンチマーク
+
+疑似Sheetsサービスを使い、従来の行ごとのappendと、まとめて送信する
+ライター（appendで追記する場合と、カーソルで確保した行ブロックに書き込む場合）の
+APIリクエスト数と処理時間を比較する。
+
+使い方:
+    python -m benchmarks.bench_sheet_writer --images 20 --rows 50 --latency 0.05
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_backends import FakeSheetsService
+from sheet_writer import BatchedSheetWriter, SheetCursor, build_rows, write_table
+
+
+def make_table(rows):
+    return [['品名', '数量', '金額']] + [[f'商品{i}', '1', str(100 + i)] for i in range(rows)]
+
+
+def legacy_append(service, table_data, image_path):
+    # 従来の実装：クリア、ヘッダー、データ行を1行ずつappend
+    service.spreadsheets().values().clear(spreadsheetId='bench', range='Sheet1!A:Z').execute()
+    values = build_rows(table_data, image_path, '2025-01-01 00:00:00')
+    for row in values:
+        service.spreadsheets().values().append(
+            spreadsheetId='bench', range='Sheet1!A:Z', valueInputOption='RAW', body={'values': [row]}
+        ).execute()
+
+
+def run(name, images, concurrency, write):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(write, range(images)))
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='スプレッドシート書き込みのベンチマーク')
+    parser.add_argument('--images', type=int, default=20, help='書き込む画像数')
+    parser.add_argument('--rows', type=int, default=50, help='画像1枚あたりの行数')
+    parser.add_argument('--concurrency', type=int, default=4, help='同時に処理する画像数')
+    parser.add_argument('--latency', type=float, default=0.05, help='1リクエストの疑似遅延（秒）')
+    args = parser.parse_args()
+
+    table_data = make_table(args.rows)
+    print(f"画像数: {args.images}  行数/画像: {args.rows}  同時実行: {args.concurrency}  疑似遅延: {args.latency}s")
+    print(f"{'writer':<10} {'requests':>9} {'seconds':>8} {'rows/s':>9}")
+
+    service = FakeSheetsService(latency=args.latency)
+    elapsed = run('legacy', args.images, args.concurrency,
+                  lambda i: legacy_append(service, table_data, f'image_{i}.jpg'))
+    print(f"{'legacy':<10} {service.requests:>9} {elapsed:>8.2f} {args.images * args.rows / elapsed:>9.1f}")
+
+    service = FakeSheetsService(latency=args.latency)
+    elapsed = run('single', args.images, args.concurrency,
+                  lambda i: write_table(service, 'bench', 'Sheet1',
+                                        build_rows(table_data, f'image_{i}.jpg', '2025-01-01 00:00:00')))
+    print(f"{'single':<10} {service.requests:>9} {elapsed:>8.2f} {args.images * args.rows / elapsed:>9.1f}")
+
+    service = FakeSheetsService(latency=args.latency)
+    writer = BatchedSheetWriter(lambda: service, max_batch_rows=500, max_latency=0.2)
+    elapsed = run('batched', args.images, args.concurrency,
+                  lambda i: writer.submit('bench', 'Sheet1',
+                                          build_rows(table_data, f'image_{i}.jpg', '2025-01-01 00:00:00'))
+                  .result())
+    writer.stop()
+    print(f"{'batched':<10} {service.requests:>9} {elapsed:>8.2f} {args.images * args.rows / elapsed:>9.1f}")
+
+    service = FakeSheetsService(latency=args.latency)
+    writer = BatchedSheetWriter(lambda: service, max_batch_rows=500, max_latency=0.2, cursor=SheetCursor())
+    elapsed = run('blocks', args.images, args.concurrency,
+                  lambda i: writer.submit('bench', 'Sheet1',
+                                          build_rows(table_data, f'image_{i}.jpg', '2025-01-01 00:00:00'))
+                  .result())
+    writer.stop()
+    rows = sum(len(grid) for grid in service.sheets.values())
+    print(f"{'blocks':<10} {service.requests:>9} {elapsed:>8.2f} {args.images * args.rows / elapsed:>9.1f}"
+          f"  (シートの行数: {rows}, 初回のみシートを読み込み)")
+
+
+if __name__ == '__main__':
+    main()
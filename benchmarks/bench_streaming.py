@@ -0,0 +1,125 @@
+"""
+Geminiの応答を最後まで待ってから書き込む場合と、ストリーミングで完成した行から
+書き込む場合（GEMINI_STREAMING=on）を比べるベンチマーク
+
+疑似モデル（出力の文字数に比例して生成に時間がかかる）と疑似Sheetsサービスを使い、
+表の行数ごとに
+- 最初の行が完成するまでの秒数（ストリーミングのみ）
+- 最初の行がシートに書き込まれるまでの秒数
+- 全ての行がシートに書き込まれるまでの秒数
+- Sheets APIのリクエスト数
+を表示し、ストリーミングで書き込んだ表が最後まで待った場合と同じかを確認する。
+
+--sink localでは、ローカルのデータベースに保存してから同期スレッドが
+スプレッドシートへ送信する場合（RESULTS_SINK=local）を測る。
+
+使い方:
+    python -m benchmarks.bench_streaming
+    python -m benchmarks.bench_streaming --sink local
+    python -m benchmarks.bench_streaming --rows 50 200 --char-latency 0.001 --sheets-latency 0.3
+"""
+import json
+import time
+import logging
+import argparse
+
+from fake_backends import FakeGeminiModel, FakeSheetsService
+from gemini_scheduler import GeminiScheduler, ScheduledModel
+from results_store import SheetsSink, LocalSink, ResultsStore
+from sheet_writer import BatchedSheetWriter, SheetCursor
+import table_extraction
+
+HEADER = ['品名', '数量', '金額', '備考']
+
+
+def make_responder(rows):
+    table = [[f'商品{i:04d}', str(i % 9 + 1), f'{(i * 37) % 5000 + 100:,}', 'メモ' * (i % 3)] for i in range(rows)]
+
+    def responder(contents):
+        return json.dumps({'header': HEADER, 'rows': table}, ensure_ascii=False)
+    return responder
+
+
+def run(mode, rows, args):
+    responder = make_responder(rows)
+    output_chars = len(responder(None))
+    model = ScheduledModel(
+        FakeGeminiModel(latency=args.call_latency + output_chars * args.char_latency, responder=responder,
+                        first_chunk_ratio=args.call_latency / (args.call_latency + output_chars * args.char_latency),
+                        chunk_chars=args.chunk_chars),
+        GeminiScheduler())
+    service = FakeSheetsService(latency=args.sheets_latency)
+    writer = BatchedSheetWriter(lambda: service, max_latency=args.batch_latency, cursor=SheetCursor())
+    if args.sink == 'local':
+        sink = LocalSink(ResultsStore(':memory:'), sheet_writer=writer, spreadsheet_id='bench')
+    else:
+        sink = SheetsSink(writer, 'bench', 'Sheet1')
+
+    first_written = []
+    started = time.perf_counter()
+
+    def record(future):
+        if not first_written:
+            first_written.append(time.perf_counter() - started)
+
+    # どちらの出力先でも、ライターへの最初の書き込みが完了した時刻を記録する
+    submit = writer.submit
+
+    def recorded_submit(*args, **kwargs):
+        future = submit(*args, **kwargs)
+        future.add_done_callback(record)
+        return future
+    writer.submit = recorded_submit
+
+    details = {}
+    image = table_extraction.image_part(b'bench')
+    if mode == 'stream':
+        stream = sink.open_stream('bench.jpg')
+        table_data = table_extraction.extract_table(image, mode='direct', model=model, details=details,
+                                                    on_rows=stream.add_rows)
+        stream.close(table_data)
+    else:
+        table_data = table_extraction.extract_table(image, mode='direct', model=model, details=details)
+        sink.write(table_data, 'bench.jpg')
+    if args.sink == 'local':
+        # 同期スレッドが全ての行を送信し終えるまで待つ
+        sink.stop()
+    elapsed = time.perf_counter() - started
+    writer.stop()
+    return {
+        'table': table_data,
+        'first_row': details.get('first_row_seconds'),
+        'first_written': first_written[0] if first_written else None,
+        'total': elapsed,
+        'requests': writer.stats()['requests'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ストリーミングで書き込む場合と最後まで待つ場合の比較')
+    parser.add_argument('--rows', type=int, nargs='+', default=[20, 100, 300], help='表の行数')
+    parser.add_argument('--call-latency', type=float, default=0.5, help='最初の出力までの秒数')
+    parser.add_argument('--char-latency', type=float, default=0.0005, help='出力1文字あたりの生成の秒数')
+    parser.add_argument('--chunk-chars', type=int, default=60, help='ストリーミングの1チャンクの文字数')
+    parser.add_argument('--sheets-latency', type=float, default=0.3, help='Sheets APIの1リクエストの秒数')
+    parser.add_argument('--batch-latency', type=float, default=0.2,
+                        help='ライターが書き込みをまとめて待つ秒数（SHEET_BATCH_MAX_LATENCY）')
+    parser.add_argument('--sink', choices=['sheets', 'local'], default='sheets', help='RESULTS_SINKの設定')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    print(f"最初の出力まで{args.call_latency}秒 + 1文字{args.char_latency * 1000:.1f}ms  "
+          f"Sheets: {args.sheets_latency}秒/リクエスト  行のまとめ: {table_extraction.STREAM_BATCH_ROWS}行  "
+          f"出力先: {args.sink}")
+    print(f"{'行数':>5} {'mode':<7} {'最初の行':>8} {'最初の書込':>10} {'全行の書込':>10} {'リクエスト':>10} {'一致':>4}")
+    for rows in args.rows:
+        results = {mode: run(mode, rows, args) for mode in ('buffer', 'stream')}
+        same = results['stream']['table'] == results['buffer']['table']
+        for mode, result in results.items():
+            first_row = '-' if result['first_row'] is None else f"{result['first_row']:.2f}"
+            print(f"{rows:>5} {mode:<7} {first_row:>8} {result['first_written']:>10.2f} "
+                  f"{result['total']:>10.2f} {result['requests']:>10} {'yes' if same else 'NO':>4}")
+
+
+if __name__ == '__main__':
+    main()
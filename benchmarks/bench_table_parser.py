@@ -0,0 +1,115 @@
+"""
+モデル出力の表パーサーのマイクロベンチマークとファジング
+
+benchmarks/table_corpus/ のモデル出力の例について、従来の「|」分割と
+table_parserの処理時間・結果の形を比較する。続けて、例をランダムに
+壊した入力で例外が出ないこと・列数がそろっていることを確認する。
+
+使い方:
+    python -m benchmarks.bench_table_parser --repeat 2000 --fuzz 5000
+"""
+import os
+import glob
+import time
+import random
+import argparse
+
+import table_parser
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'table_corpus')
+
+# ファジングで挿入する断片
+FRAGMENTS = ['|', '||', '\t', ',', '"', '---', '|---|', '\n', '```', '{', '[', '：', '\\|', ' ', '']
+
+
+def naive_parse(text):
+    """
+    従来のformat_text_to_tableと同じ「|」分割（比較用）
+    """
+    table_data = []
+    for line in text.strip().split('\n'):
+        if '|' in line:
+            row = [cell.strip() for cell in line.split('|') if cell.strip()]
+            if row:
+                table_data.append(row)
+    return table_data
+
+
+def shape(rows):
+    if not rows:
+        return '-'
+    widths = sorted({len(row) for row in rows})
+    return f"{len(rows)}行 x {'/'.join(str(w) for w in widths)}列"
+
+
+def measure(func, text, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func(text)
+    return (time.perf_counter() - started) / repeat * 1e6
+
+
+def mutate(text, rng):
+    chars = list(text)
+    for _ in range(rng.randint(1, 6)):
+        position = rng.randint(0, len(chars))
+        operation = rng.random()
+        if operation < 0.4:
+            chars[position:position] = list(rng.choice(FRAGMENTS))
+        elif operation < 0.8 and chars:
+            del chars[position:position + rng.randint(1, 5)]
+        else:
+            lines = ''.join(chars).split('\n')
+            rng.shuffle(lines)
+            chars = list('\n'.join(lines))
+    return ''.join(chars)
+
+
+def fuzz(samples, iterations, seed):
+    rng = random.Random(seed)
+    parsed = 0
+    for _ in range(iterations):
+        text = mutate(rng.choice(samples), rng)
+        try:
+            rows = table_parser.parse_table(text)
+        except Exception as e:
+            raise SystemExit(f"例外が発生しました: {e!r}\n入力:\n{text!r}")
+        if rows is None:
+            continue
+        parsed += 1
+        if len({len(row) for row in rows}) != 1:
+            raise SystemExit(f"列数がそろっていません: {rows!r}\n入力:\n{text!r}")
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='表パーサーのベンチマークとファジング')
+    parser.add_argument('--repeat', type=int, default=2000, help='各例を解析する回数')
+    parser.add_argument('--fuzz', type=int, default=5000, help='ファジングの入力数')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(CORPUS_DIR, '*.txt')))
+    samples = []
+    print(f"{'sample':<26} {'naive(us)':>10} {'parser(us)':>11}  {'naive shape':<16} parser shape")
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        samples.append(text)
+        naive_us = measure(naive_parse, text, args.repeat)
+        parser_us = measure(table_parser.parse_table, text, args.repeat)
+        name = os.path.splitext(os.path.basename(path))[0]
+        print(f"{name:<26} {naive_us:>10.1f} {parser_us:>11.1f}  "
+              f"{shape(naive_parse(text)):<16} {shape(table_parser.parse_table(text))}")
+
+    tabular = sum(1 for text in samples if table_parser.looks_tabular(text))
+    print(f"\n既に表形式で表整形の呼び出しを省略できる例: {tabular}/{len(samples)}")
+
+    started = time.perf_counter()
+    parsed = fuzz(samples, args.fuzz, args.seed)
+    print(f"ファジング: {args.fuzz}件（表として解析 {parsed}件）問題なし "
+          f"({time.perf_counter() - started:.1f}秒)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+縦長の画像を1回で読み取る場合と、帯に分けて並列に読み取る場合（OCR_TILING）を比べるベンチマーク
+
+saved_imagesのサンプル画像と、行数を変えて生成した縦長のレシート画像について
+- direct / two_stage: 前処理（長辺PREPROCESS_MAX_DIMENSION）した画像を1回で読み取る
+- tiled: 長辺を縮小しすぎずに前処理し、重なりのある帯に分けて並列に読み取り、まとめる
+の呼び出し回数・見積もりトークン数（入力/出力）・処理時間・行の再現率・重複した行の数を表示する。
+
+疑似モデルは送られた画像の位置と縮尺から読み取れる行を決める。
+- 帯の境目で切れた行は半分だけ読み取れる（重なりの除去で捨てられるかを確認する）
+- 縮小で文字の高さが--legible-px未満になった行は一定の割合で数字を読み違える
+- 1回の呼び出しは --call-latency + 出力トークン数 × --token-latency 秒かかる
+- 出力トークン数が--max-output-tokensを超えた分は出力されない
+
+使い方:
+    python -m benchmarks.bench_tiling
+    python -m benchmarks.bench_tiling --rows 40 120 240 --token-latency 0.005 --workers 8
+"""
+import io
+import os
+import glob
+import json
+import random
+import hashlib
+import logging
+import argparse
+import time
+import asyncio
+from PIL import Image, ImageDraw
+
+HEADER = ['品目', '数量', '金額']
+
+
+class Document:
+    """
+    生成したレシートの行と位置
+    """
+
+    def __init__(self, rows, width, row_height, seed):
+        randomizer = random.Random(seed)
+        self.row_height = row_height
+        self.margin = row_height
+        self.rows = [[f'品目{i:03d}', randomizer.randint(1, 9), randomizer.randint(1, 500) * 10]
+                     for i in range(rows)]
+        self.width = width
+        self.height = self.margin * 2 + row_height * (rows + 1)
+
+    def render(self):
+        image = Image.new('L', (self.width, self.height), 255)
+        draw = ImageDraw.Draw(image)
+        for i, cells in enumerate([HEADER] + self.rows):
+            top = self.margin + i * self.row_height
+            draw.text((20, top + self.row_height // 3), '   '.join(str(c) for c in cells), fill=0)
+            draw.line((0, top + self.row_height - 2, self.width, top + self.row_height - 2), fill=200)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=90)
+        return buffer.getvalue()
+
+    def line_span(self, index):
+        # ヘッダーを0行目とした各行の上端・下端（画像の高さに対する比）
+        top = self.margin + index * self.row_height
+        return top / self.height, (top + self.row_height) / self.height
+
+
+class DocumentModel:
+    """
+    送られた画像がレシートのどの範囲をどの縮尺で写しているかに応じて応答する疑似モデル
+
+    views: 画像のsha256 → (Document, 上端, 下端, 文字の高さの倍率)
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.views = {}
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def register(self, data, document, top, bottom, pixels):
+        self.views[hashlib.sha256(data).hexdigest()] = (document, top, bottom, pixels)
+
+    def read_lines(self, view, seed):
+        document, top, bottom, pixels = view
+        randomizer = random.Random(seed)
+        row_px = document.row_height / document.height * pixels
+        misread = max(0.0, 1 - row_px / self.args.legible_px)
+        lines = []
+        for index, cells in enumerate([HEADER] + document.rows):
+            row_top, row_bottom = document.line_span(index)
+            visible = min(bottom, row_bottom) - max(top, row_top)
+            if visible <= 0:
+                continue
+            cells = list(cells)
+            if index and randomizer.random() < misread:
+                cells[2] = cells[2] + randomizer.choice([-10, 10, 100])
+            if visible < (row_bottom - row_top) * 0.99:
+                # 帯の境目で切れた行は左半分しか読めない
+                if visible < (row_bottom - row_top) * 0.5:
+                    continue
+                cells = cells[:1]
+            lines.append(cells)
+        return lines
+
+    def respond(self, contents):
+        prompt, image = contents[0], contents[1]
+        digest = hashlib.sha256(image['data']).hexdigest()
+        view = self.views.get(digest)
+        if view is None:
+            return None
+        lines = self.read_lines(view, digest)
+        if 'JSON' in prompt:
+            return json.dumps({'header': HEADER, 'rows': lines[1:] if lines and lines[0] == HEADER else lines},
+                              ensure_ascii=False)
+        text = []
+        for cells in lines:
+            text.append('| ' + ' | '.join(f'{c:,}' if isinstance(c, int) else c for c in cells) + ' |')
+            if cells == HEADER:
+                text.append('|---|---|---|')
+        return '\n'.join(text)
+
+    def answer(self, contents):
+        from fake_backends import default_responder
+        from gemini_scheduler import estimate_tokens, RESPONSE_TOKENS
+
+        text = None
+        if isinstance(contents, (list, tuple)):
+            text = self.respond(contents)
+        if text is None:
+            text = default_responder(contents)
+        # 日本語は1文字がおよそ1トークン
+        text = text[:self.args.max_output_tokens]
+        self.calls += 1
+        self.input_tokens += estimate_tokens(contents) - RESPONSE_TOKENS
+        self.output_tokens += len(text)
+        return text, self.args.call_latency + len(text) * self.args.token_latency
+
+    def generate_content(self, contents, **kwargs):
+        from fake_backends import FakeResponse
+
+        text, latency = self.answer(contents)
+        time.sleep(latency)
+        return FakeResponse(text)
+
+    async def generate_content_async(self, contents, **kwargs):
+        from fake_backends import FakeResponse
+
+        text, latency = self.answer(contents)
+        await asyncio.sleep(latency)
+        return FakeResponse(text)
+
+
+def row_key(cells):
+    return tuple(str(c) for c in cells)
+
+
+def score(document, table_data):
+    """
+    抽出した表に正しく含まれた行の割合と、重複した行の数を求める
+    """
+    if document is None:
+        return None, None
+    found = [row_key(row) for row in (table_data or [])]
+    expected = {row_key(row) for row in document.rows}
+    recall = len(expected & set(found)) / len(expected)
+    duplicates = len([key for key in found if key in expected]) - len(expected & set(found))
+    return recall, duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(description='帯に分けた読み取りと1回の読み取りの比較')
+    parser.add_argument('--images', default='saved_images/*.jpg', help='サンプル画像のglobパターン')
+    parser.add_argument('--rows', type=int, nargs='+', default=[30, 80, 160, 320], help='生成するレシートの行数')
+    parser.add_argument('--width', type=int, default=800, help='生成するレシートの幅')
+    parser.add_argument('--row-height', type=int, default=36, help='生成するレシートの1行の高さ')
+    parser.add_argument('--call-latency', type=float, default=0.4, help='1回の呼び出しの固定の秒数')
+    parser.add_argument('--token-latency', type=float, default=0.002, help='出力1トークンあたりの秒数')
+    parser.add_argument('--max-output-tokens', type=int, default=8192, help='1回の呼び出しの最大出力トークン数')
+    parser.add_argument('--legible-px', type=float, default=16, help='読み違えずに読める文字の高さ（ピクセル）')
+    parser.add_argument('--workers', type=int, default=4, help='1枚の画像の帯を同時に読み取る数（TILE_WORKERS）')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # 帯の並列数はimage_tilingの読み込み時に決まるため、先に環境変数を設定する
+    os.environ.update({'TILE_WORKERS': str(args.workers), 'OCR_CACHE_BACKEND': 'off',
+                       'GOOGLE_API_KEY': os.getenv('GOOGLE_API_KEY', 'bench')})
+    logging.disable(logging.CRITICAL)
+
+    import image_tiling
+    from image_preprocess import preprocess_image, OPTIONS
+    from ocr_cache import extract_table_uncached
+
+    model = DocumentModel(args)
+    split_bands = image_tiling.split_bands
+
+    def recording_split(source):
+        # 帯の画像がレシートのどの範囲を写しているかを疑似モデルに登録する
+        bands = split_bands(source)
+        view = model.views.get(hashlib.sha256(source).hexdigest())
+        width, height = image_tiling.image_size(source)
+        for (top, bottom), band in zip(image_tiling.plan_bands(width, height), bands):
+            if view is not None:
+                with Image.open(io.BytesIO(band)) as opened:
+                    band_height = opened.height
+                document = view[0]
+                model.register(band, document, top / height, bottom / height,
+                               band_height * height / (bottom - top))
+        return bands
+
+    image_tiling.split_bands = recording_split
+
+    samples = [(os.path.basename(path), open(path, 'rb').read(), None) for path in sorted(glob.glob(args.images))]
+    documents = [Document(rows, args.width, args.row_height, args.seed + rows) for rows in args.rows]
+    samples += [(f'receipt_{len(d.rows)}rows', d.render(), d) for d in documents]
+
+    single_options = dict(OPTIONS, tall_max_dimension=0)
+    tall_options = dict(OPTIONS, tall_max_dimension=max(OPTIONS['tall_max_dimension'], 8192))
+
+    print(f"帯: 幅×{image_tiling.BAND_RATIO} 重なり{image_tiling.OVERLAP:.0%} 並列{args.workers}  "
+          f"呼び出し: {args.call_latency}秒 + {args.token_latency}秒/出力トークン")
+    print(f"{'画像':<22} {'mode':<10} {'帯':>3} {'呼出':>4} {'入力tok':>8} {'出力tok':>8} {'秒':>7} "
+          f"{'再現率':>7} {'重複':>5}")
+    for name, raw, document in samples:
+        for mode in ('direct', 'two_stage', 'tiled'):
+            options = tall_options if mode == 'tiled' else single_options
+            image_data, _, stats = preprocess_image(raw, options)
+            if document is not None:
+                width, height = stats['processed_size']
+                model.register(image_data, document, 0.0, 1.0, height)
+            bands = len(image_tiling.plan_bands(*stats['processed_size'])) if mode == 'tiled' else 1
+            model.reset()
+            started = time.perf_counter()
+            table_data = extract_table_uncached(image_data, mode, model, False, None)
+            elapsed = time.perf_counter() - started
+            recall, duplicates = score(document, table_data)
+            print(f"{name:<22} {mode:<10} {bands:>3} {model.calls:>4} {model.input_tokens:>8} "
+                  f"{model.output_tokens:>8} {elapsed:>7.2f} "
+                  f"{'-' if recall is None else f'{recall:.1%}':>7} {'-' if duplicates is None else duplicates:>5}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+import os
+import asyncio
+import hashlib
+
+from metrics import span
+
+# LINEのコンテンツ取得APIのホスト
+LINE_DATA_API = 'https://api-data.line.me'
+
+# 1度に読み込むサイズ
+CHUNK_SIZE = 64 * 1024
+
+# 受け付ける最大サイズ（デフォルト20MB）
+MAX_CONTENT_BYTES = int(os.getenv('LINE_CONTENT_MAX_BYTES', 20 * 1024 * 1024))
+
+
+class ContentTooLargeError(Exception):
+    """
+    コンテンツが上限サイズを超えた場合の例外
+    """
+
+
+def write_chunks(chunks, dest_path, max_bytes=MAX_CONTENT_BYTES):
+    """
+    チャンクを順にファイルへ書き込み、同時にSHA-256を計算する関数
+
+    書き込み中は一時ファイルに書き、完了してから置き換えるため、
+    途中で失敗しても不完全なファイルは残らない。
+
+    Args:
+        chunks: バイト列のイテレーター
+        dest_path (str): 保存先のパス
+        max_bytes (int): 受け付ける最大サイズ
+
+    Returns:
+        tuple: (サイズ, SHA-256の16進数表記)
+
+    Raises:
+        ContentTooLargeError: max_bytesを超えた場合
+    """
+    digest = hashlib.sha256()
+    size = 0
+    part_path = dest_path + '.part'
+    try:
+        with open(part_path, 'wb') as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ContentTooLargeError(f"コンテンツが上限サイズ（{max_bytes}バイト）を超えています。")
+                digest.update(chunk)
+                f.write(chunk)
+        os.replace(part_path, dest_path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return size, digest.hexdigest()
+
+
+def open_message_content(api_client, message_id):
+    """
+    メッセージのコンテンツをストリーミングで取得する関数
+
+    SDKのget_message_contentは本文を全てメモリに読み込むため、
+    同じ接続プールを使って直接リクエストする。
+
+    Args:
+        api_client (linebot.v3.messaging.ApiClient): LINEのAPIクライアント
+        message_id (str): メッセージID
+
+    Returns:
+        urllib3.response.HTTPResponse: 本文を読み込んでいないレスポンス
+    """
+    url = f'{LINE_DATA_API}/v2/bot/message/{message_id}/content'
+    headers = {'Authorization': f'Bearer {api_client.configuration.access_token}'}
+    return api_client.request('GET', url, headers=headers, _preload_content=False)
+
+
+def stream_message_content(api_client, message_id, dest_path, max_bytes=MAX_CONTENT_BYTES,
+                           chunk_size=CHUNK_SIZE):
+    """
+    メッセージのコンテンツを少しずつ読み込みながらファイルに保存する関数
+
+    Args:
+        api_client (linebot.v3.messaging.ApiClient): LINEのAPIクライアント
+        message_id (str): メッセージID
+        dest_path (str): 保存先のパス
+        max_bytes (int): 受け付ける最大サイズ
+        chunk_size (int): 1度に読み込むサイズ
+
+    Returns:
+        tuple: (サイズ, SHA-256の16進数表記)
+    """
+    response = open_message_content(api_client, message_id)
+    try:
+        length = response.headers.get('Content-Length')
+        if length and int(length) > max_bytes:
+            raise ContentTooLargeError(f"コンテンツが上限サイズ（{max_bytes}バイト）を超えています。")
+        return write_chunks(response.stream(chunk_size), dest_path, max_bytes)
+    finally:
+        response.release_conn()
+
+
+def ingest_message_image(api_client, store, message_id, preprocess, user_id=None):
+    """
+    LINEの画像をストリーミングで取得し、前処理してから画像ストアに保存する関数
+
+    Args:
+        api_client (linebot.v3.messaging.ApiClient): LINEのAPIクライアント
+        store (image_store.ImageStore): 保存先の画像ストア
+        message_id (str): メッセージID
+        preprocess: ファイルパスを受け取り(バイト列, 拡張子, 統計情報)を返す前処理関数
+        user_id (str): 送信したユーザーのID
+
+    Returns:
+        tuple: (保存したパス, 前処理後のバイト列, 統計情報のdict)
+    """
+    incoming_path = store.incoming_path(message_id)
+    with span('download'):
+        size, sha256 = stream_message_content(api_client, message_id, incoming_path)
+    try:
+        with span('preprocess'):
+            image_data, extension, stats = preprocess(incoming_path)
+    finally:
+        os.remove(incoming_path)
+    stats.update(downloaded_bytes=size, downloaded_sha256=sha256)
+    with span('image_save'):
+        path = store.put(message_id, image_data, user_id=user_id, extension=extension)
+    return path, image_data, stats
+
+
+async def write_chunks_async(chunks, dest_path, max_bytes=MAX_CONTENT_BYTES):
+    """
+    write_chunksのasyncio版（chunksは非同期イテレーター）
+
+    1チャンクの書き込みはローカルディスクへの短い書き込みのため、
+    イベントループの中でそのまま行う。
+    """
+    digest = hashlib.sha256()
+    size = 0
+    part_path = dest_path + '.part'
+    try:
+        with open(part_path, 'wb') as f:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ContentTooLargeError(f"コンテンツが上限サイズ（{max_bytes}バイト）を超えています。")
+                digest.update(chunk)
+                f.write(chunk)
+        os.replace(part_path, dest_path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return size, digest.hexdigest()
+
+
+async def open_message_content_async(api_client, message_id):
+    """
+    open_message_contentのasyncio版
+
+    Args:
+        api_client (linebot.v3.messaging.AsyncApiClient): LINEの非同期APIクライアント
+        message_id (str): メッセージID
+
+    Returns:
+        aiohttp.ClientResponse: 本文を読み込んでいないレスポンス
+    """
+    url = f'{LINE_DATA_API}/v2/bot/message/{message_id}/content'
+    headers = {'Authorization': f'Bearer {api_client.configuration.access_token}'}
+    return await api_client.request('GET', url, headers=headers, _preload_content=False)
+
+
+async def stream_message_content_async(api_client, message_id, dest_path, max_bytes=MAX_CONTENT_BYTES,
+                                       chunk_size=CHUNK_SIZE):
+    """
+    stream_message_contentのasyncio版
+
+    Returns:
+        tuple: (サイズ, SHA-256の16進数表記)
+    """
+    response = await open_message_content_async(api_client, message_id)
+    try:
+        response.raise_for_status()
+        length = response.headers.get('Content-Length')
+        if length and int(length) > max_bytes:
+            raise ContentTooLargeError(f"コンテンツが上限サイズ（{max_bytes}バイト）を超えています。")
+        return await write_chunks_async(response.content.iter_chunked(chunk_size), dest_path, max_bytes)
+    finally:
+        response.release()
+
+
+async def ingest_message_image_async(api_client, store, message_id, preprocess, user_id=None):
+    """
+    ingest_message_imageのasyncio版
+
+    Args:
+        api_client (linebot.v3.messaging.AsyncApiClient): LINEの非同期APIクライアント
+        store (image_store.ImageStore): 保存先の画像ストア
+        message_id (str): メッセージID
+        preprocess: ファイルパスを受け取り(バイト列, 拡張子, 統計情報)を返すコルーチン関数
+        user_id (str): 送信したユーザーのID
+
+    Returns:
+        tuple: (保存したパス, 前処理後のバイト列, 統計情報のdict)
+    """
+    incoming_path = store.incoming_path(message_id)
+    with span('download'):
+        size, sha256 = await stream_message_content_async(api_client, message_id, incoming_path)
+    try:
+        with span('preprocess'):
+            image_data, extension, stats = await preprocess(incoming_path)
+    finally:
+        os.remove(incoming_path)
+    stats.update(downloaded_bytes=size, downloaded_sha256=sha256)
+    with span('image_save'):
+        path = await asyncio.to_thread(store.put, message_id, image_data, user_id=user_id, extension=extension)
+    return path, image_data, stats
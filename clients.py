@@ -0,0 +1,121 @@
+import time
+import threading
+
+
+class ClientRegistry:
+    """
+    APIクライアントをプロセス内で1度だけ生成して使い回すレジストリ
+
+    スレッドセーフでないクライアント（httplib2を使うGoogle APIクライアントなど）は
+    per_thread=Trueで登録すると、スレッドごとに1つずつ生成される。
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._instances = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._stats = {}
+
+    def register(self, name, factory, per_thread=False):
+        """
+        クライアントの生成関数を登録する
+
+        Args:
+            name (str): クライアント名
+            factory: クライアントを生成する関数
+            per_thread (bool): スレッドごとに生成するかどうか
+        """
+        with self._lock:
+            self._factories[name] = (factory, per_thread)
+            self._instances.pop(name, None)
+            self._stats.setdefault(name, {'builds': 0, 'build_seconds': 0.0, 'hits': 0})
+
+    def get(self, name):
+        """
+        クライアントを取得する（初回のみ生成する）
+
+        Args:
+            name (str): クライアント名
+
+        Returns:
+            登録された生成関数が返すクライアント
+        """
+        factory, per_thread = self._factories[name]
+        if per_thread:
+            instances = getattr(self._local, 'instances', None)
+            if instances is None:
+                instances = self._local.instances = {}
+            # 登録し直された場合は古い生成関数のクライアントを使わない
+            cached = instances.get(name)
+            if cached is not None and cached[0] is factory:
+                self._count_hit(name)
+                return cached[1]
+            instance = self._build(name, factory)
+            instances[name] = (factory, instance)
+            return instance
+
+        instance = self._instances.get(name)
+        if instance is not None:
+            self._count_hit(name)
+            return instance
+        with self._build_lock:
+            # 他のスレッドが先に生成していないか再確認する
+            instance = self._instances.get(name)
+            if instance is None:
+                instance = self._build(name, factory)
+                with self._lock:
+                    self._instances[name] = instance
+            return instance
+
+    def override(self, name, instance):
+        """
+        クライアントを差し替える（疑似バックエンドを使う場合など）
+
+        Args:
+            name (str): クライアント名
+            instance: 代わりに使うクライアント
+        """
+        self.register(name, lambda: instance)
+
+    def reset(self):
+        """
+        生成済みのクライアントを破棄する（次回のgetで再生成される）
+        """
+        with self._lock:
+            self._instances.clear()
+        self._local = threading.local()
+
+    def _build(self, name, factory):
+        started = time.perf_counter()
+        instance = factory()
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._stats[name]['builds'] += 1
+            self._stats[name]['build_seconds'] += elapsed
+        return instance
+
+    def _count_hit(self, name):
+        with self._lock:
+            self._stats[name]['hits'] += 1
+
+    def stats(self):
+        """
+        クライアントごとの生成回数・生成時間・再利用回数を取得する
+
+        saved_secondsは再利用によって省略できた生成時間の推定値。
+
+        Returns:
+            dict: クライアント名をキーにした統計情報
+        """
+        with self._lock:
+            result = {}
+            for name, stat in self._stats.items():
+                average = stat['build_seconds'] / stat['builds'] if stat['builds'] else 0.0
+                result[name] = dict(stat, saved_seconds=average * stat['hits'])
+            return result
+
+
+# プロセス全体で共有するレジストリ
+registry = ClientRegistry()
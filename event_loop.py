@@ -0,0 +1,114 @@
+import time
+import asyncio
+import logging
+import threading
+import concurrent.futures
+
+logger = logging.getLogger(__name__)
+
+
+class EventLoopRunner:
+    """
+    バックグラウンドのスレッドでイベントループを動かし、同期的なコードからコルーチンを実行する
+
+    Geminiやaiohttpの非同期クライアントは作成したイベントループに結び付くため、
+    プロセスで1つのループを使い続ける。コルーチンは呼び出し元のスレッドの
+    コンテキスト（リクエストIDやGeminiの優先度）を引き継いで実行される。
+    """
+
+    def __init__(self, name='event-loop'):
+        self.name = name
+        self._loop = None
+        self._thread = None
+        self._stopped = False
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        イベントループのスレッドを起動する（起動済みの場合は何もしない）
+
+        Returns:
+            asyncio.AbstractEventLoop: イベントループ
+        """
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("イベントループは停止しています。")
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+                thread = threading.Thread(target=self._run, args=(loop, ready), name=self.name, daemon=True)
+                thread.start()
+                ready.wait()
+                self._loop, self._thread = loop, thread
+            return self._loop
+
+    def _run(self, loop, ready):
+        asyncio.set_event_loop(loop)
+        loop.call_soon(ready.set)
+        loop.run_forever()
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+    def submit(self, coro):
+        """
+        コルーチンをイベントループで実行する（完了は待たない）
+
+        Args:
+            coro: 実行するコルーチン
+
+        Returns:
+            concurrent.futures.Future: コルーチンの戻り値が設定される
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.start())
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def run(self, coro, timeout=None):
+        """
+        コルーチンをイベントループで実行し、結果を待つ（同期版の関数から使う）
+
+        Args:
+            coro: 実行するコルーチン
+            timeout (float): 待つ最大秒数
+
+        Returns:
+            コルーチンの戻り値
+        """
+        if self._thread is not None and threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("イベントループのスレッドからは呼び出せません。awaitしてください。")
+        return self.submit(coro).result(timeout)
+
+    def _discard(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def stop(self, timeout=None):
+        """
+        実行中のコルーチンの完了を待ってからイベントループを停止する
+
+        Args:
+            timeout (float): 完了とイベントループの停止を合わせて待つ最大秒数
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            self._stopped = True
+            loop, thread, pending = self._loop, self._thread, list(self._pending)
+        if loop is None:
+            return
+        done, not_done = concurrent.futures.wait(pending, timeout)
+        if not_done:
+            logger.warning(f"{len(not_done)}件の処理が完了しないまま停止します。")
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+    def stats(self):
+        with self._lock:
+            return {'running': self._loop is not None and not self._stopped, 'pending': len(self._pending)}
+
+
+# プロセス全体で共有するイベントループ（同期版の関数もこのループで非同期版を実行する）
+runner = EventLoopRunner()
@@ -0,0 +1,471 @@
+import io
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+
+SAMPLE_HEADER = ['品名', '数量', '金額']
+SAMPLE_ROWS = [
+    ['コーヒー', '1', '450'],
+    ['サンドイッチ', '2', '980'],
+    ['サラダ', '1', '520'],
+]
+
+
+def latency_distribution(kind, mean, spread=0.0, seed=None):
+    """
+    疑似遅延の分布から秒数を返す関数を作成する関数
+
+    Args:
+        kind (str): 'fixed'（常にmean）、'uniform'（mean±spread）、
+            'exponential'（平均mean）、'lognormal'（中央値mean、spreadは対数の標準偏差）
+        mean (float): 平均（lognormalでは中央値）の秒数
+        spread (float): ばらつき
+        seed (int): 乱数のシード
+
+    Returns:
+        function: 呼び出すたびに遅延の秒数を返す関数
+    """
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    if kind == 'fixed':
+        return lambda: mean
+    if kind == 'uniform':
+        sample = lambda: max(0.0, rng.uniform(mean - spread, mean + spread))
+    elif kind == 'exponential':
+        sample = lambda: rng.expovariate(1 / mean) if mean > 0 else 0.0
+    elif kind == 'lognormal':
+        sample = lambda: mean * rng.lognormvariate(0, spread) if mean > 0 else 0.0
+    else:
+        raise ValueError(f"不明な分布です: {kind}")
+
+    def draw():
+        with lock:
+            return sample()
+    return draw
+
+
+def sleep_latency(latency):
+    """
+    秒数、または秒数を返す関数の分だけ待つ関数
+    """
+    seconds = latency() if callable(latency) else latency
+    if seconds:
+        time.sleep(seconds)
+
+
+async def sleep_latency_async(latency):
+    """
+    sleep_latencyのasyncio版
+    """
+    seconds = latency() if callable(latency) else latency
+    if seconds:
+        await asyncio.sleep(seconds)
+
+
+class FakeResponse:
+    """
+    generate_contentの戻り値を模したオブジェクト
+    """
+
+    def __init__(self, text):
+        self.text = text
+
+
+def default_responder(contents):
+    """
+    プロンプトの種類に応じてそれらしい応答を返す関数
+    """
+    if isinstance(contents, str):
+        # テキストのみ → 表整形の呼び出し
+        lines = [' | '.join(SAMPLE_HEADER)]
+        lines += [' | '.join(row) for row in SAMPLE_ROWS]
+        return '\n'.join(lines)
+
+    prompt = contents[0]
+    if 'JSON' in prompt:
+        return json.dumps({'header': SAMPLE_HEADER, 'rows': SAMPLE_ROWS}, ensure_ascii=False)
+    return '\n'.join(' '.join(row) for row in [SAMPLE_HEADER] + SAMPLE_ROWS)
+
+
+class FakeRateLimitError(Exception):
+    """
+    429（RESOURCE_EXHAUSTED）を模した例外
+    """
+    code = 429
+
+
+class FakeServerError(Exception):
+    """
+    500（INTERNAL）を模した例外（スケジューラーは再試行しない）
+    """
+    code = 500
+
+
+class FakeGeminiModel:
+    """
+    genai.GenerativeModelの代わりに使う疑似モデル
+
+    max_concurrent・rpmを指定すると、それを超えた呼び出しで429を返す。
+
+    Args:
+        latency (float): 1回の呼び出しにかかる秒数（秒数を返す関数も指定できる）
+        responder: contentsを受け取り応答テキストを返す関数
+        max_concurrent (int): 同時に受け付ける呼び出し数（Noneで無制限）
+        rpm (int): window秒あたりに受け付ける呼び出し数（Noneで無制限）
+        window (float): rpmを数える期間（秒）
+        error_rate (float): ランダムに429を返す割合
+        failure_rate (float): 遅延の後にランダムに500を返す割合
+        first_chunk_ratio (float): stream=Trueの場合に、最初のチャンクまでにかかる遅延の割合
+            （残りの遅延はチャンクごとに均等に分ける）
+        chunk_chars (int): stream=Trueの場合の1チャンクの文字数
+    """
+
+    def __init__(self, latency=0.0, responder=default_responder, max_concurrent=None,
+                 rpm=None, window=60.0, error_rate=0.0, failure_rate=0.0,
+                 first_chunk_ratio=0.2, chunk_chars=40):
+        self.latency = latency
+        self.first_chunk_ratio = first_chunk_ratio
+        self.chunk_chars = chunk_chars
+        self.responder = responder
+        self.max_concurrent = max_concurrent
+        self.rpm = rpm
+        self.window = window
+        self.error_rate = error_rate
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self.rate_limited = 0
+        self.failed = 0
+        self._active = 0
+        self._recent = []
+        self._lock = threading.Lock()
+
+    def _admit(self):
+        now = time.monotonic()
+        with self._lock:
+            self.calls += 1
+            self._recent = [t for t in self._recent if now - t < self.window]
+            limited = (
+                (self.max_concurrent is not None and self._active >= self.max_concurrent)
+                or (self.rpm is not None and len(self._recent) >= self.rpm)
+                or (self.error_rate and random.random() < self.error_rate)
+            )
+            if limited:
+                self.rate_limited += 1
+                raise FakeRateLimitError('429 Resource has been exhausted (e.g. check quota).')
+            self._recent.append(now)
+            self._active += 1
+
+    def _chunks(self, text):
+        return [text[i:i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)] or ['']
+
+    def generate_content(self, contents, **kwargs):
+        self._admit()
+        try:
+            if kwargs.get('stream'):
+                seconds = self.latency() if callable(self.latency) else self.latency
+                sleep_latency(seconds * self.first_chunk_ratio)
+                return self._stream(self._chunks(self.responder(contents)), seconds * (1 - self.first_chunk_ratio))
+            sleep_latency(self.latency)
+            if self.failure_rate and random.random() < self.failure_rate:
+                with self._lock:
+                    self.failed += 1
+                raise FakeServerError('500 An internal error has occurred.')
+            return FakeResponse(self.responder(contents))
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def _stream(self, chunks, remaining):
+        # 最初のチャンクは待たずに返し、残りの遅延をチャンクの間に均等に分ける
+        for i, chunk in enumerate(chunks):
+            if i:
+                sleep_latency(remaining / (len(chunks) - 1))
+            yield FakeResponse(chunk)
+
+    async def _stream_async(self, chunks, remaining):
+        for i, chunk in enumerate(chunks):
+            if i:
+                await sleep_latency_async(remaining / (len(chunks) - 1))
+            yield FakeResponse(chunk)
+
+    async def generate_content_async(self, contents, **kwargs):
+        self._admit()
+        try:
+            if kwargs.get('stream'):
+                seconds = self.latency() if callable(self.latency) else self.latency
+                await sleep_latency_async(seconds * self.first_chunk_ratio)
+                return self._stream_async(self._chunks(self.responder(contents)),
+                                          seconds * (1 - self.first_chunk_ratio))
+            await sleep_latency_async(self.latency)
+            if self.failure_rate and random.random() < self.failure_rate:
+                with self._lock:
+                    self.failed += 1
+                raise FakeServerError('500 An internal error has occurred.')
+            return FakeResponse(self.responder(contents))
+        finally:
+            with self._lock:
+                self._active -= 1
+
+
+def parse_range(range_name):
+    """
+    'Sheet1!A5:Z' のような範囲からシート名と開始行（0始まり、指定なしはNone）を取り出す関数
+    """
+    sheet_name, _, cells = range_name.rpartition('!')
+    if sheet_name.startswith("'") and sheet_name.endswith("'"):
+        sheet_name = sheet_name[1:-1]
+    start = cells.split(':')[0]
+    digits = ''.join(c for c in start if c.isdigit())
+    return sheet_name, int(digits) - 1 if digits else None
+
+
+class FakeRequest:
+    def __init__(self, service, func):
+        self._service = service
+        self._func = func
+
+    def execute(self):
+        sleep_latency(self._service.latency)
+        with self._service.lock:
+            self._service.requests += 1
+            return self._func()
+
+
+class FakeValues:
+    def __init__(self, service):
+        self._service = service
+
+    def _grid(self, spreadsheet_id, sheet_name):
+        return self._service.sheets.setdefault((spreadsheet_id, sheet_name), [])
+
+    def get(self, spreadsheetId, range):
+        def run():
+            sheet_name, _ = parse_range(range)
+            grid = self._grid(spreadsheetId, sheet_name)
+            # 末尾の空行は返さない
+            used = len(grid)
+            while used and not any(cell != '' for cell in grid[used - 1]):
+                used -= 1
+            return {'range': range, 'values': [list(row[:1]) for row in grid[:used]]}
+        return FakeRequest(self._service, run)
+
+    def clear(self, spreadsheetId, range):
+        def run():
+            sheet_name, _ = parse_range(range)
+            self._grid(spreadsheetId, sheet_name).clear()
+            return {'clearedRange': range}
+        return FakeRequest(self._service, run)
+
+    def append(self, spreadsheetId, range, valueInputOption, body):
+        def run():
+            sheet_name, _ = parse_range(range)
+            grid = self._grid(spreadsheetId, sheet_name)
+            grid.extend(list(row) for row in body['values'])
+            cells = sum(len(row) for row in body['values'])
+            return {'updates': {'updatedRows': len(body['values']), 'updatedCells': cells}}
+        return FakeRequest(self._service, run)
+
+    def update(self, spreadsheetId, range, valueInputOption, body):
+        def run():
+            sheet_name, start = parse_range(range)
+            grid = self._grid(spreadsheetId, sheet_name)
+            start = start or 0
+            row_count = self._service.row_counts.get((spreadsheetId, sheet_name))
+            if row_count is not None and start + len(body['values']) > row_count:
+                raise ValueError(f'Range ({range}) exceeds grid limits. Max rows: {row_count}')
+            for i, row in enumerate(body['values']):
+                while len(grid) <= start + i:
+                    grid.append([])
+                grid[start + i] = list(row)
+            cells = sum(len(row) for row in body['values'])
+            return {'updatedRows': len(body['values']), 'updatedCells': cells}
+        return FakeRequest(self._service, run)
+
+    def batchUpdate(self, spreadsheetId, body):
+        def run():
+            cells = 0
+            for data in body['data']:
+                result = self.update(spreadsheetId, data['range'], body.get('valueInputOption'),
+                                     {'values': data['values']})._func()
+                cells += result['updatedCells']
+            return {'totalUpdatedCells': cells}
+        return FakeRequest(self._service, run)
+
+
+class FakeSpreadsheets:
+    def __init__(self, service):
+        self._service = service
+
+    def values(self):
+        return FakeValues(self._service)
+
+    def get(self, spreadsheetId, fields=None):
+        def run():
+            titles = [name for (sid, name) in self._service.sheets if sid == spreadsheetId]
+            titles += [name for (sid, name) in self._service.row_counts
+                       if sid == spreadsheetId and name not in titles]
+            return {'sheets': [{'properties': {
+                'sheetId': self._service.sheet_id(spreadsheetId, title),
+                'title': title,
+                'gridProperties': {'rowCount': self._service.row_counts.get((spreadsheetId, title), 1000)}
+            }} for title in titles]}
+        return FakeRequest(self._service, run)
+
+    def batchUpdate(self, spreadsheetId, body):
+        def run():
+            replies = []
+            for request in body['requests']:
+                if 'addSheet' in request:
+                    properties = request['addSheet']['properties']
+                    title = properties['title']
+                    if (spreadsheetId, title) in self._service.sheets:
+                        raise ValueError(f'A sheet with the name "{title}" already exists.')
+                    self._service.sheets[(spreadsheetId, title)] = []
+                    row_count = properties.get('gridProperties', {}).get('rowCount', 1000)
+                    self._service.row_counts[(spreadsheetId, title)] = row_count
+                    replies.append({'addSheet': {'properties': {
+                        'sheetId': self._service.sheet_id(spreadsheetId, title),
+                        'title': title,
+                        'gridProperties': {'rowCount': row_count}
+                    }}})
+                elif 'appendDimension' in request:
+                    dimension = request['appendDimension']
+                    for (sid, title), count in list(self._service.row_counts.items()):
+                        if sid == spreadsheetId and self._service.sheet_id(sid, title) == dimension['sheetId']:
+                            self._service.row_counts[(sid, title)] = count + dimension['length']
+                    replies.append({})
+            return {'replies': replies}
+        return FakeRequest(self._service, run)
+
+
+class FakeSheetsService:
+    """
+    Google Sheets APIのvalues系メソッドを模した疑似サービス
+
+    書き込まれた内容はsheets[(スプレッドシートID, シート名)]に保持される。
+    row_countsに行数を登録したシート（addSheetで作成したシートなど）は、
+    行数を超える範囲への書き込みをエラーにする。
+
+    Args:
+        latency (float): 1リクエストにかかる秒数（秒数を返す関数も指定できる）
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+        self.sheets = {}
+        self.row_counts = {}
+        self._sheet_ids = {}
+        self.lock = threading.Lock()
+
+    def sheet_id(self, spreadsheet_id, title):
+        return self._sheet_ids.setdefault((spreadsheet_id, title), len(self._sheet_ids))
+
+    def spreadsheets(self):
+        return FakeSpreadsheets(self)
+
+
+class FakeStreamResponse:
+    """
+    urllib3のストリーミングレスポンスを模したオブジェクト
+
+    Args:
+        content (bytes or str): 本文のバイト列、または本文を読み出すファイルのパス
+        chunk_latency (float): 1チャンクあたりの疑似遅延（秒）
+    """
+
+    def __init__(self, content, chunk_latency=0.0):
+        self._content = content
+        self._chunk_latency = chunk_latency
+        size = len(content) if isinstance(content, bytes) else os.path.getsize(content)
+        self.headers = {'Content-Length': str(size)}
+        self.released = False
+
+    def stream(self, chunk_size):
+        if isinstance(self._content, bytes):
+            f = io.BytesIO(self._content)
+        else:
+            f = open(self._content, 'rb')
+        with f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                if self._chunk_latency:
+                    time.sleep(self._chunk_latency)
+                yield chunk
+
+    def release_conn(self):
+        self.released = True
+
+
+class FakeConfiguration:
+    def __init__(self, access_token='dummy'):
+        self.access_token = access_token
+
+
+class FakeLineApiClient:
+    """
+    LINEのApiClientのうち、コンテンツのストリーミング取得に使う部分を模したクライアント
+
+    Args:
+        contents (dict): メッセージIDをキーにした画像のバイト列またはファイルパス
+        chunk_latency (float): 1チャンクあたりの疑似遅延（秒）
+    """
+
+    def __init__(self, contents=None, chunk_latency=0.0):
+        self.contents = contents or {}
+        self.chunk_latency = chunk_latency
+        self.configuration = FakeConfiguration()
+
+    def request(self, method, url, headers=None, _preload_content=True, **kwargs):
+        message_id = url.rstrip('/').split('/')[-2]
+        return FakeStreamResponse(self.contents[message_id], self.chunk_latency)
+
+
+class FakeAsyncStreamContent:
+    """
+    aiohttpのStreamReaderのうち、チャンクごとの読み込みを模したオブジェクト
+    """
+
+    def __init__(self, content, chunk_latency=0.0):
+        self._content = content
+        self._chunk_latency = chunk_latency
+
+    async def iter_chunked(self, chunk_size):
+        for chunk in FakeStreamResponse(self._content).stream(chunk_size):
+            if self._chunk_latency:
+                await asyncio.sleep(self._chunk_latency)
+            yield chunk
+
+
+class FakeAsyncStreamResponse:
+    """
+    aiohttpのストリーミングレスポンスを模したオブジェクト
+    """
+
+    def __init__(self, content, chunk_latency=0.0):
+        size = len(content) if isinstance(content, bytes) else os.path.getsize(content)
+        self.status = 200
+        self.headers = {'Content-Length': str(size)}
+        self.content = FakeAsyncStreamContent(content, chunk_latency)
+        self.released = False
+
+    def raise_for_status(self):
+        pass
+
+    def release(self):
+        self.released = True
+
+
+class FakeAsyncLineApiClient(FakeLineApiClient):
+    """
+    LINEのAsyncApiClientのうち、コンテンツのストリーミング取得に使う部分を模したクライアント
+    """
+
+    async def request(self, method, url, headers=None, _preload_content=True, **kwargs):
+        message_id = url.rstrip('/').split('/')[-2]
+        return FakeAsyncStreamResponse(self.contents[message_id], self.chunk_latency)
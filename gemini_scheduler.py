@@ -0,0 +1,470 @@
+import os
+import time
+import heapq
+import random
+import asyncio
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# 優先度（値が小さいほど先に実行する）
+PRIORITIES = {'interactive': 0, 'backfill': 1}
+
+# 画像1枚あたりのトークン数の目安（Geminiは画像1枚を258トークンとして数える）
+IMAGE_TOKENS = 258
+
+# 応答として見込むトークン数
+RESPONSE_TOKENS = 500
+
+# asyncioのタスクが実行できるようになったかを確認する間隔（秒）
+ASYNC_POLL_INTERVAL = 0.05
+
+
+def is_rate_limit_error(error):
+    """
+    レート制限（HTTP 429 / RESOURCE_EXHAUSTED）によるエラーかどうかを判定する関数
+
+    メッセージの文字列は見ない（IDやトークン数に含まれる「429」を誤って判定しないため）。
+    """
+    for attribute in ('code', 'status', 'status_code'):
+        value = getattr(error, attribute, None)
+        if value == 429 or str(value) in ('429', 'RESOURCE_EXHAUSTED', 'StatusCode.RESOURCE_EXHAUSTED'):
+            return True
+    return type(error).__name__ in ('ResourceExhausted', 'TooManyRequests')
+
+
+def estimate_tokens(contents):
+    """
+    generate_contentに渡す内容からトークン数を見積もる関数
+
+    日本語は1文字がおよそ1トークンになるため、文字数をそのまま数える。
+
+    Args:
+        contents: プロンプトの文字列、または文字列と画像のリスト
+
+    Returns:
+        int: 見積もったトークン数（応答分を含む）
+    """
+    if not isinstance(contents, (list, tuple)):
+        contents = [contents]
+    tokens = RESPONSE_TOKENS
+    for part in contents:
+        if isinstance(part, str):
+            tokens += len(part)
+        else:
+            tokens += IMAGE_TOKENS
+    return tokens
+
+
+class TokenBucket:
+    """
+    1分あたりの上限を一定の速度で補充するトークンバケット
+
+    Args:
+        per_minute (float): 1分あたりの上限（0以下で無制限）
+    """
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.per_minute / 60)
+        self._updated = now
+
+    def wait_time(self, amount):
+        """
+        amount分のトークンが貯まるまでの秒数を求める（0なら今すぐ使える）
+        """
+        if self.per_minute <= 0:
+            return 0.0
+        self._refill()
+        # 上限を超える要求は満杯になれば通す
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60 / self.per_minute
+
+    def consume(self, amount):
+        if self.per_minute > 0:
+            self.tokens -= min(amount, self.capacity)
+
+
+class GeminiScheduler:
+    """
+    Geminiの呼び出しを共有の上限の中で順番に実行するスケジューラー
+
+    - 1分あたりのリクエスト数・トークン数をトークンバケットで制限する
+    - 同時実行数は429を受けると半分に、成功するたびに少しずつ増やす（AIMD）
+    - 応答が遅い場合も同時実行数を少し減らす
+    - LINEからの依頼（interactive）をバックフィル（backfill）より先に実行する
+    - 429の場合はジッター付きの指数バックオフで再試行する
+    - スレッドからの呼び出し（call）とasyncioからの呼び出し（call_async）で同じ上限を共有する
+
+    Args:
+        rpm (float): 1分あたりの最大リクエスト数（0で無制限）
+        tpm (float): 1分あたりの最大トークン数（0で無制限）
+        max_concurrency (int): 同時実行数の上限
+        min_concurrency (int): 同時実行数の下限
+        latency_target (float): これより遅い応答が続くと同時実行数を減らす（秒）
+        retries (int): 429の場合の最大再試行回数
+        base_delay (float): 再試行の最初の待ち時間（秒）
+    """
+
+    def __init__(self, rpm=0, tpm=0, max_concurrency=8, min_concurrency=1,
+                 latency_target=30.0, retries=3, base_delay=1.0):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.latency_target = latency_target
+        self.retries = retries
+        self.base_delay = base_delay
+        self.limit = float(max_concurrency)
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._seq = 0
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        # スレッドごと（asyncioではタスクごと）の優先度
+        self._priority = contextvars.ContextVar('gemini_priority', default=None)
+        self._stats = {
+            'completed': 0,
+            'failed': 0,
+            'throttled': 0,
+            'retried': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+        }
+
+    @contextmanager
+    def priority(self, name):
+        """
+        このブロック内のモデル呼び出しの優先度を設定する
+
+        例:
+            with scheduler.priority('backfill'):
+                extract_table(...)
+        """
+        if name not in PRIORITIES:
+            raise ValueError(f"不明な優先度です: {name}")
+        token = self._priority.set(name)
+        try:
+            yield
+        finally:
+            self._priority.reset(token)
+
+    def current_priority(self):
+        return self._priority.get() or 'interactive'
+
+    def call(self, func, priority=None, tokens=1):
+        """
+        スケジューラーの制限の中で関数を実行する
+
+        Args:
+            func: モデルを呼び出す引数なしの関数
+            priority (str): 'interactive' または 'backfill'（省略時は現在の優先度）
+            tokens (int): 見積もったトークン数
+
+        Returns:
+            funcの戻り値
+
+        Raises:
+            再試行しても429が続いた場合やその他のエラーの場合は、funcの例外をそのまま送出する
+        """
+        priority = priority or self.current_priority()
+        attempt = 0
+        while True:
+            self._acquire(priority, tokens)
+            started = time.monotonic()
+            try:
+                result = func()
+            except Exception as e:
+                if not is_rate_limit_error(e):
+                    self._release(failed=True)
+                    raise
+                self._on_throttle(started)
+                if attempt >= self.retries:
+                    self._release(failed=True)
+                    raise
+                self._release()
+                delay = self.base_delay * (2 ** attempt) * (0.5 + random.random())
+                logger.warning(f"レート制限のため{delay:.1f}秒後に再試行します（{attempt + 1}/{self.retries}）")
+                time.sleep(delay)
+                attempt += 1
+                with self._cond:
+                    self._stats['retried'] += 1
+                continue
+            except BaseException:
+                # KeyboardInterruptなどで中断された場合も枠を返す
+                self._release(failed=True)
+                raise
+
+            self._on_success(time.monotonic() - started)
+            self._release(completed=True)
+            return result
+
+    async def call_async(self, func, priority=None, tokens=1):
+        """
+        スケジューラーの制限の中でコルーチンを実行する（callのasyncio版）
+
+        待っている間もスレッドを占有せず、スレッドからの呼び出しと同じ順番・上限で実行される。
+
+        Args:
+            func: モデルを呼び出すコルーチンを返す引数なしの関数
+            priority (str): 'interactive' または 'backfill'（省略時は現在の優先度）
+            tokens (int): 見積もったトークン数
+
+        Returns:
+            コルーチンの戻り値
+        """
+        priority = priority or self.current_priority()
+        attempt = 0
+        while True:
+            await self._acquire_async(priority, tokens)
+            started = time.monotonic()
+            try:
+                result = await func()
+            except Exception as e:
+                if not is_rate_limit_error(e):
+                    self._release(failed=True)
+                    raise
+                self._on_throttle(started)
+                if attempt >= self.retries:
+                    self._release(failed=True)
+                    raise
+                self._release()
+                delay = self.base_delay * (2 ** attempt) * (0.5 + random.random())
+                logger.warning(f"レート制限のため{delay:.1f}秒後に再試行します（{attempt + 1}/{self.retries}）")
+                await asyncio.sleep(delay)
+                attempt += 1
+                with self._cond:
+                    self._stats['retried'] += 1
+                continue
+            except BaseException:
+                # キャンセルされた場合も枠を返す
+                self._release(failed=True)
+                raise
+
+            self._on_success(time.monotonic() - started)
+            self._release(completed=True)
+            return result
+
+    def _enqueue(self, priority):
+        entry = (PRIORITIES[priority], self._seq)
+        self._seq += 1
+        heapq.heappush(self._waiting, entry)
+        return entry
+
+    def _dequeue(self, entry):
+        self._waiting.remove(entry)
+        heapq.heapify(self._waiting)
+        self._cond.notify_all()
+
+    def _try_start(self, entry, tokens, queued_at):
+        """
+        順番が来ていれば実行を開始する（self._condを取得した状態で呼ぶ）
+
+        Returns:
+            float: 開始した場合は0、レート制限で待つ場合はその秒数、
+                順番や同時実行数の空きを待つ場合はNone
+        """
+        if self._waiting[0] != entry or self._in_flight >= int(self.limit):
+            return None
+        wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+        if wait > 0:
+            return wait
+
+        heapq.heappop(self._waiting)
+        self.requests.consume(1)
+        self.tokens.consume(tokens)
+        self._in_flight += 1
+        waited = time.monotonic() - queued_at
+        self._stats['wait_seconds_total'] += waited
+        self._stats['wait_seconds_max'] = max(self._stats['wait_seconds_max'], waited)
+        # 次の待機者も実行できるかもしれないので起こす
+        self._cond.notify_all()
+        return 0
+
+    def _acquire(self, priority, tokens):
+        queued_at = time.monotonic()
+        with self._cond:
+            entry = self._enqueue(priority)
+            try:
+                while True:
+                    wait = self._try_start(entry, tokens, queued_at)
+                    if wait == 0:
+                        return
+                    self._cond.wait(wait)
+            except BaseException:
+                self._dequeue(entry)
+                raise
+
+    async def _acquire_async(self, priority, tokens):
+        # 条件変数では待てないため、短い間隔で順番が来たかを確認する
+        queued_at = time.monotonic()
+        with self._cond:
+            entry = self._enqueue(priority)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_start(entry, tokens, queued_at)
+                if wait == 0:
+                    return
+                await asyncio.sleep(min(wait or ASYNC_POLL_INTERVAL, ASYNC_POLL_INTERVAL))
+        except BaseException:
+            with self._cond:
+                self._dequeue(entry)
+            raise
+
+    def _release(self, completed=False, failed=False):
+        with self._cond:
+            self._in_flight -= 1
+            if completed:
+                self._stats['completed'] += 1
+            if failed:
+                self._stats['failed'] += 1
+            self._cond.notify_all()
+
+    def _on_throttle(self, started):
+        with self._cond:
+            self._stats['throttled'] += 1
+            # 同じ時期に送った呼び出しが続けて429になっても、減らすのは1回だけにする
+            if started >= self._last_decrease:
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                self._last_decrease = time.monotonic()
+                logger.info(f"429を受けたため同時実行数を{int(self.limit)}に減らしました。")
+
+    def _on_success(self, latency):
+        with self._cond:
+            if latency > self.latency_target:
+                self.limit = max(self.min_concurrency, self.limit * 0.9)
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def stats(self):
+        """
+        スケジューラーの状態を取得する
+
+        Returns:
+            dict: 待ち件数・実行中の件数・同時実行数・429の回数・再試行回数など
+        """
+        with self._cond:
+            queued = {name: 0 for name in PRIORITIES}
+            names = {value: name for name, value in PRIORITIES.items()}
+            for value, _ in self._waiting:
+                queued[names[value]] += 1
+            started = self._stats['completed'] + self._stats['failed'] + self._stats['retried']
+            return {
+                'queued': len(self._waiting),
+                'queued_by_priority': queued,
+                'in_flight': self._in_flight,
+                'concurrency_limit': int(self.limit),
+                'completed': self._stats['completed'],
+                'failed': self._stats['failed'],
+                'throttled': self._stats['throttled'],
+                'retried': self._stats['retried'],
+                'wait_seconds_avg': self._stats['wait_seconds_total'] / started if started else 0.0,
+                'wait_seconds_max': self._stats['wait_seconds_max'],
+            }
+
+
+def iterate_from(first, iterator):
+    yield first
+    yield from iterator
+
+
+async def aiterate_from(first, iterator):
+    yield first
+    async for chunk in iterator:
+        yield chunk
+
+
+class ScheduledModel:
+    """
+    generate_contentをスケジューラー経由で呼び出すモデルのラッパー
+
+    stream=Trueの場合は最初のチャンクを受け取るまで（429の再試行を含む）をスケジューラーの
+    中で行い、チャンクを順に返すイテレーターを返す。残りのチャンクを受け取る間は
+    同時実行数に数えない。
+
+    Args:
+        model: genai.GenerativeModel（または同じメソッドを持つ疑似モデル）
+        scheduler (GeminiScheduler): 使用するスケジューラー
+    """
+
+    def __init__(self, model, scheduler):
+        self.model = model
+        self.scheduler = scheduler
+
+    def generate_content(self, contents, **kwargs):
+        if kwargs.get('stream'):
+            return self.scheduler.call(lambda: self._start_stream(contents, **kwargs),
+                                       tokens=estimate_tokens(contents))
+        return self.scheduler.call(
+            lambda: self.model.generate_content(contents, **kwargs),
+            tokens=estimate_tokens(contents)
+        )
+
+    async def generate_content_async(self, contents, **kwargs):
+        if kwargs.get('stream'):
+            return await self.scheduler.call_async(lambda: self._start_stream_async(contents, **kwargs),
+                                                   tokens=estimate_tokens(contents))
+        return await self.scheduler.call_async(
+            lambda: self.model.generate_content_async(contents, **kwargs),
+            tokens=estimate_tokens(contents)
+        )
+
+    def _start_stream(self, contents, **kwargs):
+        iterator = iter(self.model.generate_content(contents, **kwargs))
+        try:
+            first = next(iterator)
+        except StopIteration:
+            return iterator
+        return iterate_from(first, iterator)
+
+    async def _start_stream_async(self, contents, **kwargs):
+        response = await self.model.generate_content_async(contents, **kwargs)
+        iterator = response.__aiter__()
+        try:
+            first = await iterator.__anext__()
+        except StopAsyncIteration:
+            return iterator
+        return aiterate_from(first, iterator)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+def create_scheduler():
+    """
+    環境変数の設定からスケジューラーを作成する関数
+
+    GEMINI_RPM: 1分あたりの最大リクエスト数（デフォルト15、0で無制限）
+    GEMINI_TPM: 1分あたりの最大トークン数（デフォルト1000000、0で無制限）
+    GEMINI_MAX_CONCURRENCY: 同時実行数の上限（デフォルト8）
+    GEMINI_LATENCY_TARGET: これより遅い応答で同時実行数を減らす秒数（デフォルト30）
+    GEMINI_RETRIES: 429の場合の最大再試行回数（デフォルト3）
+    GEMINI_RETRY_DELAY: 再試行の最初の待ち時間（秒、デフォルト2）
+
+    Returns:
+        GeminiScheduler: スケジューラー
+    """
+    return GeminiScheduler(
+        rpm=float(os.getenv('GEMINI_RPM', 15)),
+        tpm=float(os.getenv('GEMINI_TPM', 1000000)),
+        max_concurrency=int(os.getenv('GEMINI_MAX_CONCURRENCY', 8)),
+        latency_target=float(os.getenv('GEMINI_LATENCY_TARGET', 30)),
+        retries=int(os.getenv('GEMINI_RETRIES', 3)),
+        base_delay=float(os.getenv('GEMINI_RETRY_DELAY', 2))
+    )
+
+
+# プロセス全体で共有するスケジューラー
+scheduler = create_scheduler()
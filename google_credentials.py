@@ -0,0 +1,132 @@
+import os
+import json
+import pickle
+
+from clients import registry
+
+# Google Sheets APIのスコープ
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+
+# サービスアカウントの認証情報のファイル（環境変数GOOGLE_SERVICE_ACCOUNTがない場合に使う）
+SERVICE_ACCOUNT_FILE = 'service-account.json'
+
+# ブラウザで認可したOAuthのトークンと、認可に使うクライアントの情報（ローカルでの開発用）
+TOKEN_FILE = 'token.pickle'
+CLIENT_SECRETS_FILE = 'credentials.json'
+
+# トークンがない場合にブラウザで認可するかどうか（開発用のサーバーでだけ有効にする）
+_interactive = False
+
+
+def enable_interactive_auth():
+    """
+    認証情報がない場合に、初回の利用時にブラウザで認可できるようにする関数
+
+    画面のないサーバーでは認可を完了できず、書き込みが止まったままになるため、
+    開発用のサーバー（python line_image_saver.py）からだけ呼び出す。
+    """
+    global _interactive
+    _interactive = True
+
+
+def credentials_source():
+    """
+    利用できる認証情報の種類を求める関数（ファイルや環境変数の有無だけを確認する）
+
+    Returns:
+        str: 'service_account' または 'oauth_token'。どちらもない場合はNone
+    """
+    if os.environ.get('GOOGLE_SERVICE_ACCOUNT') or os.path.exists(SERVICE_ACCOUNT_FILE):
+        return 'service_account'
+    if os.path.exists(TOKEN_FILE):
+        return 'oauth_token'
+    return None
+
+
+def load_service_account_info():
+    """
+    サービスアカウントの認証情報を読み込む関数
+
+    環境変数GOOGLE_SERVICE_ACCOUNTから読み込み、設定がない場合は
+    service-account.jsonから読み込む。
+
+    Returns:
+        dict: サービスアカウントの認証情報
+    """
+    service_account_info = os.environ.get('GOOGLE_SERVICE_ACCOUNT')
+    if service_account_info:
+        return json.loads(service_account_info)
+    with open(SERVICE_ACCOUNT_FILE, 'r') as f:
+        return json.load(f)
+
+
+def load_oauth_credentials():
+    """
+    保存済みのOAuthのトークンを読み込み、期限切れの場合は更新する関数
+
+    Returns:
+        google.oauth2.credentials.Credentials: 認証情報
+
+    Raises:
+        RuntimeError: トークンがなく、ブラウザでの認可も有効でない場合
+    """
+    from google.auth.transport.requests import Request
+
+    creds = None
+    if os.path.exists(TOKEN_FILE):
+        with open(TOKEN_FILE, 'rb') as token:
+            creds = pickle.load(token)
+    if creds and creds.valid:
+        return creds
+    if creds and creds.expired and creds.refresh_token:
+        creds.refresh(Request())
+    elif _interactive:
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRETS_FILE, SCOPES)
+        creds = flow.run_local_server(port=0)
+    else:
+        raise RuntimeError("Google Sheetsの認証情報がありません。"
+                           "GOOGLE_SERVICE_ACCOUNTかservice-account.jsonを設定してください。")
+    with open(TOKEN_FILE, 'wb') as token:
+        pickle.dump(creds, token)
+    return creds
+
+
+def create_credentials():
+    """
+    Google Sheets APIの認証情報を生成する関数（認証用のライブラリは初回の呼び出し時に読み込む）
+
+    サービスアカウントがあればそれを使い、なければ保存済みのOAuthのトークンを使う。
+    アクセストークンは期限切れ時にAPIクライアントが自動で更新する。
+
+    Returns:
+        google.auth.credentials.Credentials: 認証情報
+    """
+    if credentials_source() == 'service_account':
+        from google.oauth2 import service_account
+        return service_account.Credentials.from_service_account_info(
+            load_service_account_info(), scopes=SCOPES)
+    return load_oauth_credentials()
+
+
+def get_credentials():
+    """
+    Google Sheets APIの認証情報を取得する関数（プロセス内で1度だけ生成する）
+    """
+    return registry.get('google_credentials')
+
+
+def build_sheets_service():
+    """
+    Google Sheets APIのサービスを生成する関数
+
+    ディスカバリードキュメントはライブラリに同梱のものを使い、起動時の通信を避ける。
+    """
+    from googleapiclient.discovery import build
+    return build('sheets', 'v4', credentials=get_credentials(),
+                 static_discovery=True, cache_discovery=False)
+
+
+registry.register('google_credentials', create_credentials)
+# httplib2はスレッドセーフではないため、サービスはスレッドごとに1度だけ生成する
+registry.register('sheets', build_sheets_service, per_thread=True)
@@ -0,0 +1,348 @@
+import os
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# 処理の状態
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+
+
+def event_keys(event):
+    """
+    Webhookイベントから重複判定に使うキーを取り出す関数
+
+    再送されたイベントはwebhookEventIdが同じになり、
+    同じ画像の別イベントはメッセージIDが同じになる。
+
+    Args:
+        event: linebot.v3.webhooks.MessageEventなど
+
+    Returns:
+        list: 重複判定に使うキーのリスト
+    """
+    keys = []
+    webhook_event_id = getattr(event, 'webhook_event_id', None)
+    if webhook_event_id:
+        keys.append(f'event:{webhook_event_id}')
+    message = getattr(event, 'message', None)
+    if message is not None and getattr(message, 'id', None):
+        keys.append(f'message:{message.id}')
+    return keys
+
+
+def is_redelivery(event):
+    """
+    LINEによって再送されたイベントかどうかを判定する関数
+    """
+    delivery_context = getattr(event, 'delivery_context', None)
+    return bool(getattr(delivery_context, 'is_redelivery', False))
+
+
+class EventDeduplicator:
+    """
+    同じWebhookイベントを1度だけ処理するための重複排除
+
+    処理中のイベントと処理済みのイベントを上限付きのインメモリの辞書で管理する。
+    db_pathを指定すると状態をSQLiteにも保存し、再起動後や他のプロセスとも共有する。
+    処理に失敗した場合は登録を取り消し、再送されたイベントで再試行できるようにする。
+
+    キューで待つ処理は、始めるときにstartで登録を更新する。待っている間に
+    in_flight_timeoutが過ぎ、再送されたイベントが改めて登録していた場合は
+    そちらだけが処理するため、同じイベントを2回処理しない。
+
+    Args:
+        max_entries (int): メモリに保持する最大件数
+        ttl (float): 処理済みのイベントを記憶する秒数
+        in_flight_timeout (float): この秒数を過ぎても完了しない（キューで待つ処理は始まらない）処理は中断したとみなす
+        db_path (str): SQLiteファイルのパス（Noneで永続化しない）
+    """
+
+    def __init__(self, max_entries=10000, ttl=24 * 3600, in_flight_timeout=600, db_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.in_flight_timeout = in_flight_timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if db_path:
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            with self._lock:
+                self._conn.execute(
+                    'CREATE TABLE IF NOT EXISTS processed_events ('
+                    'key TEXT PRIMARY KEY, state TEXT NOT NULL, '
+                    'job_id TEXT, updated_at REAL NOT NULL, token TEXT)'
+                )
+                # 登録ごとの識別子の列（以前のファイルには追加する）
+                columns = {row[1] for row in self._conn.execute('PRAGMA table_info(processed_events)')}
+                if 'token' not in columns:
+                    self._conn.execute('ALTER TABLE processed_events ADD COLUMN token TEXT')
+                self._conn.commit()
+
+        # 統計情報
+        self._claimed = 0
+        self._suppressed_in_flight = 0
+        self._suppressed_done = 0
+        self._redeliveries = 0
+        self._released = 0
+        self._superseded = 0
+
+    def claim(self, keys, redelivery=False):
+        """
+        イベントの処理を開始してよいかを確認し、よければ処理中として登録する
+
+        既に処理中の場合は、その処理に重複として紐付ける。
+
+        Args:
+            keys (list): event_keysで取り出したキー
+            redelivery (bool): LINEによる再送かどうか（統計用）
+
+        Returns:
+            tuple: (処理を開始してよいかどうか, 登録済みの情報のdict)
+                （登録した場合は'token'をジョブに渡し、処理を始めるときにstartに渡す）
+        """
+        now = time.time()
+        with self._lock:
+            if redelivery:
+                self._redeliveries += 1
+            for key in keys:
+                entry = self._lookup(key, now)
+                if entry is not None:
+                    entry['duplicates'] += 1
+                    if entry['state'] == IN_FLIGHT:
+                        self._suppressed_in_flight += 1
+                    else:
+                        self._suppressed_done += 1
+                    return False, entry
+
+            entry = {
+                'keys': list(keys),
+                'state': IN_FLIGHT,
+                'job_id': None,
+                'updated_at': now,
+                'duplicates': 0,
+                'token': uuid.uuid4().hex,
+            }
+            if self._conn is not None and not self._insert(keys, now, entry['token']):
+                # 他のプロセスが先に登録した
+                self._suppressed_in_flight += 1
+                return False, dict(entry, duplicates=1)
+
+            for key in keys:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+            self._evict(now)
+            self._claimed += 1
+            return True, entry
+
+    def start(self, keys, token=None):
+        """
+        キューで待っていた処理を始めるときに、処理中の登録の時刻を更新する
+
+        待っている間に登録の期限が切れ、再送されたイベントが改めて登録していた
+        場合は、そちらに処理を任せるためFalseを返す（その場合はcompleteを呼ばない）。
+        登録が残っていない場合は、このtokenで登録し直す。
+
+        Args:
+            keys (list): claimに渡したキー
+            token (str): claimが返した登録の'token'（Noneの場合は確認しない）
+
+        Returns:
+            bool: 処理を始めてよいかどうか
+        """
+        now = time.time()
+        with self._lock:
+            entries = [self._entries[key] for key in keys if key in self._entries]
+            if token is not None and any(entry.get('token') != token for entry in entries):
+                self._superseded += 1
+                return False
+            entry = entries[0] if entries else None
+            if self._conn is not None and not self._refresh(keys, now, token):
+                self._superseded += 1
+                return False
+
+            if entry is None:
+                entry = {'keys': list(keys), 'state': IN_FLIGHT, 'job_id': None, 'duplicates': 0,
+                         'token': token}
+            entry['state'] = IN_FLIGHT
+            entry['updated_at'] = now
+            for key in keys:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+            return True
+
+    def attach_job(self, keys, job_id):
+        """
+        処理中のイベントに実行中のジョブIDを記録する
+        """
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry['job_id'] = job_id
+            if self._conn is not None:
+                self._conn.executemany(
+                    'UPDATE processed_events SET job_id = ? WHERE key = ?',
+                    [(job_id, key) for key in keys]
+                )
+                self._conn.commit()
+
+    def complete(self, keys, success=True):
+        """
+        イベントの処理が終わったことを記録する
+
+        Args:
+            keys (list): claimに渡したキー
+            success (bool): Falseの場合は登録を取り消し、再送で再試行できるようにする
+        """
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.pop(key, None) if not success else self._entries.get(key)
+                if entry is not None:
+                    entry['state'] = DONE if success else None
+                    entry['updated_at'] = now
+            if not success:
+                self._released += 1
+            if self._conn is not None:
+                if success:
+                    self._conn.executemany(
+                        'UPDATE processed_events SET state = ?, updated_at = ? WHERE key = ?',
+                        [(DONE, now, key) for key in keys]
+                    )
+                else:
+                    self._conn.executemany('DELETE FROM processed_events WHERE key = ?',
+                                           [(key,) for key in keys])
+                self._conn.commit()
+
+    def _lookup(self, key, now):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if self._expired(entry['state'], entry['updated_at'], now):
+                del self._entries[key]
+                entry = None
+            else:
+                self._entries.move_to_end(key)
+                return entry
+
+        if self._conn is None:
+            return None
+        row = self._conn.execute(
+            'SELECT state, job_id, updated_at, token FROM processed_events WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        state, job_id, updated_at, token = row
+        if self._expired(state, updated_at, now):
+            self._conn.execute('DELETE FROM processed_events WHERE key = ?', (key,))
+            self._conn.commit()
+            return None
+        return {'keys': [key], 'state': state, 'job_id': job_id, 'updated_at': updated_at,
+                'duplicates': 0, 'token': token}
+
+    def _expired(self, state, updated_at, now):
+        limit = self.in_flight_timeout if state == IN_FLIGHT else self.ttl
+        return now - updated_at > limit
+
+    def _insert(self, keys, now, token):
+        # 期限切れの行は_lookupで削除済みのため、残っていれば他のプロセスが登録した
+        try:
+            with self._conn:
+                for key in keys:
+                    self._conn.execute(
+                        'INSERT INTO processed_events (key, state, job_id, updated_at, token) '
+                        'VALUES (?, ?, NULL, ?, ?)',
+                        (key, IN_FLIGHT, now, token)
+                    )
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def _refresh(self, keys, now, token):
+        # 確認と更新の間に他のプロセスが登録しないよう、書き込みのロックを取ってから確認する
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            for key in keys:
+                row = self._conn.execute(
+                    'SELECT state, updated_at, token FROM processed_events WHERE key = ?', (key,)
+                ).fetchone()
+                if row is None or token is None or row[2] == token:
+                    continue
+                if not self._expired(row[0], row[1], now):
+                    # 他の登録（再送されたイベント）が処理中または処理済み
+                    self._conn.rollback()
+                    return False
+            self._conn.executemany(
+                'INSERT INTO processed_events (key, state, job_id, updated_at, token) VALUES (?, ?, NULL, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at, '
+                'token = COALESCE(excluded.token, token)',
+                [(key, IN_FLIGHT, now, token) for key in keys]
+            )
+            self._conn.commit()
+        except BaseException:
+            self._conn.rollback()
+            raise
+        return True
+
+    def _evict(self, now):
+        # 処理中のものは残し、古い処理済みのものから削除する
+        excess = len(self._entries) - self.max_entries
+        for key in list(self._entries):
+            if excess <= 0:
+                break
+            entry = self._entries[key]
+            if entry['state'] != IN_FLIGHT or self._expired(IN_FLIGHT, entry['updated_at'], now):
+                del self._entries[key]
+                excess -= 1
+        if self._conn is not None:
+            self._conn.execute('DELETE FROM processed_events WHERE state = ? AND updated_at < ?',
+                               (DONE, now - self.ttl))
+            self._conn.commit()
+
+    def stats(self):
+        """
+        重複排除の統計情報を取得する
+
+        Returns:
+            dict: 処理を開始したイベント数、抑止した重複の数など
+        """
+        with self._lock:
+            in_flight = {id(entry) for entry in self._entries.values() if entry['state'] == IN_FLIGHT}
+            return {
+                'tracked_keys': len(self._entries),
+                'in_flight': len(in_flight),
+                'claimed': self._claimed,
+                'suppressed': self._suppressed_in_flight + self._suppressed_done,
+                'suppressed_in_flight': self._suppressed_in_flight,
+                'suppressed_done': self._suppressed_done,
+                'redeliveries': self._redeliveries,
+                'released': self._released,
+                'superseded': self._superseded,
+            }
+
+
+def create_deduplicator():
+    """
+    環境変数の設定から重複排除を作成する関数
+
+    DEDUP_MAX_ENTRIES: メモリに保持する最大件数（デフォルト10000）
+    DEDUP_TTL: 処理済みのイベントを記憶する秒数（デフォルト86400）
+    DEDUP_DB: 指定した場合はSQLiteに状態を保存する
+
+    Returns:
+        EventDeduplicator: 重複排除
+    """
+    return EventDeduplicator(
+        max_entries=int(os.getenv('DEDUP_MAX_ENTRIES', 10000)),
+        ttl=float(os.getenv('DEDUP_TTL', 24 * 3600)),
+        db_path=os.getenv('DEDUP_DB') or None
+    )
+
+
+# プロセス全体で共有する重複排除
+deduplicator = create_deduplicator()
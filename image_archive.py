@@ -0,0 +1,419 @@
+import io
+import os
+import mmap
+import time
+import struct
+import sqlite3
+import hashlib
+import logging
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:  # Windowsではプロセス間のロックを使わない
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# アーカイブに保存した画像のパスの接頭辞（archive://<SHA-256><拡張子>）
+ARCHIVE_SCHEME = 'archive://'
+
+# セグメント内の各画像の前に置くヘッダー（識別子・サイズ・SHA-256）
+ENTRY_MAGIC = b'LIMG'
+ENTRY_HEADER = struct.Struct('<4sI32s')
+
+
+def archive_path(sha256, extension='.jpg'):
+    """
+    アーカイブに保存した画像のパスを作成する関数
+    """
+    return f'{ARCHIVE_SCHEME}{sha256}{extension}'
+
+
+def parse_archive_path(path):
+    """
+    アーカイブのパスからSHA-256を取り出す関数
+
+    Returns:
+        str: SHA-256の16進数表記（アーカイブのパスでない場合はNone）
+    """
+    if not path or not path.startswith(ARCHIVE_SCHEME):
+        return None
+    return os.path.splitext(path[len(ARCHIVE_SCHEME):])[0]
+
+
+class ArchiveReader(io.RawIOBase):
+    """
+    memoryviewをファイルとして読み込むクラス
+
+    io.BytesIOと違い元のバッファーをコピーしないため、mmapした
+    セグメントの一部をそのままPIL.Image.openなどに渡せる。
+
+    Args:
+        view (memoryview): 読み込むバッファー
+    """
+
+    def __init__(self, view):
+        self._view = view
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        end = min(len(self._view), self._position + len(buffer))
+        count = end - self._position
+        buffer[:count] = self._view[self._position:end]
+        self._position = end
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        self._view.release()
+        super().close()
+
+
+class SegmentArchive:
+    """
+    画像を大きなセグメントファイルに追記して保存するアーカイブ
+
+    画像はSHA-256で重複を除き、セグメント（segment-000001.pack など）の末尾に
+    ヘッダーと一緒に追記する。位置はSQLiteのインデックス（SHA-256 → セグメント・
+    オフセット・サイズ）に記録し、読み込みはセグメントをmmapしてコピーせずに返す。
+
+    追記はプロセス間のファイルロックの中で行うため、gunicornの複数のワーカーが
+    同じアーカイブに書き込んでもセグメントが壊れない。
+    セグメントはsegment_max_bytesを超えると次のファイルに切り替える。
+    削除した画像の領域はセグメント内の画像が全て削除されるまで解放されない。
+
+    Args:
+        root (str): セグメントとインデックスを置くディレクトリ
+        segment_max_bytes (int): 1つのセグメントの最大サイズ
+        fsync (bool): 追記のたびにディスクへの書き込みを待つか
+    """
+
+    def __init__(self, root, segment_max_bytes=256 * 1024 * 1024, fsync=False):
+        self.root = root
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._maps = {}
+        self._active = None
+        self._stats = {'puts': 0, 'deduplicated': 0, 'reads': 0, 'remaps': 0, 'written_bytes': 0}
+        os.makedirs(root, exist_ok=True)
+        self._lock_file = open(os.path.join(root, 'archive.lock'), 'a') if fcntl is not None else None
+        self._conn = sqlite3.connect(os.path.join(root, 'index.sqlite3'), check_same_thread=False)
+        with self._lock:
+            # 1枚ごとのコミットを軽くする（fsyncしない場合は停止時に直前の登録が失われても
+            # セグメントのヘッダーからrebuild_indexで復元できる）
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            if not fsync:
+                self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS blobs ('
+                'sha256 TEXT PRIMARY KEY, segment INTEGER NOT NULL, offset INTEGER NOT NULL, '
+                'size INTEGER NOT NULL, created_at REAL NOT NULL)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS blobs_segment ON blobs (segment)')
+            self._conn.commit()
+
+    def segment_path(self, segment):
+        return os.path.join(self.root, f'segment-{segment:06d}.pack')
+
+    def segments(self):
+        """
+        存在するセグメントの番号を昇順で返す
+        """
+        numbers = []
+        for name in os.listdir(self.root):
+            if name.startswith('segment-') and name.endswith('.pack'):
+                numbers.append(int(name[len('segment-'):-len('.pack')]))
+        return sorted(numbers)
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        # 他のプロセスの追記と重ならないようにする
+        if self._lock_file is None:
+            yield
+            return
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _active_file(self, size):
+        """
+        追記先のセグメントを開く（ロックの中で呼び出す）
+
+        他のプロセスが次のセグメントに切り替えている場合もあるため、
+        毎回ディレクトリの最新のセグメントを確認する。
+        """
+        segments = self.segments()
+        segment = segments[-1] if segments else 1
+        path = self.segment_path(segment)
+        current = os.path.getsize(path) if os.path.exists(path) else 0
+        if current and current + ENTRY_HEADER.size + size > self.segment_max_bytes:
+            segment += 1
+            path = self.segment_path(segment)
+        if self._active is None or self._active[0] != segment:
+            if self._active is not None:
+                self._active[1].close()
+            self._active = (segment, open(path, 'ab'))
+        return self._active
+
+    def put(self, data, sha256=None):
+        """
+        画像を追記する（同じ内容の画像が保存済みの場合は追記しない）
+
+        Args:
+            data (bytes): 画像のバイト列
+            sha256 (str): 画像のSHA-256（省略時は計算する）
+
+        Returns:
+            tuple: (SHA-256の16進数表記, 保存済みの画像と重複していたか)
+        """
+        sha256 = sha256 or hashlib.sha256(data).hexdigest()
+        with self._lock, self._file_lock():
+            self._stats['puts'] += 1
+            if self._conn.execute('SELECT 1 FROM blobs WHERE sha256 = ?', (sha256,)).fetchone():
+                self._stats['deduplicated'] += 1
+                return sha256, True
+
+            segment, f = self._active_file(len(data))
+            f.seek(0, os.SEEK_END)
+            offset = f.tell() + ENTRY_HEADER.size
+            f.write(ENTRY_HEADER.pack(ENTRY_MAGIC, len(data), bytes.fromhex(sha256)))
+            f.write(data)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+            # 追記が終わってからインデックスに登録する（途中で停止しても壊れた画像は参照されない）
+            self._conn.execute(
+                'INSERT INTO blobs (sha256, segment, offset, size, created_at) VALUES (?, ?, ?, ?, ?)',
+                (sha256, segment, offset, len(data), time.time())
+            )
+            self._conn.commit()
+            self._stats['written_bytes'] += len(data)
+        return sha256, False
+
+    def locate(self, sha256):
+        """
+        画像の位置を取得する
+
+        Returns:
+            tuple: (セグメント, オフセット, サイズ)（見つからない場合はNone）
+        """
+        with self._lock:
+            return self._conn.execute(
+                'SELECT segment, offset, size FROM blobs WHERE sha256 = ?', (sha256,)
+            ).fetchone()
+
+    def _map(self, segment, end):
+        """
+        セグメントのmmapを取得する
+
+        追記中のセグメントはmmapした後に伸びるため、読み込む範囲が
+        mmapの外にある場合は開き直す（古いmmapは参照がなくなると閉じられる）。
+        """
+        with self._lock:
+            mapped = self._maps.get(segment)
+            if mapped is None or len(mapped) < end:
+                with open(self.segment_path(segment), 'rb') as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[segment] = mapped
+                self._stats['remaps'] += 1
+            self._stats['reads'] += 1
+            return mapped
+
+    def view(self, sha256):
+        """
+        画像をコピーせずに読み込む
+
+        返すmemoryviewはセグメントのmmapを参照する。使い終わったらrelease()する。
+
+        Returns:
+            memoryview: 画像のバイト列（見つからない場合はNone）
+        """
+        location = self.locate(sha256)
+        if location is None:
+            return None
+        segment, offset, size = location
+        return memoryview(self._map(segment, offset + size))[offset:offset + size]
+
+    def read(self, sha256):
+        """
+        画像をbytesとして読み込む
+
+        Returns:
+            bytes: 画像のバイト列（見つからない場合はNone）
+        """
+        view = self.view(sha256)
+        if view is None:
+            return None
+        with view:
+            return bytes(view)
+
+    def open(self, sha256):
+        """
+        画像をファイルとして開く（コピーせずにmmapから読み込む）
+
+        Returns:
+            ArchiveReader: 読み込み用のファイル（見つからない場合はNone）
+        """
+        view = self.view(sha256)
+        return ArchiveReader(view) if view is not None else None
+
+    def delete(self, sha256s):
+        """
+        画像をインデックスから削除し、全ての画像が削除されたセグメントを消す
+
+        追記中のセグメントは消さない。
+
+        Args:
+            sha256s (list): 削除する画像のSHA-256
+
+        Returns:
+            int: 消したセグメントの合計サイズ
+        """
+        freed = 0
+        with self._lock, self._file_lock():
+            segments = set()
+            for sha256 in sha256s:
+                row = self._conn.execute('SELECT segment FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()
+                if row:
+                    segments.add(row[0])
+                    self._conn.execute('DELETE FROM blobs WHERE sha256 = ?', (sha256,))
+            self._conn.commit()
+
+            existing = self.segments()
+            active = existing[-1] if existing else None
+            for segment in sorted(segments):
+                if segment == active:
+                    continue
+                if self._conn.execute('SELECT 1 FROM blobs WHERE segment = ? LIMIT 1', (segment,)).fetchone():
+                    continue
+                path = self.segment_path(segment)
+                if os.path.exists(path):
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+                # mmapは参照しているmemoryviewがなくなると閉じられる
+                self._maps.pop(segment, None)
+        if freed:
+            logger.info(f"画像が全て削除されたセグメントを消しました（{freed}バイト）。")
+        return freed
+
+    def scan(self, segment):
+        """
+        セグメントのヘッダーを順に読み、保存されている画像を列挙する
+
+        インデックスを作り直す場合や検証に使う。途中で切れた画像があればそこで終わる。
+
+        Yields:
+            tuple: (SHA-256, オフセット, サイズ)
+        """
+        path = self.segment_path(segment)
+        total = os.path.getsize(path)
+        if not total:
+            return
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with mapped:
+            position = 0
+            while position + ENTRY_HEADER.size <= total:
+                magic, size, digest = ENTRY_HEADER.unpack_from(mapped, position)
+                offset = position + ENTRY_HEADER.size
+                if magic != ENTRY_MAGIC or offset + size > total:
+                    logger.warning(f"{path}の{position}バイト目以降を読み込めませんでした。")
+                    return
+                yield digest.hex(), offset, size
+                position = offset + size
+
+    def rebuild_index(self):
+        """
+        セグメントを読み直してインデックスを作り直す
+
+        Returns:
+            int: 登録した画像の数
+        """
+        count = 0
+        with self._lock, self._file_lock():
+            self._conn.execute('DELETE FROM blobs')
+            for segment in self.segments():
+                for sha256, offset, size in self.scan(segment):
+                    self._conn.execute(
+                        'INSERT OR IGNORE INTO blobs (sha256, segment, offset, size, created_at) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (sha256, segment, offset, size, os.path.getmtime(self.segment_path(segment)))
+                    )
+                    count += 1
+            self._conn.commit()
+        return count
+
+    def verify(self):
+        """
+        インデックスに登録された全ての画像のSHA-256を確かめる
+
+        Returns:
+            list: 内容が一致しなかった画像のSHA-256
+        """
+        with self._lock:
+            sha256s = [row[0] for row in self._conn.execute('SELECT sha256 FROM blobs')]
+        broken = []
+        for sha256 in sha256s:
+            try:
+                view = self.view(sha256)
+            except (OSError, ValueError):
+                view = None
+            if view is None:
+                broken.append(sha256)
+                continue
+            with view:
+                if hashlib.sha256(view).hexdigest() != sha256:
+                    broken.append(sha256)
+        return broken
+
+    def stats(self):
+        """
+        アーカイブの統計情報を返す
+        """
+        with self._lock:
+            blobs, live_bytes = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs').fetchone()
+            stats = dict(self._stats)
+        segments = self.segments()
+        segment_bytes = sum(os.path.getsize(self.segment_path(segment)) for segment in segments)
+        stats.update(
+            segments=len(segments),
+            blobs=blobs,
+            live_bytes=live_bytes,
+            segment_bytes=segment_bytes,
+            # 削除された画像やヘッダーを含めた、セグメントのうち画像でない部分の割合
+            overhead_ratio=round(1 - live_bytes / segment_bytes, 4) if segment_bytes else 0.0,
+        )
+        return stats
+
+    def close(self):
+        with self._lock:
+            if self._active is not None:
+                self._active[1].close()
+                self._active = None
+            self._maps.clear()
+            self._conn.close()
+            if self._lock_file is not None:
+                self._lock_file.close()
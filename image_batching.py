@@ -0,0 +1,193 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import table_extraction
+import table_parser
+from ocr_cache import extract_table_cached
+
+logger = logging.getLogger(__name__)
+
+# 複数の画像の抽出方法（'multi': 1回の呼び出しで全ての画像を送る, 'fanout': 画像ごとに並列で呼び出す）
+BATCH_MODE = os.getenv('IMAGE_BATCH_MODE', 'multi')
+
+# fanoutで同時に抽出する画像の数
+BATCH_PARALLELISM = int(os.getenv('IMAGE_BATCH_PARALLELISM', 4))
+
+# 画像セットの残りの画像を待つ秒数（最後の画像が届いてから）
+SET_TIMEOUT = float(os.getenv('IMAGE_SET_TIMEOUT', 10))
+
+# 画像セットでない画像を同じユーザーの画像とまとめるために待つ秒数（0でまとめない）
+USER_WINDOW = float(os.getenv('IMAGE_BATCH_WINDOW', 0))
+
+
+class ImageBatcher:
+    """
+    同じ画像セット（またはユーザー）の画像を集めてからまとめて処理に回す
+
+    LINEで複数の画像をまとめて送ると、画像ごとに別のイベントとして届く。
+    画像セット（imageSet）の画像は全て揃うか、最後の画像からwindow秒経つまで待ち、
+    集まった画像をon_batchに渡す。
+
+    Args:
+        on_batch: (キー, 画像のdictのリスト) を受け取る関数
+        max_images (int): 1つのまとまりの最大の画像数（超えた分は次のまとまりにする）
+    """
+
+    def __init__(self, on_batch, max_images=10):
+        self.on_batch = on_batch
+        self.max_images = max_images
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        # 統計情報
+        self._batches = 0
+        self._images = 0
+        self._expired = 0
+
+    def add(self, key, item, window, total=None):
+        """
+        画像をまとまりに追加する
+
+        Args:
+            key (str): まとめる単位のキー（'set:<画像セットID>' など）
+            item (dict): 画像の情報（'index'があればその順に並べる）
+            window (float): 次の画像を待つ秒数
+            total (int): まとまりの画像の総数（分かる場合）
+        """
+        with self._lock:
+            batch = self._pending.get(key)
+            if batch is None:
+                batch = self._pending[key] = {'items': [], 'total': total, 'timer': None}
+            batch['items'].append(item)
+            if total:
+                batch['total'] = total
+            if batch['timer'] is not None:
+                batch['timer'].cancel()
+                batch['timer'] = None
+
+            full = len(batch['items']) >= min(batch['total'] or self.max_images, self.max_images)
+            if full:
+                del self._pending[key]
+            else:
+                batch['timer'] = threading.Timer(window, self._expire, (key, batch))
+                batch['timer'].daemon = True
+                batch['timer'].start()
+
+        if full:
+            self._emit(key, batch)
+
+    def flush(self):
+        """
+        待っている全てのまとまりをすぐに処理に回す（停止時など）
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for key, batch in pending.items():
+            if batch['timer'] is not None:
+                batch['timer'].cancel()
+            self._emit(key, batch)
+
+    def _expire(self, key, batch):
+        with self._lock:
+            if self._pending.get(key) is not batch:
+                return
+            del self._pending[key]
+            if batch['total'] and len(batch['items']) < batch['total']:
+                self._expired += 1
+        logger.info(f"画像の待ち時間が過ぎたため、{len(batch['items'])}枚で処理します: {key}")
+        self._emit(key, batch)
+
+    def _emit(self, key, batch):
+        items = sorted(batch['items'], key=lambda item: item.get('index') or 0)
+        with self._lock:
+            self._batches += 1
+            self._images += len(items)
+        try:
+            self.on_batch(key, items)
+        except Exception as e:
+            logger.error(f"画像のまとまりの処理の開始に失敗しました: {key}: {str(e)}")
+
+    def stats(self):
+        """
+        まとめ処理の統計情報を取得する
+
+        Returns:
+            dict: 待っているまとまりの数、処理に回したまとまり・画像の数など
+        """
+        with self._lock:
+            return {
+                'pending_batches': len(self._pending),
+                'pending_images': sum(len(batch['items']) for batch in self._pending.values()),
+                'batches': self._batches,
+                'images': self._images,
+                'images_per_batch': self._images / self._batches if self._batches else 0.0,
+                'expired_incomplete_sets': self._expired,
+            }
+
+
+def create_image_batcher(on_batch):
+    """
+    環境変数の設定から画像のまとめ処理を作成する関数
+
+    IMAGE_BATCH_MAX: 1つのまとまりの最大の画像数（デフォルト10）
+
+    Args:
+        on_batch: (キー, 画像のdictのリスト) を受け取る関数
+
+    Returns:
+        ImageBatcher: 画像のまとめ処理
+    """
+    return ImageBatcher(on_batch, max_images=int(os.getenv('IMAGE_BATCH_MAX', 10)))
+
+
+def extract_table_batch(images_data, mode=None, parallelism=None, details=None, user_id=None):
+    """
+    複数の画像から1つの表を抽出する関数
+
+    multiモードでは全ての画像を1回のモデル呼び出しで送り、検証に失敗した場合は
+    画像ごとの抽出（fanout）にフォールバックする。fanoutでは画像ごとにOCRキャッシュを
+    参照しながら並列に抽出し、得られた表をまとめる。
+
+    Args:
+        images_data (list): 前処理済みの画像のバイト列のリスト（ページ順）
+        mode (str): 'multi' または 'fanout'（省略時はIMAGE_BATCH_MODE）
+        parallelism (int): fanoutで同時に抽出する画像の数（省略時はIMAGE_BATCH_PARALLELISM）
+        details (dict): 指定した場合はモデルの出力を'raw_text'に、
+            抽出に失敗した画像の数を'failed_images'に格納する
+        user_id (str): 送信したユーザーのID（OCRキャッシュの類似画像の照合に使う）
+
+    Returns:
+        list: 表形式のデータ（2次元リスト）。全ての画像で失敗した場合はNone
+    """
+    mode = mode or BATCH_MODE
+    parallelism = parallelism or BATCH_PARALLELISM
+    if details is not None:
+        details['failed_images'] = 0
+    if len(images_data) == 1:
+        table_data = extract_table_cached(images_data[0], details=details, user_id=user_id)
+        if details is not None and not table_data:
+            details['failed_images'] = 1
+        return table_data
+
+    if mode == 'multi':
+        try:
+            images = [table_extraction.image_part(data) for data in images_data]
+            table_data = table_extraction.extract_table_multi(images, details=details)
+            if table_data:
+                return table_data
+            logger.info("複数画像の構造化出力の検証に失敗したため、画像ごとに抽出します。")
+        except Exception as e:
+            logger.error(f"複数画像の抽出中にエラーが発生しました。画像ごとに抽出します: {str(e)}")
+
+    per_image = [{} for _ in images_data]
+    with ThreadPoolExecutor(max_workers=min(parallelism, len(images_data))) as executor:
+        tables = list(executor.map(
+            lambda args: extract_table_cached(args[0], details=args[1], user_id=user_id),
+            zip(images_data, per_image)))
+
+    if details is not None:
+        details['failed_images'] = sum(1 for table in tables if not table)
+        details['raw_text'] = '\n\n'.join(d.get('raw_text', '') for d in per_image if d.get('raw_text'))
+    return table_parser.merge_tables(tables)
@@ -0,0 +1,208 @@
+import os
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+
+from metrics import span
+import text_prefilter
+
+# 保存形式ごとの拡張子
+EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp'}
+
+
+def load_options():
+    """
+    環境変数から前処理の設定を読み込む関数
+
+    PREPROCESS_ENABLED: 前処理を行うかどうか（デフォルト1）
+    PREPROCESS_MAX_DIMENSION: 長辺の最大ピクセル数（デフォルト2048）
+    PREPROCESS_DOCUMENT_MODE: グレースケール化とコントラスト補正を行うかどうか（デフォルト1）
+    PREPROCESS_FORMAT: 'JPEG' または 'WEBP'（デフォルト'JPEG'）
+    PREPROCESS_QUALITY: 圧縮品質（デフォルト85）
+    PREPROCESS_TARGET_BYTES: 指定した場合はこのサイズ以下になるよう品質を下げる（デフォルト0=無効）
+    PREPROCESS_MIN_QUALITY: 品質を下げる場合の下限（デフォルト50）
+    PREPROCESS_TALL_MAX_DIMENSION: 縦長・横長の画像の長辺の最大ピクセル数
+        （デフォルトはOCR_TILINGが有効なら8192、無効なら0=max_dimensionと同じ）
+    PREPROCESS_TALL_ASPECT: 長辺と短辺の比がこれ以上の画像を縦長・横長とみなす（デフォルト1.8）
+    TEXT_PREFILTER: 'off'以外の場合は文字の有無の判定に使う特徴量も求める（text_prefilterを参照）
+
+    Returns:
+        dict: 前処理の設定
+    """
+    return {
+        'enabled': os.getenv('PREPROCESS_ENABLED', '1') == '1',
+        'max_dimension': int(os.getenv('PREPROCESS_MAX_DIMENSION', 2048)),
+        'document_mode': os.getenv('PREPROCESS_DOCUMENT_MODE', '1') == '1',
+        'format': os.getenv('PREPROCESS_FORMAT', 'JPEG').upper(),
+        'quality': int(os.getenv('PREPROCESS_QUALITY', 85)),
+        'target_bytes': int(os.getenv('PREPROCESS_TARGET_BYTES', 0)),
+        'min_quality': int(os.getenv('PREPROCESS_MIN_QUALITY', 50)),
+        # 帯に分けて読み取る場合は、長いレシートの文字を潰さないよう長辺を縮小しすぎない
+        'tall_max_dimension': int(os.getenv('PREPROCESS_TALL_MAX_DIMENSION',
+                                            8192 if os.getenv('OCR_TILING', 'off') != 'off' else 0)),
+        'tall_aspect': float(os.getenv('PREPROCESS_TALL_ASPECT', 1.8)),
+        # 文字の有無の判定を行う場合は、デコード済みの画像から特徴量を求めておく
+        'text_features': os.getenv('TEXT_PREFILTER', 'off') != 'off',
+    }
+
+
+OPTIONS = load_options()
+
+
+def encode_image(image, image_format, quality):
+    """
+    画像を指定した形式・品質でエンコードする関数
+    """
+    buffer = io.BytesIO()
+    if image_format == 'WEBP':
+        image.save(buffer, 'WEBP', quality=quality, method=4)
+    else:
+        image.save(buffer, 'JPEG', quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def encode_with_target(image, options):
+    """
+    目標サイズ以下に収まる最も高い品質でエンコードする関数（二分探索）
+    """
+    data = encode_image(image, options['format'], options['quality'])
+    target = options['target_bytes']
+    if not target or len(data) <= target:
+        return data, options['quality']
+
+    low, high = options['min_quality'], options['quality'] - 1
+    best, best_quality = None, low
+    while low <= high:
+        quality = (low + high) // 2
+        candidate = encode_image(image, options['format'], quality)
+        if len(candidate) <= target:
+            best, best_quality = candidate, quality
+            low = quality + 1
+        else:
+            high = quality - 1
+
+    if best is None:
+        # 下限の品質でも収まらない場合は下限の品質を使う
+        return encode_image(image, options['format'], options['min_quality']), options['min_quality']
+    return best, best_quality
+
+
+def read_source(source):
+    """
+    バイト列またはファイルパスから画像のバイト列を取得する関数
+    """
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    with open(source, 'rb') as f:
+        return f.read()
+
+
+def thumbnail_box(size, options):
+    """
+    縮小後の画像が収まる大きさを求める関数
+
+    縦長・横長の画像は短辺をmax_dimension以下、長辺をtall_max_dimension以下にする。
+    それ以外の画像は長辺をmax_dimension以下にする。
+
+    Args:
+        size (tuple): 画像の (幅, 高さ)
+        options (dict): 前処理の設定
+
+    Returns:
+        tuple: (幅, 高さ) の上限
+    """
+    max_dimension = options['max_dimension']
+    tall_max_dimension = options.get('tall_max_dimension', 0)
+    width, height = size
+    if tall_max_dimension <= max_dimension or max(size) < min(size) * options.get('tall_aspect', 1.8):
+        return max_dimension, max_dimension
+    if height > width:
+        return max_dimension, tall_max_dimension
+    return tall_max_dimension, max_dimension
+
+
+def preprocess_image(source, options=None):
+    """
+    モデルに送る前に画像を縮小・補正・再圧縮する関数
+
+    EXIFの回転情報を反映し、長辺をmax_dimension以下に縮小する
+    （縦長・横長の画像はthumbnail_boxを参照）。
+    document_modeではグレースケール化とコントラスト補正を行う。
+    ファイルパスを渡した場合は元の画像全体をメモリに読み込まずに処理する。
+
+    Args:
+        source (bytes or str): 元の画像のバイト列またはファイルパス
+        options (dict): 前処理の設定（省略時は環境変数の設定）
+
+    Returns:
+        tuple: (処理後のバイト列, 拡張子, 統計情報のdict)
+    """
+    options = options or OPTIONS
+    started = time.perf_counter()
+    if isinstance(source, (bytes, bytearray)):
+        original_bytes = len(source)
+        opened = Image.open(io.BytesIO(source))
+    else:
+        original_bytes = os.path.getsize(source)
+        opened = Image.open(source)
+
+    with opened:
+        original_format = opened.format
+        stats = {
+            'original_bytes': original_bytes,
+            'original_size': opened.size,
+        }
+
+        if not options['enabled']:
+            data = read_source(source)
+            stats.update(processed_bytes=len(data), processed_size=opened.size,
+                         quality=None, seconds=time.perf_counter() - started)
+            return data, EXTENSIONS.get(original_format, '.jpg'), stats
+
+        # 先に縮小してから回転させ、原寸の画像のコピーを作らない
+        # （JPEGはthumbnail内で縮小デコードされる）
+        opened.thumbnail(thumbnail_box(opened.size, options), Image.LANCZOS)
+        image = ImageOps.exif_transpose(opened)
+
+    if options['document_mode']:
+        image = ImageOps.autocontrast(image.convert('L'), cutoff=1)
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    # 判定のために画像をデコードし直さないよう、ここで特徴量を求める
+    if options.get('text_features'):
+        with span('prefilter'):
+            stats['text_features'] = text_prefilter.analyze(image)
+
+    processed, quality = encode_with_target(image, options)
+    extension = EXTENSIONS.get(options['format'], '.jpg')
+
+    # 再圧縮で大きくなった場合は元の画像を使う
+    if len(processed) >= original_bytes and original_format == options['format']:
+        processed, quality, extension = read_source(source), None, EXTENSIONS.get(original_format, '.jpg')
+
+    stats.update(processed_bytes=len(processed), processed_size=image.size,
+                 quality=quality, seconds=time.perf_counter() - started)
+    return processed, extension, stats
+
+
+# 画像処理はCPUを使うため、ジョブのワーカー数とは別に同時実行数を制限する
+executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('PREPROCESS_WORKERS', os.cpu_count() or 2)),
+    thread_name_prefix='preprocess'
+)
+
+
+def preprocess_image_async(source, options=None):
+    """
+    スレッドプールで画像の前処理を行う関数
+
+    Args:
+        source (bytes or str): 元の画像のバイト列またはファイルパス
+        options (dict): 前処理の設定（省略時は環境変数の設定）
+
+    Returns:
+        concurrent.futures.Future: preprocess_imageの戻り値が設定される
+    """
+    return executor.submit(preprocess_image, source, options)
@@ -0,0 +1,336 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+from image_archive import SegmentArchive, archive_path, parse_archive_path
+
+logger = logging.getLogger(__name__)
+
+
+class ImageStore:
+    """
+    LINEのメッセージIDをキーに画像を保存する画像ストア
+
+    画像はメッセージIDのハッシュで分散したサブディレクトリ（例: ab/cd/）に保存し、
+    SQLiteのインデックスでメッセージID・ユーザーID・日時から検索する。
+    archiveを指定した場合は、画像を1枚ずつのファイルにせずアーカイブのセグメントに追記し、
+    パスには archive://<SHA-256><拡張子> を記録する（同じ内容の画像は1つだけ保存する）。
+
+    Args:
+        root (str): 保存先のディレクトリ
+        max_age_days (float): この日数より古い画像を削除する（Noneで無効）
+        max_total_bytes (int): 合計サイズがこれを超えたら古い画像から削除する（Noneで無効）
+        retention_interval (float): 保持期間の確認を行う最短間隔（秒）
+        archive (image_archive.SegmentArchive): 画像を追記するアーカイブ（Noneで1枚ずつのファイルに保存）
+    """
+
+    def __init__(self, root='saved_images', max_age_days=None, max_total_bytes=None, retention_interval=600,
+                 archive=None):
+        self.root = root
+        self.archive = archive
+        self.max_age_days = max_age_days
+        self.max_total_bytes = max_total_bytes
+        self.retention_interval = retention_interval
+        self._last_retention = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, '.incoming'), exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(root, 'index.sqlite3'), check_same_thread=False)
+        with self._lock:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS images ('
+                'message_id TEXT PRIMARY KEY, user_id TEXT, created_at REAL NOT NULL, '
+                'path TEXT NOT NULL, size INTEGER NOT NULL, sha256 TEXT)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS images_user ON images (user_id, created_at)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS images_created ON images (created_at)')
+            self._conn.commit()
+
+    def path_for(self, message_id, extension='.jpg'):
+        """
+        メッセージIDから保存先のパスを求める
+
+        1つのディレクトリに大量のファイルが溜まらないよう、
+        ハッシュの先頭4文字で2階層に分散する。
+        """
+        digest = hashlib.sha1(message_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, digest[:2], digest[2:4], f'{message_id}{extension}')
+
+    def incoming_path(self, message_id):
+        """
+        ダウンロード中の画像を一時的に置くパスを求める
+        """
+        return os.path.join(self.root, '.incoming', message_id)
+
+    def put(self, message_id, data, user_id=None, extension='.jpg', sha256=None):
+        """
+        画像を保存してインデックスに登録する
+
+        Args:
+            message_id (str): LINEのメッセージID
+            data (bytes): 画像のバイト列
+            user_id (str): 送信したユーザーのID
+            extension (str): 拡張子
+            sha256 (str): 画像のSHA-256（省略時は計算する）
+
+        Returns:
+            str: 保存したファイルのパス（アーカイブの場合は archive://<SHA-256><拡張子>）
+        """
+        sha256 = sha256 or hashlib.sha256(data).hexdigest()
+        if self.archive is not None:
+            self.archive.put(data, sha256)
+            path = archive_path(sha256, extension)
+        else:
+            path = self.path_for(message_id, extension)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            part_path = path + '.part'
+            with open(part_path, 'wb') as f:
+                f.write(data)
+            os.replace(part_path, path)
+
+        self._register(message_id, user_id, time.time(), path, len(data), sha256)
+        self.maybe_enforce_retention()
+        return path
+
+    def _register(self, message_id, user_id, created_at, path, size, sha256):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO images (message_id, user_id, created_at, path, size, sha256) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (message_id, user_id, created_at, path, size, sha256)
+            )
+            self._conn.commit()
+
+    def source(self, path):
+        """
+        画像を読み込める形で返す
+
+        ファイルに保存した画像はそのままパスを、アーカイブに保存した画像はバイト列を返す
+        （どちらもpreprocess_imageなどにそのまま渡せる）。
+
+        Args:
+            path (str): putが返したパス
+
+        Returns:
+            str or bytes: ファイルのパスまたは画像のバイト列
+
+        Raises:
+            FileNotFoundError: アーカイブに画像が見つからない場合
+        """
+        sha256 = parse_archive_path(path)
+        if sha256 is None:
+            return path
+        data = self.archive.read(sha256) if self.archive is not None else None
+        if data is None:
+            raise FileNotFoundError(f"アーカイブに画像が見つかりません: {path}")
+        return data
+
+    def open(self, path):
+        """
+        画像をファイルとして開く（アーカイブの画像はmmapからコピーせずに読み込む）
+
+        Raises:
+            FileNotFoundError: 画像が見つからない場合
+        """
+        sha256 = parse_archive_path(path)
+        if sha256 is None:
+            return open(path, 'rb')
+        reader = self.archive.open(sha256) if self.archive is not None else None
+        if reader is None:
+            raise FileNotFoundError(f"アーカイブに画像が見つかりません: {path}")
+        return reader
+
+    def pack_file(self, file_path, message_id, user_id=None, created_at=None, keep_file=False):
+        """
+        1枚ずつのファイルに保存した画像をアーカイブに移す
+
+        インデックスの登録を書き換えてからファイルを削除するため、途中で停止しても
+        画像は必ずどちらかに残る。
+
+        Args:
+            file_path (str): 画像ファイルのパス
+            message_id (str): インデックスに登録するメッセージID
+            user_id (str): 送信したユーザーのID
+            created_at (float): 保存した日時（省略時はファイルの更新日時）
+            keep_file (bool): 移した後もファイルを残すか
+
+        Returns:
+            tuple: (アーカイブのパス, 保存済みの画像と重複していたか)
+        """
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        sha256, deduplicated = self.archive.put(data)
+        path = archive_path(sha256, os.path.splitext(file_path)[1] or '.jpg')
+        if created_at is None:
+            created_at = os.path.getmtime(file_path)
+        self._register(message_id, user_id, created_at, path, len(data), sha256)
+        if not keep_file:
+            os.remove(file_path)
+        return path, deduplicated
+
+    def records(self):
+        """
+        登録されている全ての画像の情報を古い順に返す
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT message_id, user_id, created_at, path, size, sha256 FROM images ORDER BY created_at'
+            ).fetchall()
+        return [self._to_record(row) for row in rows]
+
+    def get(self, message_id):
+        """
+        メッセージIDから画像の情報を取得する
+
+        Returns:
+            dict: 画像の情報（見つからない場合はNone）
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT message_id, user_id, created_at, path, size, sha256 FROM images WHERE message_id = ?',
+                (message_id,)
+            ).fetchone()
+        return self._to_record(row)
+
+    def latest(self, user_id=None):
+        """
+        最も新しい画像の情報を取得する
+
+        Args:
+            user_id (str): 指定した場合はそのユーザーの画像に限定する
+
+        Returns:
+            dict: 画像の情報（見つからない場合はNone）
+        """
+        query = 'SELECT message_id, user_id, created_at, path, size, sha256 FROM images'
+        params = ()
+        if user_id:
+            query += ' WHERE user_id = ?'
+            params = (user_id,)
+        with self._lock:
+            row = self._conn.execute(query + ' ORDER BY created_at DESC LIMIT 1', params).fetchone()
+        return self._to_record(row)
+
+    def maybe_enforce_retention(self):
+        """
+        前回の確認からretention_interval秒以上経っていれば保持期間を確認する
+        """
+        if not self.max_age_days and not self.max_total_bytes:
+            return 0
+        now = time.time()
+        if now - self._last_retention < self.retention_interval:
+            return 0
+        self._last_retention = now
+        return self.enforce_retention()
+
+    def enforce_retention(self):
+        """
+        保持期間・合計サイズの上限を超えた画像を古いものから削除する
+
+        Returns:
+            int: 削除した画像の数
+        """
+        with self._lock:
+            expired = []
+            if self.max_age_days:
+                cutoff = time.time() - self.max_age_days * 24 * 3600
+                expired += self._conn.execute(
+                    'SELECT message_id, path, size FROM images WHERE created_at < ?', (cutoff,)
+                ).fetchall()
+
+            if self.max_total_bytes:
+                total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM images').fetchone()[0]
+                total -= sum(size for _, _, size in expired)
+                expired_ids = {message_id for message_id, _, _ in expired}
+                for message_id, path, size in self._conn.execute(
+                        'SELECT message_id, path, size FROM images ORDER BY created_at'):
+                    if total <= self.max_total_bytes:
+                        break
+                    if message_id not in expired_ids:
+                        expired.append((message_id, path, size))
+                        total -= size
+
+            archived = set()
+            for message_id, path, _ in expired:
+                sha256 = parse_archive_path(path)
+                if sha256 is not None:
+                    archived.add(sha256)
+                elif os.path.exists(path):
+                    os.remove(path)
+                self._conn.execute('DELETE FROM images WHERE message_id = ?', (message_id,))
+            self._conn.commit()
+
+            # 同じ内容の画像を他のメッセージが参照していなければアーカイブからも削除する
+            unreferenced = [sha256 for sha256 in archived if not self._conn.execute(
+                "SELECT 1 FROM images WHERE sha256 = ? AND path LIKE 'archive://%' LIMIT 1", (sha256,)
+            ).fetchone()]
+
+        if unreferenced and self.archive is not None:
+            self.archive.delete(unreferenced)
+
+        if expired:
+            logger.info(f"保持期間を過ぎた画像を{len(expired)}件削除しました。")
+        return len(expired)
+
+    def stats(self):
+        """
+        保存している画像の統計情報を返す
+        """
+        with self._lock:
+            images, total_bytes = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images').fetchone()
+        stats = {'backend': 'packed' if self.archive is not None else 'files',
+                 'images': images, 'total_bytes': total_bytes}
+        if self.archive is not None:
+            stats['archive'] = self.archive.stats()
+        return stats
+
+    def _to_record(self, row):
+        if row is None:
+            return None
+        message_id, user_id, created_at, path, size, sha256 = row
+        return {
+            'message_id': message_id,
+            'user_id': user_id,
+            'created_at': created_at,
+            'path': path,
+            'size': size,
+            'sha256': sha256,
+        }
+
+
+def create_image_store():
+    """
+    環境変数の設定から画像ストアを作成する関数
+
+    IMAGE_STORE_DIR: 保存先のディレクトリ（デフォルト'saved_images'）
+    IMAGE_RETENTION_DAYS: この日数より古い画像を削除する（デフォルトは無効）
+    IMAGE_RETENTION_MAX_BYTES: 合計サイズの上限（デフォルトは無効）
+    IMAGE_STORE_BACKEND: 'files'（1枚ずつのファイル）または'packed'（セグメントに追記、デフォルト'files'）
+    ARCHIVE_SEGMENT_MAX_BYTES: 'packed'の1つのセグメントの最大サイズ（デフォルト256MB）
+    ARCHIVE_FSYNC: '1'にすると追記のたびにディスクへの書き込みを待つ（デフォルト'0'）
+
+    Returns:
+        ImageStore: 画像ストア
+    """
+    root = os.getenv('IMAGE_STORE_DIR', 'saved_images')
+    max_age_days = os.getenv('IMAGE_RETENTION_DAYS')
+    max_total_bytes = os.getenv('IMAGE_RETENTION_MAX_BYTES')
+    archive = None
+    if os.getenv('IMAGE_STORE_BACKEND', 'files') == 'packed':
+        archive = SegmentArchive(
+            os.path.join(root, 'archive'),
+            segment_max_bytes=int(os.getenv('ARCHIVE_SEGMENT_MAX_BYTES', 256 * 1024 * 1024)),
+            fsync=os.getenv('ARCHIVE_FSYNC', '0') == '1'
+        )
+    return ImageStore(
+        root=root,
+        max_age_days=float(max_age_days) if max_age_days else None,
+        max_total_bytes=int(max_total_bytes) if max_total_bytes else None,
+        archive=archive
+    )
+
+
+image_store = create_image_store()
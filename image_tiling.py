@@ -0,0 +1,279 @@
+import io
+import os
+import math
+import asyncio
+import difflib
+import logging
+from PIL import Image, ImageOps
+
+import table_extraction
+import table_parser
+from metrics import span
+from event_loop import runner
+
+logger = logging.getLogger(__name__)
+
+# 帯に分けて読み取るかどうか（'off': 分けない, 'auto': 縦長の画像だけ, 'always': 帯が2つ以上になる画像は全て）
+TILING_MODE = os.getenv('OCR_TILING', 'off')
+
+# autoで帯に分ける縦横比（高さ/幅）
+MIN_ASPECT = float(os.getenv('TILE_MIN_ASPECT', 1.8))
+
+# 帯の高さ（幅に対する比）
+BAND_RATIO = float(os.getenv('TILE_BAND_RATIO', 1.0))
+
+# 隣り合う帯の重なり（帯の高さに対する比）
+OVERLAP = float(os.getenv('TILE_OVERLAP', 0.15))
+
+# 1枚の画像を分ける最大の帯の数（超える場合は帯を高くする）
+MAX_BANDS = int(os.getenv('TILE_MAX_BANDS', 12))
+
+# 帯の画像の長辺の最大ピクセル数
+BAND_MAX_DIMENSION = int(os.getenv('TILE_MAX_DIMENSION', 2048))
+
+# 帯の重なりとみなす行の類似度（0〜1）
+LINE_SIMILARITY = 0.8
+
+# 重なりとみなすのに必要な最小の文字数（短い行の偶然の一致で行を消さないため）
+MIN_OVERLAP_CHARS = 4
+
+# 1枚の画像の帯を同時に読み取る数
+TILE_WORKERS = int(os.getenv('TILE_WORKERS', 4))
+
+
+def plan_bands(width, height, ratio=BAND_RATIO, overlap=OVERLAP, max_bands=MAX_BANDS):
+    """
+    画像を重なりのある横長の帯に分ける位置を求める関数
+
+    帯は等間隔に並べ、隣り合う帯は少なくともoverlapの割合だけ重なる。
+
+    Args:
+        width (int): 画像の幅
+        height (int): 画像の高さ
+        ratio (float): 帯の高さ（幅に対する比）
+        overlap (float): 隣り合う帯の重なり（帯の高さに対する比）
+        max_bands (int): 最大の帯の数
+
+    Returns:
+        list: (上端, 下端) のリスト。分ける必要がない場合は要素1つ
+    """
+    band = max(1, int(width * ratio))
+    if band >= height:
+        return [(0, height)]
+    count = math.ceil((height - band * overlap) / (band * (1 - overlap)))
+    if count > max_bands:
+        count = max_bands
+        band = math.ceil(height / (count - (count - 1) * overlap))
+    step = (height - band) / (count - 1)
+    return [(round(i * step), round(i * step) + band) for i in range(count)]
+
+
+def open_image(source):
+    if isinstance(source, (bytes, bytearray)):
+        return Image.open(io.BytesIO(source))
+    return Image.open(source)
+
+
+def image_size(source):
+    """
+    EXIFの回転を反映した画像のサイズを取得する関数（画像全体はデコードしない）
+
+    Returns:
+        tuple: (幅, 高さ)
+    """
+    with open_image(source) as image:
+        width, height = image.size
+        if image.getexif().get(0x0112) in (5, 6, 7, 8):
+            width, height = height, width
+    return width, height
+
+
+def should_tile(source, mode=None):
+    """
+    画像を帯に分けて読み取るかどうかを判定する関数
+
+    Args:
+        source (bytes or str): 画像のバイト列またはファイルパス
+        mode (str): 'off', 'auto', 'always'（省略時はOCR_TILING）
+
+    Returns:
+        bool: 帯に分ける場合はTrue
+    """
+    mode = mode or TILING_MODE
+    if mode == 'off':
+        return False
+    width, height = image_size(source)
+    if mode == 'auto' and height < width * MIN_ASPECT:
+        return False
+    return len(plan_bands(width, height)) > 1
+
+
+def split_bands(source):
+    """
+    画像を重なりのある横長の帯に分け、それぞれをJPEGにエンコードする関数
+
+    Args:
+        source (bytes or str): 画像のバイト列またはファイルパス
+
+    Returns:
+        list: 帯の画像のバイト列のリスト（上から順）
+    """
+    with open_image(source) as opened:
+        image = ImageOps.exif_transpose(opened)
+    if image.mode not in ('L', 'RGB'):
+        image = image.convert('RGB')
+
+    bands = []
+    for top, bottom in plan_bands(*image.size):
+        band = image.crop((0, top, image.width, bottom))
+        band.thumbnail((BAND_MAX_DIMENSION, BAND_MAX_DIMENSION), Image.LANCZOS)
+        buffer = io.BytesIO()
+        band.save(buffer, 'JPEG', quality=90)
+        bands.append(buffer.getvalue())
+    return bands
+
+
+def normalize_line(line):
+    return ''.join(line.split())
+
+
+def similar_lines(a, b, threshold=LINE_SIMILARITY):
+    if a == b:
+        return True
+    return difflib.SequenceMatcher(None, a, b, autojunk=False).ratio() >= threshold
+
+
+def find_overlap(previous, following, threshold=LINE_SIMILARITY):
+    """
+    前の帯の末尾と次の帯の先頭で重なっている行を探す関数
+
+    帯の境目で切れた行は読み取り結果が崩れるため、前の帯の最後の1行と
+    次の帯の最初の1行は重なりに含めずに読み飛ばしてもよいものとする。
+
+    Args:
+        previous (list): 前の帯の正規化した行のリスト
+        following (list): 次の帯の正規化した行のリスト
+        threshold (float): 同じ行とみなす類似度
+
+    Returns:
+        tuple: (前の帯の末尾から捨てる行数, 次の帯の先頭から読み飛ばす行数, 重なっている行数)
+    """
+    for count in range(min(len(previous), len(following)), 0, -1):
+        for skip_tail in (0, 1):
+            for skip_head in (0, 1):
+                end = len(previous) - skip_tail
+                if end - count < 0 or skip_head + count > len(following):
+                    continue
+                tail = previous[end - count:end]
+                head = following[skip_head:skip_head + count]
+                if sum(len(line) for line in tail) < MIN_OVERLAP_CHARS:
+                    continue
+                if all(similar_lines(a, b, threshold) for a, b in zip(tail, head)):
+                    return skip_tail, skip_head, count
+    return 0, 0, 0
+
+
+def merge_band_texts(texts, threshold=LINE_SIMILARITY):
+    """
+    帯ごとの読み取り結果を、重なっている行を除いて1つのテキストにまとめる関数
+
+    Args:
+        texts (list): 帯ごとの読み取り結果（上から順。文字のない帯は空文字）
+        threshold (float): 同じ行とみなす類似度
+
+    Returns:
+        str: まとめたテキスト
+    """
+    merged = []
+    for text in texts:
+        lines = [line for line in (text or '').splitlines() if line.strip()]
+        if not merged:
+            merged = lines
+            continue
+        skip_tail, skip_head, count = find_overlap(
+            [normalize_line(line) for line in merged], [normalize_line(line) for line in lines], threshold)
+        if count:
+            # 重なった行は、前の帯の下端で切れている可能性があるため次の帯のものを使う
+            merged = merged[:len(merged) - skip_tail - count] + lines[skip_head:]
+        else:
+            merged += lines
+    return '\n'.join(merged)
+
+
+def extract_text_tiled(source, model=None):
+    """
+    画像を帯に分け、帯ごとの文字の抽出を並列に行ってまとめる関数
+
+    一部の帯だけを欠いた表を返さないよう、1つの帯でも読み取りに失敗した場合は全体を失敗とする。
+
+    Args:
+        source (bytes or str): 画像のバイト列またはファイルパス
+        model: Geminiモデル（省略時は共有のモデル）
+
+    Returns:
+        str: 重なりを除いてまとめたテキスト
+
+    Raises:
+        Exception: 読み取りに失敗した帯の最初の例外
+    """
+    return runner.run(extract_text_tiled_async(source, model))
+
+
+async def extract_text_tiled_async(source, model=None):
+    """
+    extract_text_tiledのasyncio版（同時に読み取る帯の数はTILE_WORKERSまで）
+    """
+    model = model or table_extraction.get_model()
+    with span('tile_split'):
+        bands = await asyncio.to_thread(split_bands, source)
+    semaphore = asyncio.Semaphore(TILE_WORKERS)
+
+    async def read_band(band):
+        async with semaphore:
+            return await table_extraction.extract_text_async(table_extraction.image_part(band), model)
+
+    texts = await asyncio.gather(*(read_band(band) for band in bands))
+    logger.info(f"画像を{len(bands)}個の帯に分けて読み取りました。")
+    return merge_band_texts(texts)
+
+
+def extract_table_tiled(image_data, model=None, raise_errors=False, details=None, on_rows=None):
+    """
+    画像を帯に分けて文字を抽出し、まとめてから表に整形する関数
+
+    Args:
+        image_data (bytes or str): 画像のバイト列またはファイルパス
+        model: Geminiモデル（省略時は共有のモデル）
+        raise_errors (bool): モデル呼び出しの例外をそのまま送出するかどうか
+        details (dict): 指定した場合はまとめたテキストを'raw_text'に格納する
+        on_rows: 指定した場合は表整形の応答をストリーミングで受け取り、完成した行から
+            (ヘッダー, 行のリスト)を渡す関数
+
+    Returns:
+        list: 表形式のデータ（2次元リスト）。失敗した場合はNone
+    """
+    return runner.run(extract_table_tiled_async(image_data, model=model, raise_errors=raise_errors,
+                                                details=details, on_rows=on_rows))
+
+
+async def extract_table_tiled_async(image_data, model=None, raise_errors=False, details=None, on_rows=None):
+    """
+    extract_table_tiledのasyncio版
+    """
+    model = model or table_extraction.get_model()
+    try:
+        text = await extract_text_tiled_async(image_data, model)
+        if details is not None:
+            details['raw_text'] = text
+        if not text:
+            return None
+        # まとめたテキストが表になっていればそのまま、なっていなければ表整形を呼び出す
+        table_data = table_parser.parse_table(text)
+        if table_parser.is_table(table_data):
+            return table_data
+        return await table_extraction.format_text_async(text, model, on_rows)
+    except Exception as e:
+        if raise_errors:
+            raise
+        logger.error(f"帯に分けた表の抽出中にエラーが発生しました: {str(e)}")
+        return None
@@ -1,15 +1,23 @@
 import os
-import google.generativeai as genai
+import asyncio
 from PIL import Image
 from dotenv import load_dotenv
 import glob
 from datetime import datetime
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 import pickle
 import re
 import json
 import base64
+import table_extraction
+import image_tiling
+from text_prefilter import text_prefilter, NO_TEXT_MESSAGE
+from clients import registry
+import google_credentials
+from ocr_cache import ocr_cache
+from sheet_writer import create_sheet_writer, WRITE_MODE
+from results_store import create_results_sink
+from image_store import image_store
+from async_pipeline import runner, create_async_pipeline, preprocess_async
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
@@ -19,35 +27,42 @@ GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 if not GOOGLE_API_KEY:
     raise ValueError("GOOGLE_API_KEYが設定されていません。.envファイルを確認してください。")
 
-genai.configure(api_key=GOOGLE_API_KEY)
+# Geminiのモデルはtable_extractionで初回の利用時に生成する（APIキーもその時に設定する）
 
-# 環境変数からサービスアカウントの認証情報を取得
-service_account_info = os.environ.get('GOOGLE_SERVICE_ACCOUNT')
-if service_account_info:
-    credentials_info = json.loads(service_account_info)
-else:
-    # ローカル環境では従来通りファイルから読み込む
-    with open('service-account.json', 'r') as f:
-        credentials_info = json.load(f)
-
-# Google Sheets APIのスコープ
-SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+def get_google_credentials():
+    """
+    サービスアカウントの認証情報を取得する関数
+    
+    Returns:
+        google.oauth2.service_account.Credentials: 認証情報
+    """
+    return google_credentials.get_credentials()
 
 def get_google_sheets_service():
     """
     Google Sheets APIのサービスを取得する関数
     
+    サービスはスレッドごとに1度だけ生成し、以降は使い回す。
+    
     Returns:
         googleapiclient.discovery.Resource: Google Sheets APIのサービス
     """
     try:
-        credentials = service_account.Credentials.from_service_account_info(
-            credentials_info, scopes=SCOPES)
-        return build('sheets', 'v4', credentials=credentials)
+        return registry.get('sheets')
     except Exception as e:
         print(f"Google Sheets APIの認証中にエラーが発生しました: {str(e)}")
         raise
 
+# スプレッドシートへの書き込みをまとめて送信するライター
+sheet_writer = create_sheet_writer(get_google_sheets_service)
+
+# 抽出結果の出力先（デフォルトはローカルに保存してスプレッドシートへ非同期に同期）
+results_sink = create_results_sink(sheet_writer, os.getenv('SPREADSHEET_ID'), os.getenv('SHEET_NAME', 'Sheet1'),
+                                   replace=(WRITE_MODE == 'replace'))
+
+# 画像の処理はasyncioのパイプラインで行う（以下の同期版の関数はその薄いラッパー）
+pipeline = create_async_pipeline(None, image_store, results_sink)
+
 def format_text_to_table(text):
     """
     テキストを表形式に整形する関数
@@ -58,122 +73,66 @@ def format_text_to_table(text):
     Returns:
         list: 表形式のデータ（2次元リスト）
     """
+    return runner.run(format_text_to_table_async(text))
+
+async def format_text_to_table_async(text):
+    """
+    format_text_to_tableのasyncio版
+    """
     try:
-        # Geminiモデルの初期化
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        
-        # テキストを表形式に整形するプロンプト
-        prompt = f"""
-        以下のテキストを表形式に整形してください。
-        各行は「|」で区切られ、最初の行はヘッダーとしてください。
-        可能な限り情報を整理し、見やすい表にしてください。
-        
-        テキスト:
-        {text}
-        """
-        
-        # テキストを整形
-        response = model.generate_content(prompt)
-        formatted_text = response.text
-        
-        # 表形式のデータを2次元リストに変換
-        table_data = []
-        for line in formatted_text.strip().split('\n'):
-            if '|' in line:
-                # 行を「|」で分割し、空白を削除
-                row = [cell.strip() for cell in line.split('|') if cell.strip()]
-                if row:  # 空の行を除外
-                    table_data.append(row)
-        
-        return table_data
+        async with pipeline.limits.slot('gemini'):
+            return await table_extraction.format_text_async(text)
     
     except Exception as e:
         print(f"テキストの整形中にエラーが発生しました: {str(e)}")
         return None
 
-def clear_sheet(service, spreadsheet_id, sheet_name):
+def append_to_spreadsheet(table_data, image_path, image_id=None, user_id=None, raw_text=None):
     """
-    スプレッドシートの内容をクリアする関数
+    抽出結果を保存し、スプレッドシートにデータを追加する関数
     
-    Args:
-        service: Google Sheets APIのサービス
-        spreadsheet_id (str): スプレッドシートID
-        sheet_name (str): シート名
-    """
-    try:
-        # シートの内容をクリア
-        service.spreadsheets().values().clear(
-            spreadsheetId=spreadsheet_id,
-            range=f'{sheet_name}!A:Z'
-        ).execute()
-        print("スプレッドシートの内容をクリアしました。")
-    except Exception as e:
-        print(f"スプレッドシートのクリア中にエラーが発生しました: {str(e)}")
-
-def append_to_spreadsheet(table_data, image_path):
-    """
-    スプレッドシートにデータを追加する関数
+    RESULTS_SINK=local（デフォルト）の場合はローカルのデータベースに保存し、
+    スプレッドシートにはバックグラウンドでまとめて同期する。
     
     Args:
         table_data (list): 表形式のデータ（2次元リスト）
         image_path (str): 画像ファイルのパス
+        image_id (str): 画像のID（LINEのメッセージIDなど）
+        user_id (str): 送信したユーザーのID
+        raw_text (str): モデルの出力
+    """
+    runner.run(append_to_spreadsheet_async(table_data, image_path, image_id=image_id,
+                                           user_id=user_id, raw_text=raw_text))
+
+async def append_to_spreadsheet_async(table_data, image_path, image_id=None, user_id=None, raw_text=None):
+    """
+    append_to_spreadsheetのasyncio版
     """
     try:
-        # スプレッドシートIDを環境変数から取得
-        SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
-        if not SPREADSHEET_ID:
-            raise ValueError("SPREADSHEET_IDが設定されていません。.envファイルを確認してください。")
-        
-        # シート名を環境変数から取得（デフォルトは'Sheet1'）
-        SHEET_NAME = os.getenv('SHEET_NAME', 'Sheet1')
-        
-        # 現在の日時を取得
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        # 画像情報を追加
-        image_info = [current_time, image_path]
-        
-        # スプレッドシートにデータを追加
-        service = get_google_sheets_service()
-        
-        # シートの内容をクリア
-        clear_sheet(service, SPREADSHEET_ID, SHEET_NAME)
-        
-        # ヘッダー行を追加
-        header = ['日時', '画像パス'] + table_data[0]
-        body = {'values': [header]}
-        service.spreadsheets().values().append(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f'{SHEET_NAME}!A:Z',
-            valueInputOption='RAW',
-            body=body
-        ).execute()
-        
-        # データ行を追加
-        for row in table_data[1:]:  # ヘッダー行をスキップ
-            values = image_info + row
-            body = {'values': [values]}
-            result = service.spreadsheets().values().append(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f'{SHEET_NAME}!A:Z',
-                valueInputOption='RAW',
-                body=body
-            ).execute()
-            print(f"スプレッドシートにデータを追加しました: {result.get('updates').get('updatedCells')} セル")
+        cells = await pipeline.write(table_data, image_path, image_id=image_id, user_id=user_id,
+                                     raw_text=raw_text)
+        print(f"抽出結果を保存しました: {cells} セル")
         
     except Exception as e:
         print(f"スプレッドシートへの追加中にエラーが発生しました: {str(e)}")
         print("スプレッドシートの設定を確認してください。")
-        print(f"スプレッドシートID: {SPREADSHEET_ID}")
-        print(f"シート名: {SHEET_NAME}")
+        print(f"スプレッドシートID: {os.getenv('SPREADSHEET_ID')}")
+        print(f"シート名: {os.getenv('SHEET_NAME', 'Sheet1')}")
 
 def get_latest_image():
     """
-    saved_imagesディレクトリから最新の画像ファイルを取得する関数
+    最新の画像ファイルを取得する関数
+    
+    画像ストアのインデックスから取得し、登録がない場合は
+    saved_imagesディレクトリ直下の画像ファイルから探す。
     
     Returns:
         str: 最新の画像ファイルのパス
     """
+    record = image_store.latest()
+    if record:
+        return record['path']
+    
     # saved_imagesディレクトリ内のすべての画像ファイルを取得
     image_files = glob.glob('saved_images/*.jpg')
     
@@ -194,17 +153,68 @@ def extract_text_from_image(image_path):
     Returns:
         str: 抽出されたテキスト
     """
+    return runner.run(extract_text_from_image_async(image_path))
+
+async def extract_text_from_image_async(image_path):
+    """
+    extract_text_from_imageのasyncio版
+    """
     try:
+        # 文字が写っていない画像はモデルを呼び出さない
+        if await asyncio.to_thread(text_prefilter.screen, image_path):
+            print(NO_TEXT_MESSAGE)
+            return ''
+
+        # 縦長の画像は帯に分けて並列に読み取る
+        if image_tiling.should_tile(image_path):
+            async with pipeline.limits.slot('gemini'):
+                return await image_tiling.extract_text_tiled_async(image_path)
+
         # 画像を開く
         image = Image.open(image_path)
         
-        # Geminiモデルの初期化（新しいモデルを使用）
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        
         # 画像からテキストを抽出
-        response = model.generate_content(["この画像から文字を抽出してください。", image])
+        async with pipeline.limits.slot('gemini'):
+            return await table_extraction.extract_text_async(image)
+    
+    except Exception as e:
+        print(f"エラーが発生しました: {str(e)}")
+        return None
+
+def extract_table_from_image(image_path, mode=None, stats=None):
+    """
+    画像から表形式のデータを抽出する関数
+    
+    directモードではモデルを1回だけ呼び出し、構造化出力の検証に失敗した
+    場合のみ文字抽出→表整形の2段階処理を行う。
+    
+    Args:
+        image_path (str or bytes): 画像ファイルのパスまたはバイト列
+        mode (str): 'direct' または 'two_stage'（省略時は環境変数EXTRACTION_MODE）
+        stats (dict): 前処理の統計情報（指定した場合、image_pathは前処理済みの
+            バイト列としてそのまま使い、デコードと再圧縮を繰り返さない）
+    
+    Returns:
+        list: 表形式のデータ（2次元リスト）
+    """
+    return runner.run(extract_table_from_image_async(image_path, mode=mode, stats=stats))
+
+async def extract_table_from_image_async(image_path, mode=None, stats=None):
+    """
+    extract_table_from_imageのasyncio版
+    """
+    try:
+        if stats is None:
+            # モデルに送る前に画像を縮小・補正・再圧縮する
+            image_data, _, stats = await preprocess_async(image_path)
+        else:
+            image_data = image_path
         
-        return response.text
+        # 文字が写っていない画像はモデルを呼び出さない
+        if text_prefilter.screen(image_data, stats.get('text_features')):
+            print(NO_TEXT_MESSAGE)
+            return None
+        return await pipeline.extract(image_data, mode=mode)
     
     except Exception as e:
         print(f"エラーが発生しました: {str(e)}")
@@ -216,25 +226,16 @@ if __name__ == "__main__":
         image_path = get_latest_image()
         print(f"処理する画像: {image_path}")
         
-        # テキスト抽出を実行
-        extracted_text = extract_text_from_image(image_path)
+        # 画像から表形式のデータを抽出（アーカイブに保存した画像はバイト列で渡す）
+        table_data = extract_table_from_image(image_store.source(image_path))
         
-        if extracted_text:
-            print("\n抽出されたテキスト:")
-            print(extracted_text)
+        if table_data:
+            print("\n表形式に整形されたテキスト:")
+            for row in table_data:
+                print(' | '.join(str(cell) for cell in row))
             
-            # テキストを表形式に整形
-            table_data = format_text_to_table(extracted_text)
-            
-            if table_data:
-                print("\n表形式に整形されたテキスト:")
-                for row in table_data:
-                    print(' | '.join(row))
-                
-                # スプレッドシートにデータを追加
-                append_to_spreadsheet(table_data, image_path)
-            else:
-                print("テキストの整形に失敗しました。")
+            # スプレッドシートにデータを追加
+            append_to_spreadsheet(table_data, image_path)
         else:
             print("テキストの抽出に失敗しました。")
             
@@ -242,4 +243,11 @@ if __name__ == "__main__":
         print(f"エラー: {str(e)}")
         print("LINEで画像を送信してから再度実行してください。")
     except Exception as e:
-        print(f"予期せぬエラーが発生しました: {str(e)}") 
\ No newline at end of file
+        print(f"予期せぬエラーが発生しました: {str(e)}")
+    
+    # スプレッドシートへの同期が終わるまで待つ
+    runner.stop()
+    results_sink.stop()
+    
+    if ocr_cache:
+        print(f"OCRキャッシュ: {ocr_cache.stats()}") 
\ No newline at end of file
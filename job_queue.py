@@ -0,0 +1,538 @@
+import os
+import json
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+import logging
+import traceback
+from collections import OrderedDict, deque
+
+from metrics import registry, span, request_context, STAGE_METRIC
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """
+    キューに投入される1件のジョブ
+
+    Args:
+        name (str): 実行するハンドラー名
+        payload (dict): ハンドラーに渡すデータ（JSONに変換できること）
+        job_id (str): ジョブID（省略時は自動生成）
+        enqueued_at (float): 投入時刻（UNIX時間）
+    """
+
+    def __init__(self, name, payload, job_id=None, enqueued_at=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.name = name
+        self.payload = payload
+        self.enqueued_at = enqueued_at or time.time()
+
+
+class MemoryJobStore:
+    """
+    永続化を行わないジョブストア（プロセス終了時に未処理ジョブは失われる）
+    """
+
+    def add(self, job):
+        pass
+
+    def remove(self, job_id):
+        pass
+
+    def pending(self):
+        return []
+
+
+class SQLiteJobStore:
+    """
+    SQLiteに未処理ジョブを保存するジョブストア
+
+    プロセスが再起動しても、処理が完了していないジョブを再投入できる。
+
+    Args:
+        path (str): SQLiteファイルのパス
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id TEXT PRIMARY KEY, name TEXT NOT NULL, '
+                'payload TEXT NOT NULL, enqueued_at REAL NOT NULL)'
+            )
+            self._conn.commit()
+
+    def add(self, job):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO jobs (id, name, payload, enqueued_at) VALUES (?, ?, ?, ?)',
+                (job.id, job.name, json.dumps(job.payload, ensure_ascii=False), job.enqueued_at)
+            )
+            self._conn.commit()
+
+    def remove(self, job_id):
+        with self._lock:
+            self._conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            self._conn.commit()
+
+    def pending(self):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT id, name, payload, enqueued_at FROM jobs ORDER BY enqueued_at'
+            ).fetchall()
+        return [Job(name, json.loads(payload), job_id=job_id, enqueued_at=enqueued_at)
+                for job_id, name, payload, enqueued_at in rows]
+
+
+class UserQueueFull(queue.Full):
+    """
+    1人のユーザーの処理待ちジョブが上限に達した場合の例外
+    """
+
+
+def job_key(payload):
+    """
+    公平に処理する単位（ユーザー）をジョブのデータから求める関数
+
+    Returns:
+        str: 送信したユーザーのID（取得できない場合はプッシュの送信先ID）
+    """
+    return payload.get('user_id') or payload.get('to') or ''
+
+
+def job_cost(name, payload):
+    """
+    ジョブの重さを求める関数（まとめて処理する画像は枚数分として数える）
+    """
+    return max(1, len(payload.get('images') or ()))
+
+
+class FairQueue:
+    """
+    ユーザーごとのキューを持ち、Deficit Round Robinで順番に取り出すキュー
+
+    ユーザーの順番が回ってくるたびにquantumだけ持ち分を加え、先頭のジョブの重さが
+    持ち分以下であれば取り出す。同時実行数が上限に達しているユーザーは順番を飛ばす。
+    1人のユーザーが続けて多くの画像を送っても、他のユーザーのジョブは
+    そのユーザーのジョブ1件分ずつ待つだけで済む。
+
+    Args:
+        maxsize (int): 全体で保持できる最大ジョブ数（0は無制限）
+        key_maxsize (int): 1人のユーザーが保持できる最大ジョブ数（0は無制限）
+        key_concurrency (int): 1人のユーザーのジョブを同時に実行する最大数（0は無制限）
+        quantum (int): 順番が回ってくるたびに加える持ち分
+    """
+
+    def __init__(self, maxsize=0, key_maxsize=0, key_concurrency=0, quantum=1):
+        self.maxsize = maxsize
+        self.key_maxsize = key_maxsize
+        self.key_concurrency = key_concurrency
+        self.quantum = quantum
+        # 処理待ちのジョブがあるユーザー（先頭が順番の回ってきているユーザー）
+        self._queues = OrderedDict()
+        self._deficit = {}
+        self._turn_started = False
+        self._running = {}
+        self._size = 0
+        self._getters = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        # ユーザーごとの統計情報（処理待ちか実行中のジョブがあるユーザーのみ）
+        self._served = {}
+        self._wait_total = {}
+        self._wait_max = {}
+
+    def put(self, job, key, cost=1, force=False):
+        """
+        ジョブをユーザーのキューに追加する
+
+        Args:
+            job (Job): ジョブ
+            key (str): ユーザー
+            cost (int): ジョブの重さ
+            force (bool): 上限を超えても追加するかどうか（再起動時の再投入用）
+
+        Returns:
+            tuple: (追加後のそのユーザーの処理待ち件数, すぐには実行されない場合はTrue)
+
+        Raises:
+            UserQueueFull: ユーザーの処理待ちが上限に達している場合
+            queue.Full: 全体の処理待ちが上限に達している場合
+        """
+        with self._cond:
+            pending = self._queues.get(key)
+            if not force:
+                if self.key_maxsize and pending and len(pending) >= self.key_maxsize:
+                    raise UserQueueFull()
+                if self.maxsize and self._size >= self.maxsize:
+                    raise queue.Full()
+            # 待っているワーカーがいて、このユーザーに実行の枠が空いていれば、すぐに取り出される
+            delayed = bool(pending) or self._getters == 0 or not self._eligible(key)
+            if pending is None:
+                pending = self._queues[key] = deque()
+                self._deficit[key] = 0
+            pending.append((job, cost))
+            self._size += 1
+            self._cond.notify()
+            return len(pending), delayed
+
+    def get(self):
+        """
+        次に実行するジョブを取り出す（取り出せるジョブがない間は待つ）
+
+        Returns:
+            tuple: (ジョブ, ユーザー)。close後に処理待ちがなくなった場合は(None, None)
+        """
+        with self._cond:
+            self._getters += 1
+            try:
+                while True:
+                    selected = self._select()
+                    if selected is not None:
+                        job, key = selected
+                        self._running[key] = self._running.get(key, 0) + 1
+                        wait = time.time() - job.enqueued_at
+                        self._served[key] = self._served.get(key, 0) + 1
+                        self._wait_total[key] = self._wait_total.get(key, 0.0) + wait
+                        self._wait_max[key] = max(self._wait_max.get(key, 0.0), wait)
+                        return job, key
+                    if self._closed and self._size == 0:
+                        return None, None
+                    self._cond.wait()
+            finally:
+                self._getters -= 1
+
+    def done(self, key):
+        """
+        取り出したジョブの実行が終わったことを通知する（ユーザーの実行の枠を空ける）
+        """
+        with self._cond:
+            self._running[key] -= 1
+            if not self._running[key]:
+                del self._running[key]
+                if key not in self._queues:
+                    self._forget(key)
+            # 枠が空くのを待っていたユーザーのジョブを取り出せるようにする
+            self._cond.notify_all()
+
+    def close(self):
+        """
+        処理待ちのジョブがなくなったらgetがNoneを返すようにする
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def open(self):
+        with self._cond:
+            self._closed = False
+
+    def qsize(self):
+        with self._cond:
+            return self._size
+
+    def _eligible(self, key):
+        return not self.key_concurrency or self._running.get(key, 0) < self.key_concurrency
+
+    def _select(self):
+        # 重いジョブの持ち分が貯まるまで、1回の呼び出しで何周か回ることがある
+        if not self._queues:
+            return None
+        heaviest = max(pending[0][1] for pending in self._queues.values())
+        turns = len(self._queues) * (heaviest // max(1, self.quantum) + 2)
+        for _ in range(turns):
+            key = next(iter(self._queues))
+            pending = self._queues[key]
+            if self._eligible(key):
+                if not self._turn_started:
+                    self._deficit[key] += self.quantum
+                    self._turn_started = True
+                job, cost = pending[0]
+                if cost <= self._deficit[key]:
+                    pending.popleft()
+                    self._size -= 1
+                    self._deficit[key] -= cost
+                    if not pending:
+                        # 処理待ちがなくなったユーザーの持ち分は持ち越さない
+                        del self._queues[key]
+                        del self._deficit[key]
+                        self._turn_started = False
+                    return job, key
+            # 次のユーザーに順番を回す
+            self._queues.move_to_end(key)
+            self._turn_started = False
+        return None
+
+    def _forget(self, key):
+        self._served.pop(key, None)
+        self._wait_total.pop(key, None)
+        self._wait_max.pop(key, None)
+
+    def key_stats(self):
+        """
+        処理待ちか実行中のジョブがあるユーザーごとの統計情報を取得する
+
+        Returns:
+            dict: ユーザー → 処理待ち件数、実行中の件数、最も古いジョブの待ち時間、
+                取り出したジョブの件数と待ち時間の平均・最大
+        """
+        now = time.time()
+        with self._cond:
+            result = {}
+            for key in set(self._queues) | set(self._running):
+                pending = self._queues.get(key) or ()
+                served = self._served.get(key, 0)
+                result[key] = {
+                    'queued': len(pending),
+                    'running': self._running.get(key, 0),
+                    'oldest_wait_seconds': now - pending[0][0].enqueued_at if pending else 0.0,
+                    'served': served,
+                    'wait_seconds_avg': self._wait_total.get(key, 0.0) / served if served else 0.0,
+                    'wait_seconds_max': self._wait_max.get(key, 0.0),
+                }
+            return result
+
+
+class JobQueue:
+    """
+    上限付きのインメモリジョブキューとワーカープール
+
+    ジョブはユーザーごとのキューに入れ、ユーザー間で公平に取り出す（FairQueue）。
+    全体の同時実行数はワーカー数、1人のユーザーの同時実行数はuser_concurrencyで制限する。
+
+    Args:
+        num_workers (int): ワーカースレッド数
+        maxsize (int): キューに保持できる最大ジョブ数
+        store: ジョブストア（MemoryJobStore または SQLiteJobStore）
+        user_maxsize (int): 1人のユーザーが保持できる最大ジョブ数（0は無制限）
+        user_concurrency (int): 1人のユーザーのジョブを同時に実行する最大数（0は無制限）
+        quantum (int): ユーザーの順番が回ってくるたびに処理できるジョブの重さ
+        key_func: ジョブのデータから公平に処理する単位を求める関数
+        cost_func: ジョブ名とデータからジョブの重さを求める関数
+    """
+
+    def __init__(self, num_workers=4, maxsize=100, store=None, user_maxsize=0, user_concurrency=0,
+                 quantum=1, key_func=job_key, cost_func=job_cost):
+        self.num_workers = num_workers
+        self.maxsize = maxsize
+        self.store = store or MemoryJobStore()
+        self.key_func = key_func
+        self.cost_func = cost_func
+        self._queue = FairQueue(maxsize, user_maxsize, user_concurrency, quantum)
+        self._handlers = {}
+        self._threads = []
+        self._lock = threading.Lock()
+        self._started_at = None
+
+        # 統計情報
+        self._busy_workers = 0
+        self._busy_seconds = 0.0
+        self._processed = 0
+        self._failed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._wait_last = 0.0
+        self._rejected = 0
+        self._delayed = 0
+
+    def register(self, name):
+        """
+        ジョブハンドラーを登録するデコレーター
+
+        Args:
+            name (str): ジョブ名
+        """
+        def decorator(func):
+            self._handlers[name] = func
+            return func
+        return decorator
+
+    def start(self):
+        """
+        ワーカースレッドを起動し、ストアに残っている未処理ジョブを再投入する
+        """
+        with self._lock:
+            if self._threads:
+                return
+            self._started_at = time.time()
+            self._queue.open()
+            for i in range(self.num_workers):
+                thread = threading.Thread(target=self._worker, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+        for job in self.store.pending():
+            logger.info(f"未処理のジョブを再投入します: {job.id} ({job.name})")
+            self._queue.put(job, self.key_func(job.payload), self.cost_func(job.name, job.payload), force=True)
+
+    def enqueue(self, name, payload, block=False):
+        """
+        ジョブをキューに投入する
+
+        投入したジョブのuser_depth（そのユーザーの処理待ち件数）とdelayed
+        （空いているワーカーがなく、すぐには実行されない場合はTrue）を設定する。
+
+        Args:
+            name (str): ジョブ名
+            payload (dict): ハンドラーに渡すデータ
+            block (bool): キューが満杯のときに空きを待つかどうか
+
+        Returns:
+            Job: 投入したジョブ
+
+        Raises:
+            UserQueueFull: ユーザーの処理待ちが上限に達していてblock=Falseの場合
+            queue.Full: キューが満杯でblock=Falseの場合
+        """
+        if name not in self._handlers:
+            raise KeyError(f"ジョブハンドラーが登録されていません: {name}")
+        self.start()
+
+        job = Job(name, payload)
+        key = self.key_func(payload)
+        cost = self.cost_func(name, payload)
+        self.store.add(job)
+        while True:
+            try:
+                job.user_depth, job.delayed = self._queue.put(job, key, cost)
+                break
+            except queue.Full:
+                if not block:
+                    self.store.remove(job.id)
+                    with self._lock:
+                        self._rejected += 1
+                    raise
+                time.sleep(0.1)
+        if job.delayed:
+            with self._lock:
+                self._delayed += 1
+        return job
+
+    def stop(self, timeout=None):
+        """
+        投入済みのジョブを処理し終えてからワーカーを停止する
+
+        Args:
+            timeout (float): 全てのワーカーの終了を待つ最大秒数
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            threads, self._threads = self._threads, []
+        self._queue.close()
+        for thread in threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        unfinished = self._queue.qsize() + sum(1 for thread in threads if thread.is_alive())
+        if unfinished:
+            logger.warning(f"処理が終わらないまま停止するジョブが{unfinished}件あります。")
+
+    def _worker(self):
+        while True:
+            job, key = self._queue.get()
+            if job is None:
+                return
+
+            started = time.time()
+            wait = started - job.enqueued_at
+            with self._lock:
+                self._busy_workers += 1
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
+                self._wait_last = wait
+
+            registry.observe(STAGE_METRIC, wait, (('stage', 'queue_wait'), ('outcome', 'ok')))
+
+            failed = False
+            try:
+                # Webhookを受け付けたリクエストのIDをジョブのログにも付ける
+                with request_context(job.payload.get('request_id')), span('job', job=job.name):
+                    self._handlers[job.name](job.payload)
+            except Exception as e:
+                failed = True
+                logger.error(f"ジョブの処理中にエラーが発生しました: {job.id} ({job.name}): {str(e)}")
+                logger.error(traceback.format_exc())
+            finally:
+                self.store.remove(job.id)
+                with self._lock:
+                    self._busy_workers -= 1
+                    self._busy_seconds += time.time() - started
+                    self._processed += 1
+                    if failed:
+                        self._failed += 1
+                self._queue.done(key)
+
+    def stats(self):
+        """
+        キューの統計情報を取得する
+
+        Returns:
+            dict: キューの深さ、待ち時間、ワーカー稼働率、受け付けなかったジョブの数、
+                処理待ちのユーザー数と1人あたりの最大の処理待ち件数・待ち時間など
+        """
+        users = self._queue.key_stats()
+        with self._lock:
+            elapsed = time.time() - self._started_at if self._started_at else 0.0
+            capacity = elapsed * self.num_workers
+            return {
+                'depth': self._queue.qsize(),
+                'maxsize': self.maxsize,
+                'workers': self.num_workers,
+                'busy_workers': self._busy_workers,
+                'utilization': self._busy_seconds / capacity if capacity else 0.0,
+                'processed': self._processed,
+                'failed': self._failed,
+                'wait_seconds_avg': self._wait_total / self._processed if self._processed else 0.0,
+                'wait_seconds_max': self._wait_max,
+                'wait_seconds_last': self._wait_last,
+                'rejected': self._rejected,
+                'delayed': self._delayed,
+                'active_users': len(users),
+                'user_depth_max': max((user['queued'] for user in users.values()), default=0),
+                'user_wait_seconds_max': max((user['oldest_wait_seconds'] for user in users.values()),
+                                             default=0.0),
+            }
+
+    def user_stats(self):
+        """
+        ユーザーごとの処理待ち件数と待ち時間を取得する（/metricsには出力しない）
+
+        Returns:
+            dict: ユーザー → 処理待ち件数、実行中の件数、待ち時間など（処理待ちの多い順）
+        """
+        users = self._queue.key_stats()
+        return dict(sorted(users.items(), key=lambda item: (-item[1]['queued'], item[0])))
+
+
+def create_job_queue():
+    """
+    環境変数の設定からジョブキューを作成する関数
+
+    JOB_QUEUE_WORKERS: ワーカー数（デフォルト4）
+    JOB_QUEUE_MAXSIZE: キューの最大長（デフォルト100）
+    JOB_QUEUE_DB: 指定した場合はSQLiteに未処理ジョブを永続化する
+    JOB_QUEUE_USER_MAXSIZE: 1人のユーザーの処理待ちの最大長（デフォルト0で無制限）
+    JOB_QUEUE_USER_CONCURRENCY: 1人のユーザーのジョブを同時に実行する最大数
+        （デフォルトはワーカー数の半分、0は無制限）
+    JOB_QUEUE_QUANTUM: ユーザーの順番が回ってくるたびに処理できる画像の枚数（デフォルト1）
+
+    Returns:
+        JobQueue: ジョブキュー
+    """
+    db_path = os.getenv('JOB_QUEUE_DB')
+    store = SQLiteJobStore(db_path) if db_path else MemoryJobStore()
+    num_workers = int(os.getenv('JOB_QUEUE_WORKERS', 4))
+    return JobQueue(
+        num_workers=num_workers,
+        maxsize=int(os.getenv('JOB_QUEUE_MAXSIZE', 100)),
+        store=store,
+        user_maxsize=int(os.getenv('JOB_QUEUE_USER_MAXSIZE', 0)),
+        user_concurrency=int(os.getenv('JOB_QUEUE_USER_CONCURRENCY', max(1, num_workers // 2))),
+        quantum=int(os.getenv('JOB_QUEUE_QUANTUM', 1))
+    )
@@ -1,34 +1,39 @@
 import os
-from flask import Flask, request, abort
-from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
-    MessagingApiBlob,
-    ReplyMessageRequest,
-    TextMessage
-)
+from flask import Flask, request, abort, jsonify, Response
 from linebot.v3.webhooks import (
     MessageEvent,
     ImageMessageContent
 )
 from linebot.v3.webhook import WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot.v3.exceptions import InvalidSignatureError
 from dotenv import load_dotenv
 import traceback
-import google.generativeai as genai
-from PIL import Image
-import io
-from datetime import datetime
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-import pickle
+import queue
+from clients import registry
+import google_credentials
+from job_queue import create_job_queue, job_key
+from ocr_cache import ocr_cache, extract_table_cached
+from table_extraction import STREAMING
+from sheet_writer import create_sheet_writer, WRITE_MODE
+from results_store import create_results_sink
+from image_preprocess import preprocess_image_async
+from blob_stream import ingest_message_image
+from image_store import image_store
+from gemini_scheduler import scheduler
+from idempotency import deduplicator, event_keys, is_redelivery
+from text_prefilter import text_prefilter, NO_TEXT_MESSAGE
+from image_batching import create_image_batcher, extract_table_batch, SET_TIMEOUT, USER_WINDOW
+from async_pipeline import runner, create_async_pipeline, create_admission_control, PIPELINE_MODE
+import metrics
+from metrics import span, request_context, instrument_webhook_handler
+from warmup import start_warm_up
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
 
+# ログの形式を設定する（LOG_FORMAT=jsonで1行1件のJSON）
+metrics.configure_logging()
+
 # 環境変数の確認
 access_token = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
 channel_secret = os.getenv('LINE_CHANNEL_SECRET')
@@ -39,136 +44,127 @@ sheet_name = os.getenv('SHEET_NAME', 'Sheet1')
 if not all([access_token, channel_secret, google_api_key, spreadsheet_id]):
     raise ValueError("必要な環境変数が設定されていません。.envファイルを確認してください。")
 
-# Gemini APIの設定
-genai.configure(api_key=google_api_key)
-
 app = Flask(__name__)
-app.debug = True  # デバッグモードを有効化
+app.debug = os.getenv('FLASK_DEBUG', '0') == '1'  # 開発時のみデバッグモードを有効化
 
 # LINE Messaging APIの設定
-configuration = Configuration(access_token=access_token)
-handler = WebhookHandler(channel_secret)
+handler = instrument_webhook_handler(WebhookHandler(channel_secret))
+
+# 画像処理を行うバックグラウンドジョブキュー
+job_queue = create_job_queue()
 
-# 画像を保存するディレクトリ
-SAVE_DIR = 'saved_images'
-if not os.path.exists(SAVE_DIR):
-    os.makedirs(SAVE_DIR)
+# 混み合っていて、画像の処理をすぐに始められない場合に返信するメッセージ
+BUSY_MESSAGE = '混み合っているため、順番に読み取っています。\n読み取りが終わったらお知らせします。'
 
-# Google Sheets APIのスコープ
-SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+# 処理待ちが上限に達していて、画像を受け付けられない場合に返信するメッセージ
+REJECTED_MESSAGE = '混み合っているため、画像を受け付けられませんでした。\nしばらくしてからもう一度送ってください。'
+
+# スプレッドシートの認証情報（サービスアカウントか保存済みのOAuthのトークン）がなければ起動しない
+# （開発用のサーバーでは、初回の書き込み時にブラウザで認可できる）
+if __name__ != '__main__' and google_credentials.credentials_source() is None:
+    raise ValueError("Google Sheetsの認証情報がありません。"
+                     "GOOGLE_SERVICE_ACCOUNTかservice-account.jsonを設定してください。")
+
+def get_google_credentials():
+    """
+    Google APIの認証情報を取得する関数
+    """
+    return google_credentials.get_credentials()
 
 def get_google_sheets_service():
     """
     Google Sheets APIのサービスを取得する関数
-    """
-    creds = None
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-    
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
     
-    return build('sheets', 'v4', credentials=creds)
+    httplib2はスレッドセーフではないため、サービスはスレッドごとに1度だけ生成する。
+    """
+    return registry.get('sheets')
 
-def clear_sheet(service, spreadsheet_id, sheet_name):
+def create_line_api_client():
     """
-    スプレッドシートの内容をクリアする関数
+    LINE Messaging APIのクライアントを生成する関数
+
+    Messaging APIのSDKは読み込みに時間がかかるため、Webhookの受け付けでは読み込まず、
+    初回のプッシュ送信や画像の取得の時に読み込む。
     """
-    try:
-        service.spreadsheets().values().clear(
-            spreadsheetId=spreadsheet_id,
-            range=f'{sheet_name}!A:Z'
-        ).execute()
-        app.logger.info("スプレッドシートの内容をクリアしました。")
-    except Exception as e:
-        app.logger.error(f"スプレッドシートのクリア中にエラーが発生しました: {str(e)}")
+    from linebot.v3.messaging import ApiClient, Configuration
+    return ApiClient(Configuration(access_token=access_token))
 
-def format_text_to_table(text):
+def create_async_line_api_client():
     """
-    テキストを表形式に整形する関数
+    LINE Messaging APIの非同期クライアントを生成する関数
+
+    aiohttpのセッションはイベントループに結び付くため、パイプラインの
+    イベントループの中で初回の利用時に生成する。
     """
-    try:
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        prompt = f"""
-        以下のテキストを表形式に整形してください。
-        各行は「|」で区切られ、最初の行はヘッダーとしてください。
-        可能な限り情報を整理し、見やすい表にしてください。
-        
-        テキスト:
-        {text}
-        """
-        
-        response = model.generate_content(prompt)
-        formatted_text = response.text
-        
-        table_data = []
-        for line in formatted_text.strip().split('\n'):
-            if '|' in line:
-                row = [cell.strip() for cell in line.split('|') if cell.strip()]
-                if row:
-                    table_data.append(row)
-        
-        return table_data
+    from linebot.v3.messaging import AsyncApiClient, Configuration
+    return AsyncApiClient(Configuration(access_token=access_token))
+
+registry.register('line', create_line_api_client)
+registry.register('line:async', create_async_line_api_client)
+
+# スプレッドシートへの書き込みをまとめて送信するライター
+sheet_writer = create_sheet_writer(get_google_sheets_service)
+
+# 抽出結果の出力先（デフォルトはローカルに保存してスプレッドシートへ非同期に同期）
+results_sink = create_results_sink(sheet_writer, spreadsheet_id, sheet_name, replace=(WRITE_MODE == 'replace'))
+
+# IMAGE_PIPELINE=asyncの場合に画像を処理するasyncioのパイプライン
+pipeline = create_async_pipeline(lambda: registry.get('line:async'), image_store, results_sink)
+
+# asyncioのパイプラインで受け付ける画像の数の制限（ジョブキューの上限に当たるもの）
+admission = create_admission_control()
+
+def open_result_stream(image_path):
+    """
+    GEMINI_STREAMING=onの場合に、抽出しながら行を書き込むストリームを開く関数
     
+    Returns:
+        ストリーム（add_rowsで行を受け取り、closeで残りを書き込む）。使わない場合や開けない場合はNone
+    """
+    if STREAMING != 'on':
+        return None
+    try:
+        return results_sink.open_stream(image_path)
     except Exception as e:
-        app.logger.error(f"テキストの整形中にエラーが発生しました: {str(e)}")
+        app.logger.error(f"スプレッドシートへの書き込みを開始できませんでした: {str(e)}")
         return None
 
-def append_to_spreadsheet(table_data, image_path):
+def append_to_spreadsheet(table_data, image_path, image_id=None, user_id=None, raw_text=None, stream=None):
     """
-    スプレッドシートにデータを追加する関数
+    抽出結果を保存し、スプレッドシートにデータを追加する関数
+    
+    RESULTS_SINK=local（デフォルト）の場合はローカルのデータベースへの保存だけで戻り、
+    スプレッドシートにはバックグラウンドでまとめて同期される。
+    streamを指定した場合は、抽出中に書き込んだ行の残りを書き込む。
     """
     try:
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        image_info = [current_time, image_path]
-        
-        service = get_google_sheets_service()
-        
-        # シートの内容をクリア
-        clear_sheet(service, spreadsheet_id, sheet_name)
-        
-        # ヘッダー行を追加
-        header = ['日時', '画像パス'] + table_data[0]
-        body = {'values': [header]}
-        service.spreadsheets().values().append(
-            spreadsheetId=spreadsheet_id,
-            range=f'{sheet_name}!A:Z',
-            valueInputOption='RAW',
-            body=body
-        ).execute()
-        
-        # データ行を追加
-        for row in table_data[1:]:
-            values = image_info + row
-            body = {'values': [values]}
-            result = service.spreadsheets().values().append(
-                spreadsheetId=spreadsheet_id,
-                range=f'{sheet_name}!A:Z',
-                valueInputOption='RAW',
-                body=body
-            ).execute()
-            app.logger.info(f"スプレッドシートにデータを追加しました: {result.get('updates').get('updatedCells')} セル")
+        if stream is not None:
+            cells = stream.close(table_data, image_id=image_id, user_id=user_id, raw_text=raw_text)
+        else:
+            cells = results_sink.write(table_data, image_path, image_id=image_id, user_id=user_id,
+                                       raw_text=raw_text)
+        app.logger.info(f"抽出結果を保存しました: {cells} セル")
         
     except Exception as e:
         app.logger.error(f"スプレッドシートへの追加中にエラーが発生しました: {str(e)}")
 
 @app.route("/callback", methods=['POST'])
 def callback():
+    # リクエストIDを付けて、ジョブの処理まで同じIDでログを追えるようにする
+    with request_context() as request_id:
+        response = handle_callback()
+    response.headers['X-Request-Id'] = request_id
+    return response
+
+def handle_callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
     app.logger.info("Request body: " + body)
     app.logger.info(f"Headers: {dict(request.headers)}")
 
     try:
-        handler.handle(body, signature)
+        with span('webhook'):
+            handler.handle(body, signature)
     except InvalidSignatureError:
         app.logger.error("Invalid signature. Please check your channel access token/channel secret.")
         app.logger.error(f"Signature: {signature}")
@@ -179,78 +175,407 @@ def callback():
         app.logger.error(traceback.format_exc())
         abort(500)
 
-    return 'OK'
+    return app.make_response('OK')
+
+@app.route("/jobs/stats", methods=['GET'])
+def job_stats():
+    return jsonify(job_queue.stats())
+
+@app.route("/jobs/users", methods=['GET'])
+def job_user_stats():
+    return jsonify(job_queue.user_stats())
+
+@app.route("/clients/stats", methods=['GET'])
+def client_stats():
+    return jsonify(registry.stats())
+
+@app.route("/cache/stats", methods=['GET'])
+def cache_stats():
+    return jsonify(ocr_cache.stats() if ocr_cache else {})
+
+@app.route("/sheets/stats", methods=['GET'])
+def sheets_stats():
+    return jsonify(results_sink.stats())
+
+@app.route("/gemini/stats", methods=['GET'])
+def gemini_stats():
+    return jsonify(scheduler.stats())
+
+@app.route("/dedup/stats", methods=['GET'])
+def dedup_stats():
+    return jsonify(deduplicator.stats())
+
+@app.route("/batches/stats", methods=['GET'])
+def batch_stats():
+    return jsonify(image_batcher.stats())
+
+@app.route("/pipeline/stats", methods=['GET'])
+def pipeline_stats():
+    return jsonify(dict(pipeline.stats(), admission=admission.stats()))
+
+@app.route("/prefilter/stats", methods=['GET'])
+def prefilter_stats():
+    return jsonify(text_prefilter.stats())
+
+@app.route("/images/stats", methods=['GET'])
+def image_stats():
+    return jsonify(image_store.stats())
+
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+# 各コンポーネントの統計情報を/metricsにゲージとして出力する
+metrics.registry.register_stats('job_queue', job_queue.stats)
+metrics.registry.register_stats('gemini', scheduler.stats)
+metrics.registry.register_stats('dedup', deduplicator.stats)
+metrics.registry.register_stats('image_batcher', lambda: image_batcher.stats())
+metrics.registry.register_stats('sheets', results_sink.stats)
+metrics.registry.register_stats('pipeline', pipeline.stats)
+metrics.registry.register_stats('admission', admission.stats)
+metrics.registry.register_stats('prefilter', text_prefilter.stats)
+metrics.registry.register_stats('images', image_store.stats)
+if ocr_cache:
+    metrics.registry.register_stats('ocr_cache', ocr_cache.stats)
+
+def get_push_target(source):
+    """
+    イベントの送信元からプッシュメッセージの送信先IDを取得する関数
+    """
+    return (getattr(source, 'user_id', None)
+            or getattr(source, 'group_id', None)
+            or getattr(source, 'room_id', None))
+
+def push_text(to, text):
+    """
+    テキストメッセージをプッシュ送信する関数
+    """
+    from linebot.v3.messaging import MessagingApi, PushMessageRequest, TextMessage
+    messaging_api = MessagingApi(registry.get('line'))
+    messaging_api.push_message(
+        PushMessageRequest(
+            to=to,
+            messages=[TextMessage(text=text)]
+        )
+    )
+
+async def push_text_async(to, text):
+    """
+    push_textのasyncio版
+    """
+    from linebot.v3.messaging import AsyncMessagingApi, PushMessageRequest, TextMessage
+    messaging_api = AsyncMessagingApi(registry.get('line:async'))
+    await messaging_api.push_message(
+        PushMessageRequest(
+            to=to,
+            messages=[TextMessage(text=text)]
+        )
+    )
+
+def reply_text(reply_token, text):
+    """
+    テキストメッセージで返信する関数
+
+    Webhookの応答の中で混雑を知らせるために使うため、失敗してもログに残すだけにする。
+    """
+    from linebot.v3.messaging import MessagingApi, ReplyMessageRequest, TextMessage
+    try:
+        messaging_api = MessagingApi(registry.get('line'))
+        messaging_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=reply_token,
+                messages=[TextMessage(text=text)]
+            )
+        )
+    except Exception as e:
+        app.logger.warning(f"Failed to reply: {str(e)}")
 
 @handler.add(MessageEvent)
 def handle_message(event):
+    # Webhookの応答を遅らせないよう、画像の処理はジョブキューに任せる
+    if isinstance(event.message, ImageMessageContent):
+        message_id = event.message.id
+        app.logger.info(f"Received image message: {message_id}")
+        
+        # 再送や重複したイベントは、ダウンロードやモデルの呼び出しの前に打ち切る
+        keys = event_keys(event)
+        claimed, entry = deduplicator.claim(keys, redelivery=is_redelivery(event))
+        if not claimed:
+            app.logger.info(f"Duplicate event for message {message_id} "
+                            f"({entry['state']}, job {entry['job_id']}), skipped")
+            return
+        
+        payload = {
+            'message_id': message_id,
+            'user_id': getattr(event.source, 'user_id', None),
+            'to': get_push_target(event.source),
+            'dedup_keys': keys,
+            'dedup_token': entry['token'],
+            'request_id': metrics.current_request_id()
+        }
+        
+        # 複数の画像をまとめて送った場合（画像セット）は、揃ってから1つのジョブで処理する
+        image_set = event.message.image_set
+        if image_set is not None and image_set.id:
+            image_batcher.add(f'set:{image_set.id}', dict(payload, index=image_set.index),
+                              window=SET_TIMEOUT, total=image_set.total)
+            return
+        if USER_WINDOW > 0:
+            image_batcher.add(f'user:{payload["to"]}', payload, window=USER_WINDOW)
+            return
+        
+        if PIPELINE_MODE == 'async':
+            # ジョブキューのスレッドを使わず、asyncioのパイプラインで処理する
+            key = job_key(payload)
+            try:
+                user_depth, delayed = admission.admit(key)
+            except queue.Full:
+                deduplicator.complete(keys, success=False)
+                app.logger.warning(f"Async pipeline is full, rejected message {message_id} from {payload['to']}")
+                reply_text(event.reply_token, REJECTED_MESSAGE)
+                return
+            try:
+                runner.submit(process_image_async(payload, key))
+            except Exception:
+                admission.release(key)
+                deduplicator.complete(keys, success=False)
+                raise
+            deduplicator.attach_job(keys, f'async:{message_id}')
+            if delayed and user_depth == 1:
+                reply_text(event.reply_token, BUSY_MESSAGE)
+            return
+        
+        try:
+            job = job_queue.enqueue('process_image', payload)
+        except queue.Full:
+            # 処理待ちが上限に達している場合は、タイムアウトさせずにすぐ断る（送り直せば受け付ける）
+            deduplicator.complete(keys, success=False)
+            app.logger.warning(f"Job queue is full, rejected message {message_id} from {payload['to']}")
+            reply_text(event.reply_token, REJECTED_MESSAGE)
+            return
+        except Exception:
+            deduplicator.complete(keys, success=False)
+            raise
+        deduplicator.attach_job(keys, job.id)
+        app.logger.info(f"Enqueued job: {job.id} (user queue {job.user_depth})")
+        
+        # すぐに処理を始められない場合は、待っていることを知らせる（続けて送った画像には1回だけ）
+        if job.delayed and job.user_depth == 1:
+            reply_text(event.reply_token, BUSY_MESSAGE)
+
+def enqueue_image_batch(key, items):
+    """
+    まとめた画像を1つのジョブとしてキューに投入する関数（ImageBatcherから呼ばれる）
+    """
+    keys = [dedup_key for item in items for dedup_key in item['dedup_keys']]
     try:
-        if isinstance(event.message, ImageMessageContent):
-            message_id = event.message.id
-            app.logger.info(f"Received image message: {message_id}")
+        job = job_queue.enqueue('process_image_batch', {
+            'images': [{'message_id': item['message_id'], 'dedup_keys': item['dedup_keys'],
+                        'dedup_token': item.get('dedup_token')}
+                       for item in items],
+            'user_id': items[0]['user_id'],
+            'to': items[0]['to'],
+            'request_id': items[0]['request_id']
+        })
+    except queue.Full:
+        # まとめた画像は返信用のトークンが期限切れの場合があるため、プッシュで断る
+        deduplicator.complete(keys, success=False)
+        app.logger.warning(f"Job queue is full, rejected batch {key} ({len(items)} images)")
+        push_text(items[0]['to'], REJECTED_MESSAGE)
+        return
+    except Exception:
+        deduplicator.complete(keys, success=False)
+        raise
+    deduplicator.attach_job(keys, job.id)
+    app.logger.info(f"Enqueued batch job: {job.id} ({key}, {len(items)} images)")
+
+# 画像セットの画像を集めてからジョブに回す
+image_batcher = create_image_batcher(enqueue_image_batch)
+
+@job_queue.register('process_image')
+def process_image(payload):
+    message_id = payload['message_id']
+    to = payload['to']
+    # キューで待っている間に再送されたイベントが処理を引き継いだ場合は処理しない
+    if not deduplicator.start(payload.get('dedup_keys', []), payload.get('dedup_token')):
+        app.logger.info(f"Message {message_id} was claimed again by a redelivered event, skipped")
+        return
+    succeeded = False
+    try:
+        # 画像をメモリに溜めずに少しずつディスクへ書き込み、
+        # 前処理（縮小・補正・再圧縮）してからメッセージIDをキーに保存する
+        app.logger.info("Getting message content...")
+        file_path, image_data, stats = ingest_message_image(
+            registry.get('line'), image_store, message_id,
+            preprocess=lambda path: preprocess_image_async(path).result(),
+            user_id=payload.get('user_id'))
+        app.logger.info(f"Saved image to: {file_path} ({stats['downloaded_bytes']} -> "
+                        f"{stats['processed_bytes']} bytes, preprocess {stats['seconds']:.3f}s)")
+        
+        # 文字が写っていない画像はモデルを呼び出さずに返信する
+        if text_prefilter.screen(image_data, stats.get('text_features')):
+            push_text(to, NO_TEXT_MESSAGE)
+            succeeded = True
+            return
+        
+        # 画像からテキストを抽出
+        app.logger.info("Extracting table from image...")
+        details = {}
+        # ストリーミングの場合は、完成した行からスプレッドシートに書き込み始める
+        stream = open_result_stream(file_path)
+        table_data = extract_table_cached(image_data, details=details,
+                                          on_rows=stream.add_rows if stream else None,
+                                          user_id=payload.get('user_id'))
+        if 'first_row_seconds' in details:
+            app.logger.info(f"First row after {details['first_row_seconds']:.3f}s")
+        
+        if table_data:
+            # スプレッドシートにデータを追加
+            app.logger.info("Appending data to spreadsheet...")
+            append_to_spreadsheet(table_data, file_path, image_id=message_id,
+                                  user_id=payload.get('user_id'), raw_text=details.get('raw_text'),
+                                  stream=stream)
             
-            with ApiClient(configuration) as api_client:
-                blob_api = MessagingApiBlob(api_client)
-                messaging_api = MessagingApi(api_client)
-                
-                # 画像のバイナリデータを取得
-                app.logger.info("Getting message content...")
-                message_content = blob_api.get_message_content(message_id)
-                
-                # 保存するファイル名を生成
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                file_name = f'image_{timestamp}.jpg'
-                file_path = os.path.join(SAVE_DIR, file_name)
-                
-                # 画像を保存
-                app.logger.info(f"Saving image to: {file_path}")
-                with open(file_path, 'wb') as f:
-                    f.write(message_content)
-                
-                # 画像からテキストを抽出
-                app.logger.info("Extracting text from image...")
-                image = Image.open(io.BytesIO(message_content))
-                model = genai.GenerativeModel('gemini-1.5-flash')
-                response = model.generate_content(["この画像から文字を抽出してください。", image])
-                extracted_text = response.text
-                
-                # テキストを表形式に整形
-                app.logger.info("Formatting text to table...")
-                table_data = format_text_to_table(extracted_text)
+            # ユーザーに完了を通知
+            push_text(to, '画像を保存し、文字を抽出しました。\nスプレッドシートに保存しました。')
+            succeeded = True
+        else:
+            push_text(to, '文字の抽出に失敗しました。')
                 
-                if table_data:
-                    # スプレッドシートにデータを追加
-                    app.logger.info("Appending data to spreadsheet...")
-                    append_to_spreadsheet(table_data, file_path)
-                    
-                    # ユーザーに完了を通知
-                    messaging_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=f'画像を保存し、文字を抽出しました。\nスプレッドシートに保存しました。')]
-                        )
-                    )
+    except Exception as e:
+        app.logger.error(f"Error in process_image: {str(e)}")
+        app.logger.error(traceback.format_exc())
+        push_text(to, f'エラーが発生しました: {str(e)}')
+    finally:
+        # 失敗した場合は再送されたイベントで再試行できるようにする
+        deduplicator.complete(payload.get('dedup_keys', []), success=succeeded)
+
+async def process_image_async(payload, key):
+    """
+    process_imageのasyncio版（IMAGE_PIPELINE=asyncの場合に使う）
+
+    admissionで受け付けた画像を、そのユーザーの処理の枠が空いてから処理する。
+    """
+    message_id = payload['message_id']
+    to = payload['to']
+    succeeded = False
+    superseded = False
+    try:
+        async with admission.slot(key):
+            # 枠を待っている間に再送されたイベントが処理を引き継いだ場合は処理しない
+            if not deduplicator.start(payload.get('dedup_keys', []), payload.get('dedup_token')):
+                app.logger.info(f"Message {message_id} was claimed again by a redelivered event, skipped")
+                superseded = True
+                return
+            with span('job', job='process_image_async'):
+                app.logger.info("Processing image in the async pipeline...")
+                result = await pipeline.process_message(message_id, user_id=payload.get('user_id'))
+                app.logger.info(f"Saved image to: {result['path']} ({result['stats']['downloaded_bytes']} -> "
+                                f"{result['stats']['processed_bytes']} bytes)")
+            
+                if result['no_text']:
+                    await push_text_async(to, NO_TEXT_MESSAGE)
+                    succeeded = True
+                elif result['table']:
+                    await push_text_async(to, '画像を保存し、文字を抽出しました。\nスプレッドシートに保存しました。')
+                    succeeded = True
                 else:
-                    messaging_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text='文字の抽出に失敗しました。')]
-                        )
-                    )
-                
+                    await push_text_async(to, '文字の抽出に失敗しました。')
+    
     except Exception as e:
-        app.logger.error(f"Error in handle_message: {str(e)}")
+        app.logger.error(f"Error in process_image_async: {str(e)}")
         app.logger.error(traceback.format_exc())
-        with ApiClient(configuration) as api_client:
-            messaging_api = MessagingApi(api_client)
-            messaging_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=f'エラーが発生しました: {str(e)}')]
-                )
-            )
+        await push_text_async(to, f'エラーが発生しました: {str(e)}')
+    finally:
+        if not superseded:
+            deduplicator.complete(payload.get('dedup_keys', []), success=succeeded)
+
+@job_queue.register('process_image_batch')
+def process_image_batch(payload):
+    # キューで待っている間に再送されたイベントが処理を引き継いだ画像は除く
+    images = [image for image in payload['images']
+              if deduplicator.start(image['dedup_keys'], image.get('dedup_token'))]
+    if len(images) < len(payload['images']):
+        app.logger.info(f"{len(payload['images']) - len(images)} images were claimed again "
+                        f"by redelivered events, skipped")
+    if not images:
+        return
+    to = payload['to']
+    succeeded = False
+    # 取得に失敗した画像（再送されたイベントで再試行できるよう、処理済みにしない）
+    failed = []
+    try:
+        # 各画像を取得・前処理して保存する（前処理は画像ごとに並列に行われる）
+        # 取得に失敗した画像があっても、取得できた画像だけで抽出を続ける
+        app.logger.info(f"Getting {len(images)} message contents...")
+        ingested = []
+        error = None
+        for image in images:
+            try:
+                path, image_data, stats = ingest_message_image(
+                    registry.get('line'), image_store, image['message_id'],
+                    preprocess=lambda path: preprocess_image_async(path).result(),
+                    user_id=payload.get('user_id'))
+            except Exception as e:
+                app.logger.error(f"画像の取得に失敗しました: {image['message_id']}: {str(e)}")
+                failed.append(image)
+                error = error or e
+                continue
+            ingested.append((image, path, image_data, stats))
+        if not ingested:
+            raise error
+        failed_note = f"\n（{len(failed)}枚は画像を取得できなかったため除きました）" if failed else ''
+        
+        # 文字が写っていない画像は抽出に含めない
+        extracted = [(image, path, image_data) for image, path, image_data, stats in ingested
+                     if not text_prefilter.screen(image_data, stats.get('text_features'))]
+        if not extracted:
+            push_text(to, NO_TEXT_MESSAGE + failed_note)
+            succeeded = True
+            return
+        
+        # 全ての画像から1つの表を抽出
+        app.logger.info("Extracting table from images...")
+        details = {}
+        table_data = extract_table_batch([image_data for _, _, image_data in extracted], details=details,
+                                         user_id=payload.get('user_id'))
+        
+        if table_data:
+            # まとめた表を1回でスプレッドシートに追加
+            app.logger.info("Appending data to spreadsheet...")
+            append_to_spreadsheet(table_data, ', '.join(path for _, path, _ in extracted),
+                                  image_id=','.join(image['message_id'] for image, _, _ in extracted),
+                                  user_id=payload.get('user_id'), raw_text=details.get('raw_text'))
+            
+            message = f'{len(ingested)}枚の画像を保存し、文字を抽出しました。\nスプレッドシートに保存しました。'
+            message += failed_note
+            if len(extracted) < len(ingested):
+                message += f"\n（{len(ingested) - len(extracted)}枚は文字が見つからなかったため除きました）"
+            if details.get('failed_images'):
+                message += f"\n（{details['failed_images']}枚は文字の抽出に失敗しました）"
+            push_text(to, message)
+            succeeded = True
+        else:
+            push_text(to, '文字の抽出に失敗しました。' + failed_note)
+    
+    except Exception as e:
+        app.logger.error(f"Error in process_image_batch: {str(e)}")
+        app.logger.error(traceback.format_exc())
+        push_text(to, f'エラーが発生しました: {str(e)}')
+    finally:
+        for image in images:
+            deduplicator.complete(image['dedup_keys'], success=succeeded and image not in failed)
 
 if __name__ == "__main__":
     app.logger.info("Starting server...")
     app.logger.info(f"Access Token: {access_token[:5]}...")
     app.logger.info(f"Channel Secret: {channel_secret[:5]}...")
-    app.run(host='0.0.0.0', port=5000, debug=True) 
\ No newline at end of file
+    # リローダーの監視プロセスではワーカーを起動しない
+    if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        google_credentials.enable_interactive_auth()
+        start_warm_up()
+        job_queue.start()
+        # 前回の起動時に同期できなかった抽出結果を送信する
+        results_sink.start()
+    # 開発用のサーバー（本番はserve.pyを使う）
+    app.run(host='0.0.0.0', port=int(os.getenv('PORT', 5000)), debug=app.debug) 
\ No newline at end of file
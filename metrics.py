@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import uuid
+import bisect
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# 処理時間のヒストグラムの区切り（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# 各処理段階の所要時間のヒストグラム名
+STAGE_METRIC = 'stage_duration_seconds'
+
+# スレッドごと（asyncioではタスクごと）のリクエストID
+_request_id = contextvars.ContextVar('request_id', default=None)
+
+
+class Histogram:
+    """
+    区切りごとの件数・合計・件数を保持するヒストグラム（ラベルの組み合わせごとに1つ）
+    """
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    カウンターとヒストグラムをまとめて管理し、Prometheus形式で出力するレジストリ
+
+    ラベルの組み合わせごとの値は初回だけ生成し、以降は同じオブジェクトを更新する。
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, labels=()):
+        """
+        ヒストグラムに値を記録する
+
+        Args:
+            name (str): メトリクス名
+            value (float): 値
+            labels (tuple): (ラベル名, 値) のタプル
+        """
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def inc(self, name, value=1, labels=()):
+        """
+        カウンターを増やす
+        """
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def register_stats(self, prefix, stats_func):
+        """
+        stats()が返すdictの数値をゲージとして出力に含める
+
+        Args:
+            prefix (str): メトリクス名の接頭辞（例: 'job_queue'）
+            stats_func: dictを返す関数
+        """
+        self._collectors.append((prefix, stats_func))
+
+    def render(self):
+        """
+        Prometheusのテキスト形式で出力する
+
+        Returns:
+            str: /metricsの本文
+        """
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            snapshot = [(key, list(h.counts), h.sum, h.count) for key, h in histograms]
+
+        described = set()
+        for (name, labels), value in counters:
+            if name not in described:
+                described.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{format_labels(labels)} {value}')
+
+        for (name, labels), counts, total, count in snapshot:
+            if name not in described:
+                described.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", repr(bound)),))} {cumulative}')
+            lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+
+        for prefix, stats_func in self._collectors:
+            try:
+                stats = stats_func()
+            except Exception:
+                continue
+            for key, value in flatten_stats(prefix, stats):
+                lines.append(f'# TYPE {key} gauge')
+                lines.append(f'{key} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+def flatten_stats(prefix, stats):
+    """
+    入れ子のdictから数値だけを取り出し、(メトリクス名, 値) を返す
+    """
+    for key, value in stats.items():
+        name = f'{prefix}_{key}'
+        if isinstance(value, bool):
+            yield name, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, value
+        elif isinstance(value, dict):
+            yield from flatten_stats(name, value)
+
+
+class Span:
+    """
+    1つの処理段階の所要時間を計測し、終了時にヒストグラムへ記録する
+
+    例外で終了した場合はoutcome="error"として記録する。
+    """
+
+    __slots__ = ('stage', 'labels', 'started')
+
+    def __init__(self, stage, labels):
+        self.stage = stage
+        self.labels = labels
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        outcome = 'ok' if exc_type is None else 'error'
+        registry.observe(STAGE_METRIC, elapsed, (('stage', self.stage),) + self.labels + (('outcome', outcome),))
+        if TRACE_LOG:
+            logger.info(f"span {self.stage} {outcome} {elapsed * 1000:.1f}ms")
+        return False
+
+
+def span(stage, **labels):
+    """
+    処理段階の所要時間を計測するコンテキストマネージャーを返す関数
+
+    例:
+        with span('download'):
+            ...
+        with span('ocr_call', model='gemini-1.5-flash'):
+            ...
+
+    Args:
+        stage (str): 処理段階の名前
+        **labels: 追加のラベル（modelなど）
+    """
+    return Span(stage, tuple(sorted(labels.items())) if labels else ())
+
+
+def timed(stage, **labels):
+    """
+    関数の所要時間を計測するデコレーター
+    """
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with span(stage, **labels):
+                return func(*args, **kwargs)
+        wrapper.__name__ = getattr(func, '__name__', stage)
+        wrapper.__doc__ = getattr(func, '__doc__', None)
+        return wrapper
+    return decorator
+
+
+def instrument_webhook_handler(handler):
+    """
+    LINEのWebhookHandlerの署名検証の所要時間を計測するようにする関数
+
+    handle()は署名検証とイベントの処理を続けて行うため、
+    署名検証の関数だけを置き換えて'verify_signature'として記録する。
+    署名が一致しない場合はoutcome="error"として記録する。
+
+    Args:
+        handler (linebot.v3.webhook.WebhookHandler): Webhookハンドラー
+
+    Returns:
+        WebhookHandler: 引数と同じハンドラー
+    """
+    validator = handler.parser.signature_validator
+    validate = validator.validate
+
+    def timed_validate(body, signature):
+        started = time.perf_counter()
+        valid = validate(body, signature)
+        registry.observe(STAGE_METRIC, time.perf_counter() - started,
+                         (('stage', 'verify_signature'), ('outcome', 'ok' if valid else 'error')))
+        return valid
+
+    validator.validate = timed_validate
+    return handler
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+@contextmanager
+def request_context(request_id=None):
+    """
+    このブロック内のログにリクエストIDを付ける
+
+    Args:
+        request_id (str): リクエストID（省略時は新しく生成する）
+    """
+    token = _request_id.set(request_id or new_request_id())
+    try:
+        yield _request_id.get()
+    finally:
+        _request_id.reset(token)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    ログを1行のJSONとして出力するフォーマッター（request_idを含む）
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        request_id = current_request_id()
+        if request_id:
+            entry['request_id'] = request_id
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    テキスト形式のログにrequest_idを付けるフィルター
+    """
+
+    def filter(self, record):
+        record.request_id = current_request_id() or '-'
+        return True
+
+
+def configure_logging():
+    """
+    環境変数の設定からログの形式を設定する関数
+
+    LOG_FORMAT: 'json' の場合は1行1件のJSON、それ以外はテキスト（デフォルト'text'）
+    LOG_LEVEL: ログレベル（デフォルト'INFO'）
+    """
+    handler = logging.StreamHandler()
+    if os.getenv('LOG_FORMAT', 'text') == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.addFilter(RequestIdFilter())
+        handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s %(name)s [%(request_id)s] %(message)s'))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO'))
+
+
+logger = logging.getLogger(__name__)
+
+# 各スパンの所要時間もログに出力するかどうか（METRICS_TRACE_LOG=1）
+TRACE_LOG = os.getenv('METRICS_TRACE_LOG', '0') == '1'
+
+# プロセス全体で共有するレジストリ
+registry = MetricsRegistry()
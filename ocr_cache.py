@@ -0,0 +1,467 @@
+import os
+import io
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageChops
+
+import image_tiling
+import table_extraction
+from event_loop import runner
+
+logger = logging.getLogger(__name__)
+
+# 知覚ハッシュの一辺のサイズ（16なら256ビット）
+HASH_SIZE = 16
+
+# 類似画像の確認に使う縮小画像の幅と、異なる画素とみなす明るさの差
+THUMBNAIL_WIDTH = 256
+PIXEL_DELTA = 48
+
+# 期限切れの項目をまとめて削除する間隔（秒、参照した項目はその都度期限を確認する）
+EXPIRE_SWEEP_INTERVAL = 60
+
+
+def sha256_hex(data):
+    """
+    画像バイト列のSHA-256を計算する関数
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def perceptual_hash(data, hash_size=HASH_SIZE):
+    """
+    画像の差分ハッシュ（dHash）を計算する関数
+
+    リサイズや再圧縮された同じ画像はほぼ同じハッシュになる。
+
+    Args:
+        data (bytes): 画像のバイト列
+        hash_size (int): ハッシュの一辺のサイズ
+
+    Returns:
+        str: 16進数表記のハッシュ
+    """
+    image = Image.open(io.BytesIO(data))
+    # JPEGは縮小デコードして計算を軽くする
+    image.draft('L', (hash_size * 8, hash_size * 8))
+    image = image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(image.getdata())
+
+    value = 0
+    for y in range(hash_size):
+        row = pixels[y * (hash_size + 1):(y + 1) * (hash_size + 1)]
+        for x in range(hash_size):
+            value = (value << 1) | (row[x] > row[x + 1])
+    return f'{value:0{hash_size * hash_size // 4}x}'
+
+
+def hamming_distance(a, b):
+    """
+    16進数表記のハッシュ同士のハミング距離を計算する関数
+    """
+    return (int(a, 16) ^ int(b, 16)).bit_count()
+
+
+def thumbnail(data, width=THUMBNAIL_WIDTH):
+    """
+    類似画像の確認に使う縮小画像（グレースケールのPNG）を作成する関数
+
+    知覚ハッシュは書式が同じで数字だけが違うレシートを区別できないため、
+    近い画像は文字が読み取れる程度の縮小画像を比べて確かめる。
+
+    Args:
+        data (bytes): 画像のバイト列
+        width (int): 縮小後の幅
+
+    Returns:
+        bytes: PNGのバイト列
+    """
+    image = Image.open(io.BytesIO(data)).convert('L')
+    image = image.resize((width, max(1, round(image.height * width / image.width))), Image.BILINEAR)
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def thumbnail_difference(a, b):
+    """
+    縮小画像同士で明るさがPIXEL_DELTAより大きく違う画素の数を数える関数
+
+    Returns:
+        int: 違う画素の数（縦横比が違う場合はNone）
+    """
+    image_a = Image.open(io.BytesIO(a))
+    image_b = Image.open(io.BytesIO(b))
+    if image_a.width != image_b.width or abs(image_a.height - image_b.height) > 2:
+        return None
+    if image_a.size != image_b.size:
+        image_b = image_b.resize(image_a.size, Image.BILINEAR)
+    return sum(ImageChops.difference(image_a, image_b).histogram()[PIXEL_DELTA + 1:])
+
+
+class MemoryOCRCache:
+    """
+    インメモリのLRUキャッシュ
+
+    期限切れの項目は参照したときに削除し、全体の確認は
+    EXPIRE_SWEEP_INTERVAL秒に1回だけ行う（検索のたびに全件を走査しない）。
+
+    Args:
+        max_entries (int): 保持する最大件数
+        ttl (float): 有効期限（秒）
+    """
+
+    def __init__(self, max_entries=1000, ttl=7 * 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+
+    def get(self, namespace, sha256, phash, max_distance, user_id=None, matches=None):
+        now = time.time()
+        with self._lock:
+            self._sweep_expired(now)
+            entry = self._entries.get((namespace, sha256))
+            if entry and self._expired(entry, now):
+                del self._entries[(namespace, sha256)]
+                entry = None
+            if entry:
+                self._entries.move_to_end((namespace, sha256))
+                return entry['value'], 'exact'
+
+            found = None
+            if max_distance > 0 and user_id:
+                expired = []
+                for key, entry in reversed(self._entries.items()):
+                    if key[0] != namespace or entry['user_id'] != user_id or not entry['phash']:
+                        continue
+                    if self._expired(entry, now):
+                        expired.append(key)
+                        continue
+                    if hamming_distance(entry['phash'], phash) <= max_distance and \
+                            (matches is None or matches(entry['thumbnail'])):
+                        found = key
+                        break
+                for key in expired:
+                    del self._entries[key]
+            if found is not None:
+                self._entries.move_to_end(found)
+                return self._entries[found]['value'], 'near'
+        return None, None
+
+    def put(self, namespace, sha256, phash, value, user_id=None, thumbnail=None):
+        now = time.time()
+        with self._lock:
+            self._sweep_expired(now)
+            self._entries[(namespace, sha256)] = {
+                'phash': phash,
+                'user_id': user_id,
+                'thumbnail': thumbnail,
+                'value': value,
+                'created_at': now
+            }
+            self._entries.move_to_end((namespace, sha256))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expired(self, entry, now):
+        return now - entry['created_at'] > self.ttl
+
+    def _sweep_expired(self, now):
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + EXPIRE_SWEEP_INTERVAL
+        expired = [key for key, entry in self._entries.items() if self._expired(entry, now)]
+        for key in expired:
+            del self._entries[key]
+
+
+class SQLiteOCRCache:
+    """
+    SQLiteに保存する永続キャッシュ
+
+    Args:
+        path (str): SQLiteファイルのパス
+        max_entries (int): 保持する最大件数
+        ttl (float): 有効期限（秒）
+    """
+
+    def __init__(self, path, max_entries=10000, ttl=30 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS ocr_cache ('
+                'namespace TEXT NOT NULL, sha256 TEXT NOT NULL, phash TEXT NOT NULL, '
+                'value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL, '
+                'PRIMARY KEY (namespace, sha256))'
+            )
+            # 類似画像の照合をユーザーごとに行うための列（以前のファイルには追加する）
+            columns = {row[1] for row in self._conn.execute('PRAGMA table_info(ocr_cache)')}
+            if 'user_id' not in columns:
+                self._conn.execute('ALTER TABLE ocr_cache ADD COLUMN user_id TEXT')
+            if 'thumbnail' not in columns:
+                self._conn.execute('ALTER TABLE ocr_cache ADD COLUMN thumbnail BLOB')
+            self._conn.commit()
+
+    def get(self, namespace, sha256, phash, max_distance, user_id=None, matches=None):
+        now = time.time()
+        with self._lock:
+            # 期限切れの行の削除はEXPIRE_SWEEP_INTERVAL秒に1回にし、検索では期限切れの行を除く
+            if now >= self._next_sweep:
+                self._next_sweep = now + EXPIRE_SWEEP_INTERVAL
+                self._conn.execute('DELETE FROM ocr_cache WHERE created_at < ?', (now - self.ttl,))
+            row = self._conn.execute(
+                'SELECT sha256, value FROM ocr_cache WHERE namespace = ? AND sha256 = ? AND created_at >= ?',
+                (namespace, sha256, now - self.ttl)
+            ).fetchone()
+            kind = 'exact'
+
+            if row is None and max_distance > 0 and user_id:
+                kind = 'near'
+                for candidate_sha, candidate_phash, candidate_thumbnail, value in self._conn.execute(
+                        "SELECT sha256, phash, thumbnail, value FROM ocr_cache "
+                        "WHERE namespace = ? AND user_id = ? AND phash != '' AND created_at >= ? "
+                        "ORDER BY accessed_at DESC",
+                        (namespace, user_id, now - self.ttl)).fetchall():
+                    if hamming_distance(candidate_phash, phash) <= max_distance and \
+                            (matches is None or matches(candidate_thumbnail)):
+                        row = (candidate_sha, value)
+                        break
+
+            if row is None:
+                self._conn.commit()
+                return None, None
+
+            self._conn.execute(
+                'UPDATE ocr_cache SET accessed_at = ? WHERE namespace = ? AND sha256 = ?',
+                (now, namespace, row[0])
+            )
+            self._conn.commit()
+        return json.loads(row[1]), kind
+
+    def put(self, namespace, sha256, phash, value, user_id=None, thumbnail=None):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO ocr_cache '
+                '(namespace, sha256, phash, value, created_at, accessed_at, user_id, thumbnail) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (namespace, sha256, phash, json.dumps(value, ensure_ascii=False), now, now, user_id, thumbnail)
+            )
+            # 上限を超えた分は最後に参照された時刻が古いものから削除
+            self._conn.execute(
+                'DELETE FROM ocr_cache WHERE rowid IN ('
+                'SELECT rowid FROM ocr_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM ocr_cache').fetchone()[0]
+
+
+class OCRCache:
+    """
+    画像ハッシュをキーにしたOCR結果キャッシュ
+
+    SHA-256が一致すれば同一画像とみなし、モデル呼び出しを省略する。
+    max_distanceを指定した場合は、同じユーザーが以前に送った画像のうち知覚ハッシュが近く、
+    縮小画像で違う画素がmax_pixels以下のものも同じ画像の再送（再圧縮・リサイズ）とみなす。
+    知覚ハッシュだけでは書式が同じで数字だけが違うレシートも距離0〜1になるため、
+    縮小画像の確認は省略しない。
+
+    Args:
+        backend: MemoryOCRCache または SQLiteOCRCache
+        max_distance (int): 類似画像の候補とする知覚ハッシュの最大ハミング距離（0で完全一致のみ）
+        max_pixels (int): 類似画像とみなす縮小画像の違う画素の最大数
+    """
+
+    def __init__(self, backend, max_distance=0, max_pixels=0):
+        self.backend = backend
+        self.max_distance = max_distance
+        self.max_pixels = max_pixels
+        self._lock = threading.Lock()
+        self._counters = {'hits_exact': 0, 'hits_near': 0, 'misses': 0}
+
+    @property
+    def near_matching(self):
+        return self.max_distance > 0
+
+    def matches(self, thumbnail_data):
+        """
+        縮小画像が一致するか確かめる関数を返す
+        """
+        def check(other):
+            if thumbnail_data is None or other is None:
+                return False
+            difference = thumbnail_difference(thumbnail_data, other)
+            return difference is not None and difference <= self.max_pixels
+        return check
+
+    def get(self, namespace, sha256, phash, user_id=None, thumbnail_data=None):
+        """
+        キャッシュを参照する（類似画像はuser_idと縮小画像がある場合だけ照合する）
+        """
+        max_distance = self.max_distance if thumbnail_data is not None else 0
+        value, kind = self.backend.get(namespace, sha256, phash, max_distance, user_id=user_id,
+                                       matches=self.matches(thumbnail_data))
+        with self._lock:
+            if kind:
+                self._counters[f'hits_{kind}'] += 1
+            else:
+                self._counters['misses'] += 1
+        return value
+
+    def put(self, namespace, sha256, phash, value, user_id=None, thumbnail_data=None):
+        self.backend.put(namespace, sha256, phash, value, user_id=user_id, thumbnail=thumbnail_data)
+
+    def stats(self):
+        """
+        キャッシュのヒット・ミス数を取得する
+
+        Returns:
+            dict: ヒット数（完全一致・類似）、ミス数、ヒット率、件数
+        """
+        with self._lock:
+            counters = dict(self._counters)
+        lookups = sum(counters.values())
+        hits = counters['hits_exact'] + counters['hits_near']
+        counters['hit_ratio'] = hits / lookups if lookups else 0.0
+        counters['entries'] = len(self.backend)
+        return counters
+
+
+def create_ocr_cache():
+    """
+    環境変数の設定からOCRキャッシュを作成する関数
+
+    OCR_CACHE_BACKEND: 'memory'（デフォルト）, 'sqlite', 'off'
+    OCR_CACHE_DB: SQLiteファイルのパス（デフォルト'ocr_cache.sqlite3'）
+    OCR_CACHE_MAX_ENTRIES: 最大件数（デフォルト1000）
+    OCR_CACHE_TTL: 有効期限の秒数（デフォルト7日）
+    OCR_CACHE_MAX_DISTANCE: 類似画像の候補とするハミング距離（デフォルト0で完全一致のみ）
+    OCR_CACHE_NEAR_MAX_PIXELS: 類似画像とみなす縮小画像の違う画素の数（デフォルト0）
+
+    Returns:
+        OCRCache: キャッシュ。無効の場合はNone
+    """
+    backend_name = os.getenv('OCR_CACHE_BACKEND', 'memory')
+    max_entries = int(os.getenv('OCR_CACHE_MAX_ENTRIES', 1000))
+    ttl = float(os.getenv('OCR_CACHE_TTL', 7 * 24 * 3600))
+
+    if backend_name == 'off':
+        return None
+    if backend_name == 'sqlite':
+        backend = SQLiteOCRCache(os.getenv('OCR_CACHE_DB', 'ocr_cache.sqlite3'), max_entries, ttl)
+    else:
+        backend = MemoryOCRCache(max_entries, ttl)
+    return OCRCache(backend, max_distance=int(os.getenv('OCR_CACHE_MAX_DISTANCE', 0)),
+                    max_pixels=int(os.getenv('OCR_CACHE_NEAR_MAX_PIXELS', 0)))
+
+
+ocr_cache = create_ocr_cache()
+
+
+def extract_table_uncached(image_data, mode, model, raise_errors, details, on_rows=None):
+    """
+    キャッシュを使わずに画像から表形式のデータを抽出する関数（mode='tiled'は帯に分けて読み取る）
+    """
+    return runner.run(extract_table_uncached_async(image_data, mode, model, raise_errors, details, on_rows))
+
+
+async def extract_table_uncached_async(image_data, mode, model, raise_errors, details, on_rows=None):
+    """
+    extract_table_uncachedのasyncio版
+    """
+    if mode == 'tiled':
+        return await image_tiling.extract_table_tiled_async(image_data, model=model, raise_errors=raise_errors,
+                                                            details=details, on_rows=on_rows)
+    return await table_extraction.extract_table_async(table_extraction.image_part(image_data), mode=mode,
+                                                      model=model, raise_errors=raise_errors, details=details,
+                                                      on_rows=on_rows)
+
+
+def image_keys(cache, image_data, user_id):
+    """
+    キャッシュの照合に使うSHA-256・知覚ハッシュ・縮小画像を求める関数
+
+    知覚ハッシュと縮小画像は類似画像を照合する場合（有効かつ送信者が分かる場合）だけ計算する。
+
+    Returns:
+        tuple: (SHA-256, 知覚ハッシュ（計算しない場合は''）, 縮小画像（計算しない場合はNone）)
+    """
+    sha256 = sha256_hex(image_data)
+    if not cache.near_matching or not user_id:
+        return sha256, '', None
+    return sha256, perceptual_hash(image_data), thumbnail(image_data)
+
+
+def extract_table_cached(image_data, mode=None, model=None, cache=None, raise_errors=False, details=None,
+                         on_rows=None, user_id=None):
+    """
+    キャッシュを参照しながら画像から表形式のデータを抽出する関数
+
+    Args:
+        image_data (bytes): 画像のバイト列
+        mode (str): 'direct' または 'two_stage'（省略時はEXTRACTION_MODE。OCR_TILINGで帯に分ける画像は'tiled'）
+        model: Geminiモデル（省略時は共有のモデル）
+        cache (OCRCache): 使用するキャッシュ（省略時はモジュールのキャッシュ）
+        raise_errors (bool): モデル呼び出しの例外をそのまま送出するかどうか
+        details (dict): 指定した場合はモデルの出力を'raw_text'に格納する（キャッシュにヒットした場合は格納しない）
+        on_rows: 指定した場合は表の応答をストリーミングで受け取り、完成した行から
+            (ヘッダー, 行のリスト)を渡す関数（キャッシュにヒットした場合は呼ばない）
+        user_id (str): 送信したユーザーのID（類似画像は同じユーザーの画像とだけ照合する）
+
+    Returns:
+        list: 表形式のデータ（2次元リスト）。失敗した場合はNone
+    """
+    return runner.run(extract_table_cached_async(image_data, mode=mode, model=model, cache=cache,
+                                                 raise_errors=raise_errors, details=details, on_rows=on_rows,
+                                                 user_id=user_id))
+
+
+async def extract_table_cached_async(image_data, mode=None, model=None, cache=None, raise_errors=False,
+                                     details=None, on_rows=None, user_id=None):
+    """
+    extract_table_cachedのasyncio版
+
+    ハッシュの計算とキャッシュの参照（SQLiteの場合はディスクの読み書き）は
+    スレッドプールで行い、モデルの応答はgenerate_content_asyncで待つ。
+    """
+    cache = cache or ocr_cache
+    mode = mode or table_extraction.EXTRACTION_MODE
+    # 縦長の画像は帯に分けて読み取る（結果は1回で読み取った場合と別に扱う）
+    if image_tiling.should_tile(image_data):
+        mode = 'tiled'
+    if cache is None:
+        return await extract_table_uncached_async(image_data, mode, model, raise_errors, details, on_rows)
+
+    # モデル名・プロンプトが変わった場合は別の結果として扱う
+    namespace = f'{table_extraction.MODEL_NAME}:{table_extraction.PROMPT_VERSION}:{mode}'
+    sha256, phash, thumbnail_data = await asyncio.to_thread(image_keys, cache, image_data, user_id)
+
+    table_data = await asyncio.to_thread(cache.get, namespace, sha256, phash, user_id, thumbnail_data)
+    if table_data is not None:
+        logger.info(f"OCRキャッシュにヒットしました: {sha256[:12]}")
+        return table_data
+
+    table_data = await extract_table_uncached_async(image_data, mode, model, raise_errors, details, on_rows)
+    if table_data:
+        await asyncio.to_thread(cache.put, namespace, sha256, phash, table_data, user_id, thumbnail_data)
+    return table_data
@@ -0,0 +1,127 @@
+"""
+saved_images/に1枚ずつ保存した画像をアーカイブのセグメントにまとめる移行ツール
+
+画像ストアのインデックスに登録された画像と、インデックスのない古い画像
+（image_YYYYMMDD_HHMMSS.jpg など）をアーカイブに追記し、インデックスのパスを
+archive://<SHA-256><拡張子> に書き換えてから元のファイルを削除する。
+同じ内容の画像は1つだけ保存する。途中で停止しても再実行すると続きから移行する。
+
+移行後はIMAGE_STORE_BACKEND=packedで起動する。
+
+使い方:
+    python pack_images.py
+    python pack_images.py --dir saved_images --keep-files --verify
+"""
+import os
+import time
+import argparse
+
+from image_archive import SegmentArchive, ARCHIVE_SCHEME
+from image_store import ImageStore
+
+# 対象とする画像の拡張子
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def count_inodes(root):
+    """
+    ディレクトリ以下のファイルとディレクトリの数を数える関数
+    """
+    count = 0
+    for _, dirnames, filenames in os.walk(root):
+        count += len(dirnames) + len(filenames)
+    return count
+
+
+def loose_files(root, skip):
+    """
+    インデックスに登録されていない画像ファイルを古い順に列挙する関数
+    """
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        # アーカイブとダウンロード中の一時ファイルは対象外
+        dirnames[:] = [name for name in dirnames if name not in ('archive', '.incoming')]
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if name.lower().endswith(IMAGE_EXTENSIONS) and os.path.normpath(path) not in skip:
+                found.append(path)
+    return sorted(found, key=os.path.getmtime)
+
+
+def remove_empty_dirs(root):
+    """
+    移行で空になったハッシュのサブディレクトリを削除する関数
+    """
+    for dirpath, _, _ in sorted(os.walk(root), key=lambda entry: -len(entry[0])):
+        if dirpath != root and not os.listdir(dirpath) and os.path.basename(dirpath) != '.incoming':
+            os.rmdir(dirpath)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='1枚ずつ保存した画像をアーカイブのセグメントにまとめる')
+    parser.add_argument('--dir', default=os.getenv('IMAGE_STORE_DIR', 'saved_images'), help='画像ストアのディレクトリ')
+    parser.add_argument('--segment-max-bytes', type=int,
+                        default=int(os.getenv('ARCHIVE_SEGMENT_MAX_BYTES', 256 * 1024 * 1024)),
+                        help='1つのセグメントの最大サイズ')
+    parser.add_argument('--keep-files', action='store_true', help='移行した後も元のファイルを残す')
+    parser.add_argument('--dry-run', action='store_true', help='対象の画像を数えるだけで移行しない')
+    parser.add_argument('--verify', action='store_true', help='移行後に全ての画像のSHA-256を確かめる')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dir):
+        parser.error(f"ディレクトリが見つかりません: {args.dir}")
+
+    inodes_before = count_inodes(args.dir)
+    archive = SegmentArchive(os.path.join(args.dir, 'archive'), segment_max_bytes=args.segment_max_bytes)
+    store = ImageStore(args.dir, archive=archive)
+
+    indexed = [record for record in store.records() if not record['path'].startswith(ARCHIVE_SCHEME)]
+    known = {os.path.normpath(record['path']) for record in store.records()}
+    unindexed = loose_files(args.dir, known)
+    print(f"インデックスに登録された画像: {len(indexed)}枚  登録のない画像: {len(unindexed)}枚")
+    if args.dry_run:
+        return
+
+    packed = deduplicated = missing = failed = 0
+    packed_bytes = 0
+    started = time.perf_counter()
+    pending = [(record['path'], record['message_id'], record['user_id'], record['created_at'])
+               for record in indexed]
+    # 登録のない画像はファイル名（拡張子なし）をメッセージIDとして登録する
+    pending += [(path, os.path.splitext(os.path.basename(path))[0], None, None) for path in unindexed]
+    for i, (path, message_id, user_id, created_at) in enumerate(pending, 1):
+        if not os.path.exists(path):
+            missing += 1
+            print(f"[{i}/{len(pending)}] {path}: ファイルが見つかりません")
+            continue
+        try:
+            size = os.path.getsize(path)
+            _, duplicate = store.pack_file(path, message_id, user_id=user_id, created_at=created_at,
+                                           keep_file=args.keep_files)
+        except OSError as e:
+            failed += 1
+            print(f"[{i}/{len(pending)}] {path}: エラーが発生しました: {str(e)}")
+            continue
+        packed += 1
+        packed_bytes += size
+        deduplicated += duplicate
+    if not args.keep_files:
+        remove_empty_dirs(args.dir)
+    elapsed = time.perf_counter() - started
+
+    stats = archive.stats()
+    print(f"\n移行: {packed}枚（{packed_bytes / 1024 / 1024:.1f}MB）  重複: {deduplicated}枚  "
+          f"見つからない: {missing}枚  失敗: {failed}枚  経過時間: {elapsed:.1f}秒")
+    print(f"セグメント: {stats['segments']}個（{stats['segment_bytes'] / 1024 / 1024:.1f}MB）  "
+          f"画像: {stats['blobs']}個")
+    print(f"ファイルとディレクトリの数: {inodes_before} -> {count_inodes(args.dir)}")
+
+    if args.verify:
+        broken = archive.verify()
+        print(f"検証: {stats['blobs'] - len(broken)}個が一致  {len(broken)}個が不一致")
+        for sha256 in broken:
+            print(f"  不一致: {sha256}")
+
+
+if __name__ == '__main__':
+    main()
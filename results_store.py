@@ -0,0 +1,810 @@
+import os
+import csv
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+import argparse
+import threading
+from datetime import datetime
+
+from sheet_writer import build_rows
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# エクスポートで各行の先頭に付ける列
+EXPORT_COLUMNS = ['image_id', 'created_at', 'user_id', 'image_path', 'row_index']
+
+
+class ResultsStore:
+    """
+    抽出結果を保存するローカルのSQLiteデータベース
+
+    1枚の画像の抽出結果をextractionsに、表の各行をresult_rowsに保存する。
+    スプレッドシートへの同期状況もここで管理する。
+
+    ストリーミングで抽出中の結果はbeginで保存を始め、finishで完了にする。
+    未完了の結果も届いた行から同期するが（synced_rowsに同期済みの行数を記録する）、
+    エクスポートには含めない。
+
+    Args:
+        path (str): SQLiteファイルのパス
+    """
+
+    def __init__(self, path='results.sqlite3'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS extractions ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, image_id TEXT, created_at TEXT NOT NULL, '
+                'user_id TEXT, image_path TEXT, header TEXT NOT NULL, raw_text TEXT, '
+                'synced_at TEXT, complete INTEGER NOT NULL DEFAULT 1, synced_rows INTEGER NOT NULL DEFAULT 0)'
+            )
+            # 以前のバージョンで作成したデータベースには、ストリーミング用の列を追加する
+            columns = {row[1] for row in self._conn.execute('PRAGMA table_info(extractions)')}
+            for name in ('complete INTEGER NOT NULL DEFAULT 1', 'synced_rows INTEGER NOT NULL DEFAULT 0'):
+                if name.split()[0] not in columns:
+                    try:
+                        self._conn.execute(f'ALTER TABLE extractions ADD COLUMN {name}')
+                    except sqlite3.OperationalError:
+                        # 他のプロセスが同時に追加した場合
+                        pass
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS result_rows ('
+                'extraction_id INTEGER NOT NULL, row_index INTEGER NOT NULL, cells TEXT NOT NULL, '
+                'PRIMARY KEY (extraction_id, row_index))'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS extractions_created ON extractions (created_at)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS extractions_unsynced ON extractions (synced_at, id)')
+            self._conn.commit()
+
+    def add(self, table_data, image_path, created_at, image_id=None, user_id=None, raw_text=None):
+        """
+        1枚の画像の抽出結果を保存する
+
+        Args:
+            table_data (list): 表形式のデータ（2次元リスト、最初の行がヘッダー）
+            image_path (str): 画像ファイルのパス
+            created_at (str): 日時の文字列
+            image_id (str): 画像のID（LINEのメッセージIDなど）
+            user_id (str): 送信したユーザーのID
+            raw_text (str): モデルの出力
+
+        Returns:
+            int: 抽出結果のID
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                'INSERT INTO extractions (image_id, created_at, user_id, image_path, header, raw_text) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (image_id, created_at, user_id, image_path,
+                 json.dumps(table_data[0], ensure_ascii=False), raw_text)
+            )
+            extraction_id = cursor.lastrowid
+            self._insert_rows(extraction_id, 0, table_data[1:])
+        return extraction_id
+
+    def begin(self, header, image_path, created_at):
+        """
+        ストリーミングで抽出中の結果を、未完了として保存し始める
+
+        Args:
+            header (list): 表のヘッダー
+            image_path (str): 画像ファイルのパス
+            created_at (str): 日時の文字列
+
+        Returns:
+            int: 抽出結果のID
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                'INSERT INTO extractions (created_at, image_path, header, complete) VALUES (?, ?, ?, 0)',
+                (created_at, image_path, json.dumps(header, ensure_ascii=False))
+            )
+        return cursor.lastrowid
+
+    def add_rows(self, extraction_id, start_index, rows):
+        """
+        抽出中の結果に行を追加する
+
+        Args:
+            extraction_id (int): beginが返したID
+            start_index (int): 最初の行の番号（それまでに追加した行数）
+            rows (list): 行のリスト
+        """
+        with self._lock, self._conn:
+            self._insert_rows(extraction_id, start_index, rows)
+
+    def finish(self, extraction_id, start_index, rows, image_id=None, user_id=None, raw_text=None):
+        """
+        残りの行を追加し、抽出中の結果を完了にする
+
+        Args:
+            extraction_id (int): beginが返したID
+            start_index (int): 最初の行の番号（それまでに追加した行数）
+            rows (list): 残りの行のリスト
+            image_id (str): 画像のID（LINEのメッセージIDなど）
+            user_id (str): 送信したユーザーのID
+            raw_text (str): モデルの出力
+        """
+        with self._lock, self._conn:
+            self._insert_rows(extraction_id, start_index, rows)
+            self._conn.execute(
+                'UPDATE extractions SET complete = 1, image_id = ?, user_id = ?, raw_text = ? WHERE id = ?',
+                (image_id, user_id, raw_text, extraction_id)
+            )
+
+    def _insert_rows(self, extraction_id, start_index, rows):
+        self._conn.executemany(
+            'INSERT INTO result_rows (extraction_id, row_index, cells) VALUES (?, ?, ?)',
+            [(extraction_id, start_index + i, json.dumps(row, ensure_ascii=False))
+             for i, row in enumerate(rows)]
+        )
+
+    def unsynced(self, limit=100):
+        """
+        スプレッドシートに同期していない行がある抽出結果を古い順に取得する
+
+        抽出中の結果は、同期していない行がある場合だけ返す。
+
+        Returns:
+            list: 抽出結果のdictのリスト（'table'にヘッダーと同期していない行、
+                'synced_rows'に同期済みの行数、'complete'に抽出が完了しているかを含む）
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT id, image_id, created_at, user_id, image_path, header, complete, synced_rows '
+                'FROM extractions e WHERE synced_at IS NULL AND (complete = 1 OR synced_rows < '
+                '(SELECT COUNT(*) FROM result_rows r WHERE r.extraction_id = e.id)) '
+                'ORDER BY id LIMIT ?', (limit,)
+            ).fetchall()
+            extractions = []
+            for extraction_id, image_id, created_at, user_id, image_path, header, complete, synced_rows in rows:
+                cells = self._conn.execute(
+                    'SELECT cells FROM result_rows WHERE extraction_id = ? AND row_index >= ? ORDER BY row_index',
+                    (extraction_id, synced_rows)
+                ).fetchall()
+                extractions.append({
+                    'id': extraction_id,
+                    'image_id': image_id,
+                    'created_at': created_at,
+                    'user_id': user_id,
+                    'image_path': image_path,
+                    'table': [json.loads(header)] + [json.loads(row) for row, in cells],
+                    'synced_rows': synced_rows,
+                    'complete': bool(complete),
+                })
+            return extractions
+
+    def mark_synced(self, progress):
+        """
+        スプレッドシートに同期した行数を記録し、完了した抽出結果を同期済みにする
+
+        Args:
+            progress (list): (抽出結果のID, 同期済みの行数, 抽出が完了しているか)のリスト
+        """
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock, self._conn:
+            self._conn.executemany('UPDATE extractions SET synced_rows = ?, synced_at = ? WHERE id = ?',
+                                   [(rows, now if complete else None, extraction_id)
+                                    for extraction_id, rows, complete in progress])
+
+    def iter_rows(self, since=None, until=None):
+        """
+        表の各行を抽出結果の情報と合わせて古い順に返す
+
+        Args:
+            since (str): この日時以降（'YYYY-MM-DD'など、created_atとの文字列比較）
+            until (str): この日時より前
+
+        Yields:
+            dict: EXPORT_COLUMNSの値と'header'・'cells'を持つdict
+        """
+        query = ('SELECT e.image_id, e.created_at, e.user_id, e.image_path, r.row_index, e.header, r.cells '
+                 'FROM extractions e JOIN result_rows r ON r.extraction_id = e.id')
+        conditions, params = ['e.complete = 1'], []
+        if since:
+            conditions.append('e.created_at >= ?')
+            params.append(since)
+        if until:
+            conditions.append('e.created_at < ?')
+            params.append(until)
+        query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY e.id, r.row_index'
+
+        # 書き込みを止めないよう、読み込み用に別の接続を使う
+        conn = sqlite3.connect(self.path)
+        try:
+            for image_id, created_at, user_id, image_path, row_index, header, cells in conn.execute(query, params):
+                yield {
+                    'image_id': image_id,
+                    'created_at': created_at,
+                    'user_id': user_id,
+                    'image_path': image_path,
+                    'row_index': row_index,
+                    'header': json.loads(header),
+                    'cells': json.loads(cells),
+                }
+        finally:
+            conn.close()
+
+    def stats(self):
+        """
+        保存件数と未同期の件数、抽出中（または途中で失敗した）の件数を取得する
+        """
+        with self._lock:
+            extractions, unsynced, incomplete = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(synced_at IS NULL AND complete = 1), 0), '
+                'COALESCE(SUM(complete = 0), 0) FROM extractions'
+            ).fetchone()
+            rows = self._conn.execute('SELECT COUNT(*) FROM result_rows').fetchone()[0]
+        return {'extractions': extractions, 'rows': rows, 'unsynced': unsynced, 'incomplete': incomplete}
+
+
+def column_names(header, width=0):
+    """
+    表のヘッダーを、重複と空欄のない列名のリストに変換する関数
+
+    同じ名前の2つ目以降には「金額_2」のように番号を付け、空欄の列（ヘッダーより
+    セルが多い場合の余りの列を含む）は「列3」のように位置で名前を付ける。
+
+    Args:
+        header (list): 表のヘッダー
+        width (int): 行のセル数（ヘッダーより多い場合は列名を補う）
+
+    Returns:
+        list: 列名のリスト
+    """
+    names = []
+    used = set()
+    for position in range(max(len(header), width)):
+        name = header[position] if position < len(header) else None
+        base = '' if name is None else str(name).strip()
+        base = base or f'列{position + 1}'
+        name, number = base, 1
+        while name in used:
+            number += 1
+            name = f'{base}_{number}'
+        used.add(name)
+        names.append(name)
+    return names
+
+
+def export_csv(store, path, since=None, until=None):
+    """
+    抽出結果をCSVファイルに書き出す関数
+
+    列はEXPORT_COLUMNSの後に、全ての表の列名（column_namesで重複と空欄を除いたもの）を
+    初めて現れた順に並べる。
+
+    Returns:
+        int: 書き出した行数
+    """
+    # 列名の和集合を求めるため2回読み込む（メモリに全行を溜めない）
+    columns = []
+    seen = set()
+    for row in store.iter_rows(since, until):
+        for name in column_names(row['header'], len(row['cells'])):
+            if name not in seen:
+                seen.add(name)
+                columns.append(name)
+
+    count = 0
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_COLUMNS + columns)
+        index = {name: i for i, name in enumerate(columns)}
+        for row in store.iter_rows(since, until):
+            values = [''] * len(columns)
+            for name, cell in zip(column_names(row['header'], len(row['cells'])), row['cells']):
+                values[index[name]] = cell
+            writer.writerow([row[column] for column in EXPORT_COLUMNS] + values)
+            count += 1
+    return count
+
+
+def export_parquet(store, path, since=None, until=None, batch_rows=10000):
+    """
+    抽出結果をParquetファイル（列指向）に書き出す関数
+
+    表ごとに列が異なるため、ヘッダーとセルは文字列のリストの列として保存する。
+    pyarrowが必要（pip install pyarrow）。
+
+    Returns:
+        int: 書き出した行数
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquetの書き出しにはpyarrowが必要です。pip install pyarrow を実行してください。")
+
+    schema = pa.schema([
+        ('image_id', pa.string()),
+        ('created_at', pa.string()),
+        ('user_id', pa.string()),
+        ('image_path', pa.string()),
+        ('row_index', pa.int32()),
+        ('header', pa.list_(pa.string())),
+        ('cells', pa.list_(pa.string())),
+    ])
+
+    count = 0
+    batch = []
+    with pq.ParquetWriter(path, schema) as writer:
+        for row in store.iter_rows(since, until):
+            batch.append(dict(row, header=[str(name) for name in row['header']],
+                              cells=['' if cell is None else str(cell) for cell in row['cells']]))
+            if len(batch) >= batch_rows:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                count += len(batch)
+                batch = []
+        if batch:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            count += len(batch)
+    return count
+
+
+class SheetsRowStream:
+    """
+    ストリーミングで完成した行を、モデルの生成が終わる前からスプレッドシートに書き込む
+
+    最初の書き込みにだけヘッダー行を付け、以降は行を追記する。同時に処理している
+    他の画像の行と交互に並ぶことがあるが、各行の先頭の日時と画像パスで区別できる。
+
+    Args:
+        sink (SheetsSink): 書き込み先
+        image_path (str): 画像ファイルのパス
+    """
+
+    def __init__(self, sink, image_path):
+        self.sink = sink
+        self.image_path = image_path
+        self.current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.rows = 0
+        self._futures = []
+
+    def add_rows(self, header, rows):
+        """
+        完成した行を書き込む（送信の完了は待たない）
+
+        Args:
+            header (list): 表のヘッダー
+            rows (list): 行のリスト
+        """
+        values = build_rows([header] + rows, self.image_path, self.current_time)
+        if self.rows:
+            values = values[1:]
+        self._futures.append(self.sink.sheet_writer.submit(
+            self.sink.spreadsheet_id, self.sink.sheet_name, values,
+            replace=self.sink.replace and not self._futures))
+        self.rows += len(rows)
+
+    def _finish(self, table_data):
+        if not self.rows:
+            # キャッシュにヒットした場合など、行を受け取っていない場合は表全体を書き込む
+            self._futures.append(self.sink._submit(table_data, self.image_path))
+        elif len(table_data) - 1 > self.rows:
+            self.add_rows(table_data[0], table_data[1 + self.rows:])
+        return self._futures
+
+    def close(self, table_data, image_id=None, user_id=None, raw_text=None):
+        """
+        書き込んでいない残りの行を書き込み、全ての送信の完了を待つ
+
+        Args:
+            table_data (list): 抽出した表（受け取った行はその先頭と同じであること）
+
+        Returns:
+            int: 更新されたセル数
+        """
+        return sum(future.result() for future in self._finish(table_data))
+
+    async def close_async(self, table_data, image_id=None, user_id=None, raw_text=None):
+        """
+        closeのasyncio版
+        """
+        results = await asyncio.gather(*(asyncio.wrap_future(future) for future in self._finish(table_data)))
+        return sum(results)
+
+
+class LocalRowStream:
+    """
+    ストリーミングで完成した行を、抽出の途中からローカルのデータベースに保存する
+
+    保存した行は同期スレッドが抽出の完了を待たずにスプレッドシートへ送信するため、
+    RESULTS_SINK=localでも行数の多い表の最初の行が早く書き込まれる。
+    データベースへの1回の書き込みは短いため、イベントループの中でそのまま行う。
+
+    抽出が途中で失敗した場合、保存した行は未完了のまま残り（送信済みの行は
+    SheetsRowStreamと同じくスプレッドシートに残る）、エクスポートには含めない。
+
+    Args:
+        sink (LocalSink): 書き込み先
+        image_path (str): 画像ファイルのパス
+    """
+
+    def __init__(self, sink, image_path):
+        self.sink = sink
+        self.image_path = image_path
+        self.current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.extraction_id = None
+        self.rows = 0
+
+    def add_rows(self, header, rows):
+        """
+        完成した行を保存し、同期スレッドに送信を促す
+
+        Args:
+            header (list): 表のヘッダー
+            rows (list): 行のリスト
+        """
+        if self.extraction_id is None:
+            self.extraction_id = self.sink.store.begin(header, self.image_path, self.current_time)
+        self.sink.store.add_rows(self.extraction_id, self.rows, rows)
+        self.rows += len(rows)
+        self.sink.notify()
+
+    def close(self, table_data, image_id=None, user_id=None, raw_text=None):
+        """
+        保存していない残りの行を保存し、抽出結果を完了にする（同期は待たない）
+
+        Args:
+            table_data (list): 抽出した表（受け取った行はその先頭と同じであること）
+
+        Returns:
+            int: 保存したセル数
+        """
+        if self.extraction_id is None:
+            # キャッシュにヒットした場合など、行を受け取っていない場合は表全体を保存する
+            return self.sink.write(table_data, self.image_path, image_id=image_id, user_id=user_id,
+                                   raw_text=raw_text)
+        self.sink.store.finish(self.extraction_id, self.rows, table_data[1 + self.rows:],
+                               image_id=image_id, user_id=user_id, raw_text=raw_text)
+        self.sink.notify()
+        return sum(len(row) for row in table_data[1:])
+
+    async def close_async(self, table_data, image_id=None, user_id=None, raw_text=None):
+        """
+        closeのasyncio版（データベースへの保存はスレッドプールで行う）
+        """
+        return await asyncio.to_thread(self.close, table_data, image_id=image_id, user_id=user_id,
+                                       raw_text=raw_text)
+
+
+class SheetsSink:
+    """
+    抽出結果をスプレッドシートに直接書き込む出力先（書き込みの完了を待つ）
+
+    Args:
+        sheet_writer (BatchedSheetWriter): スプレッドシートのライター
+        spreadsheet_id (str): スプレッドシートID
+        sheet_name (str): シート名
+        replace (bool): シートをクリアしてから書き込むかどうか
+    """
+
+    def __init__(self, sheet_writer, spreadsheet_id, sheet_name, replace=False):
+        self.sheet_writer = sheet_writer
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self.replace = replace
+
+    def write(self, table_data, image_path, image_id=None, user_id=None, raw_text=None):
+        """
+        抽出結果を書き込む
+
+        Returns:
+            int: 更新されたセル数
+        """
+        return self._submit(table_data, image_path).result()
+
+    async def write_async(self, table_data, image_path, image_id=None, user_id=None, raw_text=None):
+        """
+        writeのasyncio版（ライターのスレッドが送信を終えるまでスレッドを占有せずに待つ）
+        """
+        return await asyncio.wrap_future(self._submit(table_data, image_path))
+
+    def open_stream(self, image_path):
+        """
+        抽出しながら行を書き込むストリームを開く
+
+        Returns:
+            SheetsRowStream: add_rowsで受け取った行を書き込み、closeで残りを書き込むストリーム
+        """
+        if not self.spreadsheet_id:
+            raise ValueError("SPREADSHEET_IDが設定されていません。.envファイルを確認してください。")
+        return SheetsRowStream(self, image_path)
+
+    def _submit(self, table_data, image_path):
+        if not self.spreadsheet_id:
+            raise ValueError("SPREADSHEET_IDが設定されていません。.envファイルを確認してください。")
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        values = build_rows(table_data, image_path, current_time)
+        return self.sheet_writer.submit(self.spreadsheet_id, self.sheet_name, values, replace=self.replace)
+
+    def start(self):
+        pass
+
+    def stop(self, timeout=None):
+        self.sheet_writer.stop(timeout)
+
+    def stats(self):
+        return {'sink': 'sheets', 'sheets': self.sheet_writer.stats()}
+
+
+class LocalSink:
+    """
+    抽出結果をローカルのデータベースに保存し、スプレッドシートには
+    バックグラウンドでまとめて同期する出力先
+
+    writeはデータベースへの保存だけで戻るため、Sheets APIの遅延や
+    障害の影響を受けない。同期できなかった結果は次回以降に再送される。
+
+    Args:
+        store (ResultsStore): 保存先のデータベース
+        sheet_writer (BatchedSheetWriter): 同期に使うライター（Noneで同期しない）
+        spreadsheet_id (str): 同期先のスプレッドシートID
+        sheet_name (str): 同期先のシート名
+        batch_size (int): 1回に同期する抽出結果の最大数
+        interval (float): 同期に失敗した場合などに再試行するまでの秒数
+
+    同じデータベースを複数のプロセス（サーバーのワーカーなど）で使う場合は、
+    ロックファイルを取得した1つのプロセスだけが同期する。そのプロセスが
+    終了するとロックが解放され、他のプロセスが引き継ぐ。
+    """
+
+    def __init__(self, store, sheet_writer=None, spreadsheet_id=None, sheet_name='Sheet1',
+                 batch_size=100, interval=5.0):
+        self.store = store
+        self.sheet_writer = sheet_writer if spreadsheet_id else None
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self.batch_size = batch_size
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+        self._leader_file = None
+
+        # 統計情報
+        self._synced = 0
+        self._sync_errors = 0
+        self._last_error = None
+
+    def write(self, table_data, image_path, image_id=None, user_id=None, raw_text=None):
+        """
+        抽出結果を保存する（スプレッドシートへの同期は待たない）
+
+        Returns:
+            int: 保存したセル数
+        """
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.store.add(table_data, image_path, current_time,
+                       image_id=image_id, user_id=user_id, raw_text=raw_text)
+        self.notify()
+        return sum(len(row) for row in table_data[1:])
+
+    async def write_async(self, table_data, image_path, image_id=None, user_id=None, raw_text=None):
+        """
+        writeのasyncio版（データベースへの保存はスレッドプールで行う）
+        """
+        return await asyncio.to_thread(self.write, table_data, image_path, image_id=image_id,
+                                       user_id=user_id, raw_text=raw_text)
+
+    def open_stream(self, image_path):
+        """
+        抽出しながら行を保存するストリームを開く
+
+        Returns:
+            LocalRowStream: add_rowsで受け取った行を保存し、closeで残りを保存するストリーム
+        """
+        return LocalRowStream(self, image_path)
+
+    def notify(self):
+        """
+        保存した抽出結果の同期を促す（同期スレッドが起動していない場合は起動する）
+        """
+        self.start()
+        self._wakeup.set()
+
+    def start(self):
+        """
+        スプレッドシートへの同期スレッドを起動する（前回の未同期分もここで送信される）
+        """
+        if self.sheet_writer is None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sheets-replica', daemon=True)
+                self._thread.start()
+
+    def sync_once(self):
+        """
+        未同期の抽出結果をまとめてスプレッドシートに送信する
+
+        Returns:
+            int: 同期した抽出結果の数
+
+        Raises:
+            送信に失敗した抽出結果があった場合は、成功した分を同期済みにしてから最初の例外を送出する
+        """
+        extractions = self.store.unsynced(self.batch_size)
+        if not extractions:
+            return 0
+        # 画像ごとの行ブロックとして送信し、書き込まれたものから同期済みにする
+        # （失敗したものだけが未同期のまま残り、次回に送り直される）
+        futures = []
+        for extraction in extractions:
+            values = build_rows(extraction['table'], extraction['image_path'], extraction['created_at'])
+            if extraction['synced_rows']:
+                # 抽出中に行の一部を同期済みの場合は、ヘッダー行を繰り返さない
+                values = values[1:]
+            futures.append(self.sheet_writer.submit(self.spreadsheet_id, self.sheet_name, values))
+        self.sheet_writer.flush()
+        synced = []
+        error = None
+        for extraction, future in zip(extractions, futures):
+            try:
+                future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            synced.append((extraction['id'], extraction['synced_rows'] + len(extraction['table']) - 1,
+                           extraction['complete']))
+        self.store.mark_synced(synced)
+        with self._lock:
+            self._synced += len(synced)
+        if error is not None:
+            raise error
+        return len(synced)
+
+    def stop(self, timeout=None):
+        """
+        未同期の抽出結果を送信してから同期スレッドを停止する
+
+        Args:
+            timeout (float): 送信を待つ最大秒数（過ぎた場合、残りは次回の起動時に同期する）
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0, deadline - time.monotonic())
+
+        with self._lock:
+            self._stopping = True
+            thread = self._thread
+        self._wakeup.set()
+        if thread:
+            thread.join(remaining())
+        if self.sheet_writer is not None:
+            # 他のプロセスが同期している場合や同期スレッドが送信中の場合は、残りの送信を任せる
+            if (thread is None or not thread.is_alive()) and self._acquire_leader():
+                try:
+                    while remaining() != 0 and self.sync_once():
+                        pass
+                except Exception as e:
+                    logger.error(f"スプレッドシートへの同期中にエラーが発生しました: {str(e)}")
+            self.sheet_writer.stop(remaining())
+        self._release_leader()
+        with self._lock:
+            self._thread = None
+            self._stopping = False
+
+    def _acquire_leader(self):
+        """
+        同期を担当するためのロックファイルを取得する（取得済みの場合もTrue）
+        """
+        if fcntl is None or self._leader_file is not None or self.store.path.startswith(':'):
+            return True
+        lock_file = open(self.store.path + '.sync.lock', 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._leader_file = lock_file
+        return True
+
+    def _release_leader(self):
+        if self._leader_file is not None:
+            self._leader_file.close()
+            self._leader_file = None
+
+    def _run(self):
+        # 他のプロセスが同期している間は、そのプロセスが終了するまで待つ
+        while not self._stopping and not self._acquire_leader():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+        while not self._stopping:
+            try:
+                if self.sync_once() >= self.batch_size:
+                    # まだ残っている場合は待たずに続ける
+                    continue
+            except Exception as e:
+                with self._lock:
+                    self._sync_errors += 1
+                    self._last_error = str(e)
+                logger.error(f"スプレッドシートへの同期中にエラーが発生しました: {str(e)}")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'sink': 'local',
+                'leader': self._leader_file is not None or fcntl is None,
+                'synced': self._synced,
+                'sync_errors': self._sync_errors,
+                'last_error': self._last_error,
+            }
+        stats.update(self.store.stats())
+        if self.sheet_writer is not None:
+            stats['sheets'] = self.sheet_writer.stats()
+        return stats
+
+
+def create_results_sink(sheet_writer, spreadsheet_id, sheet_name, replace=False):
+    """
+    環境変数の設定から抽出結果の出力先を作成する関数
+
+    RESULTS_SINK: 'local'（デフォルト、ローカルに保存してスプレッドシートへ非同期に同期）
+                  または 'sheets'（スプレッドシートに直接書き込む）
+    RESULTS_DB: ローカルのデータベースのパス（デフォルト'results.sqlite3'）
+    RESULTS_SYNC_BATCH: 1回に同期する抽出結果の最大数（デフォルト100）
+    RESULTS_SYNC_INTERVAL: 同期に失敗した場合に再試行するまでの秒数（デフォルト5）
+
+    Args:
+        sheet_writer (BatchedSheetWriter): スプレッドシートのライター
+        spreadsheet_id (str): スプレッドシートID
+        sheet_name (str): シート名
+        replace (bool): 'sheets'の場合にシートをクリアしてから書き込むかどうか
+
+    Returns:
+        SheetsSink or LocalSink: 出力先
+    """
+    if os.getenv('RESULTS_SINK', 'local') == 'sheets':
+        return SheetsSink(sheet_writer, spreadsheet_id, sheet_name, replace=replace)
+    return LocalSink(
+        ResultsStore(os.getenv('RESULTS_DB', 'results.sqlite3')),
+        sheet_writer=sheet_writer,
+        spreadsheet_id=spreadsheet_id,
+        sheet_name=sheet_name,
+        batch_size=int(os.getenv('RESULTS_SYNC_BATCH', 100)),
+        interval=float(os.getenv('RESULTS_SYNC_INTERVAL', 5))
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='保存済みの抽出結果をCSV/Parquetに書き出す')
+    parser.add_argument('output', help='出力ファイルのパス（拡張子が.parquetの場合はParquet形式）')
+    parser.add_argument('--db', default=os.getenv('RESULTS_DB', 'results.sqlite3'), help='データベースのパス')
+    parser.add_argument('--format', choices=['csv', 'parquet'], help='出力形式（省略時は拡張子から判定）')
+    parser.add_argument('--since', help='この日時以降の結果のみ（例: 2025-01-01）')
+    parser.add_argument('--until', help='この日時より前の結果のみ')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error(f"データベースが見つかりません: {args.db}")
+    output_format = args.format or ('parquet' if args.output.endswith('.parquet') else 'csv')
+    store = ResultsStore(args.db)
+    started = time.perf_counter()
+    if output_format == 'parquet':
+        count = export_parquet(store, args.output, args.since, args.until)
+    else:
+        count = export_csv(store, args.output, args.since, args.until)
+    print(f"{count}行を{args.output}に書き出しました（{time.perf_counter() - started:.2f}秒）")
+
+
+if __name__ == '__main__':
+    main()
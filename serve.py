@@ -0,0 +1,318 @@
+"""
+本番用のサーバーを起動するエントリーポイント
+
+Flaskの開発用サーバーの代わりにgunicornで複数のワーカー（プロセス）と
+スレッドでWebhookを処理する。
+
+使い方:
+    python serve.py                          # SERVE_APPのアプリ（デフォルト line_image_saver:app）
+    python serve.py app:app                  # アプリを指定する
+"""
+import os
+import sys
+import time
+import signal
+import logging
+import importlib
+import threading
+
+from flask import jsonify
+from gunicorn.app.base import BaseApplication
+
+from metrics import configure_logging
+from warmup import HEAVY_MODULES, start_warm_up
+
+logger = logging.getLogger(__name__)
+
+# マスタープロセスで1度だけ読み込む重いライブラリ
+# （ワーカーはフォーク後にこれを共有し、各ワーカーで読み込み直さない）
+PRELOAD_MODULES = HEAVY_MODULES + ['linebot.v3.webhooks', 'PIL.Image']
+
+
+def preload_modules(names=PRELOAD_MODULES):
+    """
+    重いライブラリを読み込み、かかった秒数を返す関数
+
+    アプリ本体（SQLiteの接続やスレッドを持つシングルトン）はフォーク後に
+    各ワーカーで読み込むため、ここではライブラリだけを読み込む。
+    """
+    started = time.perf_counter()
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            logger.warning(f"事前の読み込みに失敗しました: {name}: {str(e)}")
+    return time.perf_counter() - started
+
+
+def load_target(spec):
+    """
+    'モジュール名:変数名' の形式で指定したFlaskアプリを読み込む関数
+
+    Returns:
+        tuple: (モジュール, Flaskアプリ)
+    """
+    module_name, _, attribute = spec.partition(':')
+    module = importlib.import_module(module_name)
+    return module, getattr(module, attribute or 'app')
+
+
+def results_sink_of(module):
+    """
+    アプリが使う抽出結果の出力先を取得する関数（app.pyはimage_to_textのものを使う）
+    """
+    sink = getattr(module, 'results_sink', None)
+    if sink is None and 'image_to_text' in sys.modules:
+        sink = sys.modules['image_to_text'].results_sink
+    return sink
+
+
+class ServerState:
+    """
+    ワーカーの状態（起動完了・停止中）を保持し、ヘルスチェックに答える
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self.started_at = time.time()
+        self.ready = False
+        self.draining = False
+        self.deadline = None
+
+    def health(self):
+        return {'status': 'ok', 'pid': os.getpid(), 'uptime': time.time() - self.started_at}
+
+    def readiness(self):
+        """
+        新しいリクエストを受け付けられるかどうかを判定する
+
+        Returns:
+            tuple: (受け付けられるかどうか, 状態のdict)
+        """
+        status = {'pid': os.getpid(), 'ready': self.ready, 'draining': self.draining}
+        job_queue = getattr(self.module, 'job_queue', None)
+        if job_queue is not None:
+            stats = job_queue.stats()
+            status['job_queue'] = {'depth': stats['depth'], 'maxsize': stats['maxsize']}
+            if stats['maxsize'] and stats['depth'] >= stats['maxsize']:
+                return False, dict(status, reason='job queue is full')
+        admission = getattr(self.module, 'admission', None)
+        if admission is not None:
+            stats = admission.stats()
+            if stats['maxsize'] and stats['pending'] >= stats['maxsize']:
+                return False, dict(status, reason='async pipeline is full')
+        if self.draining or not self.ready:
+            return False, status
+        return True, status
+
+    def begin_drain(self, timeout):
+        """
+        停止を始める（/readyzが503を返すようになり、まとめ待ちの画像をすぐにジョブに回す）
+
+        2回目以降の呼び出しでは期限を変えない。
+
+        Args:
+            timeout (float): 停止処理全体の期限までの秒数
+        """
+        if self.draining:
+            return
+        self.deadline = time.monotonic() + timeout
+        self.draining = True
+        image_batcher = getattr(self.module, 'image_batcher', None)
+        if image_batcher is not None:
+            image_batcher.flush()
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+    def drain(self, timeout):
+        """
+        受け付け済みのジョブを処理し終え、未同期の抽出結果を送信してから停止する
+
+        各段階はbegin_drainで決めた1つの期限を分け合い、期限を過ぎた段階は待たずに進む。
+
+        Args:
+            timeout (float): begin_drainが呼ばれていない場合の、停止処理全体の最大秒数
+        """
+        self.begin_drain(timeout)
+        started = time.monotonic()
+        job_queue = getattr(self.module, 'job_queue', None)
+        if job_queue is not None:
+            pending = job_queue.stats()['depth']
+            logger.info(f"ジョブの完了を待っています（待ち {pending}件、残り{self.remaining():.1f}秒）")
+            job_queue.stop(self.remaining())
+        # 共有のイベントループで処理中の画像（asyncioのパイプラインと同期版の抽出）も待つ
+        if 'event_loop' in sys.modules:
+            sys.modules['event_loop'].runner.stop(self.remaining())
+        sink = results_sink_of(self.module)
+        if sink is not None:
+            sink.stop(self.remaining())
+        logger.info(f"停止処理が完了しました（{time.monotonic() - started:.1f}秒）")
+
+
+def add_health_routes(app, state):
+    """
+    ヘルスチェック用のエンドポイントを追加する関数
+
+    GET /healthz: プロセスが応答できれば200
+    GET /readyz: 起動が完了し、停止中でなく、ジョブキュー（asyncioのパイプライン）に空きがあれば200（それ以外は503）
+    """
+    def healthz():
+        return jsonify(state.health())
+
+    def readyz():
+        ready, status = state.readiness()
+        return jsonify(status), 200 if ready else 503
+
+    app.add_url_rule('/healthz', 'healthz', healthz, methods=['GET'])
+    app.add_url_rule('/readyz', 'readyz', readyz, methods=['GET'])
+
+
+def configure_multi_process(workers):
+    """
+    複数のワーカー（プロセス）で状態を共有するための設定を補う関数
+
+    重複排除はプロセス内の状態だけでは、別のワーカーに届いた再送を見分けられない。
+    DEDUP_DBが設定されていない場合は、画像の保存先にSQLiteファイルを作って共有する
+    （ワーカーはフォーク後にアプリを読み込むため、環境変数の設定を引き継ぐ）。
+
+    RESULTS_SINK=sheetsでは次の空き行をワーカーごとに管理するため、
+    複数のワーカーが同じ行に書き込んでしまう。この組み合わせでは起動しない。
+
+    Args:
+        workers (int): ワーカー数
+
+    Raises:
+        ValueError: 複数のワーカーでRESULTS_SINK=sheetsが指定された場合
+    """
+    if workers <= 1:
+        return
+    if os.getenv('RESULTS_SINK', 'local') == 'sheets':
+        raise ValueError("RESULTS_SINK=sheetsは1つのワーカーでしか使えません。"
+                         "WEB_CONCURRENCY=1にするか、RESULTS_SINK=local（デフォルト）を使ってください。")
+    if not os.getenv('DEDUP_DB'):
+        root = os.getenv('IMAGE_STORE_DIR', 'saved_images')
+        os.makedirs(root, exist_ok=True)
+        os.environ['DEDUP_DB'] = os.path.join(root, 'dedup.sqlite3')
+        logger.info(f"ワーカー間で重複排除を共有します: DEDUP_DB={os.environ['DEDUP_DB']}")
+    if os.getenv('JOB_QUEUE_DB'):
+        logger.warning("JOB_QUEUE_DBの未処理ジョブは起動した各ワーカーが再投入します。"
+                       "複数のワーカーで使う場合は重複して処理される可能性があります。")
+
+
+class ServeApplication(BaseApplication):
+    """
+    gunicornのアプリケーション
+
+    ライブラリはマスタープロセスで読み込み、アプリ本体はワーカーごとに読み込む。
+    SIGTERMを受けると新しい接続の受け付けを止め、処理中のリクエストと
+    ジョブキューに残っているジョブを処理し終えてから終了する。
+
+    マスターはワーカーにSIGTERMを送ってからgraceful_timeout秒後に強制終了するため、
+    ワーカーはSIGTERMを受けた時点から、それよりdrain_margin秒早い期限の中で停止処理を行う。
+    """
+
+    def __init__(self, target, options, drain_margin=5):
+        self.target = target
+        self.options = options
+        self.drain_margin = drain_margin
+        self.state = None
+        super().__init__()
+
+    def drain_timeout(self):
+        graceful_timeout = self.options['graceful_timeout']
+        return max(0, graceful_timeout - min(self.drain_margin, graceful_timeout / 2))
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+        self.cfg.set('post_worker_init', self.post_worker_init)
+        self.cfg.set('worker_exit', self.worker_exit)
+
+    def load(self):
+        module, app = load_target(self.target)
+        self.state = ServerState(module)
+        add_health_routes(app, self.state)
+        return app
+
+    def post_worker_init(self, worker):
+        # 前回の起動時に同期できなかった抽出結果の送信を始める
+        sink = results_sink_of(self.state.module)
+        if sink is not None:
+            sink.start()
+        # JOB_QUEUE_DBに残っている未処理ジョブを、新しい画像を待たずに再開する
+        job_queue = getattr(self.state.module, 'job_queue', None)
+        if job_queue is not None:
+            job_queue.start()
+        self.install_term_handler(worker)
+        # 初回のリクエストの前にクライアント（と事前に読み込んでいないライブラリ）を準備する
+        start_warm_up()
+        self.state.ready = True
+
+    def install_term_handler(self, worker):
+        """
+        SIGTERMを受けた時点で停止を始めるよう、gunicornのハンドラーを包む
+
+        gunicornは処理中のリクエストを待ってからworker_exitを呼ぶため、
+        それまで/readyzが停止中を返さず、停止処理の期限も遅れてしまう。
+        """
+        original = signal.getsignal(signal.SIGTERM)
+        timeout = self.drain_timeout()
+
+        def handle_term(signum, frame):
+            # シグナルハンドラーの中ではロックを取らないよう、スレッドで始める
+            threading.Thread(target=self.state.begin_drain, args=(timeout,), name='begin-drain',
+                             daemon=True).start()
+            if callable(original):
+                original(signum, frame)
+
+        signal.signal(signal.SIGTERM, handle_term)
+
+    def worker_exit(self, server, worker):
+        if self.state is not None:
+            self.state.drain(timeout=self.drain_timeout())
+
+
+def create_options():
+    """
+    環境変数の設定からgunicornの設定を作成する関数
+
+    PORT: 待ち受けるポート（デフォルト5000）
+    WEB_CONCURRENCY: ワーカー（プロセス）数（デフォルト2）
+    WEB_THREADS: ワーカーごとのスレッド数（デフォルト8）
+    WEB_TIMEOUT: 応答しなくなったワーカーを再起動するまでの秒数（デフォルト60）
+    WEB_GRACEFUL_TIMEOUT: SIGTERMを受けてから処理中のリクエストとジョブを待つ秒数（デフォルト60）
+        （ワーカーの停止処理は強制終了に間に合うよう、WEB_DRAIN_MARGIN秒早く切り上げる）
+
+    Returns:
+        dict: gunicornの設定
+    """
+    return {
+        'bind': f"0.0.0.0:{os.getenv('PORT', 5000)}",
+        'workers': int(os.getenv('WEB_CONCURRENCY', 2)),
+        'threads': int(os.getenv('WEB_THREADS', 8)),
+        'worker_class': 'gthread',
+        'timeout': int(os.getenv('WEB_TIMEOUT', 60)),
+        'graceful_timeout': int(os.getenv('WEB_GRACEFUL_TIMEOUT', 60)),
+        'keepalive': 5,
+        'accesslog': '-',
+        'errorlog': '-',
+    }
+
+
+def main():
+    configure_logging()
+    target = sys.argv[1] if len(sys.argv) > 1 else os.getenv('SERVE_APP', 'line_image_saver:app')
+    options = create_options()
+    # スケールして0台から起動する環境などで、待ち受けを始めるまでの時間を短くする場合は
+    # WEB_PRELOAD=0にする（ライブラリは各ワーカーでバックグラウンドで読み込む）
+    if os.getenv('WEB_PRELOAD', '1') == '1':
+        seconds = preload_modules()
+        logger.info(f"ライブラリを読み込みました（{seconds:.2f}秒）")
+    logger.info(f"起動します: {target} workers={options['workers']} threads={options['threads']}")
+    configure_multi_process(options['workers'])
+    ServeApplication(target, options, drain_margin=float(os.getenv('WEB_DRAIN_MARGIN', 5))).run()
+
+
+if __name__ == '__main__':
+    main()
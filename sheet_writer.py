@@ -0,0 +1,553 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from concurrent.futures import Future
+
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+# 書き込み方式（'append': 画像ごとの行ブロックに追記, 'replace': シートをクリアして書き直す）
+WRITE_MODE = os.getenv('SHEET_WRITE_MODE', 'append')
+
+
+def build_rows(table_data, image_path, current_time):
+    """
+    表形式のデータをスプレッドシートに書き込む行のリストに変換する関数
+
+    Args:
+        table_data (list): 表形式のデータ（2次元リスト）
+        image_path (str): 画像ファイルのパス
+        current_time (str): 日時の文字列
+
+    Returns:
+        list: ヘッダー行とデータ行（各行の先頭に日時と画像パスを付与）
+    """
+    header = ['日時', '画像パス'] + table_data[0]
+    image_info = [current_time, image_path]
+    return [header] + [image_info + row for row in table_data[1:]]
+
+
+def write_table(service, spreadsheet_id, sheet_name, values, clear=True):
+    """
+    ヘッダーとデータ行をまとめて書き込む関数
+
+    行ごとにappendするのではなく、全行を1回のupdate（クリアする場合は
+    clearと合わせて2回）のリクエストで送信する。
+
+    Args:
+        service: Google Sheets APIのサービス
+        spreadsheet_id (str): スプレッドシートID
+        sheet_name (str): シート名
+        values (list): 書き込む行のリスト
+        clear (bool): 書き込む前にシートの内容をクリアするかどうか
+
+    Returns:
+        int: 更新されたセル数
+    """
+    if clear:
+        with span('sheet_clear'):
+            service.spreadsheets().values().clear(
+                spreadsheetId=spreadsheet_id,
+                range=f'{sheet_name}!A:Z'
+            ).execute()
+        with span('sheet_update'):
+            result = service.spreadsheets().values().update(
+                spreadsheetId=spreadsheet_id,
+                range=f'{sheet_name}!A1',
+                valueInputOption='RAW',
+                body={'values': values}
+            ).execute()
+        return result.get('updatedCells', 0)
+
+    with span('sheet_append'):
+        result = service.spreadsheets().values().append(
+            spreadsheetId=spreadsheet_id,
+            range=f'{sheet_name}!A:Z',
+            valueInputOption='RAW',
+            body={'values': values}
+        ).execute()
+    return result.get('updates', {}).get('updatedCells', 0)
+
+
+class SheetCursor:
+    """
+    シートごとに次の空き行を手元で管理するカーソル
+
+    書き込み先の行をカーソルで決めるため、書き込みの前にシートを読み込む
+    必要がなく、同時に処理している画像の書き込みが重なることもない。
+    シートの内容を読むのは、プロセス内で初めてそのシートに書き込むとき
+    （SQLiteに保存している場合は保存されていないとき）だけ。
+
+    行数がmax_rowsを超える場合は「シート名_2」のような新しいタブに切り替え、
+    1つのタブが大きくなりすぎないようにする。
+
+    カーソルはプロセスごとに管理するため、複数のプロセスから同じシートに書き込まない
+    （serve.pyは複数のワーカーでRESULTS_SINK=sheetsを指定すると起動しない）。
+    このアプリ以外がシートに行を追加すると上書きされる可能性があるため、
+    シートを手で編集した場合はプロセスを再起動する（SQLiteの場合はファイルを削除する）。
+
+    Args:
+        path (str): カーソルを保存するSQLiteファイルのパス（Noneで保存しない）
+        max_rows (int): 1つのタブに書き込む最大行数
+        grow_rows (int): タブの行数が足りない場合に追加する行数
+    """
+
+    def __init__(self, path=None, max_rows=50000, grow_rows=1000):
+        self.max_rows = max_rows
+        self.grow_rows = grow_rows
+        self._state = {}
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS sheet_cursors ('
+                'spreadsheet_id TEXT NOT NULL, sheet_name TEXT NOT NULL, tab TEXT NOT NULL, '
+                'sheet_id INTEGER NOT NULL, generation INTEGER NOT NULL, '
+                'next_row INTEGER NOT NULL, grid_rows INTEGER NOT NULL, '
+                'PRIMARY KEY (spreadsheet_id, sheet_name))'
+            )
+            self._conn.commit()
+
+        # 統計情報
+        self._discovered = 0
+        self._grown = 0
+        self._rollovers = 0
+        self._released = 0
+
+    def allocate(self, service, spreadsheet_id, sheet_name, count):
+        """
+        count行分の書き込み先を確保する
+
+        Args:
+            service: Google Sheets APIのサービス
+            spreadsheet_id (str): スプレッドシートID
+            sheet_name (str): シート名
+            count (int): 書き込む行数
+
+        Returns:
+            tuple: (書き込み先のタブ名, 開始行（1始まり）)
+        """
+        with self._lock:
+            state = self._load(service, spreadsheet_id, sheet_name)
+            if state['next_row'] > 1 and state['next_row'] - 1 + count > self.max_rows:
+                state = self._rollover(service, spreadsheet_id, sheet_name, state)
+
+            end_row = state['next_row'] + count - 1
+            if end_row > state['grid_rows']:
+                # 範囲外への書き込みはエラーになるため、先にタブの行を増やす
+                length = max(self.grow_rows, end_row - state['grid_rows'])
+                service.spreadsheets().batchUpdate(
+                    spreadsheetId=spreadsheet_id,
+                    body={'requests': [{'appendDimension': {
+                        'sheetId': state['sheet_id'], 'dimension': 'ROWS', 'length': length
+                    }}]}
+                ).execute()
+                state['grid_rows'] += length
+                self._grown += 1
+
+            start_row = state['next_row']
+            state['next_row'] = end_row + 1
+            self._save(spreadsheet_id, sheet_name, state)
+            return state['tab'], start_row
+
+    def release(self, spreadsheet_id, sheet_name, tab, start_row, count):
+        """
+        書き込みに失敗したブロックの行を返却する（次の確保で同じ行を使う）
+
+        ブロックが最後に確保されたものである場合だけ戻せるため、
+        複数のブロックを返却する場合は確保と逆の順に呼び出す。
+
+        Args:
+            spreadsheet_id (str): スプレッドシートID
+            sheet_name (str): シート名
+            tab (str): allocateが返したタブ名
+            start_row (int): allocateが返した開始行
+            count (int): 確保した行数
+
+        Returns:
+            bool: 返却できたかどうか
+        """
+        with self._lock:
+            state = self._state.get((spreadsheet_id, sheet_name))
+            if state is None or state['tab'] != tab or state['next_row'] != start_row + count:
+                return False
+            state['next_row'] = start_row
+            self._released += count
+            self._save(spreadsheet_id, sheet_name, state)
+            return True
+
+    def invalidate(self, spreadsheet_id, sheet_name):
+        """
+        カーソルを破棄する（次回の書き込み時にシートから読み直す）
+        """
+        with self._lock:
+            self._state.pop((spreadsheet_id, sheet_name), None)
+            if self._conn is not None:
+                self._conn.execute('DELETE FROM sheet_cursors WHERE spreadsheet_id = ? AND sheet_name = ?',
+                                   (spreadsheet_id, sheet_name))
+                self._conn.commit()
+
+    def _load(self, service, spreadsheet_id, sheet_name):
+        key = (spreadsheet_id, sheet_name)
+        state = self._state.get(key)
+        if state is not None:
+            return state
+
+        if self._conn is not None:
+            row = self._conn.execute(
+                'SELECT tab, sheet_id, generation, next_row, grid_rows FROM sheet_cursors '
+                'WHERE spreadsheet_id = ? AND sheet_name = ?', key
+            ).fetchone()
+            if row:
+                tab, sheet_id, generation, next_row, grid_rows = row
+                state = {'tab': tab, 'sheet_id': sheet_id, 'generation': generation,
+                         'next_row': next_row, 'grid_rows': grid_rows}
+                self._state[key] = state
+                return state
+
+        # 最も新しいタブと、その使用済みの行数を調べる
+        tabs = self._tabs(service, spreadsheet_id)
+        generation = 1
+        while f'{sheet_name}_{generation + 1}' in tabs:
+            generation += 1
+        tab = sheet_name if generation == 1 else f'{sheet_name}_{generation}'
+        if tab not in tabs:
+            tabs[tab] = self._add_tab(service, spreadsheet_id, tab)
+
+        used = service.spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id,
+            range=f"'{tab}'!A:A"
+        ).execute().get('values', [])
+        state = {
+            'tab': tab,
+            'sheet_id': tabs[tab]['sheetId'],
+            'generation': generation,
+            'next_row': len(used) + 1,
+            'grid_rows': tabs[tab].get('gridProperties', {}).get('rowCount', 1000),
+        }
+        self._discovered += 1
+        self._state[key] = state
+        return state
+
+    def _rollover(self, service, spreadsheet_id, sheet_name, state):
+        generation = state['generation'] + 1
+        tab = f'{sheet_name}_{generation}'
+        properties = self._add_tab(service, spreadsheet_id, tab)
+        logger.info(f"{state['tab']}の行数が上限に達したため、{tab}に切り替えます。")
+        self._rollovers += 1
+        state = {
+            'tab': tab,
+            'sheet_id': properties['sheetId'],
+            'generation': generation,
+            'next_row': 1,
+            'grid_rows': properties.get('gridProperties', {}).get('rowCount', self.grow_rows),
+        }
+        self._state[(spreadsheet_id, sheet_name)] = state
+        return state
+
+    def _tabs(self, service, spreadsheet_id):
+        metadata = service.spreadsheets().get(
+            spreadsheetId=spreadsheet_id,
+            fields='sheets.properties(sheetId,title,gridProperties.rowCount)'
+        ).execute()
+        return {sheet['properties']['title']: sheet['properties'] for sheet in metadata.get('sheets', [])}
+
+    def _add_tab(self, service, spreadsheet_id, title):
+        result = service.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={'requests': [{'addSheet': {'properties': {
+                'title': title, 'gridProperties': {'rowCount': self.grow_rows}
+            }}}]}
+        ).execute()
+        return result['replies'][0]['addSheet']['properties']
+
+    def _save(self, spreadsheet_id, sheet_name, state):
+        if self._conn is None:
+            return
+        self._conn.execute(
+            'INSERT OR REPLACE INTO sheet_cursors '
+            '(spreadsheet_id, sheet_name, tab, sheet_id, generation, next_row, grid_rows) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (spreadsheet_id, sheet_name, state['tab'], state['sheet_id'], state['generation'],
+             state['next_row'], state['grid_rows'])
+        )
+        self._conn.commit()
+
+    def stats(self):
+        """
+        カーソルの統計情報を取得する
+
+        Returns:
+            dict: シートの読み込み回数、行の追加回数、タブの切り替え回数、返却した行数、各シートの次の空き行
+        """
+        with self._lock:
+            return {
+                'discovered': self._discovered,
+                'grown': self._grown,
+                'rollovers': self._rollovers,
+                'released': self._released,
+                'cursors': {f'{spreadsheet_id}/{sheet_name}': f"{state['tab']}!A{state['next_row']}"
+                            for (spreadsheet_id, sheet_name), state in self._state.items()},
+            }
+
+
+class BatchedSheetWriter:
+    """
+    複数の画像からの書き込みをまとめて定期的に送信するライター
+
+    書き込み要求は対象シートごとにまとめられ、行数がmax_batch_rowsに
+    達するか、最も古い要求からmax_latency秒経過した時点で送信される。
+    クリアを伴う書き込み（replace）は、それ以前の同じシートへの
+    書き込みを上書きするため、最後のreplace以降の行だけを送信する。
+
+    cursorを指定した場合、追記は画像ごとにカーソルで確保した行のブロックに
+    書き込み、同じスプレッドシートへの書き込みを1回のbatchUpdateで送信する。
+
+    Args:
+        service_factory: Google Sheets APIのサービスを返す関数
+        max_batch_rows (int): 1回の送信にまとめる最大行数
+        max_latency (float): 要求から送信までの最大待ち時間（秒）
+        cursor (SheetCursor): 次の空き行を管理するカーソル（Noneの場合はappendで追記する）
+    """
+
+    def __init__(self, service_factory, max_batch_rows=500, max_latency=1.0, cursor=None):
+        self.service_factory = service_factory
+        self.cursor = cursor
+        self.max_batch_rows = max_batch_rows
+        self.max_latency = max_latency
+        self._pending = []
+        self._pending_rows = 0
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+
+        # 統計情報
+        self._submitted = 0
+        self._flushes = 0
+        self._requests = 0
+        self._rows_written = 0
+
+    def submit(self, spreadsheet_id, sheet_name, values, replace=False):
+        """
+        書き込みを要求する
+
+        Args:
+            spreadsheet_id (str): スプレッドシートID
+            sheet_name (str): シート名
+            values (list): 書き込む行のリスト
+            replace (bool): シートをクリアしてから書き込むかどうか
+
+        Returns:
+            concurrent.futures.Future: 送信が完了すると結果が設定される
+        """
+        future = Future()
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sheet-writer', daemon=True)
+                self._thread.start()
+            self._pending.append({
+                'target': (spreadsheet_id, sheet_name),
+                'values': values,
+                'replace': replace,
+                'future': future,
+                'submitted_at': time.time()
+            })
+            self._pending_rows += len(values)
+            self._submitted += 1
+            self._condition.notify()
+        return future
+
+    def flush(self):
+        """
+        溜まっている書き込みをすぐに送信する
+        """
+        with self._write_lock:
+            with self._condition:
+                batch = self._take_batch()
+            self._write_batch(batch)
+
+    def stop(self, timeout=None):
+        """
+        溜まっている書き込みを送信してからライターを停止する
+
+        Args:
+            timeout (float): 送信を待つ最大秒数（過ぎた場合、残りの書き込みは失敗として扱う）
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+            thread = self._thread
+        if thread:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        # 送信中のスレッドが終わらない場合は、同時に送信しないよう残りを送らない
+        if thread is None or not thread.is_alive():
+            while self._pending and (deadline is None or time.monotonic() < deadline):
+                self.flush()
+        with self._condition:
+            abandoned, self._pending = self._pending, []
+            self._pending_rows = 0
+            self._thread = None
+            self._stopping = False
+        if abandoned:
+            logger.warning(f"停止までに送信できなかった書き込みが{len(abandoned)}件あります。")
+            for op in abandoned:
+                op['future'].set_exception(TimeoutError("停止までにスプレッドシートへ送信できませんでした。"))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopping:
+                    if self._pending_rows >= self.max_batch_rows:
+                        break
+                    if self._pending:
+                        remaining = self._pending[0]['submitted_at'] + self.max_latency - time.time()
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+                    else:
+                        self._condition.wait()
+                if self._stopping:
+                    return
+            self.flush()
+
+    def _take_batch(self):
+        batch = []
+        rows = 0
+        while self._pending and (not batch or rows + len(self._pending[0]['values']) <= self.max_batch_rows):
+            op = self._pending.pop(0)
+            rows += len(op['values'])
+            batch.append(op)
+        self._pending_rows -= rows
+        return batch
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+
+        # 対象シートごとにまとめる（到着順を保持）
+        targets = {}
+        for op in batch:
+            targets.setdefault(op['target'], []).append(op)
+
+        try:
+            service = self.service_factory()
+        except Exception as e:
+            for op in batch:
+                op['future'].set_exception(e)
+            return
+
+        blocks = {}
+        for (spreadsheet_id, sheet_name), ops in targets.items():
+            replace_index = max((i for i, op in enumerate(ops) if op['replace']), default=None)
+            if replace_index is None and self.cursor is not None:
+                blocks.setdefault(spreadsheet_id, []).extend((sheet_name, op) for op in ops)
+                continue
+
+            live_ops = ops if replace_index is None else ops[replace_index:]
+            values = [row for op in live_ops for row in op['values']]
+            try:
+                updated_cells = write_table(service, spreadsheet_id, sheet_name, values,
+                                            clear=replace_index is not None)
+            except Exception as e:
+                logger.error(f"スプレッドシートへの書き込み中にエラーが発生しました: {str(e)}")
+                for op in ops:
+                    op['future'].set_exception(e)
+                continue
+
+            if replace_index is not None and self.cursor is not None:
+                # シートをクリアしたため、次の追記の前に空き行を調べ直す
+                self.cursor.invalidate(spreadsheet_id, sheet_name)
+            with self._condition:
+                self._requests += 2 if replace_index is not None else 1
+                self._rows_written += len(values)
+            for op in ops:
+                op['future'].set_result(updated_cells)
+
+        for spreadsheet_id, sheet_ops in blocks.items():
+            self._write_blocks(service, spreadsheet_id, sheet_ops)
+
+        with self._condition:
+            self._flushes += 1
+
+    def _write_blocks(self, service, spreadsheet_id, sheet_ops):
+        """
+        画像ごとの行ブロックを確保し、1回のbatchUpdateでまとめて書き込む
+        """
+        allocated = []
+        try:
+            data = []
+            for sheet_name, op in sheet_ops:
+                tab, start_row = self.cursor.allocate(service, spreadsheet_id, sheet_name, len(op['values']))
+                allocated.append((sheet_name, tab, start_row, len(op['values'])))
+                data.append({'range': f"'{tab}'!A{start_row}", 'values': op['values']})
+            with span('sheet_batch_update'):
+                service.spreadsheets().values().batchUpdate(
+                    spreadsheetId=spreadsheet_id,
+                    body={'valueInputOption': 'RAW', 'data': data}
+                ).execute()
+        except Exception as e:
+            # 確保した行を逆順に返却し、再送時に同じ行へ書き込んで空き行を残さない
+            # （ライターの送信は1つずつ行うため、返却する前に他の確保が入ることはない）
+            for sheet_name, tab, start_row, count in reversed(allocated):
+                if not self.cursor.release(spreadsheet_id, sheet_name, tab, start_row, count):
+                    logger.warning(f"{tab}の{start_row}行目から{count}行を返却できず、空き行が残ります。")
+            logger.error(f"スプレッドシートへの書き込み中にエラーが発生しました: {str(e)}")
+            for _, op in sheet_ops:
+                op['future'].set_exception(e)
+            return
+
+        with self._condition:
+            self._requests += 1
+            self._rows_written += sum(len(op['values']) for _, op in sheet_ops)
+        for _, op in sheet_ops:
+            op['future'].set_result(sum(len(row) for row in op['values']))
+
+    def stats(self):
+        """
+        ライターの統計情報を取得する
+
+        Returns:
+            dict: 要求数、送信回数、APIリクエスト数、書き込み行数など
+        """
+        with self._condition:
+            return {
+                'submitted': self._submitted,
+                'pending': len(self._pending),
+                'pending_rows': self._pending_rows,
+                'flushes': self._flushes,
+                'requests': self._requests,
+                'rows_written': self._rows_written,
+                'cursor': self.cursor.stats() if self.cursor else None,
+            }
+
+
+def create_sheet_writer(service_factory):
+    """
+    環境変数の設定からライターを作成する関数
+
+    SHEET_BATCH_MAX_ROWS: 1回の送信にまとめる最大行数（デフォルト500）
+    SHEET_BATCH_MAX_LATENCY: 送信までの最大待ち時間（秒、デフォルト1.0）
+    SHEET_CURSOR_DB: 指定した場合は次の空き行をSQLiteに保存する
+    SHEET_ROLLOVER_ROWS: 1つのタブに書き込む最大行数（デフォルト50000）
+
+    Args:
+        service_factory: Google Sheets APIのサービスを返す関数
+
+    Returns:
+        BatchedSheetWriter: ライター
+    """
+    return BatchedSheetWriter(
+        service_factory,
+        max_batch_rows=int(os.getenv('SHEET_BATCH_MAX_ROWS', 500)),
+        max_latency=float(os.getenv('SHEET_BATCH_MAX_LATENCY', 1.0)),
+        cursor=SheetCursor(
+            path=os.getenv('SHEET_CURSOR_DB') or None,
+            max_rows=int(os.getenv('SHEET_ROLLOVER_ROWS', 50000))
+        )
+    )
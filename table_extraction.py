@@ -0,0 +1,361 @@
+import os
+import time
+import hashlib
+import logging
+from clients import registry
+import table_parser
+from gemini_scheduler import scheduler, ScheduledModel
+from event_loop import runner
+from metrics import registry as metrics_registry, span, STAGE_METRIC
+
+logger = logging.getLogger(__name__)
+
+# 使用するGeminiモデル
+MODEL_NAME = 'gemini-1.5-flash'
+
+# 抽出モード（'direct': 画像から1回の呼び出しで表を取得, 'two_stage': 文字抽出→表整形の2回）
+EXTRACTION_MODE = os.getenv('EXTRACTION_MODE', 'direct')
+
+# 表の応答をストリーミングで受け取り、完成した行から書き込むかどうか（'off' / 'on'）
+STREAMING = os.getenv('GEMINI_STREAMING', 'off')
+
+# ストリーミングで完成した行をまとめて書き込む行数（最初の行はすぐに書き込む）
+STREAM_BATCH_ROWS = int(os.getenv('STREAM_BATCH_ROWS', 20))
+
+EXTRACT_TEXT_PROMPT = "この画像から文字を抽出してください。"
+
+FORMAT_TABLE_PROMPT = """
+        以下のテキストを表形式に整形してください。
+        各行は「|」で区切られ、最初の行はヘッダーとしてください。
+        可能な限り情報を整理し、見やすい表にしてください。
+
+        テキスト:
+        {text}
+        """
+
+DIRECT_TABLE_PROMPT = """
+この画像に含まれる文字を読み取り、表形式に整理してください。
+出力は次の形式のJSONのみとし、説明文やコードブロックは付けないでください。
+{"header": ["列名1", "列名2"], "rows": [["値1", "値2"]]}
+各行の要素数はヘッダーの要素数と同じにしてください。
+"""
+
+MULTI_IMAGE_PROMPT = """
+これらの画像は同じ文書の続きのページ（または同時に撮影した関連する写真）です。
+全ての画像に含まれる文字を読み取り、画像の順番どおりに1つの表に整理してください。
+出力は次の形式のJSONのみとし、説明文やコードブロックは付けないでください。
+{"header": ["列名1", "列名2"], "rows": [["値1", "値2"]]}
+各行の要素数はヘッダーの要素数と同じにし、ページごとにヘッダーを繰り返さないでください。
+"""
+
+# プロンプトのバージョン（プロンプトや表の解析方法を変更するとOCRキャッシュが無効になる）
+PROMPT_VERSION = hashlib.sha256(
+    (EXTRACT_TEXT_PROMPT + FORMAT_TABLE_PROMPT + DIRECT_TABLE_PROMPT
+     + table_parser.PARSER_VERSION).encode('utf-8')
+).hexdigest()[:12]
+
+
+def get_model():
+    """
+    Geminiモデルを取得する関数（プロセス内で使い回す）
+
+    呼び出しは全て共有のスケジューラーを経由し、レート制限の中で実行される。
+    """
+    return registry.get('gemini')
+
+
+def create_model():
+    """
+    Geminiモデルを生成する関数
+
+    google.generativeaiは読み込みに時間がかかるため、初回のモデルの利用時に
+    読み込み、GOOGLE_API_KEYを設定する。
+    """
+    import google.generativeai as genai
+    genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
+    return ScheduledModel(genai.GenerativeModel(MODEL_NAME), scheduler)
+
+
+registry.register('gemini', create_model)
+
+
+def image_part(data):
+    """
+    画像のバイト列をモデルに渡す形式に変換する関数
+
+    PIL画像を渡すとSDK内部で再エンコードされるため、前処理済みの
+    バイト列をそのまま送る。
+
+    Args:
+        data (bytes): 画像のバイト列
+
+    Returns:
+        dict: mime_typeとdataを持つdict
+    """
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        mime_type = 'image/png'
+    elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        mime_type = 'image/webp'
+    else:
+        mime_type = 'image/jpeg'
+    return {'mime_type': mime_type, 'data': data}
+
+
+def parse_direct_table(response_text):
+    """
+    構造化出力（JSON）を検証し、2次元リストに変換する関数
+
+    Args:
+        response_text (str): モデルの出力
+
+    Returns:
+        list: 表形式のデータ（2次元リスト）。検証に失敗した場合はNone
+    """
+    text = table_parser.strip_code_fence(response_text)
+    return table_parser.finish_table(table_parser.parse_json_table(text))
+
+
+def chunk_text(chunk):
+    """
+    ストリーミングの応答の1チャンクのテキストを取得する関数（テキストのないチャンクは空文字）
+    """
+    try:
+        return chunk.text
+    except ValueError:
+        return ''
+
+
+class RowEmitter:
+    """
+    ストリーミングで完成した行をまとめて書き込み先に渡す
+
+    最初の行はすぐに渡し、以降はbatch_rows行ごとに渡す。最初の行が完成するまでの
+    秒数は、呼び出し全体の秒数と同じヒストグラムにstage="first_row"として記録する。
+
+    Args:
+        on_rows: (ヘッダー, 行のリスト)を受け取る関数
+        details (dict): 指定した場合は最初の行までの秒数を'first_row_seconds'に格納する
+        batch_rows (int): まとめて渡す行数
+    """
+
+    def __init__(self, on_rows, details=None, batch_rows=STREAM_BATCH_ROWS):
+        self.on_rows = on_rows
+        self.details = details
+        self.batch_rows = batch_rows
+        self.started = time.perf_counter()
+        self.emitted = 0
+        self._batch = []
+
+    def add(self, parser, rows):
+        if not rows:
+            return
+        if not self.emitted and not self._batch:
+            elapsed = time.perf_counter() - self.started
+            metrics_registry.observe(STAGE_METRIC, elapsed,
+                                     (('stage', 'first_row'), ('model', MODEL_NAME), ('outcome', 'ok')))
+            if self.details is not None:
+                self.details['first_row_seconds'] = elapsed
+        self._batch += rows
+        if not self.emitted or len(self._batch) >= self.batch_rows:
+            self.flush(parser)
+
+    def flush(self, parser):
+        if self._batch:
+            batch, self._batch = self._batch, []
+            self.on_rows(parser.header, batch)
+            self.emitted += len(batch)
+
+
+def extract_text(image, model=None):
+    """
+    画像から文字を抽出する関数
+
+    Args:
+        image: PIL画像、またはimage_partで変換した画像
+        model: Geminiモデル（省略時は共有のモデル）
+
+    Returns:
+        str: 抽出されたテキスト
+    """
+    return runner.run(extract_text_async(image, model))
+
+
+def format_text(text, model=None, on_rows=None):
+    """
+    テキストを表形式に整形する関数
+
+    Args:
+        text (str): 整形前のテキスト
+        model: Geminiモデル（省略時は共有のモデル）
+        on_rows: 指定した場合は応答をストリーミングで受け取り、完成した行から
+            (ヘッダー, 行のリスト)を渡す関数
+
+    Returns:
+        list: 表形式のデータ（2次元リスト）
+    """
+    return runner.run(format_text_async(text, model, on_rows))
+
+
+def extract_table_direct(image, model=None, details=None, on_rows=None):
+    """
+    1回のモデル呼び出しで画像から表を抽出する関数
+
+    Args:
+        image: PIL画像、またはimage_partで変換した画像
+        model: Geminiモデル（省略時は共有のモデル）
+        details (dict): 指定した場合はモデルの出力を'raw_text'に格納する
+        on_rows: 指定した場合は応答をストリーミングで受け取り、完成した行から
+            (ヘッダー, 行のリスト)を渡す関数
+
+    Returns:
+        list: 表形式のデータ（2次元リスト）。構造化出力の検証に失敗した場合はNone
+    """
+    return runner.run(extract_table_direct_async(image, model, details, on_rows))
+
+
+def extract_table_multi(images, model=None, details=None):
+    """
+    1回のモデル呼び出しで複数の画像から1つの表を抽出する関数
+
+    Args:
+        images (list): image_partで変換した画像のリスト（ページ順）
+        model: Geminiモデル（省略時は共有のモデル）
+        details (dict): 指定した場合はモデルの出力を'raw_text'に格納する
+
+    Returns:
+        list: 表形式のデータ（2次元リスト）。構造化出力の検証に失敗した場合はNone
+    """
+    model = model or get_model()
+    with span('multi_call', model=MODEL_NAME):
+        response = model.generate_content([MULTI_IMAGE_PROMPT] + list(images))
+    if details is not None:
+        details['raw_text'] = response.text
+    return parse_direct_table(response.text)
+
+
+def extract_table(image, mode=None, model=None, raise_errors=False, details=None, on_rows=None):
+    """
+    画像から表形式のデータを抽出する関数
+
+    directモードでは構造化出力を1回で取得し、検証に失敗した場合のみ
+    文字抽出→表整形の2段階処理にフォールバックする。
+    on_rowsを指定した場合は表の応答をストリーミングで受け取り、完成した行から渡す
+    （行を渡した後はフォールバックせず、渡した行からなる表を返す）。
+    処理は共有のイベントループでextract_table_asyncを実行し、完了を待つ。
+
+    Args:
+        image: PIL画像、またはimage_partで変換した画像
+        mode (str): 'direct' または 'two_stage'（省略時はEXTRACTION_MODE）
+        model: Geminiモデル（省略時は共有のモデル）
+        raise_errors (bool): モデル呼び出しの例外をそのまま送出するかどうか
+        details (dict): 指定した場合はモデルの出力（2段階処理では抽出した文字）を'raw_text'に格納する
+        on_rows: (ヘッダー, 行のリスト)を受け取る関数
+
+    Returns:
+        list: 表形式のデータ（2次元リスト）。失敗した場合はNone
+    """
+    return runner.run(extract_table_async(image, mode=mode, model=model, raise_errors=raise_errors,
+                                          details=details, on_rows=on_rows))
+
+
+async def extract_text_async(image, model=None):
+    """
+    extract_textのasyncio版（generate_content_asyncで呼び出す）
+    """
+    model = model or get_model()
+    with span('ocr_call', model=MODEL_NAME):
+        response = await model.generate_content_async([EXTRACT_TEXT_PROMPT, image])
+    return response.text
+
+
+async def stream_table_async(model, contents, on_rows, details=None):
+    """
+    表の応答をストリーミングで受け取り、完成した行から順にon_rowsに渡す関数
+
+    Args:
+        model: Geminiモデル
+        contents: generate_content_asyncに渡す内容
+        on_rows: (ヘッダー, 行のリスト)を受け取る関数（通常の関数）
+        details (dict): 指定した場合は最初の行までの秒数を'first_row_seconds'に格納する
+
+    Returns:
+        tuple: (モデルの出力全体, 渡した行からなる表。行を渡していない場合はNone)
+    """
+    parser = table_parser.StreamingTableParser()
+    emitter = RowEmitter(on_rows, details)
+    response = await model.generate_content_async(contents, stream=True)
+    async for chunk in response:
+        emitter.add(parser, parser.feed(chunk_text(chunk)))
+    emitter.add(parser, parser.close())
+    emitter.flush(parser)
+    return parser.text, parser.table()
+
+
+async def format_text_async(text, model=None, on_rows=None):
+    """
+    format_textのasyncio版
+    """
+    model = model or get_model()
+    prompt = FORMAT_TABLE_PROMPT.format(text=text)
+    if on_rows is not None:
+        with span('format_call', model=MODEL_NAME):
+            response_text, table_data = await stream_table_async(model, prompt, on_rows)
+        # 行を渡した場合は、渡した行と同じ表を返す
+        return table_data or table_parser.parse_table(response_text)
+    with span('format_call', model=MODEL_NAME):
+        response = await model.generate_content_async(prompt)
+    return table_parser.parse_table(response.text)
+
+
+async def extract_table_direct_async(image, model=None, details=None, on_rows=None):
+    """
+    extract_table_directのasyncio版
+    """
+    model = model or get_model()
+    if on_rows is not None:
+        with span('direct_call', model=MODEL_NAME):
+            response_text, table_data = await stream_table_async(model, [DIRECT_TABLE_PROMPT, image], on_rows,
+                                                                 details)
+        if details is not None:
+            details['raw_text'] = response_text
+        return table_data or parse_direct_table(response_text)
+    with span('direct_call', model=MODEL_NAME):
+        response = await model.generate_content_async([DIRECT_TABLE_PROMPT, image])
+    if details is not None:
+        details['raw_text'] = response.text
+    return parse_direct_table(response.text)
+
+
+async def extract_table_async(image, mode=None, model=None, raise_errors=False, details=None, on_rows=None):
+    """
+    extract_tableのasyncio版
+
+    モデルの応答を待つ間もスレッドを占有しない。引数と戻り値はextract_tableと同じ。
+    """
+    mode = mode or EXTRACTION_MODE
+    model = model or get_model()
+    try:
+        if mode == 'direct':
+            table_data = await extract_table_direct_async(image, model, details, on_rows)
+            if table_data:
+                return table_data
+            logger.info("構造化出力の検証に失敗したため、2段階処理で再試行します。")
+
+        extracted_text = await extract_text_async(image, model)
+        if details is not None:
+            details['raw_text'] = extracted_text
+        if not extracted_text:
+            return None
+
+        # 抽出した文字が既に表になっている場合は整形の呼び出しを省略する
+        table_data = table_parser.parse_table(extracted_text)
+        if table_parser.is_table(table_data):
+            logger.info("抽出結果が表形式のため、表整形の呼び出しを省略します。")
+            return table_data
+        return await format_text_async(extracted_text, model, on_rows)
+
+    except Exception as e:
+        if raise_errors:
+            raise
+        logger.error(f"表の抽出中にエラーが発生しました: {str(e)}")
+        return None
@@ -0,0 +1,477 @@
+import re
+import csv
+import json
+import unicodedata
+from datetime import date
+
+# パーサーのバージョン（出力が変わる変更をしたら上げる。OCRキャッシュのキーに含まれる）
+PARSER_VERSION = '2'
+
+# Markdownの区切り行のセル（---, :---, ---:, :---:）
+SEPARATOR_CELL = re.compile(r'^(?::?-{3,}:?|:-+:?|:?-+:)$')
+
+# 3桁区切りのカンマを含む数値
+NUMBER = re.compile(r'^[-+]?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?$')
+
+# 年月日の表記（2024/5/1, 2024-05-01, 2024.5.1, 2024年5月1日）
+DATE = re.compile(r'^(\d{4})\s*(?:[/\-.]|年)\s*(\d{1,2})\s*(?:[/\-.]|月)\s*(\d{1,2})\s*日?$')
+
+# 3桁区切り以外のカンマ（CSVの区切りとみなせるもの）
+DELIMITER_COMMA = re.compile(r'(?<!\d),|,(?!\d{3}(?!\d))')
+
+# 数値の前後に付く通貨記号
+CURRENCY_PREFIXES = ('¥', '$')
+CURRENCY_SUFFIXES = ('円',)
+
+
+def strip_code_fence(text):
+    """
+    ```で囲まれたコードブロックの中身を取り出す関数
+    """
+    text = text.strip()
+    if text.startswith('```'):
+        text = text.split('\n', 1)[1] if '\n' in text else ''
+        text = text.rsplit('```', 1)[0]
+    return text.strip()
+
+
+def split_markdown_row(line):
+    """
+    Markdownの表の1行をセルに分割する関数
+
+    空のセルも残し、\\| はセル内の文字として扱う。
+
+    Args:
+        line (str): 「|」区切りの1行
+
+    Returns:
+        list: セルのリスト
+    """
+    line = line.strip()
+    if line.startswith('|'):
+        line = line[1:]
+    if line.endswith('|') and not line.endswith('\\|'):
+        line = line[:-1]
+    cells = re.split(r'(?<!\\)\|', line)
+    return [cell.strip().replace('\\|', '|') for cell in cells]
+
+
+def is_separator_row(cells):
+    """
+    Markdownのヘッダー区切り行（|---|---|）かどうかを判定する関数
+    """
+    filled = [cell.replace(' ', '') for cell in cells if cell.strip()]
+    return bool(filled) and all(SEPARATOR_CELL.match(cell) for cell in filled)
+
+
+def normalize_columns(rows):
+    """
+    各行の列数をヘッダーの列数にそろえる関数
+
+    足りない列は空文字で埋め、多い列は末尾が空なら削除し、
+    空でなければ最後の列にまとめる。
+
+    Args:
+        rows (list): 2次元リスト（最初の行がヘッダー）
+
+    Returns:
+        list: 列数をそろえた2次元リスト
+    """
+    if not rows:
+        return rows
+    width = len(rows[0])
+    normalized = [rows[0]]
+    for row in rows[1:]:
+        row = list(row)
+        while len(row) > width and row[-1] == '':
+            row.pop()
+        if len(row) > width:
+            row = row[:width - 1] + [' '.join(cell for cell in row[width - 1:] if cell != '')]
+        normalized.append(row + [''] * (width - len(row)))
+    return normalized
+
+
+def coerce_cell(cell):
+    """
+    数値・日付のセルをスプレッドシートで扱える値に変換する関数
+
+    数値はint/floatに、日付はYYYY-MM-DD形式の文字列に変換する。
+    先頭が0の数字（IDや電話番号など）は文字列のまま残す。
+
+    Args:
+        cell (str): セルの文字列
+
+    Returns:
+        int, float, or str: 変換後の値
+    """
+    if not isinstance(cell, str):
+        return cell
+    text = unicodedata.normalize('NFKC', cell).strip()
+    if not text:
+        return cell
+
+    match = DATE.match(text)
+    if match:
+        try:
+            return date(*(int(group) for group in match.groups())).isoformat()
+        except ValueError:
+            return cell
+
+    number = text
+    for prefix in CURRENCY_PREFIXES:
+        if number.startswith(prefix):
+            number = number[len(prefix):].strip()
+    for suffix in CURRENCY_SUFFIXES:
+        if number.endswith(suffix):
+            number = number[:-len(suffix)].strip()
+    if not NUMBER.match(number):
+        return cell
+    digits = number.lstrip('+-')
+    if len(digits) > 1 and digits[0] == '0' and digits[1] != '.':
+        return cell
+
+    number = number.replace(',', '')
+    return float(number) if '.' in number else int(number)
+
+
+def table_from_json(data):
+    """
+    JSONから読み込んだ値を2次元リストに変換する関数
+
+    {"header": [...], "rows": [[...]]}、リストのリスト、dictのリストに対応する。
+
+    Returns:
+        list: 表形式のデータ（2次元リスト）。表として解釈できない場合はNone
+    """
+    if isinstance(data, dict):
+        header, rows = data.get('header'), data.get('rows')
+        if not isinstance(header, list) or not header or not isinstance(rows, list):
+            return None
+        table = [header] + rows
+    elif isinstance(data, list) and data and all(isinstance(row, dict) for row in data):
+        header = []
+        for row in data:
+            header += [key for key in row if key not in header]
+        table = [header] + [[row.get(key) for key in header] for row in data]
+    elif isinstance(data, list) and data and all(isinstance(row, list) for row in data):
+        table = data
+    else:
+        return None
+
+    if not all(isinstance(row, list) for row in table):
+        return None
+    return [['' if cell is None else str(cell).strip() for cell in row] for row in table]
+
+
+def parse_json_table(text):
+    try:
+        return table_from_json(json.loads(text))
+    except ValueError:
+        return None
+
+
+def parse_markdown_table(lines):
+    rows = []
+    for line in lines:
+        if '|' not in line:
+            continue
+        cells = split_markdown_row(line)
+        if is_separator_row(cells) or not any(cells):
+            continue
+        rows.append(cells)
+    return rows
+
+
+def parse_delimited_table(lines, delimiter):
+    rows = list(csv.reader(lines, delimiter=delimiter, skipinitialspace=True))
+    return [[cell.strip() for cell in row] for row in rows if any(cell.strip() for cell in row)]
+
+
+def detect_format(text):
+    """
+    テキストの表の形式を判定する関数
+
+    Returns:
+        str: 'markdown'・'tsv'・'csv' のいずれか。表でなければNone
+    """
+    lines = [line for line in text.split('\n') if line.strip()]
+    if len(lines) < 2:
+        return None
+    if sum('|' in line for line in lines) >= 2:
+        return 'markdown'
+    for name, delimiter in (('tsv', '\t'), ('csv', ',')):
+        if name == 'csv' and not any(DELIMITER_COMMA.search(line) for line in lines):
+            # 「1,234」のような数値のカンマしかない場合は区切り文字とみなさない
+            continue
+        counts = [len(row) for row in csv.reader(lines, delimiter=delimiter)]
+        # 全ての行が同じ列数（2列以上）のときだけ区切り文字とみなす
+        if counts[0] >= 2 and len(set(counts)) == 1:
+            return name
+    return None
+
+
+def parse_table(text, coerce=True):
+    """
+    モデルの出力を表形式のデータに変換する関数
+
+    Markdownの表・TSV・CSV・JSONに対応し、区切り行を除いて
+    列数をヘッダーにそろえる。
+
+    Args:
+        text (str): モデルの出力
+        coerce (bool): 数値・日付のセルを変換するかどうか（ヘッダーは変換しない）
+
+    Returns:
+        list: 表形式のデータ（2次元リスト）。表として解釈できない場合はNone
+    """
+    text = strip_code_fence(text or '')
+    rows = parse_json_table(text) if text[:1] in '[{' else None
+    if rows is None:
+        table_format = detect_format(text)
+        if table_format == 'markdown':
+            rows = parse_markdown_table(text.split('\n'))
+        elif table_format == 'tsv':
+            rows = parse_delimited_table(text.split('\n'), '\t')
+        elif table_format == 'csv':
+            rows = parse_delimited_table(text.split('\n'), ',')
+
+    return finish_table(rows, coerce)
+
+
+def finish_table(rows, coerce=True):
+    """
+    列数をヘッダーにそろえ、必要に応じてセルの値を変換する関数
+
+    Returns:
+        list: 表形式のデータ（2次元リスト）。ヘッダーが空の場合はNone
+    """
+    if not rows or not any(rows[0]):
+        return None
+    rows = normalize_columns(rows)
+    if coerce:
+        rows = [rows[0]] + [[coerce_cell(cell) for cell in row] for row in rows[1:]]
+    return rows
+
+
+def merge_tables(tables):
+    """
+    複数の表を1つの表にまとめる関数
+
+    ヘッダーが同じ表は行をそのままつなげる。ヘッダーが異なる場合は
+    列名を出現順に並べたものをヘッダーとし、各行を列名で並べ替える（ない列は空文字）。
+
+    Args:
+        tables (list): 表形式のデータ（2次元リスト）のリスト。Noneや空の表は無視する
+
+    Returns:
+        list: まとめた表（2次元リスト）。まとめる表がない場合はNone
+    """
+    tables = [table for table in tables if table]
+    if not tables:
+        return None
+    header = list(tables[0][0])
+    for table in tables[1:]:
+        header += [name for name in table[0] if name not in header]
+
+    merged = [header]
+    for table in tables:
+        if list(table[0]) == header:
+            merged += table[1:]
+            continue
+        index = {}
+        for i, name in enumerate(table[0]):
+            index.setdefault(name, i)
+        merged += [[row[index[name]] if name in index else '' for name in header] for row in table[1:]]
+    return merged
+
+
+def is_table(rows):
+    """
+    2行2列以上の表かどうかを判定する関数
+    """
+    return bool(rows) and len(rows) >= 2 and len(rows[0]) >= 2
+
+
+def looks_tabular(text):
+    """
+    文字抽出の結果が既に表になっているかどうかを判定する関数
+
+    2行2列以上の表として解釈できる場合はTrueを返し、
+    表整形のためのモデル呼び出しを省略できる。
+    """
+    return is_table(parse_table(text, coerce=False))
+
+
+class StreamingTableParser:
+    """
+    少しずつ届くモデルの出力から、完成した行を順に表の行に変換するパーサー
+
+    Markdownの表（改行が届いた行から）と、{"header": [...], "rows": [[...], ...]}
+    形式のJSON（rowsの要素の配列が閉じた行から）に対応する。返す行はparse_tableと同じく
+    列数をヘッダーにそろえ、セルの値を変換したもの。それ以外の形式の場合は行を返さないため、
+    呼び出し側は最後にtextを全体として解析する。
+
+    Args:
+        coerce (bool): 数値・日付のセルを変換するかどうか（ヘッダーは変換しない）
+    """
+
+    def __init__(self, coerce=True):
+        self.coerce = coerce
+        self.header = None
+        self.rows = []
+        self._chunks = []
+        self._format = None
+        self._line = ''
+        self._pending = []
+        # JSONの読み取り状態
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string = []
+        self._key = None
+        self._section = None
+        self._capture = None
+
+    @property
+    def text(self):
+        """
+        これまでに受け取った出力全体
+        """
+        return ''.join(self._chunks)
+
+    def feed(self, chunk):
+        """
+        出力の続きを受け取る
+
+        Args:
+            chunk (str): 出力の続き
+
+        Returns:
+            list: 新たに完成した行のリスト（ヘッダーは含まない）
+        """
+        self._chunks.append(chunk)
+        if self._format is None:
+            # コードブロックの開始（```json など）を読み飛ばしてから形式を判定する
+            head = self.text.lstrip()
+            if head.startswith('```'):
+                if '\n' not in head:
+                    return []
+                head = head.split('\n', 1)[1].lstrip()
+            if not head:
+                return []
+            self._format = 'json' if head[0] == '{' else 'markdown'
+            chunk = self.text
+        if self._format == 'json':
+            return self._feed_json(chunk)
+        return self._feed_markdown(chunk)
+
+    def close(self):
+        """
+        出力の終わりを受け取る
+
+        Returns:
+            list: 最後に完成した行のリスト
+        """
+        if self._format == 'markdown' and self._line:
+            line, self._line = self._line, ''
+            return self._add_line(line)
+        return []
+
+    def table(self):
+        """
+        これまでに完成した行からなる表を取得する
+
+        Returns:
+            list: 表形式のデータ（2次元リスト）。行を1つも返していない場合はNone
+        """
+        if self.header is None or not self.rows:
+            return None
+        return [self.header] + self.rows
+
+    def _finish_row(self, cells):
+        rows = normalize_columns([self.header, cells])
+        row = rows[1]
+        if self.coerce:
+            row = [coerce_cell(cell) for cell in row]
+        self.rows.append(row)
+        return row
+
+    def _set_header(self, cells):
+        if not any(cells):
+            # ヘッダーが空の表はparse_tableでも表とみなさない
+            self._format = 'unsupported'
+            return []
+        self.header = cells
+        pending, self._pending = self._pending, []
+        return [self._finish_row(cells) for cells in pending]
+
+    def _feed_markdown(self, chunk):
+        lines = (self._line + chunk).split('\n')
+        self._line = lines.pop()
+        completed = []
+        for line in lines:
+            completed += self._add_line(line)
+        return completed
+
+    def _add_line(self, line):
+        if '|' not in line:
+            return []
+        cells = split_markdown_row(line)
+        if is_separator_row(cells) or not any(cells):
+            return []
+        if self.header is None:
+            return self._set_header(cells)
+        return [self._finish_row(cells)]
+
+    def _feed_json(self, chunk):
+        completed = []
+        for char in chunk:
+            if self._capture is not None:
+                self._capture.append(char)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._key = ''.join(self._string)
+                else:
+                    self._string.append(char)
+                continue
+            if char == '"':
+                self._in_string = True
+                self._string = []
+            elif char in '[{':
+                self._depth += 1
+                if self._depth == 2 and char == '[':
+                    self._section = self._key
+                    if self._section == 'header':
+                        self._capture = [char]
+                elif self._depth == 3 and char == '[' and self._section == 'rows':
+                    self._capture = [char]
+            elif char in ']}':
+                self._depth -= 1
+                if self._capture is not None and (
+                        (self._depth == 1 and self._section == 'header')
+                        or (self._depth == 2 and self._section == 'rows')):
+                    completed += self._add_json(json.loads(''.join(self._capture)))
+                    self._capture = None
+                if self._depth == 1:
+                    self._section = None
+            if self._format != 'json':
+                break
+        return completed
+
+    def _add_json(self, value):
+        if not isinstance(value, list):
+            return []
+        cells = ['' if cell is None else str(cell).strip() for cell in value]
+        if self._section == 'header':
+            return self._set_header(cells) if self.header is None else []
+        if self.header is None:
+            # rowsがheaderより先に届いた場合は、ヘッダーが届くまで保留する
+            self._pending.append(cells)
+            return []
+        return [self._finish_row(cells)]
@@ -0,0 +1,235 @@
+import io
+import os
+import logging
+import threading
+from PIL import Image, ImageOps
+
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+# 判定に使う縮小画像の長辺のピクセル数
+ANALYSIS_SIZE = 256
+
+# 明るさを0〜255に引き伸ばした場合に、隣り合う画素の差がこれ以上になる箇所を輪郭とみなす
+EDGE_THRESHOLD = 32
+
+# 輪郭の割合がこれ以上の行（縦書きの場合は列）を文字の行とみなす
+LINE_EDGE_RATIO = 0.08
+
+# 文字がないと判定した画像に返すメッセージ
+NO_TEXT_MESSAGE = '画像から文字が見つかりませんでした。\n書類や表が写っている画像を送ってください。'
+
+
+def open_image(source):
+    if isinstance(source, (bytes, bytearray)):
+        return Image.open(io.BytesIO(source))
+    return Image.open(source)
+
+
+def load_thumbnail(source, size=ANALYSIS_SIZE):
+    """
+    判定用にグレースケールの縮小画像を読み込む関数
+
+    JPEGはdraftで縮小しながらデコードするため、大きな写真でも数ミリ秒で読み込める。
+    前処理でデコード済みの画像を渡した場合はデコードを省略する（回転は反映済みとみなす）。
+
+    Args:
+        source (bytes, str or PIL.Image.Image): 画像のバイト列、ファイルパス、またはデコード済みの画像
+        size (int): 長辺のピクセル数
+
+    Returns:
+        PIL.Image.Image: グレースケールの縮小画像
+    """
+    if isinstance(source, Image.Image):
+        image = source if source.mode == 'L' else source.convert('L')
+        scale = min(1.0, size / max(image.size))
+        target = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        return image.resize(target, Image.BILINEAR, reducing_gap=2.0)
+
+    with open_image(source) as opened:
+        width, height = opened.size
+        scale = size / max(width, height)
+        opened.draft('L', (max(1, int(width * scale)), max(1, int(height * scale))))
+        image = opened.convert('L')
+    image.thumbnail((size, size), Image.BILINEAR)
+    # 縦書き・横書きの判定のため、EXIFの回転を反映する（縮小後なので軽い）
+    return ImageOps.exif_transpose(image)
+
+
+def text_line_ratio(strong_edges, axis):
+    """
+    輪郭の割合がLINE_EDGE_RATIO以上の行（axis=1）または列（axis=0）の割合を求める関数
+    """
+    return float((strong_edges.mean(axis=axis) >= LINE_EDGE_RATIO).mean())
+
+
+def analyze(source, size=ANALYSIS_SIZE):
+    """
+    縮小画像から文字の有無の判定に使う特徴量を求める関数
+
+    照明や紙の色で薄く写った文字も同じように扱えるよう、コントラスト以外の特徴量は
+    明るさを0〜255に引き伸ばしてから求める。
+
+    Args:
+        source (bytes, str or PIL.Image.Image): 画像のバイト列、ファイルパス、またはデコード済みの画像
+        size (int): 判定に使う縮小画像の長辺のピクセル数
+
+    Returns:
+        dict: 'contrast'（明るさの標準偏差。0に近いほど一様な画像）,
+            'sharpness'（ラプラシアンの絶対値の99パーセンタイル。小さいほどぼやけた画像）,
+            'edge_density'（輪郭の画素の割合。大きすぎる場合は草木などの細かい模様）,
+            'text_lines'（文字の行・列らしい行・列の割合。横書きと縦書きの大きい方）
+    """
+    # NumPyはWebhookの受け付けに不要なため、初回の判定時に読み込む
+    import numpy as np
+
+    thumbnail = load_thumbnail(source, size)
+    if min(thumbnail.size) < 3:
+        return {'contrast': 0.0, 'sharpness': 0.0, 'edge_density': 0.0, 'text_lines': 0.0}
+
+    # 標準偏差と1%・99%の明るさはヒストグラムから求める（画素を並べ替えるより速い）
+    histogram = np.asarray(thumbnail.histogram(), dtype=np.float64)
+    levels = np.arange(256)
+    count = histogram.sum()
+    mean = (histogram * levels).sum() / count
+    contrast = float(np.sqrt((histogram * (levels - mean) ** 2).sum() / count))
+    cumulative = np.cumsum(histogram)
+    low, high = np.searchsorted(cumulative, (count * 0.01, count * 0.99))
+
+    # 明るさを引き伸ばす代わりにしきい値を縮める（整数のまま計算できる）。
+    # ほぼ一様な画像のノイズを引き伸ばしすぎないよう、倍率に上限を設ける
+    gain = 255 / max(int(high) - int(low), 16)
+    edge_threshold = EDGE_THRESHOLD / gain
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+
+    laplacian = np.abs(pixels[1:-1, :-2] + pixels[1:-1, 2:] + pixels[:-2, 1:-1] + pixels[2:, 1:-1]
+                       - 4 * pixels[1:-1, 1:-1]).ravel()
+    rank = int(laplacian.size * 0.99)
+    dx = np.abs(np.diff(pixels, axis=1)) >= edge_threshold
+    dy = np.abs(np.diff(pixels, axis=0)) >= edge_threshold
+    return {
+        'contrast': contrast,
+        'sharpness': float(np.partition(laplacian, rank)[rank]) * gain,
+        'edge_density': float((dx[:-1, :] | dy[:, :-1]).mean()),
+        # 横書きの文字の行は横方向に明るさが何度も変わり、縦書きの列は縦方向に変わる
+        'text_lines': max(text_line_ratio(dx, 1), text_line_ratio(dy, 0)),
+    }
+
+
+class TextPrefilter:
+    """
+    Geminiを呼び出す前に、文字が写っていない画像（一様な画像・ぼやけた画像・
+    人物や風景の写真）を縮小画像の特徴量で判定する
+
+    判定を誤って文字のある画像を除外するとユーザーに返す結果が失われるため、
+    しきい値は文字のない画像を見逃す（モデルを呼び出す）側に寄せる。
+
+    Args:
+        mode (str): 'off'（判定しない）, 'shadow'（判定してログと統計にだけ残す）, 'on'（除外する）
+        min_contrast (float): これ未満の画像は一様とみなす
+        min_sharpness (float): これ未満の画像はぼやけているとみなす
+        max_edge_density (float): 輪郭の割合がこれより大きい画像は文字ではない細かい模様とみなす
+        min_text_lines (float): 文字の行・列らしい割合がこれ未満の画像は文字がないとみなす
+        size (int): 判定に使う縮小画像の長辺のピクセル数
+    """
+
+    def __init__(self, mode='off', min_contrast=8.0, min_sharpness=90.0, max_edge_density=0.7,
+                 min_text_lines=0.2, size=ANALYSIS_SIZE):
+        self.mode = mode
+        self.min_contrast = min_contrast
+        self.min_sharpness = min_sharpness
+        self.max_edge_density = max_edge_density
+        self.min_text_lines = min_text_lines
+        self.size = size
+        self._counts = {'checked': 0, 'skipped': 0, 'would_skip': 0, 'errors': 0}
+        self._reasons = {}
+        self._lock = threading.Lock()
+
+    def classify(self, features):
+        """
+        特徴量から文字がないと判定する理由を求める
+
+        Returns:
+            str: 'uniform', 'blurred', 'textured', 'no_text_lines' のいずれか。文字がありそうな場合はNone
+        """
+        if features['contrast'] < self.min_contrast:
+            return 'uniform'
+        if features['sharpness'] < self.min_sharpness:
+            return 'blurred'
+        if features['edge_density'] > self.max_edge_density:
+            return 'textured'
+        if features['text_lines'] < self.min_text_lines:
+            return 'no_text_lines'
+        return None
+
+    def screen(self, source, features=None):
+        """
+        画像に文字がなさそうかどうかを判定する
+
+        判定に失敗した場合は文字があるものとして扱う（モデルの呼び出しを省略しない）。
+
+        Args:
+            source (bytes or str): 画像のバイト列またはファイルパス
+            features (dict): 前処理で求めた特徴量（指定した場合は画像を読み込まない）
+
+        Returns:
+            str: mode='on'で文字がないと判定した場合はその理由。それ以外はNone
+        """
+        if self.mode == 'off':
+            return None
+        if features is None:
+            try:
+                with span('prefilter'):
+                    features = analyze(source, self.size)
+            except Exception as e:
+                logger.warning(f"文字の有無の判定に失敗しました: {str(e)}")
+                with self._lock:
+                    self._counts['errors'] += 1
+                return None
+        reason = self.classify(features)
+
+        with self._lock:
+            self._counts['checked'] += 1
+            if reason:
+                self._counts['skipped' if self.mode == 'on' else 'would_skip'] += 1
+                self._reasons[reason] = self._reasons.get(reason, 0) + 1
+        if reason:
+            logger.info(f"文字がない画像と判定しました: {reason} "
+                        + ' '.join(f'{key}={value:.3f}' for key, value in features.items()))
+        return reason if self.mode == 'on' else None
+
+    def stats(self):
+        """
+        判定の統計情報を取得する
+
+        Returns:
+            dict: 判定した数、除外した数（shadowでは除外したはずの数）、判定に失敗した数、理由ごとの数
+        """
+        with self._lock:
+            return dict(self._counts, mode=self.mode, reasons=dict(self._reasons))
+
+
+def create_text_prefilter():
+    """
+    環境変数の設定から判定器を作成する関数
+
+    TEXT_PREFILTER: 'off', 'shadow', 'on'（デフォルト'off'）
+    PREFILTER_MIN_CONTRAST: 一様とみなす明るさの標準偏差（デフォルト8）
+    PREFILTER_MIN_SHARPNESS: ぼやけているとみなすラプラシアンの99パーセンタイル（デフォルト90）
+    PREFILTER_MAX_EDGE_DENSITY: 細かい模様とみなす輪郭の割合（デフォルト0.7）
+    PREFILTER_MIN_TEXT_LINES: 文字がないとみなす文字の行・列らしい割合（デフォルト0.2）
+
+    Returns:
+        TextPrefilter: 判定器
+    """
+    return TextPrefilter(
+        mode=os.getenv('TEXT_PREFILTER', 'off'),
+        min_contrast=float(os.getenv('PREFILTER_MIN_CONTRAST', 8)),
+        min_sharpness=float(os.getenv('PREFILTER_MIN_SHARPNESS', 90)),
+        max_edge_density=float(os.getenv('PREFILTER_MAX_EDGE_DENSITY', 0.7)),
+        min_text_lines=float(os.getenv('PREFILTER_MIN_TEXT_LINES', 0.2)),
+    )
+
+
+text_prefilter = create_text_prefilter()
@@ -0,0 +1,64 @@
+import time
+import logging
+import importlib
+import threading
+
+from clients import registry
+
+logger = logging.getLogger(__name__)
+
+# Webhookの受け付けには不要で、初回の利用時に読み込む重いライブラリ
+# （benchmarks/bench_import_time.pyで、アプリの読み込み時に読み込まれていないことを確認する）
+HEAVY_MODULES = [
+    'google.generativeai',
+    'googleapiclient.discovery',
+    'google.oauth2.service_account',
+    'google_auth_oauthlib.flow',
+    'linebot.v3.messaging',
+    'numpy',
+]
+
+# 事前に生成しておくクライアント（認証情報の読み込みで対話的な処理が起きうるものは含めない）
+WARM_CLIENTS = ['line', 'gemini']
+
+
+def warm_up(modules=HEAVY_MODULES, clients=WARM_CLIENTS):
+    """
+    重いライブラリの読み込みとクライアントの生成を済ませておく関数
+
+    初回のリクエストでこれらを待たないよう、起動直後にバックグラウンドで呼び出す。
+    失敗しても初回の利用時に改めて読み込まれるため、ログに残すだけにする。
+
+    Args:
+        modules (list): 読み込むモジュール名のリスト
+        clients (list): 生成するクライアント名のリスト（clients.registryに登録されたもの）
+
+    Returns:
+        float: かかった秒数
+    """
+    started = time.perf_counter()
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            logger.warning(f"ライブラリの読み込みに失敗しました: {name}: {str(e)}")
+    for name in clients:
+        try:
+            registry.get(name)
+        except Exception as e:
+            logger.warning(f"クライアントの生成に失敗しました: {name}: {str(e)}")
+    seconds = time.perf_counter() - started
+    logger.info(f"ウォームアップが完了しました（{seconds:.2f}秒）")
+    return seconds
+
+
+def start_warm_up(modules=HEAVY_MODULES, clients=WARM_CLIENTS):
+    """
+    warm_upをバックグラウンドのスレッドで実行する関数
+
+    Returns:
+        threading.Thread: 起動したスレッド
+    """
+    thread = threading.Thread(target=warm_up, args=(modules, clients), name='warm-up', daemon=True)
+    thread.start()
+    return thread